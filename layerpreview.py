@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+import getopt
+import logging
+import os
+import sys
+
+from printrun.layerpreview import preview_files
+from printrun.utils import get_home_pos, parse_build_dimensions, setup_logging
+
+if __name__ == '__main__':
+    setup_logging(sys.stderr)
+    output_dir = None
+    size = 600
+    thumbnail_size = 0
+    layers = False
+    build_dimensions = parse_build_dimensions("")
+    jobs = None
+
+    usage = "Usage:\n"+\
+            "  layerpreview [OPTIONS] FILE...\n\n"+\
+            "Renders PNG previews of G-code files: FILE.png for the whole print,\n"+\
+            "and FILE.layerN.png for each layer or FILE.thumb.png if asked.\n\n"+\
+            "Options:\n"+\
+            "  -o, --output=DIR\t\tWrite the images in DIR instead of next\n"+\
+            "\t\t\t\tto the files\n"+\
+            "  -s, --size=PIXELS\t\tLargest side of the images. Default value\n"+\
+            "\t\t\t\tis 600\n"+\
+            "  -t, --thumbnail=PIXELS\tAlso write a thumbnail of this size\n"+\
+            "  -l, --layers\t\t\tAlso write an image of each layer\n"+\
+            "  -b, --build-dimensions=DIMS\tBuild volume and offsets of the\n"+\
+            "\t\t\t\tplatform, as in the settings. Default value\n"+\
+            "\t\t\t\tis 200x200x100+0+0+0\n"+\
+            "  -j, --jobs=PROCESSES\t\tRender in PROCESSES processes. Default\n"+\
+            "\t\t\t\tvalue is the number of CPUs\n"+\
+            "  -h, --help\t\t\tPrint this help message and exit\n"
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "o:s:t:lb:j:h",
+                        ["output=", "size=", "thumbnail=", "layers",
+                         "build-dimensions=", "jobs=", "help"])
+    except getopt.GetoptError as err:
+        print(str(err))
+        print(usage)
+        sys.exit(2)
+    try:
+        for o, a in opts:
+            if o in ('-h', '--help'):
+                print(usage)
+                sys.exit(0)
+            elif o in ('-o', '--output'):
+                output_dir = a
+            elif o in ('-s', '--size'):
+                size = int(a)
+            elif o in ('-t', '--thumbnail'):
+                thumbnail_size = int(a)
+            elif o in ('-l', '--layers'):
+                layers = True
+            elif o in ('-b', '--build-dimensions'):
+                build_dimensions = parse_build_dimensions(a)
+            elif o in ('-j', '--jobs'):
+                jobs = int(a)
+    except ValueError as err:
+        print("ValueError: %s\n" % err)
+        print(usage)
+        sys.exit(2)
+
+    if not args:
+        print("Error: No G-code file specified.\n")
+        print(usage)
+        sys.exit(2)
+    if output_dir and not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    failed = False
+    for filename, result in preview_files(args, processes = jobs, output_dir = output_dir,
+                                          layers = layers, thumbnail_size = thumbnail_size,
+                                          home_pos = get_home_pos(build_dimensions),
+                                          size = (size, size),
+                                          build_dimensions = build_dimensions):
+        if isinstance(result, Exception):
+            logging.error("%s: %s" % (filename, result))
+            failed = True
+        else:
+            logging.info("%s: %d images written" % (filename, len(result)))
+    sys.exit(1 if failed else 0)
@@ -29,6 +29,7 @@ if __name__ == '__main__':
     baud = 115200
     loud = False
     statusreport = False
+    stream = False
 
     from printrun.printcore import __version__ as printcore_version
 
@@ -38,13 +39,15 @@ if __name__ == '__main__':
             "  -b, --baud=BAUD_RATE"+\
                         "\t\tSet baud rate value. Default value is 115200\n"+\
             "  -s, --statusreport\t\tPrint progress as percentage\n"+\
+            "  -m, --stream\t\t\tRead the file while printing instead of\n"+\
+            "\t\t\t\tloading it first, for huge files\n"+\
             "  -v, --verbose\t\t\tPrint additional progress information\n"+\
             "  -V, --version\t\t\tPrint program's version number and exit\n"+\
             "  -h, --help\t\t\tPrint this help message and exit\n"
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "b:svVh",
-                        ["baud=", "statusreport", "verbose", "version", "help"])
+        opts, args = getopt.getopt(sys.argv[1:], "b:smvVh",
+                        ["baud=", "statusreport", "stream", "verbose", "version", "help"])
     except getopt.GetoptError as err:
         print(str(err))
         print(usage)
@@ -72,6 +75,8 @@ if __name__ == '__main__':
             loud = True
         elif o in ('-s', '--statusreport'):
             statusreport = True
+        elif o in ('-m', '--stream'):
+            stream = True
 
     if len(args) <= 1:
         print("Error: Port or gcode file were not specified.\n")
@@ -84,9 +89,15 @@ if __name__ == '__main__':
 
     p = printcore(port, baud)
     p.loud = loud
+    # Nothing needs the position of the printer here
+    p.reanalyze = False
     time.sleep(2)
-    gcode = [i.strip() for i in open(filename)]
-    gcode = gcoder.LightGCode(gcode)
+    if stream:
+        from printrun.gcoder_stream import StreamGCode
+        gcode = StreamGCode(filename)
+    else:
+        gcode = [i.strip() for i in open(filename)]
+        gcode = gcoder.LightGCode(gcode)
     p.startprint(gcode)
 
     try:
@@ -97,7 +108,7 @@ if __name__ == '__main__':
         while p.printing:
             time.sleep(1)
             if statusreport:
-                progress = 100 * float(p.queueindex) / len(p.mainqueue)
+                progress = 100 * float(p.queueindex) / max(len(p.mainqueue), 1)
                 sys.stdout.write("Progress: %02.1f%%\r" % progress)
                 sys.stdout.flush()
         p.disconnect()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import getopt
+import os
+import sys
+
+from printrun.farm import PrinterFarm, format_status
+from printrun.gcodecache import GCodeCache
+from printrun.utils import setup_logging
+
+async def report(farm, interval):
+    while True:
+        await asyncio.sleep(interval)
+        print(format_status(farm.status()) + "\n", flush = True)
+
+async def serve(farm, watch, status_interval):
+    tasks = []
+    if watch:
+        tasks.append(asyncio.ensure_future(farm.watch(watch)))
+    if status_interval:
+        tasks.append(asyncio.ensure_future(report(farm, status_interval)))
+    try:
+        await farm.run()
+    finally:
+        for task in tasks:
+            task.cancel()
+    print(format_status(farm.status()))
+
+if __name__ == '__main__':
+    setup_logging(sys.stderr)
+    baud = 115200
+    window = 1
+    jobs = []
+    watch = None
+    cache_dir = None
+    status_interval = 0
+    quit_when_done = False
+
+    usage = "Usage:\n"+\
+            "  printfarm [OPTIONS] [NAME=]PORT...\n\n"+\
+            "Prints G-code files on several printers at once.\n\n"+\
+            "Options:\n"+\
+            "  -b, --baud=BAUD_RATE"+\
+                        "\t\tSet baud rate value. Default value is 115200\n"+\
+            "  -j, --job=FILE[@NAME]\t\tQueue FILE, for printer NAME if given\n"+\
+            "  -w, --watch=DIR\t\tQueue the G-code files appearing in DIR\n"+\
+            "  -W, --window=COMMANDS\t\tCommands sent ahead of the oks of\n"+\
+            "\t\t\t\tbuffering firmwares. Default value is 1\n"+\
+            "  -c, --cache=DIR\t\tKeep preprocessed files in DIR\n"+\
+            "  -s, --status=SECONDS\t\tPrint the status every SECONDS\n"+\
+            "  -q, --quit\t\t\tQuit once every job is over\n"+\
+            "  -h, --help\t\t\tPrint this help message and exit\n"
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "b:j:w:W:c:s:qh",
+                        ["baud=", "job=", "watch=", "window=", "cache=",
+                         "status=", "quit", "help"])
+    except getopt.GetoptError as err:
+        print(str(err))
+        print(usage)
+        sys.exit(2)
+    try:
+        for o, a in opts:
+            if o in ('-h', '--help'):
+                print(usage)
+                sys.exit(0)
+            elif o in ('-b', '--baud'):
+                baud = int(a)
+            elif o in ('-j', '--job'):
+                jobs.append(a.rsplit("@", 1) if "@" in a else (a, None))
+            elif o in ('-w', '--watch'):
+                watch = a
+            elif o in ('-W', '--window'):
+                window = int(a)
+            elif o in ('-c', '--cache'):
+                cache_dir = a
+            elif o in ('-s', '--status'):
+                status_interval = float(a)
+            elif o in ('-q', '--quit'):
+                quit_when_done = True
+    except ValueError as err:
+        print("ValueError: %s\n" % err)
+        print(usage)
+        sys.exit(2)
+
+    if not args:
+        print("Error: No printer port specified.\n")
+        print(usage)
+        sys.exit(2)
+
+    cache = GCodeCache(cache_dir, 1024 * 1024 * 1024) if cache_dir else None
+    farm = PrinterFarm(cache, send_window = window)
+    farm.quit_when_done = quit_when_done
+    for i, printer in enumerate(args):
+        name, port = printer.split("=", 1) if "=" in printer else ("printer%d" % (i + 1), printer)
+        farm.add_printer(name, port, baud)
+    try:
+        for filename, name in jobs:
+            if not os.path.exists(filename):
+                print("Error: %s not found" % filename)
+                sys.exit(2)
+            farm.submit(filename, name)
+    except ValueError as err:
+        print("Error: %s" % err)
+        sys.exit(2)
+
+    try:
+        asyncio.run(serve(farm, watch, status_interval))
+    except KeyboardInterrupt:
+        pass
@@ -48,6 +48,17 @@ class PrinterEventHandler:
         '''
         pass
     
+    def on_recv_batch(self, lines):
+        '''
+        Called in place of on_recv with the lines read from the printer
+        since the previous call, when printcore gathers them in batches
+        (see printcore.recv_batch_interval).
+        
+        @param lines: The lines read from the printer, in order.
+        '''
+        for line in lines:
+            self.on_recv(line)
+    
     
     def on_connect(self):
         '''
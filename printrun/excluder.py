@@ -13,8 +13,11 @@
 # You should have received a copy of the GNU General Public License
 # along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
 
+import logging
+
 import wx
 from printrun import gviz
+from .exclusionplan import ExclusionPlan
 
 from .utils import imagefile, install_locale
 install_locale('pronterface')
@@ -28,6 +31,10 @@ class ExcluderWindow(gviz.GvizWindow):
                              wx.Image(imagefile('reset.png'), wx.BITMAP_TYPE_PNG).ConvertToBitmap(),
                              _("Reset selection"))
         self.Bind(wx.EVT_TOOL, self.reset_selection, id = 128)
+        self.toolbar.AddTool(129, " " + _("Save G-code"),
+                             wx.ArtProvider.GetBitmap(wx.ART_FILE_SAVE, wx.ART_TOOLBAR),
+                             _("Save the G-code without the excluded moves"))
+        self.Bind(wx.EVT_TOOL, self.save_gcode, id = 129)
         self.parent = excluder
         self.p.paint_overlay = self.paint_selection
         self.p.layerup()
@@ -43,6 +50,8 @@ class ExcluderWindow(gviz.GvizWindow):
     def mouse(self, event):
         if event.ButtonUp(wx.MOUSE_BTN_LEFT) \
            or event.ButtonUp(wx.MOUSE_BTN_RIGHT):
+            if event.ButtonUp(wx.MOUSE_BTN_LEFT) and self.initpos:
+                self.parent.rectangles_changed()
             self.initpos = None
         elif event.Dragging() and event.RightIsDown():
             e = event.GetPosition()
@@ -94,15 +103,76 @@ class ExcluderWindow(gviz.GvizWindow):
 
     def reset_selection(self, event):
         self.parent.rectangles = []
+        self.parent.rectangles_changed()
         wx.CallAfter(self.p.Refresh)
 
+    def save_gcode(self, event):
+        dlg = wx.FileDialog(self, _("Save G-code without the excluded moves"),
+                            style = wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT)
+        dlg.SetWildcard(_("G-code files (*.gcode;*.gco;*.g)|*.gcode;*.gco;*.g"))
+        if dlg.ShowModal() == wx.ID_OK:
+            self.parent.export(dlg.GetPath())
+        dlg.Destroy()
+
 class Excluder:
 
     def __init__(self):
         self.rectangles = []
         self.window = None
+        self.gcode = None
+        self.plan = None
+        self.replanning = False
+
+    def rectangles_changed(self):
+        """Plan the lines to skip and the commands to send instead ahead of
+        the print, must be called from the GUI thread"""
+        if self.gcode is None or not self.rectangles:
+            plan = None
+        else:
+            plan = ExclusionPlan(self.gcode, self.rectangles)
+        # Published at once, the sender thread getting either plan
+        self.plan = plan
+
+    def _replan(self):
+        self.replanning = False
+        self.rectangles_changed()
+
+    def plan_for(self, gcode):
+        """ExclusionPlan of the rectangles over gcode, called from the sender
+        thread. None if gcode is not the one shown or the plan does not
+        match the rectangles or the edits of gcode: the lines are then
+        tested one by one while the GUI thread plans again"""
+        if gcode is None or gcode is not self.gcode or not self.rectangles:
+            return None
+        plan = self.plan
+        if plan is None or plan.rectangles != self.rectangles:
+            # A rectangle is being drawn, planned once drawn
+            return None
+        if plan.revision != gcode.revision:
+            if not self.replanning:
+                self.replanning = True
+                wx.CallAfter(self._replan)
+            return None
+        return plan
+
+    def export(self, path):
+        """Write the G-code as printed with the exclusions to path"""
+        plan = self.plan
+        if plan is None or not plan.current() or plan.rectangles != self.rectangles:
+            self.rectangles_changed()
+            plan = self.plan
+        if plan is None:
+            return
+        try:
+            with open(path, "w") as f:
+                plan.write(f)
+        except EnvironmentError as e:
+            logging.error(_("Could not save G-code to %s: %s") % (path, e))
 
     def pop_window(self, gcode, *args, **kwargs):
+        if gcode is not self.gcode:
+            self.gcode = gcode
+            self.rectangles_changed()
         if not self.window:
             self.window = ExcluderWindow(self, *args, **kwargs)
             self.window.p.addfile(gcode, True)
@@ -0,0 +1,95 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy
+
+class ExclusionPlan:
+    """Lines of a GCode the part excluder skips and what to send instead.
+
+    skipped tells for each line in print order (see GCode.idxs) whether it
+    is a move ending in one of the rectangles. fixups gives, for the last
+    line of each run of skipped lines followed by a line to send, the
+    commands bringing the printer where the run would have: G92 E to the
+    last absolute extrusion, and G1 Z to the height it reached.  The plan
+    holds for the lines of the revision of the G-code it was made for, lines
+    appended since coming after them."""
+
+    def __init__(self, gcode, rectangles):
+        self.gcode = gcode
+        self.rectangles = list(rectangles)
+        self.index = gcode.spatial_index()
+        self.revision = self.index.revision
+        self.skipped = self.index.ends_in_rectangles(self.rectangles)
+        self.fixups = {}
+        e = z_abs = z_rel = None
+        last = len(self.skipped) - 1
+        for i in numpy.flatnonzero(self.skipped).tolist():
+            layer, line = gcode.idxs(i)
+            gline = gcode.all_layers[layer][line]
+            if gline.z is not None:
+                if gline.relative:
+                    if z_abs is not None:
+                        z_abs += gline.z
+                    elif z_rel is not None:
+                        z_rel += gline.z
+                    else:
+                        z_rel = gline.z
+                else:
+                    z_rel = None
+                    z_abs = gline.z
+            if gline.e is not None and not gline.relative_e:
+                e = gline.e
+            if i < last and not self.skipped[i + 1]:
+                self.fixups[i] = self._fixup(e, z_abs, z_rel, gline.relative)
+                e = z_abs = z_rel = None
+
+    def _fixup(self, e, z_abs, z_rel, relative):
+        commands = []
+        if e is not None:
+            commands.append("G92 E%.5f" % e)
+        if z_abs is not None:
+            if relative:
+                commands.append("G90")
+            commands.append("G1 Z%.5f" % z_abs)
+            if relative:
+                commands.append("G91")
+        if z_rel is not None:
+            if not relative:
+                commands.append("G91")
+            commands.append("G1 Z%.5f" % z_rel)
+            if not relative:
+                commands.append("G90")
+        return commands
+
+    def current(self):
+        """Whether the G-code was not edited since the plan was made"""
+        return self.index.current()
+
+    def lines(self):
+        """The G-code as printed with the plan, line by line"""
+        i = 0
+        for layer in self.gcode.all_layers:
+            skipped = self.skipped[i:i + len(layer)].tolist()
+            for line, gline in enumerate(layer):
+                if not skipped[line]:
+                    yield gline.raw
+                elif i + line in self.fixups:
+                    yield from self.fixups[i + line]
+            i += len(layer)
+
+    def write(self, f):
+        """Write the G-code as printed with the plan to the file f"""
+        for line in self.lines():
+            f.write(line + "\n")
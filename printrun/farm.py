@@ -0,0 +1,494 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Headless control of a pool of printers.
+
+PrinterFarm drives one AsyncPrintcore per printer from a single event loop.
+Jobs are queued with submit() and go to the first idle printer they may run
+on (any printer, or the one they were pinned to). A file is parsed once for
+all the jobs printing it at the same time: each print gets a SharedGCode
+view of the parsed file, the commands printcore appends during the print
+staying in the view, and the lines of the file are compiled once for all
+the printers (see sendbuffer). Printers which go offline are reconnected, the job they
+were printing is paused and may be resumed once they are back.
+
+    farm = PrinterFarm()
+    farm.add_printer("mk3", "/dev/ttyACM0", 115200)
+    farm.submit("part.gcode")
+    await farm.run()"""
+
+import asyncio
+import glob
+import itertools
+import logging
+import os
+import time
+import traceback
+
+from . import gcoder
+from .gcoder import Layer, Line, split
+from .gcoder_columnar import ColumnarGCode
+from .printcore_async import AsyncPrintcore
+from .sendbuffer import SendBuffer
+
+class SharedGCode:
+    """View of a parsed GCode for one print, keeping the commands appended
+    while printing to itself so that the GCode can be shared. sendbuffer,
+    the compiled lines of the GCode, is shared as well, printcore sending
+    the appended commands as text."""
+
+    def __init__(self, gcode, sendbuffer = None):
+        self.gcode = gcode
+        self.sendbuffer = sendbuffer
+        self.base_len = len(gcode)
+        self.append_layer = Layer([])
+        self.append_layer.duration = 0
+        self.append_layer_id = len(gcode.all_layers)
+        self.all_layers = gcode.all_layers + [self.append_layer]
+
+    def __len__(self):
+        return self.base_len + len(self.append_layer)
+
+    def __bool__(self):
+        return len(self) > 0
+
+    @property
+    def revision(self):
+        return getattr(self.gcode, "revision", 0)
+
+    @property
+    def lines(self):
+        return self
+
+    def __getitem__(self, i):
+        layer, line = self.idxs(i)
+        return self.all_layers[layer][line]
+
+    def __iter__(self):
+        yield from self.gcode
+        yield from self.append_layer
+
+    def idxs(self, i):
+        if i < self.base_len:
+            return self.gcode.idxs(i)
+        return (self.append_layer_id, i - self.base_len)
+
+    def append(self, command, store = True):
+        command = command.strip()
+        if not command:
+            return
+        gline = Line(command)
+        split(gline)
+        if store:
+            self.append_layer.append(gline)
+        return gline
+
+class GCodePool:
+    """Parsed G-code files, shared by the jobs printing them at once.
+
+    Files are parsed in a worker thread, through cache (a GCodeCache) when
+    given. A file is dropped once the last job using it releases it."""
+
+    def __init__(self, cache = None):
+        self.cache = cache
+        self.entries = {}
+        self.loads = 0
+        self.hits = 0
+
+    async def acquire(self, filename):
+        """Key, parsed GCode and send buffer of filename, loading it if
+        needed"""
+        stat = os.stat(filename)
+        key = (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+        entry = self.entries.get(key)
+        if entry is None:
+            future = asyncio.get_running_loop().run_in_executor(None, self._load, filename)
+            entry = self.entries[key] = [future, 0, None]
+            self.loads += 1
+        else:
+            self.hits += 1
+        entry[1] += 1
+        try:
+            gcode = await asyncio.shield(entry[0])
+        except:
+            self.release(key)
+            raise
+        if entry[2] is None:
+            # Compiled as the first print sends the lines, once for all
+            entry[2] = SendBuffer(gcode)
+        return key, gcode, entry[2]
+
+    def release(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del self.entries[key]
+
+    def _load(self, filename):
+        if self.cache is None:
+            with open(filename, "r", encoding = "utf-8") as f:
+                return gcoder.LightGCode([line.strip() for line in f])
+        # The cache holds packed lines, only ColumnarGCode can use them
+        gcode = ColumnarGCode(deferred = True)
+        if not self.cache.load(filename, None, gcode):
+            with open(filename, "r", encoding = "utf-8") as f:
+                gcode.prepare(f, None)
+            self.cache.store(filename, None, gcode)
+        return gcode
+
+class FarmJob:
+    """A file to print, on printer if given or on any printer"""
+
+    def __init__(self, jobid, filename, printer = None):
+        self.id = jobid
+        self.filename = filename
+        self.printer = printer
+        # queued, loading, printing, paused, done, failed or cancelled
+        self.state = "queued"
+        self.assigned = None
+        self.key = None
+        self.gcode = None
+        # Print lines sent once the job is over
+        self.lines = 0
+        self.queued = time.time()
+        self.started = None
+        self.ended = None
+
+    def progress(self):
+        if self.state == "done":
+            return 1.0
+        if self.gcode is None or not len(self.gcode):
+            return 0.0
+        return self.assigned.core.queueindex / len(self.gcode)
+
+class FarmPrinter:
+    """A printer of the farm and its printcore"""
+
+    def __init__(self, name, port, baud):
+        self.name = name
+        self.port = port
+        self.baud = baud
+        self.core = AsyncPrintcore()
+        # Pausing catches the analyzer up, sent lines need no analysis
+        self.core.reanalyze = False
+        self.job = None
+        # Print lines sent by the finished jobs of the printer
+        self.lines = 0
+        self.wake = None
+        self.task = None
+
+    def state(self):
+        if not self.core.online:
+            return "offline"
+        if self.job is None:
+            return "idle"
+        return self.job.state
+
+    def lines_sent(self):
+        if self.job is not None and self.job.state in ("printing", "paused"):
+            return self.lines + self.core.queueindex
+        return self.lines
+
+class PrinterFarm:
+    """Printers, their job queue and their status.
+
+    All the methods must be called from the thread running run()."""
+
+    # Seconds between attempts to reach a printer which is offline
+    reconnect_interval = 10
+    # Seconds given to a printer to answer once connected
+    online_timeout = 10
+
+    def __init__(self, cache = None, send_window = 1):
+        self.printers = {}
+        self.jobs = []
+        self.pool = GCodePool(cache)
+        self.send_window = send_window
+        self.quit_when_done = False
+        self._ids = itertools.count(1)
+        self._stopping = False
+        self._started = None
+
+    def add_printer(self, name, port, baud = 115200):
+        if name in self.printers:
+            raise ValueError(_("Printer %s already exists") % name)
+        printer = FarmPrinter(name, port, baud)
+        printer.core.send_window = self.send_window
+        self.printers[name] = printer
+        if self._started is not None:
+            self._start_printer(printer)
+        return printer
+
+    def submit(self, filename, printer = None):
+        """Queue filename for printing, on the printer named printer if
+        given. Returns the FarmJob."""
+        if printer is not None and printer not in self.printers:
+            raise ValueError(_("Unknown printer %s") % printer)
+        job = FarmJob(next(self._ids), filename, printer)
+        self.jobs.append(job)
+        self._notify()
+        return job
+
+    def job(self, jobid):
+        for job in self.jobs:
+            if job.id == jobid:
+                return job
+        raise ValueError(_("Unknown job %s") % jobid)
+
+    def cancel(self, jobid):
+        job = self.job(jobid)
+        if job.state == "queued":
+            job.state = "cancelled"
+            job.ended = time.time()
+        elif job.state in ("loading", "printing", "paused"):
+            job.state = "cancelled"
+            job.assigned.core.cancelprint()
+        self._notify()
+
+    def pause(self, jobid):
+        job = self.job(jobid)
+        if job.state == "printing":
+            job.assigned.core.pause()
+
+    def resume(self, jobid):
+        """Resume a paused job, returns False if its printer is offline"""
+        job = self.job(jobid)
+        if job.state != "paused" or not job.assigned.core.online:
+            return False
+        job.state = "printing"
+        job.assigned.core.resume()
+        self._notify()
+        return True
+
+    def _notify(self):
+        for printer in self.printers.values():
+            if printer.wake is not None:
+                printer.wake.set()
+
+    async def _wait(self, printer, condition, timeout = None):
+        """Wait until condition() holds, or for timeout seconds"""
+        deadline = None if timeout is None else time.time() + timeout
+        while not condition() and not self._stopping:
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                return False
+            printer.wake.clear()
+            try:
+                await asyncio.wait_for(printer.wake.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+        return condition()
+
+    def _next_job(self, printer):
+        for job in self.jobs:
+            if job.state == "queued" and job.printer in (None, printer.name):
+                return job
+        return None
+
+    async def _connect(self, printer):
+        core = printer.core
+        await core.connect(printer.port, printer.baud)
+        if not core.printer:
+            return False
+        if not await core.wait_online(self.online_timeout):
+            await core.disconnect()
+            return False
+        if core.send_window > 1:
+            # Let the firmware identify itself
+            await self._wait(printer, lambda: core.firmware_name is not None, 5)
+        return True
+
+    async def _run_printer(self, printer):
+        core = printer.core
+        core.on("disconnect", lambda: self._notify())
+        core.on("end", lambda: self._notify())
+        while not self._stopping:
+            if not core.online:
+                if core.printer:
+                    await core.disconnect()
+                if not await self._connect(printer):
+                    await self._wait(printer, lambda: False, self.reconnect_interval)
+                    continue
+                logging.info(_("Printer %s is online") % printer.name)
+            if printer.job is not None:
+                await self._follow_job(printer)
+                continue
+            # Look at the connection now and then, losing it does not notify
+            await self._wait(printer, lambda: self._next_job(printer) is not None
+                             or not core.online, self.reconnect_interval)
+            job = self._next_job(printer)
+            if job is None or not core.online:
+                continue
+            await self._start_job(printer, job)
+
+    async def _start_job(self, printer, job):
+        job.state = "loading"
+        job.assigned = printer
+        printer.job = job
+        try:
+            key, gcode, sendbuffer = await self.pool.acquire(job.filename)
+        except Exception:
+            logging.error(_("Could not load %s:") % job.filename + "\n" +
+                          traceback.format_exc())
+            job.state = "failed"
+            job.ended = time.time()
+            printer.job = None
+            return
+        job.key = key
+        if job.state == "cancelled" or not printer.core.online:
+            self.pool.release(key)
+            if job.state != "cancelled":
+                # Back to the queue for another printer
+                job.state = "queued"
+                job.assigned = None
+            printer.job = None
+            return
+        job.gcode = SharedGCode(gcode, sendbuffer)
+        job.started = time.time()
+        job.state = "printing"
+        printer.core.startprint(job.gcode)
+        logging.info(_("Printing %s on %s") % (job.filename, printer.name))
+
+    async def _follow_job(self, printer):
+        core = printer.core
+        job = printer.job
+        await core.wait_print()
+        if core.paused and job.state != "cancelled":
+            job.state = "paused"
+            # Wait to be resumed or cancelled, or to reconnect the printer
+            await self._wait(printer, lambda: job.state != "paused" or not core.online)
+            if job.state in ("printing", "paused"):
+                return
+        if job.state == "cancelled":
+            job.lines = core.queueindex
+        elif job.state == "printing":
+            job.state = "done"
+            job.lines = len(job.gcode)
+            logging.info(_("Printed %s on %s") % (job.filename, printer.name))
+        else:
+            # Stopped with the farm
+            return
+        job.ended = time.time()
+        printer.lines += job.lines
+        self.pool.release(job.key)
+        job.gcode = None
+        printer.job = None
+        self._notify()
+
+    def _start_printer(self, printer):
+        printer.wake = asyncio.Event()
+        printer.task = asyncio.ensure_future(self._run_printer(printer))
+
+    def done(self):
+        """Whether every job is over"""
+        return all(job.state in ("done", "failed", "cancelled")
+                   for job in self.jobs)
+
+    async def watch(self, directory, interval = 2):
+        """Queue the G-code files appearing in directory"""
+        seen = set()
+        while not self._stopping:
+            for filename in sorted(glob.glob(os.path.join(directory, "*.g*"))):
+                try:
+                    key = (filename, os.stat(filename).st_mtime_ns)
+                except OSError:
+                    continue
+                if key not in seen:
+                    seen.add(key)
+                    self.submit(filename)
+            await asyncio.sleep(interval)
+
+    async def run(self):
+        """Drive the printers until stop(), or until every job is over if
+        quit_when_done is set"""
+        self._started = (time.time(), time.process_time())
+        for printer in self.printers.values():
+            self._start_printer(printer)
+        try:
+            while not self._stopping:
+                if self.quit_when_done and self.done():
+                    break
+                await asyncio.sleep(0.1)
+        finally:
+            await self.stop()
+
+    async def stop(self):
+        self._stopping = True
+        self._notify()
+        for printer in self.printers.values():
+            if printer.task is not None:
+                printer.task.cancel()
+                try:
+                    await printer.task
+                except asyncio.CancelledError:
+                    pass
+                printer.task = None
+            if printer.core.printer:
+                await printer.core.disconnect()
+
+    def status(self):
+        """Status of the printers and jobs, and host resource use"""
+        printers = []
+        for printer in self.printers.values():
+            job = printer.job
+            printers.append({"name": printer.name,
+                             "port": printer.port,
+                             "state": printer.state(),
+                             "firmware": printer.core.firmware_name,
+                             "job": job.id if job else None,
+                             "file": job.filename if job else None,
+                             "progress": job.progress() if job else None,
+                             "lines": printer.lines_sent()})
+        jobs = {}
+        for job in self.jobs:
+            jobs[job.state] = jobs.get(job.state, 0) + 1
+        lines = sum(printer["lines"] for printer in printers)
+        elapsed = cpu = 0
+        if self._started is not None:
+            elapsed = time.time() - self._started[0]
+            cpu = time.process_time() - self._started[1]
+        online = sum(1 for printer in printers if printer["state"] != "offline")
+        return {"printers": printers,
+                "jobs": jobs,
+                "online": online,
+                "lines": lines,
+                "lines_per_second": lines / elapsed if elapsed else 0,
+                "cpu": cpu / elapsed if elapsed else 0,
+                "cpu_per_printer": cpu / elapsed / max(len(printers), 1) if elapsed else 0,
+                "parsed_files": len(self.pool.entries),
+                "parse_loads": self.pool.loads,
+                "parse_hits": self.pool.hits}
+
+def format_status(status):
+    """Human readable form of PrinterFarm.status()"""
+    out = []
+    for printer in status["printers"]:
+        job = ""
+        if printer["job"] is not None:
+            job = "job %d %s %.1f%%" % (printer["job"], os.path.basename(printer["file"]),
+                                        100 * printer["progress"])
+        out.append("%-12s %-9s %9d lines  %s" % (printer["name"], printer["state"],
+                                                 printer["lines"], job))
+    jobs = ", ".join("%d %s" % (count, state)
+                     for state, count in sorted(status["jobs"].items()))
+    out.append(_("%d/%d printers online, jobs: %s") %
+               (status["online"], len(status["printers"]), jobs or _("none")))
+    out.append(_("%.0f lines/s, %.1f%% CPU (%.2f%% per printer), "
+                 "%d files parsed for %d jobs") %
+               (status["lines_per_second"], 100 * status["cpu"],
+                100 * status["cpu_per_printer"], status["parse_loads"],
+                status["parse_loads"] + status["parse_hits"]))
+    return "\n".join(out)
@@ -0,0 +1,430 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""On-disk cache of preprocessed G-code files.
+
+Each cached file is a directory holding the packed lines of a ColumnarGCode
+(one structured array for all lines, the raw text and its offsets), the
+layer table (first line, Z and duration of each layer) as .npy files, plus
+a meta.json with the command table and the global results (bounding box, filament, duration...).
+Loading maps these files in memory instead of parsing anything, the line
+array being mapped copy-on-write since viewers annotate lines.
+
+Entries are keyed by the content hash of the file along with the home
+position, the duration estimator settings and the cache format version.  The hash of a path is remembered
+along with its size and mtime so unchanged files are not hashed again.
+Entries are evicted in least recently used order once the cache grows over
+its size limit.
+
+The geometry the 3D view builds for a file (see MeshCache) is kept in
+entries of its own, also keyed by the path size and colors of the view."""
+
+import datetime
+import hashlib
+import json
+import logging
+import mmap
+import os
+import shutil
+import threading
+import time
+from array import array
+
+import numpy
+
+from .gcoder import Layer, LayerLines, Line
+from .gcoder_columnar import ColumnarGCode, ColumnarLayer, \
+    line_dtype, remap_commands, pos_gcview_end_vertex
+
+cache_version = 4
+
+layer_dtype = numpy.dtype([("start", numpy.uint64),
+                           ("z", numpy.float64),
+                           ("duration", numpy.float64)])
+
+gcode_fields = ("imperial", "relative", "relative_e", "current_tool",
+                "current_x", "current_y", "current_z",
+                "offset_x", "offset_y", "offset_z", "current_f",
+                "current_e", "offset_e", "total_e", "max_e",
+                "current_e_multi", "offset_e_multi", "total_e_multi",
+                "max_e_multi", "filament_length", "filament_length_multi",
+                "xmin", "xmax", "ymin", "ymax", "zmin", "zmax",
+                "width", "depth", "height", "est_layer_height")
+
+# Buffers of the 3D view geometry and its tables, stored as .npy files
+mesh_buffers = ("travels", "vertices", "colors", "normals", "indices",
+                "lod_indices")
+mesh_counts = ("layer_stops", "count_travel_indices", "count_print_indices",
+               "count_print_vertices", "count_lod_indices")
+
+# Version of the 3D view geometry, which changes along with GcodeModel
+mesh_version = 2
+
+# gcview_end_vertex of the lines without one
+no_vertex = 0xffffffff
+
+# Leftovers of interrupted writes older than this get cleaned up
+stale_tmp_age = 24 * 3600
+
+# Number of remembered path hashes
+max_path_memos = 1000
+
+def _none_to_nan(value):
+    return float("nan") if value is None else value
+
+def _nan_to_none(value):
+    return None if value != value else value
+
+def _hash_file(filename):
+    digest = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+class GCodeCache:
+    """Cache of preprocessed G-code in directory, bounded to max_size bytes"""
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.entries_dir = os.path.join(directory, "entries")
+        self.paths_dir = os.path.join(directory, "paths")
+
+    def _content_hash(self, filename):
+        """Hash of filename, reusing the last one if size and mtime match"""
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        memo = os.path.join(self.paths_dir,
+                            hashlib.sha1(path.encode("utf-8")).hexdigest() + ".json")
+        try:
+            with open(memo) as f:
+                known = json.load(f)
+            if known["path"] == path and known["size"] == stat.st_size \
+               and known["mtime"] == stat.st_mtime_ns:
+                return known["hash"]
+        except (OSError, ValueError, KeyError):
+            pass
+        content_hash = _hash_file(path)
+        try:
+            os.makedirs(self.paths_dir, exist_ok = True)
+            # The G-code and its 3D view get loaded in different threads
+            tmp = "%s.tmp-%d-%d" % (memo, os.getpid(), threading.get_ident())
+            with open(tmp, "w") as f:
+                json.dump({"path": path, "size": stat.st_size,
+                           "mtime": stat.st_mtime_ns, "hash": content_hash}, f)
+            os.replace(tmp, memo)
+        except OSError:
+            logging.warning("Could not write G-code cache memo %s" % memo,
+                            exc_info = True)
+        return content_hash
+
+    def _write_entry(self, entry, files, meta):
+        """Write files, mapping file names to arrays (saved as .npy) or to
+        chunks of bytes, and meta.json as entry, atomically"""
+        tmp = "%s.tmp-%d-%d" % (entry, os.getpid(), threading.get_ident())
+        os.makedirs(tmp, exist_ok = True)
+        try:
+            for name, data in files.items():
+                if isinstance(data, numpy.ndarray):
+                    numpy.save(os.path.join(tmp, name), data)
+                else:
+                    with open(os.path.join(tmp, name), "wb") as f:
+                        for chunk in data:
+                            f.write(chunk)
+            # meta.json goes last, an entry without it is incomplete
+            with open(os.path.join(tmp, "meta.json"), "w") as f:
+                json.dump(meta, f)
+            os.rename(tmp, entry)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors = True)
+            if not os.path.exists(entry):
+                raise
+
+    def mesh_cache(self, filename, home_pos):
+        """Cache of the 3D view geometry of filename"""
+        if self.max_size <= 0:
+            return None
+        return MeshCache(self, filename, home_pos)
+
+    def _key(self, filename, home_pos, gcode):
+        key = json.dumps([cache_version, self._content_hash(filename),
+                          list(home_pos) if home_pos else None,
+                          gcode.estimator.key()])
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def load(self, filename, home_pos, gcode, layer_callback = None):
+        """Fill the deferred ColumnarGCode gcode with the cached result for
+        filename. Returns False if there is none."""
+        if self.max_size <= 0 or not isinstance(gcode, ColumnarGCode):
+            return False
+        entry = os.path.join(self.entries_dir, self._key(filename, home_pos, gcode))
+        meta_file = os.path.join(entry, "meta.json")
+        try:
+            with open(meta_file) as f:
+                meta = json.load(f)
+            data = numpy.load(os.path.join(entry, "data.npy"), mmap_mode = "c")
+            offsets = numpy.load(os.path.join(entry, "offsets.npy"), mmap_mode = "r")
+            layers = numpy.load(os.path.join(entry, "layers.npy"))
+            with open(os.path.join(entry, "raw.bin"), "rb") as f:
+                if meta["raw_size"]:
+                    raw = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+                else:
+                    raw = b""
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, KeyError):
+            logging.warning("Dropping broken G-code cache entry %s" % entry,
+                            exc_info = True)
+            shutil.rmtree(entry, ignore_errors = True)
+            return False
+        if data.dtype != line_dtype or meta.get("version") != cache_version:
+            return False
+        try:
+            # Mark as recently used
+            os.utime(meta_file)
+        except OSError:
+            pass
+
+        gcode.home_pos = home_pos
+        gcode.lines = LayerLines(gcode)
+        for name in gcode_fields:
+            setattr(gcode, name, meta["gcode"][name])
+        gcode.all_zs = set(meta["all_zs"])
+        commands = meta["commands"]
+        all_layers = gcode.all_layers = []
+        layer_starts = gcode.layer_starts = array('I')
+        ends = list(layers["start"][1:].tolist()) + [len(data)]
+        for i, (start, end) in enumerate(zip(layers["start"].tolist(), ends)):
+            layer = ColumnarLayer.from_rows(data[start:end], raw,
+                                            offsets[start:end + 1], commands,
+                                            _nan_to_none(layers["z"][i].item()))
+            layer.duration = layers["duration"][i].item()
+            all_layers.append(layer)
+            layer_starts.append(start)
+            if layer_callback is not None:
+                layer_callback(gcode, i)
+        gcode.append_layer_id = len(all_layers)
+        gcode.append_layer = Layer([])
+        gcode.append_layer.duration = 0
+        all_layers.append(gcode.append_layer)
+        layer_starts.append(len(data))
+        gcode.duration = datetime.timedelta(seconds = meta["duration"])
+        return True
+
+    def store(self, filename, home_pos, gcode):
+        """Store a freshly prepared gcode, which must hold full lines (GCode
+        or ColumnarGCode), as the result for filename"""
+        if self.max_size <= 0 or gcode.line_class is not Line:
+            return
+        try:
+            self._store(filename, home_pos, gcode)
+            self._evict()
+        except OSError:
+            logging.warning("Could not store %s in the G-code cache" % filename,
+                            exc_info = True)
+
+    def _store(self, filename, home_pos, gcode):
+        entry = os.path.join(self.entries_dir, self._key(filename, home_pos, gcode))
+        if os.path.exists(entry):
+            return
+        names = []
+        table = {}
+        datas = []
+        raws = []
+        offsets = []
+        layers = numpy.zeros(gcode.append_layer_id, dtype = layer_dtype)
+        start = 0
+        raw_size = 0
+        for i, layer in enumerate(gcode.all_layers[:gcode.append_layer_id]):
+            if not isinstance(layer, ColumnarLayer):
+                packed = ColumnarLayer(list(layer), layer.z)
+            else:
+                packed = layer
+            data = packed.data.copy()
+            data["command"] = remap_commands(data["command"], packed.commands,
+                                             names, table)
+            datas.append(data)
+            layer_offsets = packed.offsets.astype(numpy.uint64)
+            raws.append(packed.raw[layer_offsets[0]:layer_offsets[-1]])
+            offsets.append(layer_offsets[:-1] - layer_offsets[0] + raw_size)
+            raw_size += int(layer_offsets[-1] - layer_offsets[0])
+            layers[i] = (start, _none_to_nan(layer.z),
+                         _none_to_nan(layer.duration))
+            start += len(data)
+        offsets.append(numpy.array([raw_size], dtype = numpy.uint64))
+        data = numpy.concatenate(datas) if datas \
+            else numpy.zeros(0, dtype = line_dtype)
+        if data.nbytes + raw_size > self.max_size:
+            return
+
+        meta = {"version": cache_version,
+                "path": os.path.abspath(filename),
+                "commands": names,
+                "raw_size": raw_size,
+                "all_zs": list(gcode.all_zs),
+                "duration": gcode.duration.total_seconds(),
+                "gcode": {name: getattr(gcode, name) for name in gcode_fields}}
+        self._write_entry(entry, {"data.npy": data,
+                                  "offsets.npy": numpy.concatenate(offsets),
+                                  "layers.npy": layers,
+                                  "raw.bin": raws}, meta)
+
+    def _evict(self):
+        """Remove least recently used entries until the cache fits"""
+        entries = []
+        total = 0
+        now = time.time()
+        for name in os.listdir(self.entries_dir):
+            path = os.path.join(self.entries_dir, name)
+            if ".tmp-" in name:
+                if now - os.path.getmtime(path) > stale_tmp_age:
+                    shutil.rmtree(path, ignore_errors = True)
+                continue
+            try:
+                size = sum(entry.stat().st_size for entry in os.scandir(path))
+                used = os.path.getmtime(os.path.join(path, "meta.json"))
+            except OSError:
+                continue
+            entries.append((used, size, path))
+            total += size
+        entries.sort()
+        for used, size, path in entries:
+            if total <= self.max_size:
+                break
+            shutil.rmtree(path, ignore_errors = True)
+            total -= size
+
+        memos = sorted(os.scandir(self.paths_dir),
+                       key = lambda memo: memo.stat().st_mtime)
+        for memo in memos[:-max_path_memos]:
+            try:
+                os.remove(memo.path)
+            except OSError:
+                pass
+
+class MeshCache:
+    """Geometry of the 3D view (GcodeModel) of a G-code file in a GCodeCache.
+
+    An entry holds the buffers of the model and its tables as .npy files,
+    along with the vertex each line of the file ends at, and a meta.json
+    with the layer map and dimensions. Buffers are loaded memory mapped, to
+    go straight to the GPU.  The geometry depends on the file, the home
+    position, the path size and the extrusion colors, which make the key.
+    Edited G-code is neither loaded from nor stored in the cache."""
+
+    def __init__(self, cache, filename, home_pos):
+        self.cache = cache
+        self.filename = filename
+        self.home_pos = home_pos
+        self.end_vertices = None
+
+    def _entry(self, model):
+        colors = [list(getattr(model, "color_tool%d" % i)) for i in range(5)]
+        key = json.dumps([cache_version, "mesh", mesh_version,
+                          self.cache._content_hash(self.filename),
+                          list(self.home_pos) if self.home_pos else None,
+                          model.path_halfwidth, model.path_halfheight, colors])
+        return os.path.join(self.cache.entries_dir,
+                            hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+    def load(self, model, gcode):
+        """Cached geometry of model for gcode, as a dict of model attributes,
+        or None. Lines get their gcview_end_vertex from annotate_layer."""
+        if gcode.revision:
+            return None
+        try:
+            entry = self._entry(model)
+            meta_file = os.path.join(entry, "meta.json")
+            with open(meta_file) as f:
+                meta = json.load(f)
+            if meta.get("version") != cache_version \
+               or meta.get("mesh_version") != mesh_version:
+                return None
+            geometry = {name: numpy.load(os.path.join(entry, name + ".npy"),
+                                         mmap_mode = "r")
+                        for name in mesh_buffers}
+            for name in mesh_counts:
+                counts = array('L')
+                counts.frombytes(numpy.load(os.path.join(entry, name + ".npy"))
+                                 .astype("=u%d" % counts.itemsize).tobytes())
+                geometry[name] = counts
+            self.end_vertices = numpy.load(os.path.join(entry, "end_vertices.npy"),
+                                           mmap_mode = "r")
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError):
+            logging.warning("Dropping broken G-code cache entry %s" % entry,
+                            exc_info = True)
+            shutil.rmtree(entry, ignore_errors = True)
+            return None
+        try:
+            # Mark as recently used
+            os.utime(meta_file)
+        except OSError:
+            pass
+        geometry["layer_idxs_map"] = dict(meta["layer_idxs_map"])
+        geometry["dims"] = tuple(tuple(dims) for dims in meta["dims"])
+        return geometry
+
+    def annotate_layer(self, gcode, layer_idx):
+        """Set the gcview_end_vertex of the lines of a layer of gcode from
+        the loaded entry"""
+        layer = gcode.all_layers[layer_idx]
+        start = gcode.layer_starts[layer_idx]
+        ends = self.end_vertices[start:start + len(layer)]
+        if isinstance(layer, ColumnarLayer):
+            has_vertex = ends != no_vertex
+            layer.data["gcview_end_vertex"][has_vertex] = ends[has_vertex]
+            layer.data["status"][has_vertex] |= pos_gcview_end_vertex
+        else:
+            for gline, end in zip(layer, ends.tolist()):
+                if end != no_vertex:
+                    gline.gcview_end_vertex = end
+
+    def store(self, model, gcode, geometry):
+        """Store the geometry of model (as returned by load) built from the
+        whole, unedited gcode"""
+        if gcode.revision or getattr(gcode, "error", None) is not None:
+            return
+        try:
+            entry = self._entry(model)
+            if os.path.exists(entry):
+                return
+            end_vertices = numpy.full(len(gcode), no_vertex, dtype = numpy.uint32)
+            for start, layer in zip(gcode.layer_starts, gcode.all_layers):
+                ends = end_vertices[start:start + len(layer)]
+                if isinstance(layer, ColumnarLayer):
+                    has_vertex = (layer.data["status"] & pos_gcview_end_vertex) != 0
+                    ends[has_vertex] = layer.data["gcview_end_vertex"][has_vertex]
+                else:
+                    ends[:] = [no_vertex if gline.gcview_end_vertex is None
+                               else gline.gcview_end_vertex for gline in layer]
+            files = {name + ".npy": numpy.asarray(geometry[name])
+                     for name in mesh_buffers + mesh_counts}
+            files["end_vertices.npy"] = end_vertices
+            if sum(data.nbytes for data in files.values()) > self.cache.max_size:
+                return
+            meta = {"version": cache_version,
+                    "mesh_version": mesh_version,
+                    "path": os.path.abspath(self.filename),
+                    "layer_idxs_map": sorted(geometry["layer_idxs_map"].items()),
+                    "dims": [[None if value is None else float(value)
+                              for value in dims] for dims in geometry["dims"]]}
+            self.cache._write_entry(entry, files, meta)
+            self.cache._evict()
+        except OSError:
+            logging.warning("Could not store the 3D view of %s in the G-code cache"
+                            % self.filename, exc_info = True)
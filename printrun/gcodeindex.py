@@ -0,0 +1,230 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Spatial index over the moves of G-code.
+
+Each layer gets a uniform grid over the XY segments of its moves, built
+with NumPy from their start and end points, to find the lines whose move
+touches a rectangle or passes close to a point without testing them all:
+
+    index = gcode.spatial_index()
+    index.lines_touching(layer_idx, x0, y0, x1, y1)
+    index.nearest_line(layer_idx, x, y, radius)
+    index.ends_in_rectangles(rectangles)
+
+Moves go from the position of the previous move to their current_x and
+current_y, arcs being indexed by their chord."""
+
+import numpy
+
+from .gcoder_columnar import ColumnarLayer, pos_is_move
+
+def _carried(values, start):
+    """values with each NaN replaced by the last value before it, or start"""
+    last = numpy.where(numpy.isnan(values), -1, numpy.arange(len(values)))
+    numpy.maximum.accumulate(last, out = last)
+    return numpy.where(last >= 0, values[last], start)
+
+def _layer_moves(layer):
+    """Line indexes and current X and Y of the moves of layer, None being
+    NaN"""
+    if isinstance(layer, ColumnarLayer):
+        lines = numpy.flatnonzero(layer.data["status"] & pos_is_move)
+        return (lines, layer.data["current_x"][lines].astype(numpy.float64),
+                layer.data["current_y"][lines].astype(numpy.float64))
+    moves = [(i, gline.current_x, gline.current_y)
+             for i, gline in enumerate(layer) if gline.is_move]
+    moves = numpy.array(moves, dtype = numpy.float64).reshape(-1, 3)
+    return moves[:, 0].astype(numpy.int64), moves[:, 1], moves[:, 2]
+
+def _clipped(starts, ends, x0, y0, x1, y1):
+    """Which segments go through the rectangle (Liang-Barsky clipping)"""
+    deltas = ends - starts
+    enter = numpy.zeros(len(starts))
+    leave = numpy.ones(len(starts))
+    inside = numpy.ones(len(starts), dtype = bool)
+    for p, q in ((-deltas[:, 0], starts[:, 0] - x0), (deltas[:, 0], x1 - starts[:, 0]),
+                 (-deltas[:, 1], starts[:, 1] - y0), (deltas[:, 1], y1 - starts[:, 1])):
+        parallel = p == 0
+        inside &= ~(parallel & (q < 0))
+        with numpy.errstate(divide = "ignore", invalid = "ignore"):
+            t = q / p
+        entering = ~parallel & (p < 0)
+        leaving = ~parallel & (p > 0)
+        enter[entering] = numpy.maximum(enter[entering], t[entering])
+        leave[leaving] = numpy.minimum(leave[leaving], t[leaving])
+    return inside & (enter <= leave)
+
+def _distances(starts, ends, x, y):
+    """Distances from (x, y) to the segments"""
+    deltas = ends - starts
+    relative = numpy.array((x, y)) - starts
+    lengths2 = (deltas * deltas).sum(axis = 1)
+    with numpy.errstate(divide = "ignore", invalid = "ignore"):
+        t = (relative * deltas).sum(axis = 1) / lengths2
+    t = numpy.clip(numpy.nan_to_num(t), 0, 1)
+    return numpy.hypot(*(relative - t[:, None] * deltas).T)
+
+class LayerIndex:
+    """Uniform grid over the moves of a layer, lines giving the index of the
+    line of each move in the layer and starts and ends its segment"""
+
+    # Moves over more cells than this are tested by every query rather than
+    # listed in each of their cells, as are long travels
+    max_cells = 16
+    # Cells along the sides of the grid at most
+    max_side = 1024
+
+    def __init__(self, lines, starts, ends, cell_size):
+        self.lines = lines
+        self.starts = starts
+        self.ends = ends
+        self.cell_size = cell_size
+        self.shape = (0, 0)
+        self.origin = numpy.zeros(2)
+        self.cell_starts = numpy.zeros(1, dtype = numpy.int64)
+        self.cell_moves = numpy.zeros(0, dtype = numpy.int64)
+        self.large = numpy.zeros(0, dtype = numpy.int64)
+        known = ~(numpy.isnan(starts).any(axis = 1) | numpy.isnan(ends).any(axis = 1))
+        if not known.any():
+            return
+        low = numpy.minimum(starts, ends)[known]
+        high = numpy.maximum(starts, ends)[known]
+        moves = numpy.flatnonzero(known)
+        self.origin = low.min(axis = 0)
+        # Bound the grid when a few moves go far away
+        cell_size = self.cell_size = max(cell_size, (high.max(axis = 0) - self.origin).max() / self.max_side)
+        cell_low = numpy.floor((low - self.origin) / cell_size).astype(numpy.int64)
+        cell_high = numpy.floor((high - self.origin) / cell_size).astype(numpy.int64)
+        nx, ny = self.shape = tuple(int(side) + 1 for side in cell_high.max(axis = 0))
+        spans = cell_high - cell_low + 1
+        counts = spans[:, 0] * spans[:, 1]
+        large = counts > self.max_cells
+        self.large = moves[large]
+        # List each other move in every cell its bounding box covers
+        small = numpy.flatnonzero(~large)
+        counts = counts[small]
+        owners = numpy.repeat(small, counts)
+        steps = numpy.arange(len(owners)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        cell_x = cell_low[owners, 0] + steps % spans[owners, 0]
+        cell_y = cell_low[owners, 1] + steps // spans[owners, 0]
+        cells = cell_y * nx + cell_x
+        order = numpy.argsort(cells, kind = "stable")
+        self.cell_moves = moves[owners[order]]
+        self.cell_starts = numpy.searchsorted(cells[order], numpy.arange(nx * ny + 1))
+
+    def candidates(self, x0, y0, x1, y1):
+        """Moves whose bounding box may meet the rectangle"""
+        nx, ny = self.shape
+        found = [self.large]
+        cell_x0, cell_y0 = numpy.floor((numpy.array((x0, y0)) - self.origin) / self.cell_size)
+        cell_x1, cell_y1 = numpy.floor((numpy.array((x1, y1)) - self.origin) / self.cell_size)
+        cell_x0, cell_y0 = max(0, int(cell_x0)), max(0, int(cell_y0))
+        cell_x1, cell_y1 = min(nx - 1, int(cell_x1)), min(ny - 1, int(cell_y1))
+        if cell_x0 <= cell_x1:
+            for cell_y in range(cell_y0, cell_y1 + 1):
+                row = cell_y * nx
+                found.append(self.cell_moves[self.cell_starts[row + cell_x0]:
+                                             self.cell_starts[row + cell_x1 + 1]])
+        return numpy.unique(numpy.concatenate(found))
+
+    def touching(self, x0, y0, x1, y1):
+        """Lines whose move goes through the rectangle, sorted"""
+        moves = self.candidates(x0, y0, x1, y1)
+        moves = moves[_clipped(self.starts[moves], self.ends[moves], x0, y0, x1, y1)]
+        return numpy.unique(self.lines[moves])
+
+    def nearest(self, x, y, radius):
+        """Line whose move passes closest to (x, y), and its distance, or
+        None if none is within radius"""
+        moves = self.candidates(x - radius, y - radius, x + radius, y + radius)
+        if not len(moves):
+            return None
+        distances = _distances(self.starts[moves], self.ends[moves], x, y)
+        best = numpy.argmin(distances)
+        if not distances[best] <= radius:
+            return None
+        return int(self.lines[moves[best]]), float(distances[best])
+
+class GCodeIndex:
+    """Spatial index over the moves of a GCode, by layer of all_layers, the
+    grid of each layer being built on its first query"""
+
+    def __init__(self, gcode, cell_size = 5.0):
+        self.gcode = gcode
+        self.cell_size = cell_size
+        self.revision = gcode.revision
+        self.nlines = len(gcode)
+        columns = [_layer_moves(layer) for layer in gcode.all_layers]
+        counts = [len(lines) for lines, x, y in columns]
+        self.layer_offsets = numpy.zeros(len(columns) + 1, dtype = numpy.int64)
+        numpy.cumsum(counts, out = self.layer_offsets[1:])
+        if columns:
+            lines, x, y = [numpy.concatenate(column) for column in zip(*columns)]
+            self.layer_lines = lines.astype(numpy.int64)
+            # Index of each move among all the lines of the G-code
+            layer_starts = numpy.array(gcode.layer_starts[:len(columns)], dtype = numpy.int64)
+            self.move_lines = self.layer_lines + numpy.repeat(layer_starts, counts)
+        else:
+            self.layer_lines = self.move_lines = numpy.zeros(0, dtype = numpy.int64)
+            x = y = numpy.zeros(0)
+        self.ends = numpy.stack((_carried(x, 0.0), _carried(y, 0.0)), axis = 1)
+        self.starts = numpy.concatenate((numpy.zeros((1, 2)), self.ends[:-1]))
+        self.layers = {}
+
+    def current(self):
+        """Whether the G-code was not edited since the index was built"""
+        return self.revision == self.gcode.revision and self.nlines == len(self.gcode)
+
+    def layer(self, layer_idx):
+        """LayerIndex of the layer of index layer_idx in all_layers"""
+        index = self.layers.get(layer_idx)
+        if index is None:
+            moves = slice(self.layer_offsets[layer_idx], self.layer_offsets[layer_idx + 1])
+            index = self.layers[layer_idx] = LayerIndex(self.layer_lines[moves], self.starts[moves],
+                                                        self.ends[moves], self.cell_size)
+        return index
+
+    def lines_touching(self, layer_idx, x0, y0, x1, y1):
+        """Indexes in their layer of the lines whose move goes through the
+        rectangle from (x0, y0) to (x1, y1)"""
+        return self.layer(layer_idx).touching(min(x0, x1), min(y0, y1),
+                                              max(x0, x1), max(y0, y1))
+
+    def nearest_line(self, layer_idx, x, y, radius = 1.0):
+        """Index in its layer of the line whose move passes closest to
+        (x, y) and the distance to it, or None if none is within radius"""
+        return self.layer(layer_idx).nearest(x, y, radius)
+
+    def segment(self, layer_idx, line_idx):
+        """Start and end (x, y) of the move of a line, or None if not a move"""
+        moves = slice(self.layer_offsets[layer_idx], self.layer_offsets[layer_idx + 1])
+        found = numpy.flatnonzero(self.layer_lines[moves] == line_idx)
+        if not len(found):
+            return None
+        move = self.layer_offsets[layer_idx] + found[0]
+        return tuple(self.starts[move]), tuple(self.ends[move])
+
+    def ends_in_rectangles(self, rectangles):
+        """Which lines of the G-code are moves ending in one of rectangles
+        (x0, y0, x1, y1 with x0 <= x1 and y0 <= y1), as a boolean array"""
+        inside = numpy.zeros(len(self.ends), dtype = bool)
+        x = self.ends[:, 0]
+        y = self.ends[:, 1]
+        for x0, y0, x1, y1 in rectangles:
+            inside |= (x0 <= x) & (x <= x1) & (y0 <= y) & (y <= y1)
+        excluded = numpy.zeros(self.nlines, dtype = bool)
+        excluded[self.move_lines[inside]] = True
+        return excluded
@@ -19,7 +19,15 @@ import re
 import math
 import datetime
 import logging
+import threading
 from array import array
+from bisect import bisect_right
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .gcoder_estimator import TrapezoidEstimator, limit_commands, stop_commands
 
 gcode_parsed_args = ["x", "y", "e", "f", "z", "i", "j"]
 gcode_parsed_nonargs = ["g", "t", "m", "n"]
@@ -76,6 +84,13 @@ def S(line):
 def P(line):
     return find_specific_code(line, "P")
 
+def dwell_time(line):
+    """Dwell time of a G4 line, in seconds"""
+    milliseconds = P(line)
+    if milliseconds is not None:
+        return milliseconds / 1000.0
+    return S(line) or 0.0
+
 def split(line):
     split_raw = gcode_exp.findall(line.raw.lower())
     if split_raw and split_raw[0][0] == "n":
@@ -90,6 +105,16 @@ def split(line):
     line.is_move = line.command in move_gcodes
     return split_raw
 
+# Moves as printcore sends them (line number and checksum optional) and
+# slicers write them, with the arguments in the usual order: their command
+# and arguments are the ones split() and parse_coordinates() would find
+plain_number = r" *([-+]?[0-9]*\.?[0-9]*) *"
+plain_move_exp = re.compile(r"(?:[Nn][0-9]+ *)?[Gg]([0-3])(?![0-9.]) *"
+                            + "".join(r"(?:[%s%s]%s)?" % (c.upper(), c, plain_number)
+                                      for c in "fxyzefij")
+                            + r"(?:\*[0-9]+)?\Z")
+plain_move_args = ("f", "x", "y", "z", "e", "f", "i", "j")
+
 def parse_coordinates(line, split_raw, imperial = False, force = False):
     # Not a G-line, we don't want to parse its arguments
     if not force and line.command[0] != "G":
@@ -100,23 +125,205 @@ def parse_coordinates(line, split_raw, imperial = False, force = False):
         if code not in gcode_parsed_nonargs and bit[1]:
             setattr(line, code, unit_factor * float(bit[1]))
 
+# Batch parsing scans a whole chunk of lines at once over its bytes. Comments
+# (which must not span lines there) are first replaced by a NUL marker, so
+# that every code letter, comment marker or newline starts a token made of
+# that byte followed by a number. Digits following a newline or a comment are
+# swallowed by the marker token, which is fine as split() skips digits which
+# do not follow a code letter.
+batch_comment_exp = re.compile("\([^\(\)\n]*\)|;.*")
+batch_size = 4096
+# Decimal numbers with at most this many digits are exactly representable as
+# integers and parsed as integer / power of ten, which rounds like float()
+batch_max_digits = 15
+
+if numpy is not None:
+    batch_token_chars = numpy.zeros(256, dtype = bool)
+    batch_token_chars[[ord(c) for c in to_parse + "\n\x00"]] = True
+    batch_args = numpy.array([ord(c) for c in gcode_parsed_args], dtype = numpy.uint8)
+
+def _batch_numbers(buf, starts, lengths, signs, int_digits, frac_digits):
+    """Converts the numbers found by batch_parse to floats"""
+    digits = buf - 48
+    values = numpy.empty(len(starts))
+    ndigits = int_digits + frac_digits
+    fast = (ndigits > 0) & (ndigits <= batch_max_digits)
+    # Gather all digits of the fast path numbers and sum them with their
+    # weights, integer part first then fractional part
+    mantissa = numpy.zeros(len(starts))
+    for offsets, counts in ((starts + signs, int_digits),
+                            (starts + signs + int_digits + 1, frac_digits)):
+        counts = numpy.where(fast, counts, 0)
+        number = numpy.repeat(numpy.arange(len(starts)), counts)
+        first = numpy.cumsum(counts) - counts
+        rank = numpy.arange(len(number)) - first[number]
+        positions = offsets[number] + rank
+        mantissa *= 10.0 ** counts
+        mantissa += numpy.bincount(number, digits[positions] * 10.0 ** (counts[number] - 1 - rank),
+                                   minlength = len(starts))
+    values[fast] = mantissa[fast] / 10.0 ** frac_digits[fast]
+    negative = fast & (buf[starts] == ord("-"))
+    values[negative] = -values[negative]
+    # Long or malformed numbers go through float(), which raises on the
+    # latter just like parse_coordinates does
+    for i in numpy.flatnonzero(~fast).tolist():
+        values[i] = float(bytes(buf[starts[i]:starts[i] + lengths[i]]))
+    return values
+
+def batch_parse(raws, imperial = False, force = False):
+    """Parses a list of stripped, non-empty raw lines in one pass.
+
+    Returns (commands, coordinates, imperial) where commands holds the
+    command of each line as split() would set it, coordinates maps each of
+    gcode_parsed_args to an array of the values parse_coordinates() would
+    set (NaN when unset) and imperial is the G20/G21 state after the last
+    line.  Results are identical to running split() and parse_coordinates()
+    line by line, as _preprocess does."""
+    count = len(raws)
+    if not count:
+        return [], dict((c, numpy.zeros(0)) for c in gcode_parsed_args), imperial
+    text = "\n".join(raws).lower().replace("\x00", " ")
+    text = batch_comment_exp.sub("\x00", text) + "\n"
+    # Pad so that number scanning never reads past the end
+    data = text.encode("utf-8") + b"   "
+    buf = numpy.frombuffer(data, dtype = numpy.uint8)
+
+    tokens = numpy.flatnonzero(batch_token_chars[buf])
+    codes = buf[tokens]
+    is_newline = codes == 10
+    if numpy.count_nonzero(is_newline) != count:
+        raise ValueError("lines passed to batch_parse must not contain newlines")
+    token_line = numpy.cumsum(is_newline) - is_newline
+
+    # Number following each token: [-+]?[0-9]*\.?[0-9]*
+    is_digit = (buf >= 48) & (buf <= 57)
+    next_non_digit = numpy.where(is_digit, len(buf), numpy.arange(len(buf)))
+    next_non_digit = numpy.minimum.accumulate(next_non_digit[::-1])[::-1]
+    starts = tokens + 1
+    signs = ((buf[starts] == ord("-")) | (buf[starts] == ord("+"))).astype(numpy.intp)
+    int_digits = next_non_digit[starts + signs] - (starts + signs)
+    dots = starts + signs + int_digits
+    has_dot = buf[dots] == ord(".")
+    frac_digits = numpy.where(has_dot, next_non_digit[dots + 1] - (dots + 1), 0)
+    lengths = signs + int_digits + has_dot + frac_digits
+
+    # First token of each line, skipping a leading line number
+    words = numpy.flatnonzero(~is_newline)
+    firsts = words[numpy.diff(token_line[words], prepend = -1) != 0]
+    firsts[codes[firsts] == ord("n")] += 1
+    firsts = firsts[~is_newline[firsts]]
+    parsed = numpy.zeros(count, dtype = bool)
+    parsed[token_line[firsts]] = True
+
+    heads = bytes(codes[firsts]).upper().decode()
+    words = [head + data[start:end].decode() if head != "\x00" else ""
+             for head, start, end in zip(heads, starts[firsts].tolist(),
+                                         (starts + lengths)[firsts].tolist())]
+    if len(words) == count:
+        commands = words
+    else:
+        # Lines without any word keep their raw text as command
+        commands = list(raws)
+        for i, word in zip(numpy.flatnonzero(parsed).tolist(), words):
+            commands[i] = word
+        for i in numpy.flatnonzero(~parsed).tolist():
+            logging.warning("raw G-Code line \"%s\" could not be parsed" % raws[i])
+
+    # G20/G21 state in effect on each line
+    modes = numpy.full(count + 1, -1, dtype = numpy.int8)
+    modes[0] = imperial
+    command_array = numpy.array(commands, dtype = object)
+    modes[1:][command_array == "G20"] = 1
+    modes[1:][command_array == "G21"] = 0
+    fill = numpy.where(modes >= 0, numpy.arange(count + 1), 0)
+    modes = modes[numpy.maximum.accumulate(fill)]
+    imperial = bool(modes[-1])
+
+    # Coordinates, for G commands only unless forced
+    is_arg = numpy.isin(codes, batch_args) & (lengths > 0)
+    if not force:
+        is_g = numpy.zeros(count, dtype = bool)
+        is_g[token_line[firsts]] = codes[firsts] == ord("g")
+        is_arg &= is_g[token_line]
+    arg_lines = token_line[is_arg]
+    arg_values = _batch_numbers(buf, starts[is_arg], lengths[is_arg],
+                                signs[is_arg], int_digits[is_arg],
+                                frac_digits[is_arg])
+    arg_values = numpy.where(modes[1:][arg_lines] == 1, 25.4 * arg_values,
+                             arg_values)
+    arg_codes = codes[is_arg]
+    coordinates = {}
+    for code in gcode_parsed_args:
+        column = numpy.full(count, numpy.nan)
+        mask = arg_codes == ord(code)
+        # Repeated codes on a line: the last one wins, as with setattr
+        lines_rev = arg_lines[mask][::-1]
+        kept, kept_idx = numpy.unique(lines_rev, return_index = True)
+        column[kept] = arg_values[mask][::-1][kept_idx]
+        coordinates[code] = column
+    return commands, coordinates, imperial
+
+def batch_split(lines, imperial = False):
+    """Batch counterpart of split() followed by parse_coordinates() with the
+    running G20/G21 state, for a list of Line objects. Returns the imperial
+    state after the last line."""
+    commands, coordinates, imperial = batch_parse([line.raw for line in lines],
+                                                  imperial)
+    for line, command in zip(lines, commands):
+        line.command = command
+        line.is_move = command in move_gcodes
+    for code, column in coordinates.items():
+        idxs = numpy.flatnonzero(~numpy.isnan(column))
+        for idx, value in zip(idxs.tolist(), column[idxs].tolist()):
+            setattr(lines[idx], code, value)
+    return imperial
+
 class Layer(list):
 
     __slots__ = ("duration", "z")
 
     def __init__(self, lines, z = None):
         super(Layer, self).__init__(lines)
+        self.duration = None
         self.z = z
 
+class LayerLines:
+    """Sequence view over the lines of all the layers of a GCode, in print
+    order. The layers are the chunks the lines are stored in, so that
+    editing a layer only touches its own list and the layer offsets."""
+
+    def __init__(self, gcode):
+        self.gcode = gcode
+
+    def __len__(self):
+        return len(self.gcode)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        layer, line = self.gcode.idxs(index)
+        return self.gcode.all_layers[layer][line]
+
+    def __iter__(self):
+        for layer in self.gcode.all_layers:
+            yield from layer
+
 class GCode:
 
     line_class = Line
+    layer_class = Layer
+    # Gives the move durations, see gcoder_estimator
+    estimator = TrapezoidEstimator()
 
     lines = None
     layers = None
     all_layers = None
-    layer_idxs = None
-    line_idxs = None
+    # Index of the first line of each layer of all_layers in print order
+    layer_starts = None
+    # Bumped by the edits of the layers, see prepend_to_layer
+    revision = 0
+    _spatial_index = None
+    _flat_idxs_cache = None
     append_layer = None
     append_layer_id = None
 
@@ -217,7 +424,17 @@ class GCode:
     layers_count = property(_get_layers_count)
 
     def __init__(self, data = None, home_pos = None,
-                 layer_callback = None, deferred = False):
+                 layer_callback = None, deferred = False, estimator = None):
+        if estimator is not None:
+            # Estimates this GCode only, instead of the one of the class
+            self.estimator = estimator
+        # Per instance multi extruder counters, the class level lists would
+        # otherwise be shared (and grown in place) by every GCode
+        self.current_e_multi = [0]
+        self.offset_e_multi = [0]
+        self.total_e_multi = [0]
+        self.max_e_multi = [0]
+        self.filament_length_multi = [0]
         if not deferred:
             self.prepare(data, home_pos, layer_callback)
 
@@ -225,84 +442,67 @@ class GCode:
         self.home_pos = home_pos
         if data:
             line_class = self.line_class
-            self.lines = [line_class(l2) for l2 in
-                          (l.strip() for l in data)
-                          if l2]
-            self._preprocess(build_layers = True,
+            self.lines = LayerLines(self)
+            # Parsed as read, layers being usable as soon as they are built
+            self._preprocess((line_class(l2) for l2 in
+                              (l.strip() for l in data)
+                              if l2),
+                             build_layers = True,
                              layer_callback = layer_callback)
         else:
-            self.lines = []
+            self.lines = LayerLines(self)
             self.append_layer_id = 0
             self.append_layer = Layer([])
             self.all_layers = [self.append_layer]
             self.all_zs = set()
             self.layers = {}
-            self.layer_idxs = array('I', [])
-            self.line_idxs = array('I', [])
+            self.layer_starts = array('I', [0])
 
     def __len__(self):
-        return len(self.line_idxs)
+        # Layers get added to all_layers before their start to layer_starts,
+        # so that while loading in another thread the last start always has
+        # its layer
+        starts = self.layer_starts
+        last = len(starts) - 1
+        if last < 0:
+            return 0
+        return starts[last] + len(self.all_layers[last])
 
     def __iter__(self):
         return self.lines.__iter__()
 
-    def prepend_to_layer(self, commands, layer_idx):
-        # Prepend commands in reverse order
-        commands = [c.strip() for c in commands[::-1] if c.strip()]
-        layer = self.all_layers[layer_idx]
-        # Find start index to append lines
-        # and end index to append new indices
-        start_index = self.layer_idxs.index(layer_idx)
-        for i in range(start_index, len(self.layer_idxs)):
-            if self.layer_idxs[i] != layer_idx:
-                end_index = i
-                break
-        else:
-            end_index = i + 1
-        end_line = self.line_idxs[end_index - 1]
-        for i, command in enumerate(commands):
+    def _injected_lines(self, commands):
+        glines = []
+        for command in commands:
             gline = Line(command)
             # Split to get command
             split(gline)
             # Force is_move to False
             gline.is_move = False
-            # Insert gline at beginning of layer
-            layer.insert(0, gline)
-            # Insert gline at beginning of list
-            self.lines.insert(start_index, gline)
-            # Update indices arrays & global gcodes list
-            self.layer_idxs.insert(end_index + i, layer_idx)
-            self.line_idxs.insert(end_index + i, end_line + i + 1)
-        return commands[::-1]
+            glines.append(gline)
+        return glines
+
+    def _shift_layers(self, layer_idx, count):
+        """Moves the start of the layers after layer_idx by count lines"""
+        starts = self.layer_starts
+        for i in range(layer_idx + 1, len(starts)):
+            starts[i] += count
+        self.revision += 1
+
+    def prepend_to_layer(self, commands, layer_idx):
+        commands = [c.strip() for c in commands if c.strip()]
+        layer = self.all_layers[layer_idx]
+        layer[0:0] = self._injected_lines(commands)
+        self._shift_layers(layer_idx, len(commands))
+        return commands
 
     def rewrite_layer(self, commands, layer_idx):
-        # Prepend commands in reverse order
-        commands = [c.strip() for c in commands[::-1] if c.strip()]
+        commands = [c.strip() for c in commands if c.strip()]
         layer = self.all_layers[layer_idx]
-        # Find start index to append lines
-        # and end index to append new indices
-        start_index = self.layer_idxs.index(layer_idx)
-        for i in range(start_index, len(self.layer_idxs)):
-            if self.layer_idxs[i] != layer_idx:
-                end_index = i
-                break
-        else:
-            end_index = i + 1
-        self.layer_idxs = self.layer_idxs[:start_index] + array('I', len(commands) * [layer_idx]) + self.layer_idxs[end_index:]
-        self.line_idxs = self.line_idxs[:start_index] + array('I', range(len(commands))) + self.line_idxs[end_index:]
-        del self.lines[start_index:end_index]
-        del layer[:]
-        for i, command in enumerate(commands):
-            gline = Line(command)
-            # Split to get command
-            split(gline)
-            # Force is_move to False
-            gline.is_move = False
-            # Insert gline at beginning of layer
-            layer.insert(0, gline)
-            # Insert gline at beginning of list
-            self.lines.insert(start_index, gline)
-        return commands[::-1]
+        count = len(layer)
+        layer[:] = self._injected_lines(commands)
+        self._shift_layers(layer_idx, len(commands) - count)
+        return commands
 
     def append(self, command, store = True):
         command = command.strip()
@@ -311,12 +511,40 @@ class GCode:
         gline = Line(command)
         self._preprocess([gline])
         if store:
-            self.lines.append(gline)
             self.append_layer.append(gline)
-            self.layer_idxs.append(self.append_layer_id)
-            self.line_idxs.append(len(self.append_layer))
         return gline
 
+    def _parse_lines(self, lines):
+        """Yields (line, parsed line) pairs, the parsed line having its
+        command and coordinates set. Big inputs are parsed by batches."""
+        if self.line_class != Line:
+            # Use a heavy copy of the light line to preprocess
+            get_line = lambda l: Line(l.raw)
+        else:
+            get_line = lambda l: l
+        imperial = self.imperial
+        if numpy is not None and (not isinstance(lines, list)
+                                  or len(lines) > batch_size):
+            lines = iter(lines)
+            while True:
+                chunk = [l for _, l in zip(range(batch_size), lines)]
+                if not chunk:
+                    break
+                parsed = [get_line(l) for l in chunk]
+                imperial = batch_split(parsed, imperial)
+                yield from zip(chunk, parsed)
+            return
+        for true_line in lines:
+            line = get_line(true_line)
+            split_raw = split(line)
+            if line.command == "G20":
+                imperial = True
+            elif line.command == "G21":
+                imperial = False
+            if line.command[:1] == "G":
+                parse_coordinates(line, split_raw, imperial)
+            yield true_line, line
+
     def _preprocess(self, lines = None, build_layers = False,
                     layer_callback = None):
         """Checks for imperial/relativeness settings and tool changes"""
@@ -363,28 +591,14 @@ class GCode:
             ymax_e = float("-inf")
 
             # Duration estimation
-            # TODO:
-            # get device caps from firmware: max speed, acceleration/axis
-            # (including extruder)
-            # calculate the maximum move duration accounting for above ;)
-            lastx = lasty = lastz = laste = lastf = 0.0
-            lastdx = 0
-            lastdy = 0
-            x = y = e = f = 0.0
-            currenttravel = 0.0
-            moveduration = 0.0
-            totalduration = 0.0
-            acceleration = 2000.0  # mm/s^2
-            layerbeginduration = 0.0
+            moves = self.estimator.moves(current_x, current_y, current_z, total_e)
+            layer_marks = []
 
             # Initialize layers
             all_layers = self.all_layers = []
             all_zs = self.all_zs = set()
-            layer_idxs = self.layer_idxs = []
-            line_idxs = self.line_idxs = []
-
-            layer_id = 0
-            layer_line = 0
+            layer_starts = self.layer_starts = array('I', [])
+            layer_start = 0
 
             last_layer_z = None
             prev_z = None
@@ -392,15 +606,7 @@ class GCode:
             cur_z = None
             cur_lines = []
 
-        if self.line_class != Line:
-            get_line = lambda l: Line(l.raw)
-        else:
-            get_line = lambda l: l
-        for true_line in lines:
-            # # Parse line
-            # Use a heavy copy of the light line to preprocess
-            line = get_line(true_line)
-            split_raw = split(line)
+        for true_line, line in self._parse_lines(lines):
             if line.command:
                 # Update properties
                 if line.is_move:
@@ -436,10 +642,6 @@ class GCode:
                 total_e_multi = self.total_e_multi[current_tool]
                 max_e_multi = self.max_e_multi[current_tool]
 
-
-                if line.command[0] == "G":
-                    parse_coordinates(line, split_raw, imperial)
-
                 # Compute current position
                 if line.is_move:
                     x = line.x
@@ -532,72 +734,15 @@ class GCode:
                                 ymin = min(ymin, line.current_y)
                                 ymax = max(ymax, line.current_y)
 
-                    # Compute duration
+                    # Collect the moves for the duration estimation
                     if line.command == "G0" or line.command == "G1":
-                        x = line.x if line.x is not None else lastx
-                        y = line.y if line.y is not None else lasty
-                        z = line.z if line.z is not None else lastz
-                        e = line.e if line.e is not None else laste
-                        # mm/s vs mm/m => divide by 60
-                        f = line.f / 60.0 if line.f is not None else lastf
-
-                        # given last feedrate and current feedrate calculate the
-                        # distance needed to achieve current feedrate.
-                        # if travel is longer than req'd distance, then subtract
-                        # distance to achieve full speed, and add the time it took
-                        # to get there.
-                        # then calculate the time taken to complete the remaining
-                        # distance
-
-                        # FIXME: this code has been proven to be super wrong when 2
-                        # subsquent moves are in opposite directions, as requested
-                        # speed is constant but printer has to fully decellerate
-                        # and reaccelerate
-                        # The following code tries to fix it by forcing a full
-                        # reacceleration if this move is in the opposite direction
-                        # of the previous one
-                        dx = x - lastx
-                        dy = y - lasty
-                        if dx * lastdx + dy * lastdy <= 0:
-                            lastf = 0
-
-                        currenttravel = math.hypot(dx, dy)
-                        if currenttravel == 0:
-                            if line.z is not None:
-                                currenttravel = abs(line.z) if line.relative else abs(line.z - lastz)
-                            elif line.e is not None:
-                                currenttravel = abs(line.e) if line.relative_e else abs(line.e - laste)
-                        # Feedrate hasn't changed, no acceleration/decceleration planned
-                        if f == lastf:
-                            moveduration = currenttravel / f if f != 0 else 0.
-                        else:
-                            # FIXME: review this better
-                            # this looks wrong : there's little chance that the feedrate we'll decelerate to is the previous feedrate
-                            # shouldn't we instead look at three consecutive moves ?
-                            distance = 2 * abs(((lastf + f) * (f - lastf) * 0.5) / acceleration)  # multiply by 2 because we have to accelerate and decelerate
-                            if distance <= currenttravel and lastf + f != 0 and f != 0:
-                                moveduration = 2 * distance / (lastf + f)  # This is distance / mean(lastf, f)
-                                moveduration += (currenttravel - distance) / f
-                            else:
-                                moveduration = 2 * currenttravel / (lastf + f)  # This is currenttravel / mean(lastf, f)
-                                # FIXME: probably a little bit optimistic, but probably a much better estimate than the previous one:
-                                # moveduration = math.sqrt(2 * distance / acceleration) # probably buggy : not taking actual travel into account
-
-                        lastdx = dx
-                        lastdy = dy
-
-                        totalduration += moveduration
-
-                        lastx = x
-                        lasty = y
-                        lastz = z
-                        laste = e
-                        lastf = f
-                    elif line.command == "G4":
-                        moveduration = P(line)
-                        if moveduration:
-                            moveduration /= 1000.0
-                            totalduration += moveduration
+                        moves.move(current_x, current_y, current_z, total_e,
+                                   self.current_f)
+                    elif line.command in stop_commands:
+                        moves.stop(current_x, current_y, current_z, total_e,
+                                   dwell_time(line) if line.command == "G4" else 0.0)
+                    elif line.command in limit_commands:
+                        moves.set_limits(line.command, line.raw)
 
                     # FIXME : looks like this needs to be tested with "lift Z on move"
                     if line.z is not None:
@@ -629,16 +774,16 @@ class GCode:
                             base_z = prev_z
 
                         if base_z != prev_base_z:
-                            new_layer = Layer(cur_lines, base_z)
-                            new_layer.duration = totalduration - layerbeginduration
-                            layerbeginduration = totalduration
+                            new_layer = self.layer_class(cur_lines, base_z)
+                            layer_marks.append(len(moves))
+                            # Layer first, see __len__
                             all_layers.append(new_layer)
+                            layer_starts.append(layer_start)
+                            layer_start += len(cur_lines)
                             if cur_layer_has_extrusion and prev_z not in all_zs:
                                 all_zs.add(prev_z)
                             cur_lines = []
                             cur_layer_has_extrusion = False
-                            layer_id += 1
-                            layer_line = 0
                             last_layer_z = base_z
                             if layer_callback is not None:
                                 layer_callback(self, len(all_layers) - 1)
@@ -647,9 +792,6 @@ class GCode:
 
             if build_layers:
                 cur_lines.append(true_line)
-                layer_idxs.append(layer_id)
-                line_idxs.append(layer_line)
-                layer_line += 1
                 prev_z = cur_z
             # ## Loop done
 
@@ -677,10 +819,11 @@ class GCode:
         # Finalize layers
         if build_layers:
             if cur_lines:
-                new_layer = Layer(cur_lines, prev_z)
-                new_layer.duration = totalduration - layerbeginduration
-                layerbeginduration = totalduration
+                new_layer = self.layer_class(cur_lines, prev_z)
+                layer_marks.append(len(moves))
                 all_layers.append(new_layer)
+                layer_starts.append(layer_start)
+                layer_start += len(cur_lines)
                 if cur_layer_has_extrusion and prev_z not in all_zs:
                     all_zs.add(prev_z)
 
@@ -688,8 +831,7 @@ class GCode:
             self.append_layer = Layer([])
             self.append_layer.duration = 0
             all_layers.append(self.append_layer)
-            self.layer_idxs = array('I', layer_idxs)
-            self.line_idxs = array('I', line_idxs)
+            layer_starts.append(layer_start)
 
             # Compute bounding box
             all_zs = self.all_zs.union({zmin}).difference({None})
@@ -720,11 +862,55 @@ class GCode:
             self.height = self.zmax - self.zmin
 
             # Finalize duration
+            durations, totalduration = self.estimator.estimate(moves, layer_marks)
+            for layer, duration in zip(all_layers, durations):
+                layer.duration = duration
             totaltime = datetime.timedelta(seconds = int(totalduration))
             self.duration = totaltime
 
+    def spatial_index(self):
+        """Index of the moves of each layer (gcodeindex.GCodeIndex), built
+        on first use and again after edits"""
+        from .gcodeindex import GCodeIndex
+        index = self._spatial_index
+        if index is None or not index.current():
+            index = self._spatial_index = GCodeIndex(self)
+        return index
+
     def idxs(self, i):
-        return self.layer_idxs[i], self.line_idxs[i]
+        """Layer of line i in print order and its index in the layer"""
+        if i < 0:
+            i += len(self)
+        starts = self.layer_starts
+        layer = bisect_right(starts, i) - 1
+        line = i - starts[layer]
+        # Past the end, line is beyond the end of the last layer
+        if layer < 0 or line >= len(self.all_layers[layer]):
+            raise IndexError("line index out of range")
+        return layer, line
+
+    def _flat_idxs(self):
+        """layer_idxs and line_idxs, built from the layer offsets once per
+        revision and length of the G-code"""
+        key = (self.revision, len(self))
+        if self._flat_idxs_cache is None or self._flat_idxs_cache[0] != key:
+            layer_idxs = array('I')
+            line_idxs = array('I')
+            for layer_idx, layer in enumerate(self.all_layers):
+                layer_idxs.extend(array('I', [layer_idx]) * len(layer))
+                line_idxs.extend(range(len(layer)))
+            self._flat_idxs_cache = (key, layer_idxs, line_idxs)
+        return self._flat_idxs_cache[1:]
+
+    def _get_layer_idxs(self):
+        return self._flat_idxs()[0]
+    # Layer of each line in print order
+    layer_idxs = property(_get_layer_idxs)
+
+    def _get_line_idxs(self):
+        return self._flat_idxs()[1]
+    # Index of each line in its layer, in print order
+    line_idxs = property(_get_line_idxs)
 
     def estimate_duration(self):
         return self.layers_count, self.duration
@@ -732,6 +918,217 @@ class GCode:
 class LightGCode(GCode):
     line_class = LightLine
 
+class Analyzer:
+    """Follows the state of GCode._preprocess (modes, tool, position,
+    offsets and extrusion) over commands given one at a time, such as the
+    ones sent to a printer, without storing them nor building layers.
+
+    GCode.append runs the whole _preprocess for each line, loading all of
+    its state from the GCode and storing it back. The state lives in the
+    slots of the analyzer instead and is only updated by what each command
+    changes, and plain moves are parsed with a single match of
+    plain_move_exp instead of split() and parse_coordinates()."""
+
+    __slots__ = ("imperial", "relative", "relative_e", "current_tool",
+                 "home_x", "home_y", "home_z",
+                 "current_x", "current_y", "current_z", "current_f",
+                 "offset_x", "offset_y", "offset_z",
+                 "current_e", "offset_e", "total_e", "max_e",
+                 "current_e_multi", "offset_e_multi", "total_e_multi",
+                 "max_e_multi")
+
+    abs_x = GCode.abs_x
+    abs_y = GCode.abs_y
+    abs_z = GCode.abs_z
+    abs_e = GCode.abs_e
+    abs_pos = GCode.abs_pos
+    current_pos = GCode.current_pos
+    home_pos = GCode.home_pos
+
+    def __init__(self, home_pos = None):
+        self.imperial = False
+        self.relative = False
+        self.relative_e = False
+        self.current_tool = 0
+        self.home_x = self.home_y = self.home_z = 0
+        self.current_x = self.current_y = self.current_z = 0
+        self.current_f = 0
+        self.offset_x = self.offset_y = self.offset_z = 0
+        self.current_e = self.offset_e = self.total_e = self.max_e = 0
+        self.current_e_multi = [0]
+        self.offset_e_multi = [0]
+        self.total_e_multi = [0]
+        self.max_e_multi = [0]
+        self.home_pos = home_pos
+
+    def append(self, command):
+        """Analyze command, returns its Line like GCode.append does"""
+        command = command.strip()
+        if not command:
+            return None
+        line = Line(command)
+        match = plain_move_exp.match(command)
+        if match is not None:
+            code = line.command = "G" + match.group(1)
+            line.is_move = True
+            factor = 25.4 if self.imperial else 1
+            for arg, number in zip(plain_move_args, match.groups()[1:]):
+                if number:
+                    setattr(line, arg, factor * float(number))
+        else:
+            split_raw = split(line)
+            code = line.command
+            if not code:
+                return line
+            if code[0] == "G":
+                if code == "G20":
+                    self.imperial = True
+                elif code == "G21":
+                    self.imperial = False
+                parse_coordinates(line, split_raw, self.imperial)
+        tool = self.current_tool
+
+        if line.is_move:
+            relative = self.relative
+            line.relative = relative
+            line.relative_e = self.relative_e
+            line.current_tool = tool
+            if line.f is not None:
+                self.current_f = line.f
+            x = line.x
+            y = line.y
+            z = line.z
+            if relative:
+                self.current_x += x or 0
+                self.current_y += y or 0
+                self.current_z += z or 0
+            else:
+                if x is not None: self.current_x = x + self.offset_x
+                if y is not None: self.current_y = y + self.offset_y
+                if z is not None: self.current_z = z + self.offset_z
+        elif code == "G28":
+            home_all = not any([line.x, line.y, line.z])
+            if home_all or line.x is not None:
+                self.offset_x = 0
+                self.current_x = self.home_x
+            if home_all or line.y is not None:
+                self.offset_y = 0
+                self.current_y = self.home_y
+            if home_all or line.z is not None:
+                self.offset_z = 0
+                self.current_z = self.home_z
+        elif code == "G92":
+            if line.x is not None: self.offset_x = self.current_x - line.x
+            if line.y is not None: self.offset_y = self.current_y - line.y
+            if line.z is not None: self.offset_z = self.current_z - line.z
+        elif code == "G90":
+            self.relative = self.relative_e = False
+        elif code == "G91":
+            self.relative = self.relative_e = True
+        elif code == "M82":
+            self.relative_e = False
+        elif code == "M83":
+            self.relative_e = True
+        elif code[0] == "T":
+            try:
+                tool = self.current_tool = int(code[1:])
+            except ValueError:
+                pass  # handle T? by treating it as no tool change
+            while tool + 1 > len(self.current_e_multi):
+                self.current_e_multi.append(0)
+                self.offset_e_multi.append(0)
+                self.total_e_multi.append(0)
+                self.max_e_multi.append(0)
+
+        line.current_x = self.current_x
+        line.current_y = self.current_y
+        line.current_z = self.current_z
+
+        e = line.e
+        if e is not None:
+            if line.is_move:
+                if line.relative_e:
+                    line.extruding = e > 0
+                    self.total_e += e
+                    self.current_e += e
+                    self.total_e_multi[tool] += e
+                    self.current_e_multi[tool] += e
+                else:
+                    new_e = e + self.offset_e
+                    line.extruding = new_e > self.current_e
+                    self.total_e += new_e - self.current_e
+                    self.current_e = new_e
+                    new_e_multi = e + self.offset_e_multi[tool]
+                    self.total_e_multi[tool] += new_e_multi - self.current_e_multi[tool]
+                    self.current_e_multi[tool] = new_e_multi
+                self.max_e = max(self.max_e, self.total_e)
+                self.max_e_multi[tool] = max(self.max_e_multi[tool],
+                                             self.total_e_multi[tool])
+            elif code == "G92":
+                self.offset_e = self.current_e - e
+                self.offset_e_multi[tool] = self.current_e_multi[tool] - e
+        return line
+
+class ProgressiveLoad:
+    """Makes a GCode being prepared in another thread printable as its
+    layers get parsed.
+
+    Until finish() gets called, the gcode has a wait_for_line() method like
+    the streamed sources of gcoder_stream, so that printcore prints the lines
+    parsed so far and waits for the parser when it catches up with it.
+    layer_callback must be given to prepare() (or the cache) as its layer
+    callback: it calls the one given here, then ready_callback once the
+    first ready_layers layers are parsed."""
+
+    def __init__(self, gcode, layer_callback = None, ready_layers = 2,
+                 ready_callback = None):
+        self.gcode = gcode
+        self.parsed = 0
+        self.ready = False
+        self.done = False
+        self.error = None
+        self.ready_layers = ready_layers
+        self.ready_callback = ready_callback
+        self._layer_callback = layer_callback
+        self._cond = threading.Condition()
+        gcode.wait_for_line = self.wait_for_line
+
+    def layer_callback(self, gcode, layer):
+        if self._layer_callback is not None:
+            self._layer_callback(gcode, layer)
+        with self._cond:
+            self.parsed = gcode.layer_starts[layer] + len(gcode.all_layers[layer])
+            self._cond.notify_all()
+        if not self.ready and layer + 1 >= self.ready_layers:
+            self.ready = True
+            if self.ready_callback is not None:
+                self.ready_callback()
+
+    def finish(self, error = None):
+        """Ends the load, error being the exception which stopped it if it
+        failed. The lines of the gcode are then all available, a print
+        reaching the end of a failed load stops there as for a pause."""
+        with self._cond:
+            if self.done:
+                return
+            if error is not None:
+                self.error = self.gcode.error = error
+            self.done = True
+            self._cond.notify_all()
+        try:
+            del self.gcode.wait_for_line
+        except AttributeError:
+            pass
+
+    def wait_for_line(self, i):
+        """Wait until line i is parsed, returns False if there is none"""
+        with self._cond:
+            while i >= self.parsed and not self.done:
+                self._cond.wait()
+            if not self.done:
+                return True
+        return i < len(self.gcode)
+
 def main():
     if len(sys.argv) < 2:
         print("usage: %s filename.gcode" % sys.argv[0])
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Columnar, NumPy backed storage for GCode.
+
+Instead of keeping one Line object per G-code line alive for the whole file,
+ColumnarGCode packs each finished layer into a structured NumPy array plus a
+byte buffer holding the raw text.  Lines are handed out as lightweight views
+exposing the same attributes as gcoder.Line, so printcore, gviz and the 3D
+viewer can use a ColumnarGCode wherever they use a GCode.
+"""
+
+import sys
+import time
+import numpy
+from array import array
+from operator import attrgetter
+
+from . import gcoder
+from .gcoder import GCode, Layer, Line
+
+# Status bits, laid out like the ones of gcoder_line.GLine
+pos_is_move = 1 << 0
+pos_relative = 1 << 1
+pos_relative_e = 1 << 2
+pos_extruding = 1 << 3
+pos_current_tool = 1 << 4
+pos_gcview_end_vertex = 1 << 5
+
+float_fields = ("x", "y", "z", "e", "f", "i", "j",
+                "current_x", "current_y", "current_z")
+
+# Unparsable lines get their whole raw text as command: rather than interning
+# it, store this code and read the command back from the raw buffer
+command_is_raw = 0xFFFF
+
+# Coordinates are kept in double precision so that lines read back the
+# values Line would hold
+line_dtype = numpy.dtype([("command", numpy.uint16)] +
+                         [(name, numpy.float64) for name in float_fields] +
+                         [("status", numpy.uint8),
+                          ("current_tool", numpy.uint32),
+                          ("gcview_end_vertex", numpy.uint32)])
+
+def _column(lines, name, dtype = numpy.float64):
+    """Attribute name of all lines as an array, None becoming NaN or False"""
+    return numpy.array(list(map(attrgetter(name), lines)), dtype = dtype)
+
+def _checked(values, dtype, name):
+    """values, raising OverflowError if they do not fit in dtype"""
+    if len(values) and (values.min() < 0 or values.max() > numpy.iinfo(dtype).max):
+        raise OverflowError("%s out of range for %s" % (name, numpy.dtype(dtype).name))
+    return values
+
+def remap_commands(codes, commands, names, table):
+    """Translate command codes indexing commands into codes indexing the
+    shared names list, table mapping names to their code"""
+    lut = numpy.empty(len(commands) + 1, dtype = numpy.uint16)
+    for i, command in enumerate(commands):
+        code = table.get(command)
+        if code is None:
+            code = table[command] = len(names)
+            names.append(command)
+        if code >= command_is_raw:
+            raise OverflowError("too many distinct commands")
+        lut[i] = code
+    lut[-1] = command_is_raw
+    return lut[numpy.where(codes == command_is_raw, len(commands), codes)]
+
+def _float_getter(name):
+    def getter(self):
+        value = self.layer.data[name][self.index]
+        if value != value:  # NaN encodes None
+            return None
+        return value.item()
+    return property(getter)
+
+def _status_getter(pos):
+    def getter(self):
+        return bool(self.layer.data["status"][self.index] & pos)
+    return property(getter)
+
+class ColumnarLine:
+    """Lazy view on a line stored in a ColumnarLayer"""
+
+    __slots__ = ("layer", "index")
+
+    def __init__(self, layer, index):
+        self.layer = layer
+        self.index = index
+
+    x = _float_getter("x")
+    y = _float_getter("y")
+    z = _float_getter("z")
+    e = _float_getter("e")
+    f = _float_getter("f")
+    i = _float_getter("i")
+    j = _float_getter("j")
+    current_x = _float_getter("current_x")
+    current_y = _float_getter("current_y")
+    current_z = _float_getter("current_z")
+    is_move = _status_getter(pos_is_move)
+    relative = _status_getter(pos_relative)
+    relative_e = _status_getter(pos_relative_e)
+    extruding = _status_getter(pos_extruding)
+
+    @property
+    def raw(self):
+        return self.layer.raw_line(self.index)
+
+    @property
+    def command(self):
+        code = self.layer.data["command"][self.index]
+        if code == command_is_raw:
+            return self.raw
+        return self.layer.commands[code]
+
+    @property
+    def current_tool(self):
+        row = self.layer.data[self.index]
+        if row["status"] & pos_current_tool:
+            return int(row["current_tool"])
+        return None
+
+    def _get_gcview_end_vertex(self):
+        row = self.layer.data[self.index]
+        if row["status"] & pos_gcview_end_vertex:
+            return int(row["gcview_end_vertex"])
+        return None
+
+    def _set_gcview_end_vertex(self, value):
+        data = self.layer.data
+        data["gcview_end_vertex"][self.index] = value
+        data["status"][self.index] |= pos_gcview_end_vertex
+    gcview_end_vertex = property(_get_gcview_end_vertex,
+                                 _set_gcview_end_vertex)
+
+    def __eq__(self, other):
+        return (isinstance(other, ColumnarLine)
+                and other.layer is self.layer and other.index == self.index)
+
+    def __hash__(self):
+        return hash((id(self.layer), self.index))
+
+    def __repr__(self):
+        return "<ColumnarLine %r>" % self.raw
+
+class ColumnarLayer:
+    """Layer of lines packed into a structured array and a raw text buffer.
+
+    Built from the list of parsed Line objects gathered by
+    GCode._preprocess, which are released once packed."""
+
+    __slots__ = ("data", "raw", "offsets", "commands", "duration", "z")
+
+    def __init__(self, lines, z = None):
+        self.z = z
+        self.duration = None
+        count = len(lines)
+        data = self.data = numpy.zeros(count, dtype = line_dtype)
+        for name in float_fields:
+            data[name] = _column(lines, name)
+        commands = self.commands = []
+        codes = {}
+        command_codes = array('H')
+        raws = list(map(attrgetter("raw"), lines))
+        for command, raw in zip(map(attrgetter("command"), lines), raws):
+            if len(command) > 8 and command == raw:
+                command_codes.append(command_is_raw)
+            else:
+                code = codes.get(command)
+                if code is None:
+                    code = codes[command] = len(commands)
+                    if code >= command_is_raw:
+                        raise OverflowError("too many distinct commands in layer")
+                    commands.append(command)
+                command_codes.append(code)
+        if count:
+            data["command"] = command_codes
+            status = data["status"]
+            for name, pos in (("is_move", pos_is_move),
+                              ("relative", pos_relative),
+                              ("relative_e", pos_relative_e),
+                              ("extruding", pos_extruding)):
+                status[_column(lines, name, bool)] |= pos
+            tools = _column(lines, "current_tool")
+            has_tool = ~numpy.isnan(tools)
+            status[has_tool] |= pos_current_tool
+            data["current_tool"][has_tool] = _checked(tools[has_tool], numpy.uint32,
+                                                      "tool number")
+            vertices = _column(lines, "gcview_end_vertex")
+            has_vertex = ~numpy.isnan(vertices)
+            status[has_vertex] |= pos_gcview_end_vertex
+            data["gcview_end_vertex"][has_vertex] = _checked(vertices[has_vertex], numpy.uint32,
+                                                             "gcview_end_vertex")
+        raw = self.raw = "".join(raws).encode("utf-8")
+        offsets = numpy.zeros(count + 1, dtype = numpy.uint64)
+        if len(raw) == sum(map(len, raws)):
+            # Plain ASCII, characters are bytes
+            lengths = map(len, raws)
+        else:
+            lengths = (len(r.encode("utf-8")) for r in raws)
+        numpy.cumsum(numpy.fromiter(lengths, dtype = numpy.uint64, count = count),
+                     out = offsets[1:])
+        self.offsets = offsets
+
+    @classmethod
+    def from_rows(cls, data, raw, offsets, commands, z = None):
+        """Build a layer from already packed rows. offsets index into raw,
+        which may be a buffer shared by several layers."""
+        layer = cls.__new__(cls)
+        layer.data = data
+        layer.raw = raw
+        layer.offsets = offsets
+        layer.commands = commands
+        layer.duration = None
+        layer.z = z
+        return layer
+
+    def raw_line(self, index):
+        return self.raw[self.offsets[index]:self.offsets[index + 1]].decode("utf-8")
+
+    def materialize(self):
+        """Return a regular Layer holding real Line objects"""
+        lines = []
+        for view in self:
+            line = Line(view.raw)
+            for name in float_fields:
+                value = getattr(view, name)
+                if value is not None:
+                    setattr(line, name, value)
+            line.command = view.command
+            line.is_move = view.is_move
+            if view.is_move:
+                line.relative = view.relative
+                line.relative_e = view.relative_e
+                line.current_tool = view.current_tool
+            line.extruding = view.extruding
+            lines.append(line)
+        layer = Layer(lines, self.z)
+        layer.duration = self.duration
+        return layer
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [ColumnarLine(self, i)
+                    for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("layer index out of range")
+        return ColumnarLine(self, index)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield ColumnarLine(self, i)
+
+    @property
+    def nbytes(self):
+        # The raw buffer may be shared with other layers, count our part only
+        raw = int(self.offsets[-1] - self.offsets[0]) if len(self.offsets) else 0
+        return self.data.nbytes + raw + self.offsets.nbytes
+
+class ColumnarGCode(GCode):
+    """GCode whose lines live in per-layer NumPy arrays.
+
+    Memory use is about a hundred bytes per line plus the raw text, instead of a
+    full Line object per line. Only the lines of the layer currently being
+    parsed exist as Line objects."""
+
+    line_class = Line
+    layer_class = ColumnarLayer
+
+    def _materialize_layer(self, layer_idx):
+        layer = self.all_layers[layer_idx]
+        if isinstance(layer, ColumnarLayer):
+            layer = self.all_layers[layer_idx] = layer.materialize()
+        return layer
+
+    def prepend_to_layer(self, commands, layer_idx):
+        self._materialize_layer(layer_idx)
+        return super(ColumnarGCode, self).prepend_to_layer(commands, layer_idx)
+
+    def rewrite_layer(self, commands, layer_idx):
+        self._materialize_layer(layer_idx)
+        return super(ColumnarGCode, self).rewrite_layer(commands, layer_idx)
+
+    @property
+    def nbytes(self):
+        """Memory held by the packed layers and the layer offsets"""
+        total = self.layer_starts.itemsize * len(self.layer_starts)
+        for layer in self.all_layers:
+            if isinstance(layer, ColumnarLayer):
+                total += layer.nbytes
+        return total
+
+def main():
+    if len(sys.argv) < 2:
+        print("usage: %s filename.gcode" % sys.argv[0])
+        return
+
+    for gcode_class in (gcoder.GCode, gcoder.LightGCode, ColumnarGCode):
+        start = time.time()
+        gcode = gcode_class(open(sys.argv[1]))
+        print("%s: %d lines, %d layers loaded in %.02fs" %
+              (gcode_class.__name__, len(gcode), gcode.layers_count,
+               time.time() - start))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,558 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Print duration estimation.
+
+GCode._preprocess collects the moves of the file and hands them to the
+estimator of the GCode (GCode.estimator, or the one given when creating it),
+which gives the duration of each of them.  TrapezoidEstimator plans the moves like a firmware does: each
+move accelerates, cruises and decelerates, its speed being capped by its
+feedrate and the per axis maximum feedrates, and its acceleration by the per
+axis maximum accelerations.  The speed at the junction of two moves is
+limited by the junction deviation (or the classic jerk) and by the lookahead:
+the firmware only plans the moves of its buffer and must be able to stop at
+the end of it.  The firmware commands setting these limits (M201, M203, M204,
+M205) are followed along the file.
+
+The backward (deceleration) and forward (acceleration) passes of the planner
+are recurrences taking the minimum of the junction limit and of the speed
+reachable from the next or previous junction.  On squared speeds these are
+cumulative minimums over prefix sums of 2 * acceleration * length, or sliding
+window minimums for a bounded lookahead, which NumPy computes over blocks of
+moves at once.  The moves are handed to the planner by blocks as they are
+collected: only the moves within the lookahead of the last block wait for
+the next one, the squared speed at their first junction being carried over.
+A pure Python planner computing the same is used without NumPy.
+"""
+
+import abc
+import math
+import re
+from array import array
+from collections import deque
+from itertools import accumulate
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Firmware commands setting the machine limits
+limit_commands = frozenset(("M201", "M203", "M204", "M205"))
+# Commands emptying the planner buffer of the firmware, stopping the motion
+stop_commands = frozenset(("G4", "G28", "M400", "M109", "M190"))
+
+limit_comment_exp = re.compile(r"\([^\(\)]*\)|;.*")
+limit_arg_exp = re.compile(r"([A-Za-z])\s*([-+]?[0-9]*\.?[0-9]+)")
+limit_command_exp = re.compile(r"(M20[1345])(?![\d.])([^M]*)")
+
+axes = "XYZE"
+
+# Squared speed above which a junction does not limit the speed
+unlimited = float("inf")
+
+# Moves planned at once by the NumPy planner
+block_moves = 8192
+
+class MachineLimits:
+    """Motion limits of a printer, in mm, s and mm/s, defaulting to the ones
+    of Marlin.  A None junction_deviation selects the classic jerk."""
+
+    def __init__(self, max_feedrate = (300.0, 300.0, 5.0, 25.0),
+                 max_acceleration = (3000.0, 3000.0, 100.0, 10000.0),
+                 acceleration = 3000.0, retract_acceleration = 3000.0,
+                 travel_acceleration = 3000.0, jerk = (10.0, 10.0, 0.3, 5.0),
+                 junction_deviation = 0.013, default_feedrate = 25.0,
+                 lookahead = 16):
+        self.max_feedrate = tuple(float(v) for v in max_feedrate)
+        self.max_acceleration = tuple(float(v) for v in max_acceleration)
+        self.acceleration = float(acceleration)
+        self.retract_acceleration = float(retract_acceleration)
+        self.travel_acceleration = float(travel_acceleration)
+        self.jerk = tuple(float(v) for v in jerk)
+        self.junction_deviation = junction_deviation
+        # Feedrate of the moves before the first F
+        self.default_feedrate = float(default_feedrate)
+        # Planner buffer size in moves, None to plan the whole file at once
+        self.lookahead = lookahead
+
+    def key(self):
+        return (self.max_feedrate, self.max_acceleration, self.acceleration,
+                self.retract_acceleration, self.travel_acceleration,
+                self.jerk, self.junction_deviation, self.default_feedrate,
+                self.lookahead)
+
+    def __repr__(self):
+        return "MachineLimits%r" % (self.key(),)
+
+    def apply(self, command, raw):
+        """Copy of the limits updated by a M201, M203, M204 or M205 line"""
+        text = limit_comment_exp.sub("", raw)
+        start = text.upper().find(command)
+        if start < 0:
+            return self
+        args = dict((letter.upper(), float(value)) for letter, value
+                    in limit_arg_exp.findall(text[start + len(command):]))
+        limits = MachineLimits(*self.key())
+        def per_axis(values):
+            return tuple(args.get(axis, value) for axis, value in zip(axes, values))
+        if command == "M201":
+            limits.max_acceleration = per_axis(self.max_acceleration)
+        elif command == "M203":
+            limits.max_feedrate = per_axis(self.max_feedrate)
+        elif command == "M204":
+            # Like Marlin, S sets both the printing and travel accelerations
+            if "S" in args:
+                limits.acceleration = limits.travel_acceleration = args["S"]
+            limits.acceleration = args.get("P", limits.acceleration)
+            limits.retract_acceleration = args.get("R", limits.retract_acceleration)
+            limits.travel_acceleration = args.get("T", limits.travel_acceleration)
+        elif command == "M205":
+            limits.jerk = per_axis(self.jerk)
+            if "J" in args:
+                limits.junction_deviation = args["J"]
+            elif "X" in args or "Y" in args:
+                # Only classic jerk firmwares take XY jerks
+                limits.junction_deviation = None
+        return limits
+
+    @classmethod
+    def from_commands(cls, text, limits = None):
+        """Limits set by the firmware commands found in text, such as
+        "M204 S1500 M205 J0.02", on top of limits or the defaults"""
+        if limits is None:
+            limits = cls()
+        for match in limit_command_exp.finditer(text.upper()):
+            limits = limits.apply(match.group(1), match.group(0))
+        return limits
+
+class Moves:
+    """Moves of a print along with the stops (dwells, homing, waits) emptying
+    the planner of the firmware, in file order.
+
+    Each entry holds the machine position reached, E being the total
+    extruded length, then the feedrate in mm/s of a move or the dwell time
+    in seconds of a stop.  Stops and limit changes being rare, their entry
+    indices are kept aside.  With a planner, the entries are handed to it by
+    blocks and dropped, data and stops only holding the ones collected
+    since."""
+
+    def __init__(self, limits, x = 0, y = 0, z = 0, e = 0):
+        self.start = (x, y, z, e)
+        self.data = array('d')
+        self.stops = array('I')
+        self.limits = [limits]
+        self.limit_id = 0
+        self.limit_changes = [(0, 0)]
+        self._limit_ids = {limits.key(): 0}
+        self.planner = None
+        # Entries handed to the planner
+        self.planned = 0
+
+    def __len__(self):
+        return self.planned + len(self.data) // 5
+
+    def move(self, x, y, z, e, f):
+        """Move to x, y, z, e at f mm/min"""
+        self.data.extend((x, y, z, e, f / 60.0))
+        if self.planner is not None and len(self.data) >= 5 * block_moves:
+            self.flush()
+
+    def stop(self, x, y, z, e, dwell = 0.0):
+        """Stop, then dwell seconds, the position becoming x, y, z, e"""
+        self.stops.append(len(self))
+        self.data.extend((x, y, z, e, dwell))
+
+    def extend(self, x, y, z, e, f, dwell, stop):
+        """Append moves and stops from NumPy arrays, like move() and stop()
+        would one at a time"""
+        base = len(self)
+        self.stops.extend((base + numpy.flatnonzero(stop)).tolist())
+        entries = numpy.stack([x, y, z, e, numpy.where(stop, dwell, f / 60.0)],
+                              axis = 1).astype(numpy.float64)
+        self.data.frombytes(entries.tobytes())
+        if self.planner is not None and len(self.data) >= 5 * block_moves:
+            self.flush()
+
+    def flush(self):
+        """Hand the entries collected to the planner"""
+        self.planner.plan(self.data, self.stops, self.planned)
+        self.planned = len(self)
+        self.data = array('d')
+        self.stops = array('I')
+
+    def set_limits(self, command, raw):
+        """Follow a firmware command setting the machine limits"""
+        limits = self.limits[self.limit_id].apply(command, raw)
+        key = limits.key()
+        if key not in self._limit_ids:
+            self._limit_ids[key] = len(self.limits)
+            self.limits.append(limits)
+        self.limit_id = self._limit_ids[key]
+        self.limit_changes.append((len(self), self.limit_id))
+
+class Estimator(metaclass = abc.ABCMeta):
+    """Base class of the duration estimators"""
+
+    def __init__(self, limits = None):
+        self.limits = limits if limits is not None else MachineLimits()
+
+    def key(self):
+        """Identifies the estimates, for caching"""
+        return "%s %r" % (type(self).__name__, self.limits.key())
+
+    def moves(self, x = 0, y = 0, z = 0, e = 0):
+        return Moves(self.limits, x, y, z, e)
+
+    @abc.abstractmethod
+    def durations(self, moves):
+        """Duration of each move and stop, in seconds"""
+
+    def estimate(self, moves, marks):
+        """Durations between the consecutive marks (counts of moves and
+        stops) and total duration"""
+        durations = self.durations(moves)
+        if numpy is not None:
+            totals = numpy.concatenate(([0.0], numpy.cumsum(durations)))
+            ends = totals[numpy.array(marks, dtype = numpy.int64)].tolist()
+            total = totals[-1].item()
+        else:
+            totals = [0.0] + list(accumulate(durations))
+            ends = [totals[mark] for mark in marks]
+            total = totals[-1]
+        return [end - begin for begin, end in zip([0.0] + ends, ends)], total
+
+def _window_min(values, width):
+    """Minimum of values[i:i + width] for each i"""
+    result = values.copy()
+    span = 1
+    while span * 2 <= width and span < len(values):
+        result[:-span] = numpy.minimum(result[:-span], result[span:])
+        span *= 2
+    if span < width and span < len(values):
+        shift = min(width - span, len(values) - 1)
+        result[:-shift] = numpy.minimum(result[:-shift], result[shift:])
+    return result
+
+class BlockPlanner:
+    """NumPy planner of TrapezoidEstimator, planning the moves block by
+    block.
+
+    Between blocks it keeps the position, whether the motion stopped since
+    the last move planned and the axis speed ratios, direction and nominal
+    speed of that move, which give the junction speed of the next one.  The
+    moves within the lookahead of the end of the block (all of them without
+    lookahead) wait in pending for the next blocks to know the junctions
+    they may have to slow down for, squared_entry being the squared speed at
+    the start of the first of them."""
+
+    def __init__(self, moves):
+        self.moves = moves
+        self.lookahead = moves.limits[0].lookahead
+        self.position = numpy.array(moves.start, dtype = numpy.float64)
+        self.stopped = True
+        self.previous = None
+        self.squared_entry = 0.0
+        # Entry rows, nominal speeds, accelerations, lengths and squared
+        # junction speed limits of the moves waiting for the lookahead
+        self.pending = []
+        self.pending_count = 0
+        self.durations = numpy.zeros(0)
+        self.count = 0
+
+    def plan(self, data, stops, first):
+        """Plan entries data (see Moves), first being the index of the
+        first one and stops the indices of the stops among them"""
+        count = len(data) // 5
+        if not count:
+            return
+        entries = numpy.frombuffer(data, dtype = numpy.float64).reshape(count, 5)
+        stop = numpy.zeros(count, dtype = bool)
+        stop[numpy.frombuffer(stops, dtype = numpy.uint32) - first] = True
+        if first + count > len(self.durations):
+            durations = numpy.zeros(max(first + count, 2 * len(self.durations)))
+            durations[:self.count] = self.durations[:self.count]
+            self.durations = durations
+        for start in range(0, count, block_moves):
+            end = min(start + block_moves, count)
+            self._plan_block(entries[start:end], stop[start:end], first + start)
+        self.count = first + count
+
+    def finish(self):
+        """Duration of each entry planned"""
+        if self.pending_count:
+            self._plan_pending(self.pending_count, True)
+        return self.durations[:self.count]
+
+    def _plan_block(self, entries, stop, first):
+        durations = self.durations[first:first + len(entries)]
+        delta = numpy.diff(entries[:, :4], axis = 0, prepend = self.position[None, :])
+        self.position = entries[-1, :4].copy()
+        feed = entries[:, 4]
+        durations[stop] = feed[stop]
+
+        xyz = numpy.sqrt((delta[:, :3] ** 2).sum(axis = 1))
+        length = numpy.where(xyz > 0, xyz, numpy.abs(delta[:, 3]))
+        rows = numpy.flatnonzero(~stop & (length > 0))
+        if not len(rows):
+            self.stopped = self.stopped or bool(stop.any())
+            return
+        # Moves right after a stop start from rest
+        stops = numpy.cumsum(stop)
+        from_rest = numpy.concatenate(([self.stopped or stops[rows[0]] > 0],
+                                       stops[rows[1:]] != stops[rows[:-1]]))
+        self.stopped = bool(stops[-1] > stops[rows[-1]])
+        delta = delta[rows]
+        length = length[rows]
+        xyz = xyz[rows]
+        feed = feed[rows]
+        rows = rows + first
+
+        limits = self.moves.limits
+        starts, ids = zip(*self.moves.limit_changes)
+        lim = numpy.array(ids)[numpy.searchsorted(starts, rows, side = "right") - 1]
+        table = lambda name: numpy.array([getattr(l, name) for l in limits],
+                                         dtype = numpy.float64)[lim]
+        max_feedrate = table("max_feedrate")
+        max_acceleration = table("max_acceleration")
+        jerk = table("jerk")
+        junction_deviation = numpy.array([l.junction_deviation if l.junction_deviation is not None
+                                          else numpy.nan for l in limits])[lim]
+
+        with numpy.errstate(divide = "ignore", invalid = "ignore"):
+            # Speed of each axis at unit speed along the move
+            ratio = delta / length[:, None]
+            scale = numpy.abs(ratio)
+            feed = numpy.where(feed > 0, feed, table("default_feedrate"))
+            nominal = numpy.minimum(feed, (max_feedrate / scale).min(axis = 1))
+            base = numpy.where(xyz == 0, table("retract_acceleration"),
+                               numpy.where(delta[:, 3] > 0, table("acceleration"),
+                                           table("travel_acceleration")))
+            accel = numpy.minimum(base, (max_acceleration / scale).min(axis = 1))
+
+            # Squared speed limit at the start of each move, from the
+            # previous move planned
+            unit = delta / numpy.sqrt((delta ** 2).sum(axis = 1))[:, None]
+            if self.previous is None:
+                self.previous = (numpy.zeros(4), numpy.zeros(4), 0.0)
+            previous_ratio, previous_unit, previous_nominal = self.previous
+            self.previous = (ratio[-1].copy(), unit[-1].copy(), nominal[-1])
+            previous_ratio = numpy.concatenate(([previous_ratio], ratio[:-1]))
+            previous_unit = numpy.concatenate(([previous_unit], unit[:-1]))
+            previous_nominal = numpy.concatenate(([previous_nominal], nominal[:-1]))
+            cos_theta = -(unit * previous_unit).sum(axis = 1)
+            sin_half = numpy.sqrt(numpy.maximum(0.5 * (1.0 - cos_theta), 0.0))
+            deviation = accel * junction_deviation * sin_half / (1.0 - sin_half)
+            deviation = numpy.where(cos_theta > 0.999999, 0.0,
+                                    numpy.where(cos_theta < -0.999999, unlimited,
+                                                deviation))
+            change = numpy.abs(ratio - previous_ratio)
+            jerked = (jerk / change).min(axis = 1) ** 2
+            junction = numpy.where(numpy.isnan(junction_deviation), jerked,
+                                   deviation)
+            junction = numpy.minimum(junction, numpy.minimum(nominal, previous_nominal) ** 2)
+            junction[from_rest] = 0.0
+
+        self.pending.append((rows, nominal, accel, length, junction))
+        self.pending_count += len(rows)
+        if self.lookahead and self.pending_count > self.lookahead:
+            self._plan_pending(self.pending_count - self.lookahead)
+
+    def _plan_pending(self, count, last = False):
+        """Durations of the first count pending moves, the pending moves
+        being the last ones of the print if last"""
+        pending = [numpy.concatenate(values) for values in zip(*self.pending)]
+        rows, nominal, accel, length, limit = [values[:count] for values in pending]
+        lookahead = self.lookahead
+        with numpy.errstate(divide = "ignore", invalid = "ignore"):
+            # Backward then forward passes on the squared junction speeds,
+            # up to the junction after the count moves
+            reach = 2.0 * pending[2] * pending[3]
+            prefix = numpy.concatenate(([0.0], numpy.cumsum(reach)))
+            # The print ends at rest
+            bound = numpy.concatenate((pending[4], [0.0] if last else [])) \
+                + prefix[:len(pending[4]) + last]
+            if lookahead:
+                # Able to stop at the end of the buffer
+                ends = numpy.minimum(numpy.arange(len(bound)) + lookahead,
+                                     len(reach))
+                backward = numpy.minimum(_window_min(bound, lookahead),
+                                         prefix[ends]) - prefix[:len(bound)]
+            else:
+                backward = numpy.minimum.accumulate(bound[::-1])[::-1] - prefix[:len(bound)]
+            backward = backward[:count + 1]
+            prefix = prefix[:count + 1]
+            # Carried over from the previous blocks
+            backward[0] = self.squared_entry
+            speed2 = prefix + numpy.minimum.accumulate(backward - prefix)
+            numpy.maximum(speed2, 0.0, out = speed2)
+
+            entry2 = speed2[:-1]
+            exit2 = speed2[1:]
+            entry = numpy.sqrt(entry2)
+            exit = numpy.sqrt(exit2)
+            cruise = length - (2 * nominal ** 2 - entry2 - exit2) / (2 * accel)
+            peak = numpy.sqrt(numpy.maximum((2 * accel * length + entry2 + exit2) / 2,
+                                            0.0))
+            self.durations[rows] = numpy.where(
+                cruise >= 0,
+                (2 * nominal - entry - exit) / accel + cruise / nominal,
+                (2 * peak - entry - exit) / accel)
+        self.squared_entry = speed2[-1]
+        self.pending = [tuple(values[count:] for values in pending)]
+        self.pending_count -= count
+
+class TrapezoidEstimator(Estimator):
+    """Trapezoidal motion planner with junction deviation or classic jerk
+    and a lookahead buffer, as in Marlin.
+
+    Moves without XYZ motion run at the E limits with the retract
+    acceleration, moves without extrusion with the travel one.  The classic
+    jerk is approximated by capping the change of speed of each axis at the
+    junction."""
+
+    def moves(self, x = 0, y = 0, z = 0, e = 0):
+        moves = super(TrapezoidEstimator, self).moves(x, y, z, e)
+        if numpy is not None:
+            # Planned as they are collected
+            moves.planner = BlockPlanner(moves)
+        return moves
+
+    def durations(self, moves):
+        if numpy is None:
+            return self._durations_python(moves)
+        return self._durations_numpy(moves)
+
+    def _durations_numpy(self, moves):
+        if moves.planner is None:
+            planner = BlockPlanner(moves)
+            planner.plan(moves.data, moves.stops, 0)
+        else:
+            planner = moves.planner
+            moves.flush()
+        return planner.finish()
+
+    def _durations_python(self, moves):
+        count = len(moves)
+        durations = [0.0] * count
+        limits = moves.limits
+        lookahead = limits[0].lookahead
+        rows = []
+        nominals = []
+        accels = []
+        lengths = []
+        limit = []
+        previous = None
+        from_rest = True
+        stops = set(moves.stops)
+        changes = dict(moves.limit_changes)
+        limit_id = 0
+        data = moves.data
+        position = moves.start
+        for i in range(count):
+            limit_id = changes.get(i, limit_id)
+            entry = data[5 * i:5 * i + 5]
+            feed = entry[4]
+            delta = tuple(a - b for a, b in zip(entry[:4], position))
+            position = entry[:4]
+            if i in stops:
+                durations[i] = feed
+                from_rest = True
+                continue
+            xyz = math.sqrt(delta[0] ** 2 + delta[1] ** 2 + delta[2] ** 2)
+            length = xyz if xyz > 0 else abs(delta[3])
+            if length == 0:
+                continue
+            l = limits[limit_id]
+            ratio = [d / length for d in delta]
+            feed = feed if feed > 0 else l.default_feedrate
+            nominal = min([feed] + [m / abs(r) for m, r in zip(l.max_feedrate, ratio) if r])
+            if xyz == 0:
+                base = l.retract_acceleration
+            elif delta[3] > 0:
+                base = l.acceleration
+            else:
+                base = l.travel_acceleration
+            accel = min([base] + [m / abs(r) for m, r in zip(l.max_acceleration, ratio) if r])
+            norm = math.sqrt(sum(d * d for d in delta))
+            unit = [d / norm for d in delta]
+            if from_rest:
+                junction = 0.0
+            else:
+                if l.junction_deviation is not None:
+                    cos_theta = -sum(a * b for a, b in zip(unit, previous[1]))
+                    if cos_theta > 0.999999:
+                        junction = 0.0
+                    elif cos_theta < -0.999999:
+                        junction = unlimited
+                    else:
+                        sin_half = math.sqrt(max(0.5 * (1.0 - cos_theta), 0.0))
+                        junction = accel * l.junction_deviation * sin_half / (1.0 - sin_half)
+                else:
+                    junction = min([j / abs(r - p) for j, r, p
+                                    in zip(l.jerk, ratio, previous[0]) if r != p]
+                                   + [unlimited]) ** 2
+                junction = min(junction, min(nominal, nominals[-1]) ** 2)
+            previous = (ratio, unit)
+            from_rest = False
+            rows.append(i)
+            nominals.append(nominal)
+            accels.append(accel)
+            lengths.append(length)
+            limit.append(junction)
+        if not rows:
+            return durations
+        limit.append(0.0)
+
+        prefix = [0.0] + list(accumulate(2.0 * a * l for a, l in zip(accels, lengths)))
+        bound = [c + s for c, s in zip(limit, prefix)]
+        last = len(bound) - 1
+        backward = [0.0] * len(bound)
+        if lookahead:
+            window = deque()
+            for k in range(last, -1, -1):
+                while window and bound[window[-1]] >= bound[k]:
+                    window.pop()
+                window.append(k)
+                if window[0] >= k + lookahead:
+                    window.popleft()
+                backward[k] = min(bound[window[0]],
+                                  prefix[min(k + lookahead, last)]) - prefix[k]
+        else:
+            lowest = unlimited
+            for k in range(last, -1, -1):
+                lowest = min(lowest, bound[k])
+                backward[k] = lowest - prefix[k]
+        lowest = unlimited
+        speed2 = []
+        for b, s in zip(backward, prefix):
+            lowest = min(lowest, b - s)
+            speed2.append(max(s + lowest, 0.0))
+
+        for k, i in enumerate(rows):
+            entry2 = speed2[k]
+            exit2 = speed2[k + 1]
+            entry = math.sqrt(entry2)
+            exit = math.sqrt(exit2)
+            nominal = nominals[k]
+            accel = accels[k]
+            length = lengths[k]
+            cruise = length - (2 * nominal ** 2 - entry2 - exit2) / (2 * accel)
+            if cruise >= 0:
+                durations[i] = (2 * nominal - entry - exit) / accel + cruise / nominal
+            else:
+                peak = math.sqrt(max((2 * accel * length + entry2 + exit2) / 2, 0.0))
+                durations[i] = (2 * peak - entry - exit) / accel
+        return durations
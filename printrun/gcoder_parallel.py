@@ -0,0 +1,521 @@
+#!/usr/bin/env python3
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Multi-process G-code preprocessing.
+
+The file is cut into chunks at line boundaries and each chunk is parsed and
+run through the GCode state machine by a worker process.  Workers do not know
+the state (position, offsets, modes) the chunk starts in, so they start from
+a guess.  The chunks are then stitched in order: the first lines of each chunk
+are replayed from the true incoming state until the replay reaches the state
+the worker had at the same line, from which point the worker results are the
+right ones.  This usually takes a handful of lines (up to the first absolute
+X, Y, Z move and E reset).  Layers, durations, extrusion totals and the
+bounding box are finally computed on the stitched columns with NumPy, giving
+the same result as ColumnarGCode's serial preprocessing.
+"""
+
+import datetime
+import io
+import mmap
+import os
+import re
+import sys
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+
+from .gcoder import GCode, Layer, LayerLines, Line, dwell_time
+from .gcoder_estimator import limit_commands, stop_commands
+from .gcoder_columnar import ColumnarGCode, ColumnarLayer, \
+    remap_commands, _column, command_is_raw, pos_is_move, pos_relative, \
+    pos_relative_e, pos_extruding
+
+# Files smaller than this are preprocessed in the calling process
+min_parallel_size = 4 * 1024 * 1024
+
+# Commands switching the modal state the workers have to guess
+modal_exp = re.compile(rb"^[ \t]*(?:N\d+[ \t]*)?(G9[01]|M8[23]|G2[01]|T\d+)(?![\d.])",
+                       re.M | re.I)
+
+aux_fields = ("x", "y", "z", "e", "f", "current_x", "current_y", "current_z")
+
+state_fields = ("imperial", "relative", "relative_e", "current_tool",
+                "current_x", "current_y", "current_z",
+                "offset_x", "offset_y", "offset_z", "current_f")
+
+def _chunk_bounds(buf, chunks):
+    """Split buf in about chunks pieces, cutting right after newlines"""
+    size = len(buf)
+    bounds = []
+    start = 0
+    for i in range(1, chunks):
+        end = buf.find(b"\n", max(size * i // chunks, start)) + 1
+        if end <= start:
+            break
+        bounds.append((start, end))
+        start = end
+    if start < size:
+        bounds.append((start, size))
+    return bounds
+
+def _guess_modes(buf, bounds):
+    """Modal state (imperial, relative, relative_e, tool) at each chunk start,
+    from a quick scan of the modal commands.  This is only the starting guess
+    of the workers: a wrong guess only makes the replay longer."""
+    modes = [(m.start(), m.group(1).upper()) for m in modal_exp.finditer(buf)]
+    imperial = relative = relative_e = False
+    tool = 0
+    guesses = []
+    i = 0
+    for start, _ in bounds:
+        while i < len(modes) and modes[i][0] < start:
+            command = modes[i][1]
+            i += 1
+            if command == b"G20": imperial = True
+            elif command == b"G21": imperial = False
+            elif command == b"G90": relative = relative_e = False
+            elif command == b"G91": relative = relative_e = True
+            elif command == b"M82": relative_e = False
+            elif command == b"M83": relative_e = True
+            else: tool = int(command[1:])
+        guesses.append((imperial, relative, relative_e, tool))
+    return guesses
+
+def _new_state(home_pos, modes = None):
+    state = GCode(deferred = True)
+    state.home_pos = home_pos
+    if modes:
+        state.imperial, state.relative, state.relative_e, tool = modes
+        state.current_tool = tool
+        _grow_tools(state, tool)
+    return state
+
+def _grow_tools(state, tool):
+    while tool + 1 > len(state.current_e_multi):
+        state.current_e_multi += [0]
+        state.offset_e_multi += [0]
+        state.total_e_multi += [0]
+        state.max_e_multi += [0]
+
+def _snapshot(state):
+    snapshot = {name: getattr(state, name) for name in state_fields}
+    snapshot["tools"] = len(state.current_e_multi)
+    return snapshot
+
+def _sync_key(state):
+    return tuple(getattr(state, name) for name in state_fields[:-1])
+
+def _e_key(state):
+    abs_multi = [c - o for c, o in zip(state.current_e_multi,
+                                       state.offset_e_multi)]
+    while abs_multi and not abs_multi[-1]:
+        abs_multi.pop()
+    return state.current_e - state.offset_e, abs_multi
+
+def _pack(lines):
+    """Pack preprocessed lines, along with float64 copies of the values the
+    layer analysis works on"""
+    packed = ColumnarLayer(lines)
+    aux = {name: _column(lines, name) for name in aux_fields}
+    dwell = numpy.zeros(len(lines))
+    for i, line in enumerate(lines):
+        if line.command == "G4":
+            dwell[i] = dwell_time(line)
+    aux["dwell"] = dwell
+    return packed, aux
+
+def _process_chunk(filename, start, end, home_pos, modes):
+    """Worker side: parse and preprocess one chunk of filename"""
+    with open(filename, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    text = io.TextIOWrapper(io.BytesIO(data), encoding = "utf-8")
+    lines = [Line(l2) for l2 in (l.strip() for l in text) if l2]
+    state = _new_state(home_pos, modes)
+    if lines:
+        state._preprocess(lines)
+    packed, aux = _pack(lines)
+    return packed, aux, _snapshot(state)
+
+def _replay(packed, state, home_pos, modes):
+    """Replay the lines of a chunk from the true incoming state until the
+    state matches the one of the worker at the same line.
+
+    Returns the replayed lines and whether the states met.  The E position
+    only matters for absolute extrusion, so it is not compared while in
+    relative E mode if the rest of the chunk never leaves it."""
+    absolute_e = [code for code, command in enumerate(packed.commands)
+                  if command in ("G90", "M82")]
+    rows = numpy.flatnonzero(numpy.isin(packed.data["command"], absolute_e))
+    last_absolute_e = rows[-1] if len(rows) else -1
+    worker = _new_state(home_pos, modes)
+    lines = []
+    for i in range(len(packed)):
+        raw = packed.raw_line(i)
+        line = Line(raw)
+        state._preprocess([line])
+        worker._preprocess([Line(raw)])
+        lines.append(line)
+        if _sync_key(state) == _sync_key(worker):
+            if (state.relative_e and i >= last_absolute_e) \
+               or _e_key(state) == _e_key(worker):
+                return lines, True
+    return lines, False
+
+def _extrusion(e, move, relative_e, abs_e, total_e, max_e):
+    """Follow the E axis over E events (moves with E and G92 E) the way
+    GCode._preprocess does, returning the updated (abs_e, total_e, max_e)
+    and total_e after each event"""
+    if not len(e):
+        return abs_e, total_e, max_e, numpy.zeros(0)
+    relative = move & relative_e
+    # Absolute moves and G92 set the position, relative moves add to it
+    reset = ~relative
+    group = numpy.cumsum(reset)
+    base = numpy.concatenate(([abs_e], e[reset]))[group]
+    steps = numpy.cumsum(numpy.where(relative, e, 0.0))
+    start = numpy.concatenate(([0.0], steps[reset]))[group]
+    after = base + (steps - start)
+    before = numpy.concatenate(([abs_e], after[:-1]))
+    total = total_e + numpy.cumsum(numpy.where(relative, e,
+                                               numpy.where(move, e - before, 0.0)))
+    if move.any():
+        max_e = max(max_e, total[move].max().item())
+    return after[-1].item(), total[-1].item(), max_e, total
+
+def _ffill(values, initial):
+    """Replace NaNs by the last preceding value, or initial"""
+    mask = ~numpy.isnan(values)
+    src = numpy.where(mask, numpy.arange(1, len(values) + 1), 0)
+    numpy.maximum.accumulate(src, out = src)
+    return numpy.concatenate(([initial], values))[src]
+
+class ParallelGCode(ColumnarGCode):
+    """ColumnarGCode preprocessed by a pool of worker processes.
+
+    Pass a filename instead of an iterable of lines to use the worker pool,
+    anything else is preprocessed serially like ColumnarGCode does."""
+
+    # Number of worker processes, None meaning one per CPU
+    workers = None
+
+    def prepare(self, data = None, home_pos = None, layer_callback = None):
+        if not isinstance(data, (str, os.PathLike)):
+            return super(ParallelGCode, self).prepare(data, home_pos,
+                                                      layer_callback)
+        self.home_pos = home_pos
+        self.lines = LayerLines(self)
+        self._stitch(self._run_workers(data), layer_callback)
+
+    def _run_workers(self, filename):
+        workers = self.workers or os.cpu_count() or 1
+        with open(filename, "rb") as f:
+            if not os.fstat(f.fileno()).st_size:
+                return []
+            with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as buf:
+                chunks = workers if len(buf) >= min_parallel_size else 1
+                bounds = _chunk_bounds(buf, chunks)
+                guesses = _guess_modes(buf, bounds)
+        guesses[0] = None
+        home_pos = self.home_pos
+        jobs = [(filename, start, end, home_pos, modes)
+                for (start, end), modes in zip(bounds, guesses)]
+        if len(jobs) == 1:
+            results = [_process_chunk(*jobs[0])]
+        else:
+            with ProcessPoolExecutor(min(workers, len(jobs))) as pool:
+                results = list(pool.map(_process_chunk, *zip(*jobs)))
+        return [result + (modes,) for result, modes in zip(results, guesses)]
+
+    def _stitch(self, results, layer_callback):
+        home_pos = self.home_pos
+        names = []
+        table = {}
+        datas = []
+        raws = []
+        offsets = []
+        auxs = []
+        state = _new_state(home_pos)
+        abs_e = total_e = max_e = 0.0
+        abs_multi = [0.0]
+        total_multi = [0.0]
+        max_multi = [0.0]
+        base = 0
+        for packed, aux, snapshot, modes in results:
+            data = packed.data
+            incoming_tool = state.current_tool
+            if datas:
+                lines, synced = _replay(packed, state, home_pos, modes)
+                head, head_aux = _pack(lines)
+                data[:len(lines)] = head.data
+                data["command"][:len(lines)] = \
+                    remap_commands(head.data["command"], head.commands, names, table)
+                data["command"][len(lines):] = \
+                    remap_commands(data["command"][len(lines):], packed.commands,
+                                names, table)
+                for name, values in head_aux.items():
+                    aux[name][:len(lines)] = values
+                if synced:
+                    for name in state_fields:
+                        setattr(state, name, snapshot[name])
+            else:
+                data["command"] = remap_commands(data["command"], packed.commands,
+                                              names, table)
+                synced = True
+                for name in state_fields:
+                    setattr(state, name, snapshot[name])
+            _grow_tools(state, max(snapshot["tools"], len(state.current_e_multi)) - 1)
+
+            # Tool of each line, for the per extruder E counters
+            flags = self._flags(data["command"], names)
+            tool = numpy.full(len(data), numpy.nan)
+            for row in numpy.flatnonzero(flags["tool_change"]).tolist():
+                try:
+                    tool[row] = int(names[data["command"][row]][1:])
+                except ValueError:
+                    pass
+            tool = _ffill(tool, incoming_tool).astype(numpy.int64)
+
+            # Follow E along the chunk to seed the next replay
+            status = data["status"]
+            move = (status & pos_is_move) != 0
+            relative_e = (status & pos_relative_e) != 0
+            e = aux["e"]
+            events = ~numpy.isnan(e) & (move | flags["g92"])
+            abs_e, total_e, max_e, totals = _extrusion(
+                e[events], move[events], relative_e[events],
+                abs_e, total_e, max_e)
+            aux["total_e"] = numpy.full(len(data), numpy.nan)
+            aux["total_e"][events] = totals
+            if len(tool):
+                ntools = max(len(abs_multi), int(tool.max()) + 1)
+                while len(abs_multi) < ntools:
+                    abs_multi.append(0.0)
+                    total_multi.append(0.0)
+                    max_multi.append(0.0)
+            for t in numpy.unique(tool[events]).tolist():
+                sel = events & (tool == t)
+                abs_multi[t], total_multi[t], max_multi[t] = _extrusion(
+                    e[sel], move[sel], relative_e[sel],
+                    abs_multi[t], total_multi[t], max_multi[t])[:3]
+            if synced:
+                state.current_e = abs_e
+                state.offset_e = 0
+                _grow_tools(state, len(abs_multi) - 1)
+                for t, value in enumerate(abs_multi):
+                    state.current_e_multi[t] = value
+                    state.offset_e_multi[t] = 0
+
+            datas.append(data)
+            raws.append(packed.raw)
+            offsets.append(packed.offsets[:-1].astype(numpy.int64) + base)
+            base += len(packed.raw)
+            auxs.append(aux)
+
+        data = numpy.concatenate(datas) if datas else ColumnarLayer([]).data
+        raw = b"".join(raws)
+        offsets.append(numpy.array([base], dtype = numpy.int64))
+        offsets = numpy.concatenate(offsets)
+        aux = {name: numpy.concatenate([a[name] for a in auxs])
+               if auxs else numpy.zeros(0) for name in aux_fields + ("dwell", "total_e")}
+
+        self.imperial = state.imperial
+        self.relative = state.relative
+        self.relative_e = state.relative_e
+        self.current_tool = state.current_tool
+        self.current_x = state.current_x
+        self.current_y = state.current_y
+        self.current_z = state.current_z
+        self.offset_x = state.offset_x
+        self.offset_y = state.offset_y
+        self.offset_z = state.offset_z
+        self.current_f = state.current_f
+        # Like in GCode._preprocess, current_e follows total_e
+        self.current_e = self.total_e = total_e
+        self.offset_e = total_e - abs_e
+        self.max_e = max_e
+        self.current_e_multi = list(total_multi)
+        self.total_e_multi = list(total_multi)
+        self.offset_e_multi = [t - a for t, a in zip(total_multi, abs_multi)]
+        self.max_e_multi = list(max_multi)
+
+        self._build_layers(data, raw, offsets, aux, names, layer_callback)
+
+    @staticmethod
+    def _flags(codes, names):
+        """Per line command classes, from the shared command table"""
+        def lookup(predicate, raw = False):
+            lut = numpy.array([predicate(name) for name in names] + [raw],
+                              dtype = bool)
+            return lut[index]
+        index = numpy.where(codes == command_is_raw, len(names), codes)
+        return {
+            "has_command": lookup(bool, True),
+            "g01": lookup(lambda name: name in ("G0", "G1")),
+            "g92": lookup(lambda name: name == "G92"),
+            "stop": lookup(lambda name: name in stop_commands),
+            "limits": lookup(lambda name: name in limit_commands),
+            "tool_change": lookup(lambda name: name[:1] == "T"),
+        }
+
+    def _build_layers(self, data, raw, offsets, aux, names, layer_callback):
+        count = len(data)
+        flags = self._flags(data["command"], names)
+        status = data["status"]
+        move = (status & pos_is_move) != 0
+        relative = (status & pos_relative) != 0
+        relative_e = (status & pos_relative_e) != 0
+        extruding = (status & pos_extruding) != 0
+
+        # Duration of every line, from the moves and stops collected in
+        # the order GCode._preprocess does
+        moves = self.estimator.moves()
+        entries = flags["g01"] | flags["stop"]
+        positions = (aux["current_x"], aux["current_y"], aux["current_z"],
+                     _ffill(aux["total_e"], 0.0))
+        feed = _ffill(numpy.where(move, aux["f"], numpy.nan), 0.0)
+        start = 0
+        for row in numpy.flatnonzero(flags["limits"]).tolist() + [count]:
+            rows = start + numpy.flatnonzero(entries[start:row])
+            moves.extend(*[values[rows] for values in positions],
+                         feed[rows], aux["dwell"][rows], ~flags["g01"][rows])
+            if row < count:
+                moves.set_limits(names[data["command"][row]],
+                                 raw[offsets[row]:offsets[row + 1]].decode("utf-8"))
+            start = row
+        durations = numpy.zeros(count)
+        durations[numpy.flatnonzero(entries)] = self.estimator.durations(moves)
+        totaldurations = numpy.cumsum(durations)
+        extrusions = numpy.cumsum(extruding)
+
+        all_layers = self.all_layers = []
+        all_zs = self.all_zs = set()
+        starts = self.layer_starts = array('I')
+
+        def add_layer(start, end, z, duration):
+            layer = ColumnarLayer.from_rows(
+                data[start:end].copy(), raw[offsets[start]:offsets[end]],
+                (offsets[start:end + 1] - offsets[start]).astype(numpy.uint64),
+                names, z)
+            layer.duration = duration
+            all_layers.append(layer)
+            starts.append(start)
+
+        # Walk the lines where the Z used for layer detection changes
+        layer_start = 0
+        reset_row = -1
+        layerbeginduration = 0.0
+        last_layer_z = None
+        prev_base_z = (None, None)
+        cur_z = None
+        z = aux["z"]
+        rows = numpy.flatnonzero(~numpy.isnan(z) & (move | flags["g92"]))
+        for row, line_z, g92, rel in zip(rows.tolist(), z[rows].tolist(),
+                                         flags["g92"][rows].tolist(),
+                                         relative[rows].tolist()):
+            prev_z = cur_z
+            if g92:
+                cur_z = line_z
+            elif rel and cur_z is not None:
+                cur_z += line_z
+            else:
+                cur_z = line_z
+            if cur_z == prev_z:
+                continue
+            if prev_z is not None and last_layer_z is not None:
+                offset = self.est_layer_height if self.est_layer_height else 0.01
+                if abs(prev_z - last_layer_z) < offset:
+                    if self.est_layer_height is None:
+                        zs = sorted([l.z for l in all_layers if l.z is not None])
+                        heights = [round(zs[i + 1] - zs[i], 3) for i in range(len(zs) - 1)]
+                        heights = [height for height in heights if height]
+                        if len(heights) >= 2: self.est_layer_height = heights[1]
+                        elif heights: self.est_layer_height = heights[0]
+                        else: self.est_layer_height = 0.1
+                    base_z = round(prev_z - (prev_z % self.est_layer_height), 2)
+                else:
+                    base_z = round(prev_z, 2)
+            else:
+                base_z = prev_z
+
+            if base_z != prev_base_z:
+                totalduration = totaldurations[row].item()
+                add_layer(layer_start, row, base_z,
+                          totalduration - layerbeginduration)
+                layerbeginduration = totalduration
+                has_extrusion = extrusions[row] - (extrusions[reset_row] if reset_row >= 0 else 0)
+                if has_extrusion and prev_z not in all_zs:
+                    all_zs.add(prev_z)
+                layer_start = reset_row = row
+                last_layer_z = base_z
+                if layer_callback is not None:
+                    layer_callback(self, len(all_layers) - 1)
+            prev_base_z = base_z
+
+        totalduration = totaldurations[-1].item() if count else 0.0
+        if layer_start < count:
+            add_layer(layer_start, count, cur_z, totalduration - layerbeginduration)
+            has_extrusion = extrusions[-1] - (extrusions[reset_row] if reset_row >= 0 else 0)
+            if has_extrusion and cur_z not in all_zs:
+                all_zs.add(cur_z)
+
+        self.append_layer_id = len(all_layers)
+        self.append_layer = Layer([])
+        self.append_layer.duration = 0
+        all_layers.append(self.append_layer)
+        starts.append(count)
+
+        # Compute bounding box
+        zs = all_zs.union({0}).difference({None})
+        self.zmin = min(zs)
+        self.zmax = max(zs)
+        self.filament_length = self.max_e
+        self.filament_length_multi = list(self.max_e_multi)
+        if self.filament_length > 0:
+            selected = move & extruding
+        else:
+            selected = move
+        for axis in ("x", "y"):
+            values = aux["current_" + axis][selected]
+            setattr(self, axis + "min", values.min().item() if len(values) else 0)
+            setattr(self, axis + "max", values.max().item() if len(values) else 0)
+        self.width = self.xmax - self.xmin
+        self.depth = self.ymax - self.ymin
+        self.height = self.zmax - self.zmin
+
+        self.duration = datetime.timedelta(seconds = int(totalduration))
+
+def main():
+    if len(sys.argv) < 2:
+        print("usage: %s filename.gcode [workers]" % sys.argv[0])
+        return
+
+    if len(sys.argv) > 2:
+        ParallelGCode.workers = int(sys.argv[2])
+    start = time.time()
+    gcode = ColumnarGCode(open(sys.argv[1], encoding = "utf-8"))
+    print("serial: %d lines, %d layers loaded in %.02fs" %
+          (len(gcode), gcode.layers_count, time.time() - start))
+    start = time.time()
+    gcode = ParallelGCode(sys.argv[1])
+    print("parallel: %d lines, %d layers loaded in %.02fs" %
+          (len(gcode), gcode.layers_count, time.time() - start))
+
+if __name__ == '__main__':
+    main()
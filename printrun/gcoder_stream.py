@@ -0,0 +1,355 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Streaming print source for huge G-code files.
+
+StreamGCode gives printcore the part of the GCode interface it prints from
+(len(), idxs(), all_layers, lines and append()) without loading the file.
+The file is mapped in memory and a background thread builds a sidecar index
+holding the offset of every non empty line, so that line i (for a startindex
+resume or a resend) is found with a single lookup.  Lines are only turned
+into Line objects when printcore asks for them, and pages of the file which
+were read are dropped from the process mapping as the print goes on, so
+memory stays flat whatever the file size.
+
+The sidecar is written in the user cache directory (or in the temporary
+directory when that one is not writable), named after the path of the
+G-code file, and reused as long as the size and mtime of the file match.
+Sidecars unused for index_max_age get removed as new ones are written.  The file is not analyzed: there is a single layer
+holding all its lines, and no duration or bounding box."""
+
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import numpy
+
+from appdirs import user_cache_dir
+
+from .gcoder import Layer, Line, split, parse_coordinates
+
+index_magic = b"PRLIDX01"
+index_header = struct.Struct("<8sQQQ")
+# Line count of an index which is still being built
+index_incomplete = 2 ** 64 - 1
+
+# Bytes of the file scanned by the indexer at once
+index_scan_size = 1024 * 1024
+# Offsets read from the sidecar at once, and number of such blocks kept
+index_block_size = 4096
+index_cached_blocks = 8
+# Sidecars in the cache directory not used for that long get removed
+index_max_age = 7 * 24 * 3600
+# Pages behind the current position are released by steps of that many bytes
+release_step = 16 * 1024 * 1024
+
+# Bytes str.strip() removes, lines made only of those are skipped like
+# GCode does
+whitespace = numpy.zeros(256, dtype = bool)
+whitespace[list(b" \t\n\r\x0b\x0c\x1c\x1d\x1e\x1f")] = True
+
+def _release(buf, start, end):
+    """Drop the pages of the mapping buf between start and end from the
+    process, they are read back from the page cache if needed again"""
+    start -= start % mmap.PAGESIZE
+    if end > start and hasattr(buf, "madvise") and hasattr(mmap, "MADV_DONTNEED"):
+        buf.madvise(mmap.MADV_DONTNEED, start, end - start)
+
+def default_index_filename(filename):
+    """Sidecar index of filename in the user cache directory"""
+    name = hashlib.sha1(os.path.abspath(filename).encode("utf-8", "surrogateescape")).hexdigest()
+    return os.path.join(user_cache_dir("Printrun"), "lineidx", name + ".lineidx")
+
+def remove_unused_indexes(directory):
+    """Remove the sidecar indexes of directory unused for index_max_age"""
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return
+    limit = time.time() - index_max_age
+    for name in names:
+        if not name.endswith(".lineidx"):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            if os.stat(path).st_mtime < limit:
+                os.remove(path)
+        except OSError:
+            pass
+
+class StreamLayer:
+    """The layer of a StreamGCode holding all the lines of its file"""
+
+    z = None
+    duration = 0
+
+    def __init__(self, gcode):
+        self.gcode = gcode
+
+    def __len__(self):
+        return self.gcode.indexed
+
+    def __getitem__(self, i):
+        return self.gcode.file_line(i)
+
+    def __iter__(self):
+        for i in range(self.gcode.line_count()):
+            yield self.gcode.file_line(i)
+
+class StreamGCode:
+    """Print source reading the lines of filename lazily.
+
+    Lines which get indexed are available right away: len() only counts
+    those, wait_for_line() blocks until a given line is indexed. Commands
+    given to append() are kept in memory after the lines of the file."""
+
+    def __init__(self, filename, index_filename = None):
+        self.filename = filename
+        self.indexed = 0
+        self.done = False
+        self.error = None
+        self.append_layer = Layer([])
+        self.append_layer.duration = 0
+        self.append_layer_id = 1
+        self.all_layers = [StreamLayer(self), self.append_layer]
+        self._cond = threading.Condition()
+        self._lock = threading.Lock()
+        self._blocks = OrderedDict()
+        self._released = 0
+        self._stop = False
+        self._temporary = None
+
+        self._file = open(filename, "rb")
+        stat = os.fstat(self._file.fileno())
+        self.size = stat.st_size
+        if self.size:
+            self._buf = mmap.mmap(self._file.fileno(), 0, access = mmap.ACCESS_READ)
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                self._buf.madvise(mmap.MADV_SEQUENTIAL)
+        else:
+            self._buf = b""
+        header = (index_magic, self.size, stat.st_mtime_ns)
+
+        in_cache = index_filename is None
+        if in_cache:
+            index_filename = default_index_filename(filename)
+        self.index_filename = index_filename
+        count = self._read_header(index_filename, header)
+        if count is not None:
+            self._index = open(index_filename, "rb")
+            self.indexed = count
+            self.done = True
+            # Keep it from being removed as unused
+            try:
+                os.utime(index_filename)
+            except OSError:
+                pass
+            return
+        if in_cache:
+            remove_unused_indexes(os.path.dirname(index_filename))
+        try:
+            os.makedirs(os.path.dirname(index_filename), exist_ok = True)
+            writer = open(index_filename, "w+b")
+        except OSError:
+            fd, index_filename = tempfile.mkstemp(suffix = ".lineidx")
+            writer = os.fdopen(fd, "w+b")
+            self._temporary = index_filename
+            self.index_filename = index_filename
+        writer.write(index_header.pack(*(header + (index_incomplete,))))
+        writer.flush()
+        self._index = open(index_filename, "rb")
+        self._indexer = threading.Thread(target = self._build_index,
+                                         args = (writer,), daemon = True)
+        self._indexer.start()
+
+    def _read_header(self, index_filename, header):
+        """Line count of the sidecar index_filename if it is complete and
+        matches header, None otherwise"""
+        try:
+            with open(index_filename, "rb") as f:
+                data = f.read(index_header.size)
+                size = os.fstat(f.fileno()).st_size
+        except OSError:
+            return None
+        if len(data) != index_header.size:
+            return None
+        magic, file_size, mtime, count = index_header.unpack(data)
+        if (magic, file_size, mtime) != header or count == index_incomplete \
+           or size != index_header.size + 8 * count:
+            return None
+        return count
+
+    def _build_index(self, writer):
+        buf = self._buf
+        line_start = 0
+        pending = False  # whether the line being scanned has non blank bytes
+        count = 0
+        try:
+            pos = 0
+            while pos < self.size and not self._stop:
+                end = min(pos + index_scan_size, self.size)
+                chunk = numpy.frombuffer(buf, dtype = numpy.uint8,
+                                         count = end - pos, offset = pos)
+                newlines = numpy.flatnonzero(chunk == 10)
+                # Non blank bytes before each position of the chunk
+                filled = numpy.zeros(len(chunk) + 1, dtype = numpy.int32)
+                numpy.cumsum(~whitespace[chunk], out = filled[1:])
+                starts = numpy.concatenate(([0], newlines + 1))
+                ends = numpy.concatenate((newlines, [len(chunk)]))
+                nonblank = filled[ends] > filled[starts]
+                del chunk, filled
+                if len(newlines):
+                    starts += pos
+                    starts[0] = line_start
+                    nonblank[0] |= pending
+                    offsets = starts[:-1][nonblank[:-1]].astype("<u8")
+                    writer.write(offsets.tobytes())
+                    count += len(offsets)
+                    line_start = int(starts[-1])
+                    pending = bool(nonblank[-1])
+                else:
+                    pending |= bool(nonblank[-1])
+                writer.flush()
+                _release(buf, pos, end)
+                pos = end
+                with self._cond:
+                    self.indexed = count
+                    self._cond.notify_all()
+            if pending and not self._stop:
+                writer.write(struct.pack("<Q", line_start))
+                count += 1
+            if not self._stop:
+                writer.seek(index_header.size - 8)
+                writer.write(struct.pack("<Q", count))
+            writer.close()
+        except Exception as e:
+            logging.error("Could not index %s: %s" % (self.filename, e),
+                          exc_info = True)
+            self.error = e
+        with self._cond:
+            self.indexed = count
+            self.done = True
+            self._cond.notify_all()
+
+    def wait_for_line(self, i):
+        """Wait until line i is indexed, returns False if there is none"""
+        with self._cond:
+            while i >= self.indexed and not self.done:
+                self._cond.wait()
+        return i < len(self)
+
+    def line_count(self):
+        """Number of lines in the file, waiting for the whole index"""
+        with self._cond:
+            while not self.done:
+                self._cond.wait()
+        return self.indexed
+
+    def __len__(self):
+        if self.done:
+            return self.indexed + len(self.append_layer)
+        return self.indexed
+
+    def __bool__(self):
+        return not self.done or len(self) > 0
+
+    @property
+    def lines(self):
+        return self
+
+    def __getitem__(self, i):
+        layer, line = self.idxs(i)
+        return self.all_layers[layer][line]
+
+    def __iter__(self):
+        for i in range(self.line_count()):
+            yield self.file_line(i)
+        yield from self.append_layer
+
+    def idxs(self, i):
+        if i < self.indexed:
+            return (0, i)
+        return (self.append_layer_id, i - self.indexed)
+
+    def _offset(self, i):
+        first = i - i % index_block_size
+        with self._lock:
+            block = self._blocks.get(first)
+            if block is None or i - first >= len(block):
+                count = min(index_block_size, self.indexed - first)
+                self._index.seek(index_header.size + 8 * first)
+                block = numpy.frombuffer(self._index.read(8 * count),
+                                         dtype = "<u8")
+                self._blocks[first] = block
+                if len(self._blocks) > index_cached_blocks:
+                    self._blocks.popitem(last = False)
+            else:
+                self._blocks.move_to_end(first)
+            return int(block[i - first])
+
+    def raw_line(self, i):
+        """Text of line i of the file"""
+        if i < 0 or i >= self.indexed:
+            raise IndexError("line %d of %s is not indexed" % (i, self.filename))
+        start = self._offset(i)
+        end = self._buf.find(b"\n", start)
+        if end < 0:
+            end = self.size
+        if start > self._released + release_step:
+            _release(self._buf, self._released, start)
+            self._released = start - start % mmap.PAGESIZE
+        elif start < self._released:
+            # Resumed or resending behind the released area
+            self._released = start - start % mmap.PAGESIZE
+        return self._buf[start:end].decode("utf-8", "replace").strip()
+
+    def file_line(self, i):
+        """Line i of the file, as a Line with its command and coordinates"""
+        gline = Line(self.raw_line(i))
+        split_raw = split(gline)
+        if gline.command[:1] == "G":
+            parse_coordinates(gline, split_raw)
+        return gline
+
+    def append(self, command, store = True):
+        command = command.strip()
+        if not command:
+            return
+        gline = Line(command)
+        split(gline)
+        if store:
+            self.append_layer.append(gline)
+        return gline
+
+    def close(self):
+        """Stop indexing and release the file and its index"""
+        self._stop = True
+        if not self.done:
+            self._indexer.join()
+        self._index.close()
+        if self._buf:
+            self._buf.close()
+        self._file.close()
+        if self._temporary:
+            try:
+                os.remove(self._temporary)
+            except OSError:
+                pass
@@ -16,6 +16,8 @@
 # along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+import time
+import numpy
 import wx
 
 from . import gcoder
@@ -26,7 +28,7 @@ from .injectgcode import injector, injector_edit
 
 from pyglet.gl import glPushMatrix, glPopMatrix, \
     glTranslatef, glRotatef, glScalef, glMultMatrixd, \
-    glGetDoublev, GL_MODELVIEW_MATRIX, GLdouble
+    glGetDoublev, GL_MODELVIEW_MATRIX, GLdouble, glFinish
 
 from .gviz import GvizBaseFrame
 
@@ -68,6 +70,13 @@ def set_gcview_params(self, path_width, path_height):
 
 class GcodeViewPanel(wxGLPanel):
 
+    # Drawing options of the G-code models, see actors.GcodeModel
+    frustum_culling = True
+    lod = True
+
+    # Number of frames the frame times are logged over, when timing frames
+    timed_frames = 20
+
     def __init__(self, parent, id = wx.ID_ANY,
                  build_dimensions = None, realparent = None,
                  antialias_samples = 0):
@@ -88,6 +97,8 @@ class GcodeViewPanel(wxGLPanel):
         self.dist = max(self.build_dimensions[0], self.build_dimensions[1])
         self.basequat = [0, 0, 0, 1]
         self.mousepos = [0, 0]
+        self.time_frames = False
+        self.frame_times = []
 
     def inject(self):
         l = self.parent.model.num_layers_to_draw
@@ -130,6 +141,8 @@ class GcodeViewPanel(wxGLPanel):
 
     def draw_objects(self):
         '''called in the middle of ondraw after the buffer has been cleared'''
+        if self.time_frames:
+            start = time.perf_counter()
         self.create_objects()
 
         glPushMatrix()
@@ -151,10 +164,52 @@ class GcodeViewPanel(wxGLPanel):
             glTranslatef(*(obj.centeroffset))
             glScalef(*obj.scale)
 
+            if isinstance(obj.model, actors.GcodeModel):
+                obj.model.frustum_culling = self.frustum_culling
+                obj.model.lod = self.lod
             obj.model.display()
             glPopMatrix()
         glPopMatrix()
 
+        if self.time_frames:
+            # Wait for the GPU to be done with the frame
+            glFinish()
+            self.frame_times.append(time.perf_counter() - start)
+            if len(self.frame_times) >= self.timed_frames:
+                self.log_frame_times()
+
+    def log_frame_times(self):
+        times = self.frame_times
+        self.frame_times = []
+        message = _("Frame time over %d frames: %.1f ms average, %.1f ms max") % \
+            (len(times), 1000 * sum(times) / len(times), 1000 * max(times))
+        model = self.parent.model if hasattr(self.parent, "model") else None
+        if isinstance(model, actors.GcodeModel) and model.layer_modes is not None:
+            counts = numpy.bincount(model.layer_modes[1:], minlength = 3)
+            message += _(" (layers: %d in full, %d as lines, %d out of view)") % \
+                (counts[actors.draw_full], counts[actors.draw_lines],
+                 counts[actors.draw_none])
+        logging.info(message)
+
+    def toggle_lod(self):
+        self.lod = not self.lod
+        logging.info(_("Simplified far and small layers: %s") %
+                     (_("on") if self.lod else _("off")))
+        wx.CallAfter(self.Refresh)
+
+    def toggle_frustum_culling(self):
+        self.frustum_culling = not self.frustum_culling
+        logging.info(_("Skipping layers out of view: %s") %
+                     (_("on") if self.frustum_culling else _("off")))
+        wx.CallAfter(self.Refresh)
+
+    def toggle_frame_times(self):
+        self.time_frames = not self.time_frames
+        if not self.time_frames and self.frame_times:
+            self.log_frame_times()
+        self.frame_times = []
+        logging.info(_("Frame timing: %s") % (_("on") if self.time_frames else _("off")))
+
     # ==========================================================================
     # Utils
     # ==========================================================================
@@ -280,6 +335,9 @@ class GcodeViewPanel(wxGLPanel):
         kfit = [70]       # Fit to print keys
         kshowcurrent = [67]       # Show only current layer keys
         kreset = [82]       # Reset keys
+        klod = [76]       # Toggle level of detail keys
+        kculling = [86]       # Toggle frustum culling keys
+        ktime = [84]       # Toggle frame timing keys
         key = event.GetKeyCode()
         if key in kup:
             self.layerup()
@@ -299,6 +357,12 @@ class GcodeViewPanel(wxGLPanel):
             wx.CallAfter(self.Refresh)
         if key in kreset:
             self.resetview()
+        if key in klod:
+            self.toggle_lod()
+        if key in kculling:
+            self.toggle_frustum_culling()
+        if key in ktime:
+            self.toggle_frame_times()
         event.Skip()
 
     def resetview(self):
@@ -331,7 +395,12 @@ class GcodeViewLoader:
         if self.root:
             set_model_colors(self.model, self.root)
         if gcode is not None:
-            generator = self.model.load_data(gcode)
+            if isinstance(self.model, actors.GcodeModel) \
+               and hasattr(self.root, "get_mesh_cache"):
+                generator = self.model.load_data(
+                    gcode, mesh_cache = self.root.get_mesh_cache(gcode))
+            else:
+                generator = self.model.load_data(gcode)
             generator_output = next(generator)
             while generator_output is not None:
                 yield generator_output
@@ -369,9 +438,12 @@ class GcodeViewMainWrapper(GcodeViewLoader):
         return getattr(self.glpanel, name)
 
     def set_current_gline(self, gline):
-        if gline.is_move and gline.gcview_end_vertex is not None \
-           and self.model and self.model.loaded:
-            self.model.printed_until = gline.gcview_end_vertex
+        if gline.is_move and gline.gcview_end_vertex is not None:
+            self.set_printed_until(gline.gcview_end_vertex)
+
+    def set_printed_until(self, vertex):
+        if self.model and self.model.loaded:
+            self.model.printed_until = vertex
             if not self.refresh_timer.IsRunning():
                 self.refresh_timer.Start()
 
@@ -381,6 +453,9 @@ class GcodeViewMainWrapper(GcodeViewLoader):
     def addgcodehighlight(self, *a):
         pass
 
+    def addgcodehighlights(self, *a):
+        pass
+
     def setlayer(self, layer):
         if layer in self.model.layer_idxs_map:
             viz_layer = self.model.layer_idxs_map[layer]
@@ -434,6 +509,31 @@ class GcodeViewFrame(GvizBaseFrame, GcodeViewLoader):
         self.Bind(wx.EVT_TOOL, lambda x: self.glpanel.fit(), id = 8)
         self.Bind(wx.EVT_TOOL, lambda x: self.glpanel.inject(), id = 6)
         self.Bind(wx.EVT_TOOL, lambda x: self.glpanel.editlayer(), id = 7)
+        self.clickcb = self.select_line
+
+    def select_line(self, event):
+        """Tell in the status bar the line of the current layer whose move
+        passes closest to the double-clicked point"""
+        if not self.model or not self.model.loaded:
+            return
+        layer = self.model.num_layers_to_draw
+        filtered = [k for k, v in self.model.layer_idxs_map.items() if v == layer]
+        if not filtered:
+            return
+        true_layer = filtered[0]
+        gcode = self.model.gcode
+        z = gcode.all_layers[true_layer].z or 0.
+        x, y = event.GetPosition()
+        point = self.glpanel.mouse_to_plane(x, y, (0, 0, 1), -z, local_transform = True)
+        if point is None:
+            return
+        found = gcode.spatial_index().nearest_line(true_layer, point[0], point[1], 2.0)
+        if found is None:
+            self.update_status("")
+            return
+        line = found[0]
+        gline = gcode.all_layers[true_layer][line]
+        wx.CallAfter(self.SetStatusText, _("Layer %d, line %d: %s") % (layer, line + 1, gline.raw), 0)
 
     def setlayercb(self, layer):
         self.layerslider.SetValue(layer)
@@ -459,9 +559,12 @@ class GcodeViewFrame(GvizBaseFrame, GcodeViewLoader):
         wx.CallAfter(self.Refresh)
 
     def set_current_gline(self, gline):
-        if gline.is_move and gline.gcview_end_vertex is not None \
-           and self.model and self.model.loaded:
-            self.model.printed_until = gline.gcview_end_vertex
+        if gline.is_move and gline.gcview_end_vertex is not None:
+            self.set_printed_until(gline.gcview_end_vertex)
+
+    def set_printed_until(self, vertex):
+        if self.model and self.model.loaded:
+            self.model.printed_until = vertex
             if not self.refresh_timer.IsRunning():
                 self.refresh_timer.Start()
 
@@ -23,6 +23,7 @@ import math
 import logging
 import threading
 
+from bisect import bisect_left
 from ctypes import sizeof
 
 from pyglet.gl import glPushMatrix, glPopMatrix, glTranslatef, \
@@ -35,7 +36,9 @@ from pyglet.gl import glPushMatrix, glPopMatrix, glTranslatef, \
     glEnableClientState, glDisableClientState, GL_VERTEX_ARRAY, GL_COLOR_ARRAY, \
     GL_FRONT_AND_BACK, GL_FRONT, glMaterialfv, GL_SPECULAR, GL_EMISSION, \
     glColorMaterial, GL_AMBIENT_AND_DIFFUSE, glMaterialf, GL_SHININESS, \
-    GL_NORMAL_ARRAY, glNormalPointer, GL_LIGHTING, glColor3f
+    GL_NORMAL_ARRAY, glNormalPointer, GL_LIGHTING, glColor3f, GLdouble, GLint, \
+    glGetDoublev, glGetIntegerv, GL_MODELVIEW_MATRIX, GL_PROJECTION_MATRIX, \
+    GL_VIEWPORT
 from pyglet.graphics.vertexbuffer import create_buffer, VertexBufferObject
 
 from printrun.utils import install_locale
@@ -315,6 +318,270 @@ def get_next_move(gcode, layer_idx, gline_idx):
         gline_idx = 0
     return None
 
+# Triangles closing the rectangle across a path at its start and at its end,
+# and linking two rectangles (vertices 0-3 to vertices 4-7), as index offsets
+rectangle_start = numpy.array(triangulate_rectangle(0, 1, 2, 3))
+rectangle_end = numpy.array(triangulate_rectangle(3, 2, 1, 0))
+box_offsets = numpy.array(triangulate_box(0, 1, 2, 3, 4, 5, 6, 7))
+
+def _box_indices(first, second):
+    """Indices of the boxes linking the rectangles starting at vertices
+    first to the ones starting at second"""
+    return numpy.where(box_offsets < 4, first[:, None] + box_offsets,
+                       second[:, None] + (box_offsets - 4))
+
+def _rectangles(centers, normals, halfwidths, halfheight):
+    """Vertices and normals of the rectangles across paths going through
+    centers, normals being the unit normals of the paths in the XY plane"""
+    count = len(centers)
+    offsets = halfwidths[:, None] * normals
+    vertices = numpy.repeat(centers[:, None, :], 4, axis = 1)
+    vertices[:, 0, 2] += halfheight
+    vertices[:, 1, :2] -= offsets
+    vertices[:, 2, 2] -= halfheight
+    vertices[:, 3, :2] += offsets
+    vertex_normals = numpy.zeros((count, 4, 3))
+    vertex_normals[:, 0, 2] = 1
+    vertex_normals[:, 1, :2] = -normals
+    vertex_normals[:, 2, 2] = -1
+    vertex_normals[:, 3, :2] = normals
+    return vertices, vertex_normals
+
+class PathGeometry:
+    """Builds the geometry of GcodeModel from whole layers of moves.
+
+    Each extruding move is a box around its path: a rectangle across the
+    path at its start, joined to the end of the previous move when that one
+    extrudes too (with an extra rectangle in sharp turns), and a rectangle
+    closing the path at its end unless the next move extrudes. Other moves
+    are travel segments. Extruding moves which do not move in XY are not
+    drawn at all. The position and direction of the last move carry over
+    from one layer to the next."""
+
+    def __init__(self, path_halfwidth, path_halfheight, tool_colors):
+        self.path_halfwidth = path_halfwidth
+        self.path_halfheight = path_halfheight
+        # RGB of the extrusions of tools 0 to 3, then of the other tools
+        self.tool_colors = numpy.array(tool_colors)[:, :3]
+        self.prev_pos = numpy.zeros(3)
+        self.prev_is_extruding = False
+        self.prev_move_normal = None
+        self.prev_move_angle = None
+
+    def add_layer(self, positions, extruding, next_extruding, tools,
+                  first_vertex = 0):
+        """Geometry of the moves to positions (n x 3), first_vertex being
+        the number of vertices built before.
+
+        Returns whether each move gets drawn, the travel segments, the
+        vertices, normals, colors and indices of the extrusions, the indices
+        of their outline as lines (one along each box, at the top of the
+        path), and the number of travel vertices, indices, vertices and line
+        indices added up to each drawn move."""
+        positions = numpy.asarray(positions, dtype = numpy.float64).reshape(-1, 3)
+        extruding = numpy.asarray(extruding, dtype = bool)
+        # An extruding move staying in place in XY is skipped, without
+        # becoming the previous position: the previous position always
+        # has the XY of the previous move
+        previous = numpy.concatenate((self.prev_pos[None, :], positions[:-1]))
+        delta = positions[:, :2] - previous[:, :2]
+        norm = delta[:, 0] * delta[:, 0] + delta[:, 1] * delta[:, 1]
+        drawn = ~(extruding & (norm == 0))
+        positions = positions[drawn]
+        extruding = extruding[drawn]
+        next_extruding = numpy.asarray(next_extruding, dtype = bool)[drawn]
+        tools = numpy.asarray(tools, dtype = numpy.int64)[drawn]
+        tools[(tools < 0) | (tools > 4)] = 4
+        previous = numpy.concatenate((self.prev_pos[None, :], positions[:-1]))
+        delta = delta[drawn]
+        norm = norm[drawn]
+        prev_extruding = numpy.concatenate(([self.prev_is_extruding], extruding[:-1]))
+
+        travel = ~extruding
+        travels = numpy.concatenate((previous[travel], positions[travel]), axis = 1)
+
+        # Extrusions
+        moves = numpy.flatnonzero(extruding)
+        count = len(moves)
+        norm = numpy.sqrt(norm[moves])
+        move_normals = numpy.empty((count, 2))
+        move_normals[:, 0] = - delta[moves, 1] / norm
+        move_normals[:, 1] = delta[moves, 0] / norm
+        # math rather than NumPy, whose vectorized functions may round
+        # differently
+        move_angles = numpy.fromiter(map(math.atan2, delta[moves, 1].tolist(),
+                                         delta[moves, 0].tolist()),
+                                     dtype = numpy.float64, count = count)
+        if self.prev_move_normal is not None:
+            prev_move_normals = numpy.concatenate(([self.prev_move_normal], move_normals[:-1]))
+            prev_move_angles = numpy.concatenate(([self.prev_move_angle], move_angles[:-1]))
+        else:
+            # Only used after an extruding move, there is none before
+            prev_move_normals = numpy.concatenate((numpy.zeros((1, 2)), move_normals[:-1]))[:count]
+            prev_move_angles = numpy.concatenate(([0.0], move_angles[:-1]))[:count]
+        joined = prev_extruding[moves]
+        twopi = 2 * math.pi
+        delta_angles = (move_angles - prev_move_angles + twopi) % twopi
+        facts = numpy.abs(numpy.fromiter(map(math.cos, (delta_angles / 2).tolist()),
+                                         dtype = numpy.float64, count = count))
+        # Sharp turns get an intermediate rectangle instead of a big peak
+        sharp = joined & (facts < 0.5)
+        smooth = joined & ~sharp
+        capped = ~next_extruding[moves]
+
+        path_halfwidth = self.path_halfwidth
+        halfwidths = numpy.full(count, path_halfwidth)
+        start_normals = move_normals.copy()
+        start_normals[sharp] = prev_move_normals[sharp]
+        avg_normals = (prev_move_normals[smooth] + move_normals[smooth]) / 2
+        avg_norm = avg_normals[:, 0] * avg_normals[:, 0] + avg_normals[:, 1] * avg_normals[:, 1]
+        degenerate = avg_norm == 0
+        avg_normals[degenerate] = move_normals[smooth][degenerate]
+        avg_normals[~degenerate] /= numpy.sqrt(avg_norm[~degenerate])[:, None]
+        start_normals[smooth] = avg_normals
+        halfwidths[smooth] = path_halfwidth / facts[smooth]
+
+        nvertices = 4 + 4 * sharp + 4 * capped
+        nindices = numpy.where(joined, numpy.where(sharp, 48, 24), 6) + 30 * capped
+        vertex_ends = numpy.cumsum(nvertices)
+        index_ends = numpy.cumsum(nindices)
+        bases = first_vertex + vertex_ends - nvertices
+        index_starts = index_ends - nindices
+        nvertex = int(vertex_ends[-1]) if count else 0
+
+        # Rectangles: at the start of each move, after it in sharp turns,
+        # at the end of capped moves
+        halfheight = self.path_halfheight
+        move_previous = previous[moves]
+        groups = [(move_previous, start_normals, halfwidths, bases),
+                  (move_previous[sharp], move_normals[sharp],
+                   numpy.full(int(sharp.sum()), path_halfwidth), bases[sharp] + 4),
+                  (positions[moves][capped], move_normals[capped],
+                   numpy.full(int(capped.sum()), path_halfwidth),
+                   bases[capped] + nvertices[capped] - 4)]
+        vertices = numpy.empty((nvertex, 3))
+        normals = numpy.empty((nvertex, 3))
+        for centers, group_normals, group_halfwidths, group_bases in groups:
+            group_vertices, group_vertex_normals = _rectangles(
+                centers, group_normals, group_halfwidths, halfheight)
+            slots = (group_bases - first_vertex)[:, None] + numpy.arange(4)
+            vertices[slots] = group_vertices
+            normals[slots] = group_vertex_normals
+        colors = numpy.repeat(self.tool_colors[tools[moves]],
+                              nvertices, axis = 0)
+
+        indices = numpy.empty(int(index_ends[-1]) if count else 0, dtype = numpy.int64)
+        starts = ~joined
+        indices[index_starts[starts, None] + numpy.arange(6)] = \
+            bases[starts, None] + rectangle_start
+        indices[index_starts[joined, None] + numpy.arange(24)] = \
+            _box_indices(bases[joined] - 4, bases[joined])
+        indices[index_starts[sharp, None] + 24 + numpy.arange(24)] = \
+            _box_indices(bases[sharp], bases[sharp] + 4)
+        ends = bases[capped] + nvertices[capped] - 4
+        cap_starts = index_starts[capped] + nindices[capped] - 30
+        indices[cap_starts[:, None] + numpy.arange(6)] = ends[:, None] + rectangle_end
+        indices[cap_starts[:, None] + 6 + numpy.arange(24)] = \
+            _box_indices(bases[capped] + 4 * sharp[capped], ends)
+
+        # Lines joining the top vertices of the rectangles each box links
+        nlines = 2 * (joined.astype(numpy.int64) + sharp + capped)
+        line_ends = numpy.cumsum(nlines)
+        line_starts = line_ends - nlines
+        lines = numpy.empty(int(line_ends[-1]) if count else 0, dtype = numpy.int64)
+        lines[line_starts[joined]] = bases[joined] - 4
+        lines[line_starts[joined] + 1] = bases[joined]
+        lines[line_starts[sharp] + 2] = bases[sharp]
+        lines[line_starts[sharp] + 3] = bases[sharp] + 4
+        lines[line_ends[capped] - 2] = bases[capped] + 4 * sharp[capped]
+        lines[line_ends[capped] - 1] = ends
+
+        # Totals after each drawn move
+        travel_counts = numpy.cumsum(2 * travel)
+        move_nindices = numpy.zeros(len(positions), dtype = numpy.int64)
+        move_nindices[moves] = nindices
+        move_nvertices = numpy.zeros(len(positions), dtype = numpy.int64)
+        move_nvertices[moves] = nvertices
+        index_counts = numpy.cumsum(move_nindices)
+        vertex_counts = numpy.cumsum(move_nvertices)
+        move_nlines = numpy.zeros(len(positions), dtype = numpy.int64)
+        move_nlines[moves] = nlines
+        line_counts = numpy.cumsum(move_nlines)
+
+        if len(positions):
+            self.prev_pos = positions[-1]
+            self.prev_is_extruding = bool(extruding[-1])
+        if count:
+            self.prev_move_normal = move_normals[-1]
+            self.prev_move_angle = move_angles[-1]
+        return (drawn, travels.reshape(-1), vertices.reshape(-1),
+                normals.reshape(-1), colors.reshape(-1), indices, lines,
+                travel_counts, index_counts, vertex_counts, line_counts)
+
+# How layers get drawn (see GcodeModel.plan_layers)
+draw_none = 0
+draw_lines = 1
+draw_full = 2
+
+def layer_bounds(vertices, count_print_vertices, layer_stops, nlayers):
+    """Lower and upper corners of the extrusions of the first nlayers layers
+    of a GcodeModel, indexed like layer_stops (NaN for layers without any)"""
+    vertex_stops = numpy.array([count_print_vertices[stop]
+                                for stop in layer_stops[:nlayers + 1]], dtype = numpy.int64)
+    points = vertices[:3 * vertex_stops[-1]].reshape(-1, 3)
+    lower = numpy.full((len(vertex_stops), 3), numpy.nan)
+    upper = numpy.full((len(vertex_stops), 3), numpy.nan)
+    starts = vertex_stops[:-1]
+    nonempty = vertex_stops[1:] > starts
+    if nonempty.any():
+        # Empty layers in between do not add anything to the reductions
+        layers = 1 + numpy.flatnonzero(nonempty)
+        lower[layers] = numpy.minimum.reduceat(points, starts[nonempty], axis = 0)
+        upper[layers] = numpy.maximum.reduceat(points, starts[nonempty], axis = 0)
+    return lower, upper
+
+class ViewFrustum:
+    """The volume in view, in model coordinates, from the OpenGL matrices
+    (column major, as glGetDoublev returns them) and viewport"""
+
+    def __init__(self, projection, modelview, viewport):
+        projection = numpy.array(projection, dtype = numpy.float64).reshape(4, 4).T
+        modelview = numpy.array(modelview, dtype = numpy.float64).reshape(4, 4).T
+        self.clip = clip = projection @ modelview
+        self.viewport = tuple(viewport)
+        # Planes with the volume on their positive side
+        self.planes = numpy.array([clip[3] + clip[0], clip[3] - clip[0],
+                                   clip[3] + clip[1], clip[3] - clip[1],
+                                   clip[3] + clip[2], clip[3] - clip[2]])
+
+    @classmethod
+    def current(cls):
+        projection = (GLdouble * 16)()
+        modelview = (GLdouble * 16)()
+        viewport = (GLint * 4)()
+        glGetDoublev(GL_PROJECTION_MATRIX, projection)
+        glGetDoublev(GL_MODELVIEW_MATRIX, modelview)
+        glGetIntegerv(GL_VIEWPORT, viewport)
+        return cls(projection, modelview, viewport)
+
+    def visible(self, lower, upper):
+        """Whether the boxes from lower to upper (n x 3) may be in view"""
+        normals = self.planes[:, :3]
+        # Corners of the boxes the furthest along each plane normal
+        corners = numpy.where(normals >= 0, upper[:, None, :], lower[:, None, :])
+        with numpy.errstate(invalid = "ignore"):
+            distances = (corners * normals).sum(axis = 2) + self.planes[:, 3]
+            return (distances >= 0).all(axis = 1)
+
+    def pixels_per_mm(self, points):
+        """Rough size on screen of a millimeter around points (n x 3)"""
+        clip = self.clip
+        scale = max(numpy.linalg.norm(clip[0, :3]) * self.viewport[2],
+                    numpy.linalg.norm(clip[1, :3]) * self.viewport[3]) / 2
+        depths = numpy.abs(points @ clip[3, :3] + clip[3, 3])
+        with numpy.errstate(divide = "ignore", invalid = "ignore"):
+            return scale / depths
+
 class GcodeModel(Model):
     """
     Model for displaying Gcode data.
@@ -342,25 +609,51 @@ class GcodeModel(Model):
     path_halfwidth = 0.2
     path_halfheight = 0.2
 
+    # Skip layers out of view
+    frustum_culling = True
+    # Draw the extrusions as lines in layers more than lod_layers below the
+    # last drawn one, and in those where paths would be thinner than
+    # lod_pixels on screen
+    lod = True
+    lod_layers = 20
+    lod_pixels = 1.5
+
+    # How each layer got drawn in the last frame, by plan_layers
+    layer_modes = None
+
     def set_path_size(self, path_halfwidth, path_halfheight):
         with self.lock:
             self.path_halfwidth = path_halfwidth
             self.path_halfheight = path_halfheight
 
-    def load_data(self, model_data, callback=None):
+    # What load_data builds, which gets stored in a mesh cache
+    geometry_fields = ("travels", "vertices", "colors", "normals", "indices",
+                       "lod_indices", "layer_stops", "count_travel_indices",
+                       "count_print_indices", "count_print_vertices",
+                       "count_lod_indices", "layer_idxs_map", "dims")
+
+    def load_data(self, model_data, callback=None, mesh_cache=None):
         t_start = time.time()
         self.gcode = model_data
 
+        if mesh_cache is not None:
+            geometry = mesh_cache.load(self, model_data)
+            if geometry is not None:
+                yield from self.load_cached_data(model_data, geometry, mesh_cache,
+                                                 callback, t_start)
+                return
+
         self.count_travel_indices = count_travel_indices = [0]
         self.count_print_indices = count_print_indices = [0]
         self.count_print_vertices = count_print_vertices = [0]
+        self.count_lod_indices = count_lod_indices = [0]
 
         # Some trivial computations, but that's mostly for documentation :)
         # Not like 10 multiplications are going to cost much time vs what's
         # about to happen :)
 
-        # Max number of values which can be generated per gline
-        # to store coordinates/colors/normals.
+        # Number of values which are usually generated per gline
+        # to store coordinates/colors/normals (sharp turns take more).
         # Nicely enough we have 3 per kind of thing for all kinds.
         coordspervertex = 3
         verticesperline = 8
@@ -394,224 +687,85 @@ class GcodeModel(Model):
         normal_k = 0
         indices = self.indices = numpy.zeros(nindices, dtype = GLuint)
         index_k = 0
+        lod_indices = self.lod_indices = numpy.zeros(nlines * 2, dtype = GLuint)
+        lod_index_k = 0
         self.layer_idxs_map = {}
         self.layer_stops = [0]
 
-        prev_is_extruding = False
-        prev_move_normal_x = None
-        prev_move_normal_y = None
-        prev_move_angle = None
-
-        prev_pos = (0, 0, 0)
+        # FIXME: compute these dynamically
+        geometry = PathGeometry(self.path_halfwidth * 1.2, self.path_halfheight * 1.2,
+                                (self.color_tool0, self.color_tool1, self.color_tool2,
+                                 self.color_tool3, self.color_tool4))
         layer_idx = 0
 
         self.printed_until = 0
         self.only_current = False
 
-        twopi = 2 * math.pi
-
         processed_lines = 0
 
+        def reserve(array_, size, needed):
+            if needed > array_.size:
+                array_.resize(max(size, needed), refcheck = False)
+
         while layer_idx < len(model_data.all_layers):
             with self.lock:
                 nlines = len(model_data)
                 remaining_lines = nlines - processed_lines
-                # Only reallocate memory which might be needed, not memory
-                # for everything
-                ntravelcoords = coords_count(remaining_lines) + travel_vertex_k
-                ncoords = coords_count(remaining_lines) + vertex_k
-                nindices = indices_count(remaining_lines) + index_k
-                if ncoords > vertices.size:
-                    self.travels.resize(ntravelcoords, refcheck = False)
-                    self.vertices.resize(ncoords, refcheck = False)
-                    self.colors.resize(ncoords, refcheck = False)
-                    self.normals.resize(ncoords, refcheck = False)
-                    self.indices.resize(nindices, refcheck = False)
                 layer = model_data.all_layers[layer_idx]
-                has_movement = False
-                for gline_idx, gline in enumerate(layer):
-                    if not gline.is_move:
-                        continue
-                    if gline.x is None and gline.y is None and gline.z is None:
-                        continue
-                    has_movement = True
-                    current_pos = (gline.current_x, gline.current_y, gline.current_z)
-                    if not gline.extruding:
-                        travel_vertices[travel_vertex_k] = prev_pos[0]
-                        travel_vertices[travel_vertex_k + 1] = prev_pos[1]
-                        travel_vertices[travel_vertex_k + 2] = prev_pos[2]
-                        travel_vertices[travel_vertex_k + 3] = current_pos[0]
-                        travel_vertices[travel_vertex_k + 4] = current_pos[1]
-                        travel_vertices[travel_vertex_k + 5] = current_pos[2]
-                        travel_vertex_k += 6
-                        prev_is_extruding = False
-                    else:
-                        gline_color = self.movement_color(gline)
-
-                        next_move = get_next_move(model_data, layer_idx, gline_idx)
-                        next_is_extruding = (next_move.extruding
-                                             if next_move is not None else False)
-
-                        delta_x = current_pos[0] - prev_pos[0]
-                        delta_y = current_pos[1] - prev_pos[1]
-                        norm = delta_x * delta_x + delta_y * delta_y
-                        if norm == 0:  # Don't draw anything if this move is Z+E only
-                            continue
-                        norm = math.sqrt(norm)
-                        move_normal_x = - delta_y / norm
-                        move_normal_y = delta_x / norm
-                        move_angle = math.atan2(delta_y, delta_x)
-
-                        # FIXME: compute these dynamically
-                        path_halfwidth = self.path_halfwidth * 1.2
-                        path_halfheight = self.path_halfheight * 1.2
-
-                        new_indices = []
-                        new_vertices = []
-                        new_normals = []
-                        if prev_is_extruding:
-                            # Store previous vertices indices
-                            prev_id = vertex_k // 3 - 4
-                            avg_move_normal_x = (prev_move_normal_x + move_normal_x) / 2
-                            avg_move_normal_y = (prev_move_normal_y + move_normal_y) / 2
-                            norm = avg_move_normal_x * avg_move_normal_x + avg_move_normal_y * avg_move_normal_y
-                            if norm == 0:
-                                avg_move_normal_x = move_normal_x
-                                avg_move_normal_y = move_normal_y
-                            else:
-                                norm = math.sqrt(norm)
-                                avg_move_normal_x /= norm
-                                avg_move_normal_y /= norm
-                            delta_angle = move_angle - prev_move_angle
-                            delta_angle = (delta_angle + twopi) % twopi
-                            fact = abs(math.cos(delta_angle / 2))
-                            # If move is turning too much, avoid creating a big peak
-                            # by adding an intermediate box
-                            if fact < 0.5:
-                                # FIXME: It looks like there's some heavy code duplication here...
-                                hw = path_halfwidth
-                                p1x = prev_pos[0] - hw * prev_move_normal_x
-                                p2x = prev_pos[0] + hw * prev_move_normal_x
-                                p1y = prev_pos[1] - hw * prev_move_normal_y
-                                p2y = prev_pos[1] + hw * prev_move_normal_y
-                                new_vertices.extend((prev_pos[0], prev_pos[1], prev_pos[2] + path_halfheight))
-                                new_vertices.extend((p1x, p1y, prev_pos[2]))
-                                new_vertices.extend((prev_pos[0], prev_pos[1], prev_pos[2] - path_halfheight))
-                                new_vertices.extend((p2x, p2y, prev_pos[2]))
-                                new_normals.extend((0, 0, 1))
-                                new_normals.extend((-prev_move_normal_x, -prev_move_normal_y, 0))
-                                new_normals.extend((0, 0, -1))
-                                new_normals.extend((prev_move_normal_x, prev_move_normal_y, 0))
-                                first = vertex_k // 3
-                                # Link to previous
-                                new_indices += triangulate_box(prev_id, prev_id + 1,
-                                                               prev_id + 2, prev_id + 3,
-                                                               first, first + 1,
-                                                               first + 2, first + 3)
-                                p1x = prev_pos[0] - hw * move_normal_x
-                                p2x = prev_pos[0] + hw * move_normal_x
-                                p1y = prev_pos[1] - hw * move_normal_y
-                                p2y = prev_pos[1] + hw * move_normal_y
-                                new_vertices.extend((prev_pos[0], prev_pos[1], prev_pos[2] + path_halfheight))
-                                new_vertices.extend((p1x, p1y, prev_pos[2]))
-                                new_vertices.extend((prev_pos[0], prev_pos[1], prev_pos[2] - path_halfheight))
-                                new_vertices.extend((p2x, p2y, prev_pos[2]))
-                                new_normals.extend((0, 0, 1))
-                                new_normals.extend((-move_normal_x, -move_normal_y, 0))
-                                new_normals.extend((0, 0, -1))
-                                new_normals.extend((move_normal_x, move_normal_y, 0))
-                                prev_id += 4
-                                first += 4
-                                # Link to previous
-                                new_indices += triangulate_box(prev_id, prev_id + 1,
-                                                               prev_id + 2, prev_id + 3,
-                                                               first, first + 1,
-                                                               first + 2, first + 3)
-                            else:
-                                hw = path_halfwidth / fact
-                                # Compute vertices
-                                p1x = prev_pos[0] - hw * avg_move_normal_x
-                                p2x = prev_pos[0] + hw * avg_move_normal_x
-                                p1y = prev_pos[1] - hw * avg_move_normal_y
-                                p2y = prev_pos[1] + hw * avg_move_normal_y
-                                new_vertices.extend((prev_pos[0], prev_pos[1], prev_pos[2] + path_halfheight))
-                                new_vertices.extend((p1x, p1y, prev_pos[2]))
-                                new_vertices.extend((prev_pos[0], prev_pos[1], prev_pos[2] - path_halfheight))
-                                new_vertices.extend((p2x, p2y, prev_pos[2]))
-                                new_normals.extend((0, 0, 1))
-                                new_normals.extend((-avg_move_normal_x, -avg_move_normal_y, 0))
-                                new_normals.extend((0, 0, -1))
-                                new_normals.extend((avg_move_normal_x, avg_move_normal_y, 0))
-                                first = vertex_k // 3
-                                # Link to previous
-                                new_indices += triangulate_box(prev_id, prev_id + 1,
-                                                               prev_id + 2, prev_id + 3,
-                                                               first, first + 1,
-                                                               first + 2, first + 3)
-                        else:
-                            # Compute vertices normal to the current move and cap it
-                            p1x = prev_pos[0] - path_halfwidth * move_normal_x
-                            p2x = prev_pos[0] + path_halfwidth * move_normal_x
-                            p1y = prev_pos[1] - path_halfwidth * move_normal_y
-                            p2y = prev_pos[1] + path_halfwidth * move_normal_y
-                            new_vertices.extend((prev_pos[0], prev_pos[1], prev_pos[2] + path_halfheight))
-                            new_vertices.extend((p1x, p1y, prev_pos[2]))
-                            new_vertices.extend((prev_pos[0], prev_pos[1], prev_pos[2] - path_halfheight))
-                            new_vertices.extend((p2x, p2y, prev_pos[2]))
-                            new_normals.extend((0, 0, 1))
-                            new_normals.extend((-move_normal_x, -move_normal_y, 0))
-                            new_normals.extend((0, 0, -1))
-                            new_normals.extend((move_normal_x, move_normal_y, 0))
-                            first = vertex_k // 3
-                            new_indices = triangulate_rectangle(first, first + 1,
-                                                                first + 2, first + 3)
-
-                        if not next_is_extruding:
-                            # Compute caps and link everything
-                            p1x = current_pos[0] - path_halfwidth * move_normal_x
-                            p2x = current_pos[0] + path_halfwidth * move_normal_x
-                            p1y = current_pos[1] - path_halfwidth * move_normal_y
-                            p2y = current_pos[1] + path_halfwidth * move_normal_y
-                            new_vertices.extend((current_pos[0], current_pos[1], current_pos[2] + path_halfheight))
-                            new_vertices.extend((p1x, p1y, current_pos[2]))
-                            new_vertices.extend((current_pos[0], current_pos[1], current_pos[2] - path_halfheight))
-                            new_vertices.extend((p2x, p2y, current_pos[2]))
-                            new_normals.extend((0, 0, 1))
-                            new_normals.extend((-move_normal_x, -move_normal_y, 0))
-                            new_normals.extend((0, 0, -1))
-                            new_normals.extend((move_normal_x, move_normal_y, 0))
-                            end_first = vertex_k // 3 + len(new_vertices) // 3 - 4
-                            new_indices += triangulate_rectangle(end_first + 3, end_first + 2,
-                                                                 end_first + 1, end_first)
-                            new_indices += triangulate_box(first, first + 1,
-                                                           first + 2, first + 3,
-                                                           end_first, end_first + 1,
-                                                           end_first + 2, end_first + 3)
-
-                        for new_i, item in enumerate(new_indices):
-                            indices[index_k + new_i] = item
-                        index_k += len(new_indices)
-                        for new_i, item in enumerate(new_vertices):
-                            vertices[vertex_k + new_i] = item
-                        vertex_k += len(new_vertices)
-                        for new_i, item in enumerate(new_normals):
-                            normals[normal_k + new_i] = item
-                        normal_k += len(new_normals)
-                        new_colors = list(gline_color)[:-1] * (len(new_vertices) // 3)
-                        for new_i, item in enumerate(new_colors):
-                            colors[color_k + new_i] = item
-                        color_k += len(new_colors)
-
-                        prev_is_extruding = True
-                        prev_move_normal_x = move_normal_x
-                        prev_move_normal_y = move_normal_y
-                        prev_move_angle = move_angle
+                moves = [gline for gline in layer if gline.is_move]
+                next_extruding = [gline.extruding for gline in moves[1:]]
+                if moves:
+                    next_move = get_next_move(model_data, layer_idx, len(layer) - 1)
+                    next_extruding.append(next_move.extruding
+                                          if next_move is not None else False)
+                drawn = [(gline, next_is_extruding)
+                         for gline, next_is_extruding in zip(moves, next_extruding)
+                         if gline.x is not None or gline.y is not None or gline.z is not None]
+                has_movement = bool(drawn)
+                (kept, new_travels, new_vertices, new_normals, new_colors, new_indices,
+                 new_lod_indices, travel_counts, index_counts, vertex_counts,
+                 lod_counts) = geometry.add_layer(
+                    [(gline.current_x, gline.current_y, gline.current_z) for gline, _ in drawn],
+                    [bool(gline.extruding) for gline, _ in drawn],
+                    [bool(next_is_extruding) for _, next_is_extruding in drawn],
+                    [gline.current_tool for gline, _ in drawn],
+                    vertex_k // 3)
 
-                    prev_pos = current_pos
-                    count_travel_indices.append(travel_vertex_k // 3)
-                    count_print_indices.append(index_k)
-                    count_print_vertices.append(vertex_k // 3)
-                    gline.gcview_end_vertex = len(count_print_indices) - 1
+                # Only reallocate memory which might be needed, not memory
+                # for everything
+                reserve(travel_vertices, travel_coords_count(remaining_lines) + travel_vertex_k,
+                        travel_vertex_k + len(new_travels))
+                reserve(vertices, coords_count(remaining_lines) + vertex_k,
+                        vertex_k + len(new_vertices))
+                reserve(colors, coords_count(remaining_lines) + vertex_k,
+                        vertex_k + len(new_vertices))
+                reserve(normals, coords_count(remaining_lines) + vertex_k,
+                        vertex_k + len(new_vertices))
+                reserve(indices, indices_count(remaining_lines) + index_k,
+                        index_k + len(new_indices))
+                reserve(lod_indices, 2 * remaining_lines + lod_index_k,
+                        lod_index_k + len(new_lod_indices))
+                travel_vertices[travel_vertex_k:travel_vertex_k + len(new_travels)] = new_travels
+                vertices[vertex_k:vertex_k + len(new_vertices)] = new_vertices
+                normals[normal_k:normal_k + len(new_normals)] = new_normals
+                colors[color_k:color_k + len(new_colors)] = new_colors
+                indices[index_k:index_k + len(new_indices)] = new_indices
+                lod_indices[lod_index_k:lod_index_k + len(new_lod_indices)] = new_lod_indices
+
+                end_vertex = len(count_print_indices)
+                for gline in [gline for (gline, _), is_kept in zip(drawn, kept) if is_kept]:
+                    gline.gcview_end_vertex = end_vertex
+                    end_vertex += 1
+                count_travel_indices.extend((travel_counts + travel_vertex_k // 3).tolist())
+                count_print_indices.extend((index_counts + index_k).tolist())
+                count_print_vertices.extend((vertex_counts + vertex_k // 3).tolist())
+                count_lod_indices.extend((lod_counts + lod_index_k).tolist())
+                travel_vertex_k += len(new_travels)
+                vertex_k += len(new_vertices)
+                normal_k += len(new_normals)
+                color_k += len(new_colors)
+                index_k += len(new_indices)
+                lod_index_k += len(new_lod_indices)
 
                 if has_movement:
                     self.layer_stops.append(len(count_print_indices) - 1)
@@ -639,11 +793,13 @@ class GcodeModel(Model):
             self.colors.resize(color_k, refcheck = False)
             self.normals.resize(normal_k, refcheck = False)
             self.indices.resize(index_k, refcheck = False)
+            self.lod_indices.resize(lod_index_k, refcheck = False)
 
             self.layer_stops = array.array('L', self.layer_stops)
             self.count_travel_indices = array.array('L', count_travel_indices)
             self.count_print_indices = array.array('L', count_print_indices)
             self.count_print_vertices = array.array('L', count_print_vertices)
+            self.count_lod_indices = array.array('L', count_lod_indices)
 
             self.max_layers = len(self.layer_stops) - 1
             self.num_layers_to_draw = self.max_layers + 1
@@ -651,20 +807,51 @@ class GcodeModel(Model):
             self.initialized = False
             self.loaded = True
             self.fully_loaded = True
+            geometry = {name: getattr(self, name) for name in self.geometry_fields}
 
         t_end = time.time()
 
         logging.debug(_('Initialized 3D visualization in %.2f seconds') % (t_end - t_start))
-        logging.debug(_('Vertex count: %d') % ((len(self.vertices) + len(self.travels)) // 3))
+        logging.debug(_('Vertex count: %d') % ((len(geometry["vertices"]) + len(geometry["travels"])) // 3))
+        if mesh_cache is not None:
+            mesh_cache.store(self, model_data, geometry)
+        yield None
+
+    def load_cached_data(self, model_data, geometry, mesh_cache, callback, t_start):
+        """load_data with the geometry loaded from mesh_cache, only going
+        through the layers of model_data to annotate their lines"""
+        with self.lock:
+            for name, value in geometry.items():
+                setattr(self, name, value)
+            self.printed_until = 0
+            self.only_current = False
+            self.max_layers = len(self.layer_stops) - 1
+            self.num_layers_to_draw = self.max_layers + 1
+            self.initialized = False
+            self.loaded = True
+            self.fully_loaded = True
+
+        layer_idx = 0
+        while layer_idx < len(model_data.all_layers):
+            mesh_cache.annotate_layer(model_data, layer_idx)
+            if callback:
+                callback(layer_idx + 1)
+            yield layer_idx
+            layer_idx += 1
+
+        t_end = time.time()
+
+        logging.debug(_('Loaded 3D visualization from cache in %.2f seconds') % (t_end - t_start))
         yield None
 
     def copy(self):
         copy = GcodeModel()
         for var in ["vertices", "colors", "travels", "indices", "normals",
-                    "max_layers", "num_layers_to_draw", "printed_until",
-                    "layer_stops", "dims", "only_current",
+                    "lod_indices", "max_layers", "num_layers_to_draw",
+                    "printed_until", "layer_stops", "dims", "only_current",
                     "layer_idxs_map", "count_travel_indices",
                     "count_print_indices", "count_print_vertices",
+                    "count_lod_indices", "frustum_culling", "lod",
                     "path_halfwidth", "path_halfheight",
                     "gcode"]:
             setattr(copy, var, getattr(self, var))
@@ -684,19 +871,25 @@ class GcodeModel(Model):
             if self.buffers_created:
                 self.travel_buffer.delete()
                 self.index_buffer.delete()
+                self.lod_index_buffer.delete()
                 self.vertex_buffer.delete()
                 self.vertex_color_buffer.delete()
                 self.vertex_normal_buffer.delete()
             self.travel_buffer = numpy2vbo(self.travels, use_vbos = self.use_vbos)
             self.index_buffer = numpy2vbo(self.indices, use_vbos = self.use_vbos,
                                           target = GL_ELEMENT_ARRAY_BUFFER)
+            self.lod_index_buffer = numpy2vbo(self.lod_indices, use_vbos = self.use_vbos,
+                                              target = GL_ELEMENT_ARRAY_BUFFER)
             self.vertex_buffer = numpy2vbo(self.vertices, use_vbos = self.use_vbos)
             self.vertex_color_buffer = numpy2vbo(self.colors, use_vbos = self.use_vbos)
             self.vertex_normal_buffer = numpy2vbo(self.normals, use_vbos = self.use_vbos)
+            self.layer_bounds = layer_bounds(self.vertices, self.count_print_vertices,
+                                             self.layer_stops, self.layers_loaded)
             if self.fully_loaded:
                 # Delete numpy arrays after creating VBOs after full load
                 self.travels = None
                 self.indices = None
+                self.lod_indices = None
                 self.vertices = None
                 self.colors = None
                 self.normals = None
@@ -708,6 +901,11 @@ class GcodeModel(Model):
             glTranslatef(self.offset_x, self.offset_y, 0)
             glEnableClientState(GL_VERTEX_ARRAY)
 
+            if self.frustum_culling or self.lod:
+                self.layer_modes = self.plan_layers(ViewFrustum.current())
+            else:
+                self.layer_modes = None
+
             has_vbo = isinstance(self.vertex_buffer, VertexBufferObject)
             if self.display_travels:
                 self._display_travels(has_vbo)
@@ -750,16 +948,65 @@ class GcodeModel(Model):
 
         self.travel_buffer.unbind()
 
+    def plan_layers(self, frustum):
+        """How to draw each loaded layer in view of frustum, as an array of
+        draw_none, draw_lines or draw_full indexed like layer_stops"""
+        lower, upper = self.layer_bounds
+        modes = numpy.full(len(lower), draw_full, dtype = numpy.int8)
+        if self.frustum_culling:
+            modes[~frustum.visible(lower, upper)] = draw_none
+        if self.lod:
+            last_layer = min(self.num_layers_to_draw, self.layers_loaded)
+            far = numpy.arange(len(modes)) < last_layer - self.lod_layers
+            with numpy.errstate(invalid = "ignore"):
+                thin = frustum.pixels_per_mm((lower + upper) / 2) \
+                    * (2.4 * self.path_halfwidth) < self.lod_pixels
+            modes[(modes == draw_full) & (far | thin)] = draw_lines
+        return modes
+
+    def plan_ranges(self, start, end):
+        """Split the moves from start to end by how their layers get drawn,
+        as (mode, start, end) tuples, merging consecutive layers drawn the
+        same way and leaving out the ones not drawn"""
+        modes = self.layer_modes
+        if modes is None:
+            return [(draw_full, start, end)]
+        stops = self.layer_stops
+        ranges = []
+        last_layer = min(bisect_left(stops, end, 1), len(modes) - 1)
+        for layer in range(bisect_left(stops, start, 1), last_layer + 1):
+            mode = modes[layer]
+            if mode == draw_none:
+                continue
+            range_start = max(start, stops[layer - 1] + 1)
+            range_end = min(end, stops[layer])
+            if range_start > range_end:
+                continue
+            if ranges and ranges[-1][0] == mode and ranges[-1][2] + 1 == range_start:
+                ranges[-1] = (mode, ranges[-1][1], range_end)
+            else:
+                ranges.append((mode, range_start, range_end))
+        return ranges
+
     def _draw_elements(self, start, end, draw_type = GL_TRIANGLES):
+        for mode, range_start, range_end in self.plan_ranges(start, end):
+            if mode == draw_lines:
+                self.lod_index_buffer.bind()
+                self._draw_range(range_start, range_end, self.count_lod_indices, GL_LINES)
+                self.index_buffer.bind()
+            else:
+                self._draw_range(range_start, range_end, self.count_print_indices, draw_type)
+
+    def _draw_range(self, start, end, count_indices, draw_type):
         # Don't attempt printing empty layer
-        if self.count_print_indices[end] == self.count_print_indices[start - 1]:
+        if count_indices[end] == count_indices[start - 1]:
             return
         glDrawRangeElements(draw_type,
                             self.count_print_vertices[start - 1],
                             self.count_print_vertices[end] - 1,
-                            self.count_print_indices[end] - self.count_print_indices[start - 1],
+                            count_indices[end] - count_indices[start - 1],
                             GL_UNSIGNED_INT,
-                            sizeof(GLuint) * self.count_print_indices[start - 1])
+                            sizeof(GLuint) * count_indices[start - 1])
 
     def _display_movements(self, has_vbo):
         self.vertex_buffer.bind()
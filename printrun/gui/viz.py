@@ -41,6 +41,9 @@ class NoViz:
     def addgcodehighlight(self, *a, **kw):
         pass
 
+    def addgcodehighlights(self, *a, **kw):
+        pass
+
     def Refresh(self, *a):
         pass
 
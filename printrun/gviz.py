@@ -14,12 +14,13 @@
 # along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
 
 from queue import Queue
-from collections import deque
+from collections import deque, OrderedDict
 import numpy
 import wx
 import time
 from . import gcoder
 from .injectgcode import injector, injector_edit
+from .layerpreview import layer_moves
 
 from .utils import imagefile, install_locale, get_home_pos
 install_locale('pronterface')
@@ -103,6 +104,9 @@ class GvizWindow(GvizBaseFrame):
     def set_current_gline(self, gline):
         return
 
+    def set_printed_until(self, vertex):
+        return
+
     def process_slider(self, event):
         self.p.layerindex = self.layerslider.GetValue()
         z = self.p.get_currentz()
@@ -119,6 +123,8 @@ class GvizWindow(GvizBaseFrame):
         if event.ButtonUp(wx.MOUSE_BTN_LEFT) or event.ButtonUp(wx.MOUSE_BTN_RIGHT):
             if self.initpos is not None:
                 self.initpos = None
+        elif event.LeftDClick():
+            self.p.select_line(*event.GetPosition())
         elif event.Dragging():
             e = event.GetPosition()
             if self.initpos is None:
@@ -171,6 +177,11 @@ class Gviz(wx.Panel):
             self._showall = showall
     showall = property(_get_showall, _set_showall)
 
+    # Layers whose scaled coordinates are kept, and images of the platform
+    # with the layers on display kept for the last layers shown
+    cached_layers = 16
+    cached_composites = 8
+
     def __init__(self, parent, size = (200, 200), build_dimensions = [200, 200, 100, 0, 0, 0], grid = (10, 50), extrusion_width = 0.5, bgcolor = "#000000", realparent = None):
         wx.Panel.__init__(self, parent, -1)
         self.widget = self
@@ -187,6 +198,8 @@ class Gviz(wx.Panel):
         self.hilightarcs = deque()
         self.hilightqueue = Queue(0)
         self.hilightarcsqueue = Queue(0)
+        self.background = None
+        self.background_key = None
         self.clear()
         self.filament_width = extrusion_width  # set it to 0 to disable scaling lines with zoom
         self.update_basescale()
@@ -230,12 +243,15 @@ class Gviz(wx.Panel):
         self.arcpens = {}
         self.layers = {}
         self.layersz = []
+        self.selected = None
         self.clearhilights()
         self.layerindex = 0
         self.showall = 0
         self.dirty = True
         self.partial = False
         self.painted_layers = set()
+        self.scaled = OrderedDict()
+        self.composites = OrderedDict()
         wx.CallAfter(self.Refresh)
 
     def get_currentz(self):
@@ -269,6 +285,33 @@ class Gviz(wx.Panel):
             self.showall = 0
             wx.CallAfter(self.Refresh)
 
+    def select_line(self, x, y):
+        """Select the line of the current layer whose move passes closest to
+        the window position (x, y), telling it in the status bar"""
+        if self.gcode is None or self.showall:
+            return None
+        layers = [layer for layer, viz_layer in self.layers.items()
+                  if viz_layer == self.layerindex]
+        if not layers:
+            return None
+        layer = layers[0]
+        # Window to platform coordinates, and these to G-code positions
+        x = (x - self.translate[0]) / self.scale[0] + self.build_dimensions[3]
+        y = self.build_dimensions[4] + self.build_dimensions[1] - (y - self.translate[1]) / self.scale[1]
+        index = self.gcode.spatial_index()
+        found = index.nearest_line(layer, x, y, 5.0 / min(self.scale))
+        if found is None:
+            self.selected = None
+        else:
+            line = found[0]
+            start, end = index.segment(layer, line)
+            self.selected = (self.layerindex, self._platform_coords([start + end]))
+            gline = self.gcode.all_layers[layer][line]
+            wx.CallAfter(self.parent.SetStatusText, _("Layer %d, line %d: %s") % (self.layerindex + 1, line + 1, gline.raw), 0)
+        self.dirty = True
+        wx.CallAfter(self.Refresh)
+        return found and (layer, found[0])
+
     def update_basescale(self):
         self.basescale = 2 * [min(float(self.size[0] - 1) / self.build_dimensions[0],
                                   float(self.size[1] - 1) / self.build_dimensions[1])]
@@ -294,40 +337,61 @@ class Gviz(wx.Panel):
         penwidth = max(1.0, self.filament_width * ((self.scale[0] + self.scale[1]) / 2.0))
         for pen in self.penslist:
             pen.SetWidth(penwidth)
+        self.scaled.clear()
+        self.composites.clear()
         self.dirty = True
         wx.CallAfter(self.Refresh)
 
-    def _line_scaler(self, x):
-        return (self.scale[0] * x[0],
-                self.scale[1] * x[1],
-                self.scale[0] * x[2],
-                self.scale[1] * x[3],)
+    def _scale(self, coords):
+        """Coordinates as a list of (x, y, ...) tuples at the current scale"""
+        if not len(coords):
+            return []
+        coords = numpy.asarray(coords, dtype = numpy.float64)
+        return (coords * numpy.tile(self.scale, coords.shape[1] // 2)).tolist()
+
+    def _scaled_layer(self, layer_i):
+        """Scaled lines and arcs of a layer, kept for the last layers drawn"""
+        scaled = self.scaled.get(layer_i)
+        if scaled is None:
+            scaled = self.scaled[layer_i] = (self._scale(self.lines[layer_i]),
+                                             self._scale(self.arcs[layer_i]))
+            while len(self.scaled) > self.cached_layers:
+                self.scaled.popitem(last = False)
+        else:
+            self.scaled.move_to_end(layer_i)
+        return scaled
 
-    def _arc_scaler(self, x):
-        return (self.scale[0] * x[0],
-                self.scale[1] * x[1],
-                self.scale[0] * x[2],
-                self.scale[1] * x[3],
-                self.scale[0] * x[4],
-                self.scale[1] * x[5],)
+    def _joined(self, batches):
+        """Highlighted lines or arcs added in batches, in a single array"""
+        return numpy.concatenate(batches) if batches else []
 
     def _drawlines(self, dc, lines, pens):
-        scaled_lines = [self._line_scaler(l) for l in lines]
-        dc.DrawLineList(scaled_lines, pens)
+        dc.DrawLineList(self._scale(lines), pens)
 
     def _drawarcs(self, dc, arcs, pens):
-        scaled_arcs = [self._arc_scaler(a) for a in arcs]
+        self._drawscaledarcs(dc, self._scale(arcs), pens)
+
+    def _drawscaledarcs(self, dc, scaled_arcs, pens):
         dc.SetBrush(wx.TRANSPARENT_BRUSH)
         for i in range(len(scaled_arcs)):
-            dc.SetPen(pens[i] if isinstance(pens, list) else pens)
+            dc.SetPen(pens if isinstance(pens, wx.Pen) else pens[i])
             dc.DrawArc(*scaled_arcs[i])
 
-    def repaint_everything(self):
-        width = self.scale[0] * self.build_dimensions[0]
-        height = self.scale[1] * self.build_dimensions[1]
-        self.blitmap = wx.Bitmap(width + 1, height + 1, -1)
+    def _drawlayer(self, dc, layer_i, pen = None):
+        """Draw a layer with its own pens, or all in pen"""
+        lines, arcs = self._scaled_layer(layer_i)
+        dc.DrawLineList(lines, self.pens[layer_i] if pen is None else pen)
+        self._drawscaledarcs(dc, arcs, self.arcpens[layer_i] if pen is None else pen)
+
+    def _get_background(self, width, height):
+        """Bitmap of the platform and its grid, kept until the scale changes"""
+        key = (width, height, tuple(self.grid), tuple(self.build_dimensions))
+        if key == self.background_key:
+            return self.background
+        self.background = wx.Bitmap(width + 1, height + 1, -1)
+        self.background_key = key
         dc = wx.MemoryDC()
-        dc.SelectObject(self.blitmap)
+        dc.SelectObject(self.background)
         dc.SetBackground(wx.Brush((250, 250, 200)))
         dc.Clear()
         dc.SetPen(wx.Pen(wx.Colour(180, 180, 150)))
@@ -340,8 +404,30 @@ class Gviz(wx.Panel):
                     draw_y = self.scale[1] * (self.build_dimensions[1] - y * grid_unit)
                     dc.DrawLine(0, draw_y, width, draw_y)
             dc.SetPen(wx.Pen(wx.Colour(0, 0, 0)))
+        dc.SelectObject(wx.NullBitmap)
+        return self.background
+
+    def _get_composite(self, width, height):
+        """Bitmap of the platform with the layer gauge and the layers on
+        display, kept for the last few layers shown at this scale"""
+        if self.showall:
+            key = (None, len(self.layersz))
+        else:
+            key = (self.layerindex, len(self.layers))
+        composite = self.composites.get(key)
+        if composite is not None:
+            self.composites.move_to_end(key)
+            return composite
+        composite = wx.Bitmap(width + 1, height + 1, -1)
+        dc = wx.MemoryDC()
+        dc.SelectObject(composite)
+        dc.DrawBitmap(self._get_background(width, height), 0, 0)
 
-        if not self.showall:
+        if self.showall:
+            for i in range(len(self.layersz)):
+                self._drawlines(dc, self.lines[i], self.pens[i])
+                self._drawarcs(dc, self.arcs[i], self.arcpens[i])
+        else:
             # Draw layer gauge
             dc.SetBrush(wx.Brush((43, 144, 255)))
             dc.DrawRectangle(width - 15, 0, 15, height)
@@ -349,23 +435,33 @@ class Gviz(wx.Panel):
             if self.layers:
                 dc.DrawRectangle(width - 14, (1.0 - (1.0 * (self.layerindex + 1)) / len(self.layers)) * height, 13, height - 1)
 
+            if self.layerindex < len(self.layers) and self.layerindex in self.lines:
+                for layer_i in range(max(0, self.layerindex - 6), self.layerindex):
+                    self._drawlayer(dc, layer_i, self.fades[self.layerindex - layer_i - 1])
+                self._drawlayer(dc, self.layerindex)
+
+        dc.SelectObject(wx.NullBitmap)
+        self.composites[key] = composite
+        while len(self.composites) > self.cached_composites:
+            self.composites.popitem(last = False)
+        return composite
+
+    def repaint_everything(self):
+        width = self.scale[0] * self.build_dimensions[0]
+        height = self.scale[1] * self.build_dimensions[1]
+        composite = self._get_composite(width, height)
+        # Highlights get drawn over a copy, keeping the cached image clean
+        self.blitmap = composite.GetSubBitmap(wx.Rect(0, 0, composite.GetWidth(), composite.GetHeight()))
         if self.showall:
-            for i in range(len(self.layersz)):
-                self.painted_layers.add(i)
-                self._drawlines(dc, self.lines[i], self.pens[i])
-                self._drawarcs(dc, self.arcs[i], self.arcpens[i])
-            dc.SelectObject(wx.NullBitmap)
+            self.painted_layers = set(range(len(self.layersz)))
             return
 
-        if self.layerindex < len(self.layers) and self.layerindex in self.lines:
-            for layer_i in range(max(0, self.layerindex - 6), self.layerindex):
-                self._drawlines(dc, self.lines[layer_i], self.fades[self.layerindex - layer_i - 1])
-                self._drawarcs(dc, self.arcs[layer_i], self.fades[self.layerindex - layer_i - 1])
-            self._drawlines(dc, self.lines[self.layerindex], self.pens[self.layerindex])
-            self._drawarcs(dc, self.arcs[self.layerindex], self.arcpens[self.layerindex])
-
-        self._drawlines(dc, self.hilight, self.hlpen)
-        self._drawarcs(dc, self.hilightarcs, self.hlpen)
+        dc = wx.MemoryDC()
+        dc.SelectObject(self.blitmap)
+        self._drawlines(dc, self._joined(self.hilight), self.hlpen)
+        self._drawarcs(dc, self._joined(self.hilightarcs), self.hlpen)
+        if self.selected is not None and self.selected[0] == self.layerindex:
+            self._drawlines(dc, self.selected[1], self.hlpen)
 
         self.paint_hilights(dc)
 
@@ -390,11 +486,11 @@ class Gviz(wx.Panel):
             dc.SelectObject(self.blitmap)
         while not self.hilightqueue.empty():
             hl.append(self.hilightqueue.get_nowait())
-        self._drawlines(dc, hl, self.hlpen)
+        self._drawlines(dc, self._joined(hl), self.hlpen)
         hlarcs = []
         while not self.hilightarcsqueue.empty():
             hlarcs.append(self.hilightarcsqueue.get_nowait())
-        self._drawarcs(dc, hlarcs, self.hlpen)
+        self._drawarcs(dc, self._joined(hlarcs), self.hlpen)
         dc.SelectObject(wx.NullBitmap)
 
     def paint(self, event):
@@ -433,117 +529,77 @@ class Gviz(wx.Panel):
         while next(generator) is not None:
             continue
 
-    def _get_movement(self, start_pos, gline):
-        """Takes a start position and a gcode, and returns a 3-uple containing
-        (final position, line, arc), with line and arc being None if not
-        used"""
-        target = start_pos[:]
-        target[5] = 0.0
-        target[6] = 0.0
-        if gline.current_x is not None: target[0] = gline.current_x
-        if gline.current_y is not None: target[1] = gline.current_y
-        if gline.current_z is not None: target[2] = gline.current_z
-        if gline.e is not None:
-            if gline.relative_e:
-                target[3] += gline.e
-            else:
-                target[3] = gline.e
-        if gline.f is not None: target[4] = gline.f
-        if gline.i is not None: target[5] = gline.i
-        if gline.j is not None: target[6] = gline.j
-
-        if gline.command in ["G0", "G1"]:
-            line = [self._x(start_pos[0]),
-                    self._y(start_pos[1]),
-                    self._x(target[0]),
-                    self._y(target[1])]
-            return target, line, None
-        elif gline.command in ["G2", "G3"]:
-            # startpos, endpos, arc center
-            arc = [self._x(start_pos[0]), self._y(start_pos[1]),
-                   self._x(target[0]), self._y(target[1]),
-                   self._x(start_pos[0] + target[5]), self._y(start_pos[1] + target[6])]
-            if gline.command == "G2":  # clockwise, reverse endpoints
-                arc[0], arc[1], arc[2], arc[3] = arc[2], arc[3], arc[0], arc[1]
-            return target, None, arc
-
-    def _y(self, y):
-        return self.build_dimensions[1] - (y - self.build_dimensions[4])
-
-    def _x(self, x):
-        return x - self.build_dimensions[3]
+    def _platform_coords(self, coords):
+        """Columns of X and Y positions in mm to the coordinates of the
+        platform"""
+        coords = numpy.array(coords, dtype = numpy.float32)
+        coords[:, 0::2] -= self.build_dimensions[3]
+        coords[:, 1::2] = self.build_dimensions[1] - (coords[:, 1::2] - self.build_dimensions[4])
+        return coords
+
+    def _platform_moves(self, movement):
+        """Lines and arcs of LayerMoves on the platform, arcs as startpos,
+        endpos, arc center with the endpoints reversed when clockwise"""
+        arcs = self._platform_coords(movement.arcs)
+        arcs[movement.clockwise] = arcs[movement.clockwise][:, [2, 3, 0, 1, 4, 5]]
+        return self._platform_coords(movement.lines), arcs
 
     def add_parsed_gcodes(self, gcode):
         start_time = time.time()
 
         layer_idx = 0
         while layer_idx < len(gcode.all_layers):
-            layer = gcode.all_layers[layer_idx]
-            has_move = False
-            for gline in layer:
-                if gline.is_move:
-                    has_move = True
-                    break
-            if not has_move:
-                yield layer_idx
-                layer_idx += 1
-                continue
-            viz_layer = len(self.layers)
-            self.lines[viz_layer] = []
-            self.pens[viz_layer] = []
-            self.arcs[viz_layer] = []
-            self.arcpens[viz_layer] = []
-            for gline in layer:
-                if not gline.is_move:
+            # Moves are computed at once for all the layers parsed so far,
+            # but the last one, which may still be loading if not alone
+            layers = [gcode.all_layers[i]
+                      for i in range(layer_idx, max(layer_idx + 1, len(gcode.all_layers) - 1))]
+            moves, self.lastpos[:4] = layer_moves(layers, self.lastpos[:4])
+            for layer, movement in zip(layers, moves):
+                if movement is None:
+                    yield layer_idx
+                    layer_idx += 1
                     continue
+                viz_layer = len(self.layers)
+                self.lines[viz_layer], arcs = self._platform_moves(movement)
+                self.arcs[viz_layer] = arcs
+                pens = self.pens[viz_layer] = numpy.empty(len(movement.lines), dtype = object)
+                pens[:] = self.travelpen
+                pens[movement.extruding] = self.mainpen
+                arcpens = self.arcpens[viz_layer] = numpy.empty(len(arcs), dtype = object)
+                arcpens[:] = self.arcpen
+                # Only add layer to self.layers now to prevent the display of an
+                # unfinished layer
+                self.layers[layer_idx] = viz_layer
+                self.layersz.append(layer.z)
+
+                # Refresh display if more than 0.2s have passed
+                if time.time() - start_time > 0.2:
+                    start_time = time.time()
+                    self.partial = True
+                    wx.CallAfter(self.Refresh)
 
-                target, line, arc = self._get_movement(self.lastpos[:], gline)
-
-                if line is not None:
-                    self.lines[viz_layer].append(line)
-                    self.pens[viz_layer].append(self.mainpen if target[3] != self.lastpos[3] else self.travelpen)
-                elif arc is not None:
-                    self.arcs[viz_layer].append(arc)
-                    self.arcpens[viz_layer].append(self.arcpen)
-
-                self.lastpos = target
-            # Transform into a numpy array for memory efficiency
-            self.lines[viz_layer] = numpy.asarray(self.lines[viz_layer], dtype = numpy.float32)
-            self.pens[viz_layer] = numpy.asarray(self.pens[viz_layer])
-            self.arcs[viz_layer] = numpy.asarray(self.arcs[viz_layer], dtype = numpy.float32)
-            self.arcpens[viz_layer] = numpy.asarray(self.arcpens[viz_layer])
-            # Only add layer to self.layers now to prevent the display of an
-            # unfinished layer
-            self.layers[layer_idx] = viz_layer
-            self.layersz.append(layer.z)
-
-            # Refresh display if more than 0.2s have passed
-            if time.time() - start_time > 0.2:
-                start_time = time.time()
-                self.partial = True
-                wx.CallAfter(self.Refresh)
-
-            yield layer_idx
-            layer_idx += 1
+                yield layer_idx
+                layer_idx += 1
 
         self.dirty = True
         wx.CallAfter(self.Refresh)
         yield None
 
     def addgcodehighlight(self, gline):
-        if gline.command not in ["G0", "G1", "G2", "G3"]:
-            return
-
-        target, line, arc = self._get_movement(self.hilightpos[:], gline)
+        self.addgcodehighlights([gline])
 
-        if line is not None:
-            self.hilight.append(line)
-            self.hilightqueue.put_nowait(line)
-        elif arc is not None:
-            self.hilightarcs.append(arc)
-            self.hilightarcsqueue.put_nowait(arc)
-
-        self.hilightpos = target
+    def addgcodehighlights(self, glines):
+        """Highlight moves sent to the printer, in a single batch"""
+        moves, self.hilightpos[:4] = layer_moves([glines], self.hilightpos[:4])
+        if moves[0] is None:
+            return
+        lines, arcs = self._platform_moves(moves[0])
+        if len(lines):
+            self.hilight.append(lines)
+            self.hilightqueue.put_nowait(lines)
+        if len(arcs):
+            self.hilightarcs.append(arcs)
+            self.hilightarcsqueue.put_nowait(arcs)
         wx.CallAfter(self.Refresh)
 
 if __name__ == '__main__':
@@ -0,0 +1,393 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Headless previews of G-code layers as PNG images.
+
+Previews look like the 2D view (gviz.Gviz): the platform and its grid, the
+extrusions, travels and arcs of a layer over the few layers below it fading
+out, or every layer at once for the whole print.  The segments of each
+layer are built from GCode.all_layers as Gviz.add_parsed_gcodes builds them,
+then rasterized with anti-aliasing into NumPy arrays and encoded as PNG,
+without wx nor OpenGL.  Layers get rendered in a process pool.
+
+    gcode = gcoder.GCode(open("part.gcode"))
+    paths = layer_paths(gcode)
+    write_png("part.png", render(paths))
+    for layer, png in render_layers(paths):
+        ...
+
+layerpreview.py renders the previews of G-code files from the command line.
+"""
+
+import math
+import os
+import struct
+import zlib
+from collections import namedtuple
+from operator import attrgetter
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+
+from . import gcoder
+from .gcoder_columnar import ColumnarLayer, command_is_raw, pos_is_move, pos_relative_e
+
+# Kinds of segments, drawn with the pens of Gviz
+extrusion = 0
+travel = 1
+arc = 2
+
+default_build_dimensions = [200, 200, 100, 0, 0, 0]
+
+# Colors of Gviz
+background_color = (250, 250, 200)
+grid_color = (180, 180, 150)
+pen_colors = {extrusion: (0, 0, 0),
+              travel: (10, 80, 80),
+              arc: (255, 0, 0)}
+fade_colors = [(int(250 - 0.6 ** i * 100), int(250 - 0.6 ** i * 100),
+                int(200 - 0.4 ** i * 50)) for i in range(6)]
+
+# Length of the straight segments arcs are split into (mm)
+arc_resolution = 0.5
+
+# Segments rasterized at once, bounding the memory used
+segments_per_batch = 4096
+
+# Kinds of moves
+move_other = 0
+move_line = 1
+move_arc_cw = 2
+move_arc_ccw = 3
+move_kinds = {"G0": move_line, "G1": move_line,
+              "G2": move_arc_cw, "G3": move_arc_ccw}
+
+LayerMoves = namedtuple("LayerMoves", ("lines", "extruding", "arcs", "clockwise"))
+LayerMoves.__doc__ = """Lines (x1, y1, x2, y2 in mm) of the G0 and G1 moves
+of a layer and whether they extrude, arcs (x1, y1, x2, y2, center x, center
+y) of its G2 and G3 moves and whether they turn clockwise"""
+
+LayerPaths = namedtuple("LayerPaths", ("z", "segments", "kinds"))
+LayerPaths.__doc__ = """Segments (x1, y1, x2, y2 in mm) of a layer and their
+kinds (extrusion, travel or arc)"""
+
+def _move_columns(layer):
+    """Kinds, current X, Y and Z, E, relative E and I, J of the moves of
+    layer, None values being NaN"""
+    if isinstance(layer, ColumnarLayer):
+        data = layer.data[(layer.data["status"] & pos_is_move) != 0]
+        table = numpy.array([move_kinds.get(command, move_other) for command in layer.commands]
+                            + [move_other], dtype = numpy.uint8)
+        codes = data["command"].astype(numpy.intp)
+        codes[codes == command_is_raw] = len(table) - 1
+        return (table[codes],) + \
+            tuple(data[name].astype(numpy.float64)
+                  for name in ("current_x", "current_y", "current_z", "e")) + \
+            ((data["status"] & pos_relative_e) != 0,) + \
+            tuple(data[name].astype(numpy.float64) for name in ("i", "j"))
+    moves = [gline for gline in layer if gline.is_move]
+    kinds = numpy.array([move_kinds.get(gline.command, move_other) for gline in moves],
+                        dtype = numpy.uint8)
+    return (kinds,) + \
+        tuple(numpy.array(list(map(attrgetter(name), moves)), dtype = numpy.float64)
+              for name in ("current_x", "current_y", "current_z", "e")) + \
+        (numpy.array(list(map(attrgetter("relative_e"), moves)), dtype = bool),) + \
+        tuple(numpy.array(list(map(attrgetter(name), moves)), dtype = numpy.float64)
+              for name in ("i", "j"))
+
+def _carried(values, start):
+    """values with each NaN replaced by the last value before it, or start"""
+    last = numpy.where(numpy.isnan(values), -1, numpy.arange(len(values)))
+    numpy.maximum.accumulate(last, out = last)
+    return numpy.where(last >= 0, values[last], start)
+
+def layer_moves(layers, start = (0.0, 0.0, 0.0, 0.0)):
+    """Lines and arcs of the moves of layers, as LayerMoves or None for
+    layers without moves. start is the position (X, Y, Z, E) before the
+    first move. The positions are followed as Gviz does, for all the layers
+    at once. Returns the moves of each layer and the position after them."""
+    columns = [_move_columns(layer) for layer in layers]
+    counts = [len(layer_columns[0]) for layer_columns in columns]
+    if not sum(counts):
+        return [None] * len(layers), list(start)
+    kinds, x, y, z, e, relative_e, i, j = [numpy.concatenate(column) for column in zip(*columns)]
+    x = _carried(x, start[0])
+    y = _carried(y, start[1])
+    z = _carried(z, start[2])
+    # E adds up from the last absolute value on
+    has_e = ~numpy.isnan(e)
+    steps = numpy.cumsum(numpy.where(has_e & relative_e, e, 0))
+    e = _carried(numpy.where(has_e & ~relative_e, e - steps, numpy.nan), start[3]) + steps
+    previous_x = numpy.concatenate(([start[0]], x[:-1]))
+    previous_y = numpy.concatenate(([start[1]], y[:-1]))
+    previous_e = numpy.concatenate(([start[3]], e[:-1]))
+
+    is_line = kinds == move_line
+    is_arc = (kinds == move_arc_cw) | (kinds == move_arc_ccw)
+    lines = numpy.stack((previous_x, previous_y, x, y), axis = 1)[is_line]
+    extruding = (e != previous_e)[is_line]
+    arcs = numpy.stack((previous_x, previous_y, x, y,
+                        previous_x + numpy.nan_to_num(i),
+                        previous_y + numpy.nan_to_num(j)), axis = 1)[is_arc]
+    clockwise = (kinds == move_arc_cw)[is_arc]
+
+    layer_ids = numpy.repeat(numpy.arange(len(layers)), counts)
+    line_stops = numpy.cumsum(numpy.bincount(layer_ids[is_line], minlength = len(layers)))[:-1]
+    arc_stops = numpy.cumsum(numpy.bincount(layer_ids[is_arc], minlength = len(layers)))[:-1]
+    parts = zip(numpy.split(lines, line_stops), numpy.split(extruding, line_stops),
+                numpy.split(arcs, arc_stops), numpy.split(clockwise, arc_stops))
+    moves = [LayerMoves(*layer_parts) if count else None
+             for count, layer_parts in zip(counts, parts)]
+    return moves, [x[-1], y[-1], z[-1], e[-1]]
+
+def _arc_points(start, end, center, clockwise):
+    """Points from start to end along the arc around center"""
+    center_x, center_y = center
+    radius = math.hypot(start[0] - center_x, start[1] - center_y)
+    start_angle = math.atan2(start[1] - center_y, start[0] - center_x)
+    end_angle = math.atan2(end[1] - center_y, end[0] - center_x)
+    if clockwise:
+        sweep = -((start_angle - end_angle) % (2 * math.pi)) or -2 * math.pi
+    else:
+        sweep = ((end_angle - start_angle) % (2 * math.pi)) or 2 * math.pi
+    count = max(2, int(math.ceil(abs(sweep) * radius / arc_resolution)))
+    angles = start_angle + sweep * numpy.linspace(0, 1, count + 1)
+    points = numpy.stack((center_x + radius * numpy.cos(angles),
+                          center_y + radius * numpy.sin(angles)), axis = 1)
+    points[-1] = end[:2]
+    return points
+
+def layer_paths(gcode):
+    """Segments of the G0 to G3 moves of gcode (a GCode with full lines)
+    for each layer having some, following the positions as Gviz does"""
+    paths = []
+    moves = layer_moves(gcode.all_layers)[0]
+    for layer, movement in zip(gcode.all_layers, moves):
+        if movement is None:
+            continue
+        segments = [movement.lines]
+        kinds = [numpy.where(movement.extruding, extrusion, travel)]
+        for coords, clockwise in zip(movement.arcs, movement.clockwise):
+            points = _arc_points(coords[0:2], coords[2:4], coords[4:6], clockwise)
+            segments.append(numpy.concatenate((points[:-1], points[1:]), axis = 1))
+            kinds.append(numpy.full(len(points) - 1, arc))
+        segments = numpy.concatenate(segments).astype(numpy.float32)
+        if len(segments):
+            paths.append(LayerPaths(layer.z, segments,
+                                    numpy.concatenate(kinds).astype(numpy.uint8)))
+    return paths
+
+class Canvas:
+    """RGB image of the platform, with the same scale and orientation as
+    Gviz: size is the largest the image may be, in pixels"""
+
+    def __init__(self, size = (600, 600), build_dimensions = default_build_dimensions,
+                 extrusion_width = 0.5, grid = (10, 50)):
+        self.build_dimensions = build_dimensions
+        self.scale = min((size[0] - 1) / build_dimensions[0],
+                         (size[1] - 1) / build_dimensions[1])
+        self.width = int(self.scale * build_dimensions[0]) + 1
+        self.height = int(self.scale * build_dimensions[1]) + 1
+        self.pen_width = max(1.0, extrusion_width * self.scale)
+        self.image = numpy.empty((self.height, self.width, 3), dtype = numpy.float32)
+        self.image[:] = background_color
+        # As in Gviz, the first grid is drawn in grid_color, the next ones
+        # in black
+        color = grid_color
+        for grid_unit in grid:
+            if grid_unit > 0:
+                for x in range(int(build_dimensions[0] / grid_unit) + 1):
+                    self.image[:, min(self.width - 1, int(round(self.scale * x * grid_unit)))] = color
+                for y in range(int(build_dimensions[1] / grid_unit) + 1):
+                    row = int(round(self.scale * (build_dimensions[1] - y * grid_unit)))
+                    self.image[min(self.height - 1, row)] = color
+            color = (0, 0, 0)
+
+    def to_pixels(self, segments):
+        """Segments in mm to pixels, Y going down"""
+        dims = self.build_dimensions
+        pixels = numpy.empty(segments.shape, dtype = numpy.float64)
+        pixels[:, 0::2] = (segments[:, 0::2] - dims[3]) * self.scale
+        pixels[:, 1::2] = (dims[1] - (segments[:, 1::2] - dims[4])) * self.scale
+        return pixels
+
+    def coverage(self, segments):
+        """How much the pixels are covered by the lines drawn along segments
+        (in pixels) with the pen width, from 0 to 1. Returns the window of
+        the image (a pair of slices) holding the lines and its coverage."""
+        halfwidth = self.pen_width / 2
+        # Pixels are covered up to half a pixel further than the line edges,
+        # and are at most reach away from a point sampled every pixel
+        reach = int(math.ceil(halfwidth + 1))
+        left = max(0, int(math.floor(segments[:, 0::2].min())) - reach)
+        right = min(self.width, int(math.ceil(segments[:, 0::2].max())) + reach + 1)
+        top = max(0, int(math.floor(segments[:, 1::2].min())) - reach)
+        bottom = min(self.height, int(math.ceil(segments[:, 1::2].max())) + reach + 1)
+        window = (slice(top, max(top, bottom)), slice(left, max(left, right)))
+        width = max(0, right - left)
+        coverage = numpy.zeros(width * max(0, bottom - top), dtype = numpy.float32)
+        offsets = numpy.arange(-reach, reach + 1)
+        offset_x = numpy.tile(offsets, len(offsets))
+        offset_y = numpy.repeat(offsets, len(offsets))
+        for batch in range(0, len(segments), segments_per_batch):
+            chunk = segments[batch:batch + segments_per_batch]
+            starts = chunk[:, :2]
+            deltas = chunk[:, 2:] - starts
+            lengths2 = (deltas * deltas).sum(axis = 1)
+            samples = numpy.ceil(numpy.sqrt(lengths2)).astype(numpy.int64) + 1
+            owners = numpy.repeat(numpy.arange(len(chunk)), samples)
+            steps = numpy.arange(len(owners)) - numpy.repeat(numpy.cumsum(samples) - samples, samples)
+            fractions = steps / numpy.maximum(samples - 1, 1)[owners]
+            points = starts[owners] + fractions[:, None] * deltas[owners]
+            pixel_x = (numpy.round(points[:, 0]).astype(numpy.int64)[:, None] + offset_x).ravel()
+            pixel_y = (numpy.round(points[:, 1]).astype(numpy.int64)[:, None] + offset_y).ravel()
+            owners = numpy.repeat(owners, len(offset_x))
+            inside = (pixel_x >= left) & (pixel_x < right) & (pixel_y >= top) & (pixel_y < bottom)
+            pixel_x = pixel_x[inside]
+            pixel_y = pixel_y[inside]
+            owners = owners[inside]
+            # Distance from the pixel centers to their segment
+            relative = numpy.stack((pixel_x, pixel_y), axis = 1) - starts[owners]
+            owner_deltas = deltas[owners]
+            with numpy.errstate(divide = "ignore", invalid = "ignore"):
+                t = (relative * owner_deltas).sum(axis = 1) / lengths2[owners]
+            t = numpy.clip(numpy.nan_to_num(t), 0, 1)
+            distances = numpy.hypot(*(relative - t[:, None] * owner_deltas).T)
+            covered = numpy.clip(halfwidth + 0.5 - distances, 0, 1).astype(numpy.float32)
+            numpy.maximum.at(coverage, (pixel_y - top) * width + pixel_x - left, covered)
+        return window, coverage.reshape(max(0, bottom - top), width)
+
+    def draw(self, segments, color):
+        """Draw segments (in mm) over the image"""
+        if not len(segments):
+            return
+        window, alpha = self.coverage(self.to_pixels(segments))
+        alpha = alpha[:, :, None]
+        image = self.image[window]
+        image *= 1 - alpha
+        image += alpha * numpy.array(color, dtype = numpy.float32)
+
+    def draw_layer(self, paths, colors = None):
+        """Draw the travels, then the extrusions and arcs of a layer, each
+        kind in its pen color unless colors gives one for all of them"""
+        for kind in (travel, extrusion, arc):
+            self.draw(paths.segments[paths.kinds == kind],
+                      colors if colors is not None else pen_colors[kind])
+
+    def pixels(self):
+        return numpy.round(self.image).astype(numpy.uint8)
+
+def render(paths, layer = None, size = (600, 600), build_dimensions = default_build_dimensions,
+           extrusion_width = 0.5, grid = (10, 50)):
+    """Image of the layer of index layer in paths (as returned by
+    layer_paths) over the previous ones fading out, as Gviz shows it, or of
+    all the layers if layer is None"""
+    canvas = Canvas(size, build_dimensions, extrusion_width, grid)
+    if layer is None:
+        for layer_paths in paths:
+            canvas.draw_layer(layer_paths)
+    else:
+        for below in range(max(0, layer - len(fade_colors)), layer):
+            canvas.draw_layer(paths[below], fade_colors[layer - below - 1])
+        canvas.draw_layer(paths[layer])
+    return canvas.pixels()
+
+def encode_png(image):
+    """PNG file of an RGB image (height x width x 3 uint8 array)"""
+    height, width = image.shape[:2]
+    rows = numpy.zeros((height, 1 + 3 * width), dtype = numpy.uint8)
+    # Filter type 0 (none) on every row
+    rows[:, 1:] = image.reshape(height, 3 * width)
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + \
+            struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+    return b"\x89PNG\r\n\x1a\n" + \
+        chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)) + \
+        chunk(b"IDAT", zlib.compress(rows.tobytes(), 6)) + \
+        chunk(b"IEND", b"")
+
+def write_png(filename, image):
+    with open(filename, "wb") as f:
+        f.write(encode_png(image))
+
+def _render_png(args):
+    paths, layer, options = args
+    return encode_png(render(paths, layer, **options))
+
+def render_layers(paths, layers = None, processes = None, **options):
+    """PNG previews of layers (indexes in paths, all of them by default),
+    rendered in a pool of processes (one per CPU by default, none when 1).
+    Yields (layer, png) pairs in order; options are the ones of render."""
+    if layers is None:
+        layers = range(len(paths))
+    # Each layer only needs the few ones below it
+    tasks = [(paths[max(0, layer - len(fade_colors)):layer + 1],
+              min(layer, len(fade_colors)), options) for layer in layers]
+    if processes == 1 or len(tasks) < 2:
+        results = map(_render_png, tasks)
+        yield from zip(layers, results)
+        return
+    with ProcessPoolExecutor(processes) as executor:
+        yield from zip(layers, executor.map(_render_png, tasks, chunksize = 4))
+
+def preview_file(filename, output_dir = None, layers = False, thumbnail_size = 0,
+                 processes = None, home_pos = None, **options):
+    """Write the PNG previews of a G-code file in output_dir (next to it by
+    default): name.png for the whole print, name.thumb.png sized
+    thumbnail_size if not 0, and name.layerN.png for each layer if layers
+    is true. Returns the written file names."""
+    base = os.path.splitext(os.path.basename(filename))[0]
+    output_dir = output_dir or os.path.dirname(os.path.abspath(filename))
+    with open(filename, encoding = "utf-8") as f:
+        paths = layer_paths(gcoder.GCode(f, home_pos))
+    written = []
+    if thumbnail_size:
+        thumbnail_options = dict(options, size = (thumbnail_size, thumbnail_size))
+        thumbnail_options.pop("grid", None)
+        written.append(os.path.join(output_dir, base + ".thumb.png"))
+        write_png(written[-1], render(paths, grid = (), **thumbnail_options))
+    written.append(os.path.join(output_dir, base + ".png"))
+    write_png(written[-1], render(paths, **options))
+    if layers:
+        digits = len(str(len(paths)))
+        for layer, png in render_layers(paths, processes = processes, **options):
+            written.append(os.path.join(output_dir, "%s.layer%0*d.png" % (base, digits, layer)))
+            with open(written[-1], "wb") as f:
+                f.write(png)
+    return written
+
+def _preview_file(args):
+    filename, kwargs = args
+    return preview_file(filename, processes = 1, **kwargs)
+
+def preview_files(filenames, processes = None, **kwargs):
+    """preview_file for each of filenames, a file per process of the pool.
+    Yields the file names and the images written for each of them, or the
+    exception raised."""
+    if processes == 1 or len(filenames) < 2:
+        for filename in filenames:
+            try:
+                yield filename, preview_file(filename, processes = processes, **kwargs)
+            except Exception as e:
+                yield filename, e
+        return
+    with ProcessPoolExecutor(processes) as executor:
+        futures = [executor.submit(_preview_file, (filename, kwargs)) for filename in filenames]
+        for filename, future in zip(filenames, futures):
+            try:
+                yield filename, future.result()
+            except Exception as e:
+                yield filename, e
@@ -23,7 +23,7 @@ if sys.version_info.major < 3:
 from serial import Serial, SerialException, PARITY_ODD, PARITY_NONE
 from select import error as SelectError
 import threading
-from queue import Queue, Empty as QueueEmpty
+from queue import Queue
 import time
 import platform
 import os
@@ -35,6 +35,7 @@ import re
 from functools import wraps, reduce
 from collections import deque
 from printrun import gcoder
+from .sendbuffer import SendBuffer, COMMAND, EMPTY, HOST_COMMAND, UNENCODED
 from .utils import set_utf8_locale, install_locale, decode_utf8
 try:
     set_utf8_locale()
@@ -65,6 +66,80 @@ def enable_hup(port):
 def disable_hup(port):
     control_ttyhup(port, True)
 
+# Firmwares known to queue the commands they receive while busy, to which
+# more than one command may be sent ahead of their oks
+buffering_firmwares = ("Marlin", "Prusa-Firmware", "RepRapFirmware",
+                       "Klipper", "Smoothieware")
+# Queued to priqueue to stop the sender thread
+stop_sender = object()
+
+# ADVANCED_OK replies, giving the free planner and command buffer slots
+advanced_ok_exp = re.compile(r"ok\s+(?:N-?\d+\s+)?P(\d+)\s+B(\d+)")
+
+host_regexp = re.compile("^(([0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])\.){3}([0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])$|^(([a-zA-Z0-9]|[a-zA-Z0-9][a-zA-Z0-9\-]*[a-zA-Z0-9])\.)*([A-Za-z0-9]|[A-Za-z0-9][A-Za-z0-9\-]*[A-Za-z0-9])$")
+
+def tcp_address(port):
+    """(hostname, port) if port is a "host:port" network address, None if it
+    is a serial device"""
+    bits = port.split(":")
+    if len(bits) == 2:
+        try:
+            number = int(bits[1])
+        except ValueError:
+            return None
+        if host_regexp.match(bits[0]) and 1 <= number <= 65535:
+            return (bits[0], number)
+    return None
+
+class SentLines:
+    """Ring of the last size numbered lines sent to the printer, by line
+    number, which is all a resend may ask for"""
+
+    def __init__(self, size):
+        self.size = size
+        self.linenos = [-1] * size
+        self.commands = [None] * size
+
+    def __setitem__(self, lineno, command):
+        i = lineno % self.size
+        self.linenos[i] = lineno
+        self.commands[i] = command
+
+    def get(self, lineno):
+        """Line lineno, None if it was not sent or is out of the ring"""
+        i = lineno % self.size
+        if lineno < 0 or self.linenos[i] != lineno:
+            return None
+        return self.commands[i]
+
+class SocketFile:
+    """Binary, line oriented file over a socket for printcore.  Unlike the
+    files of socket.makefile(), reads keep working after a timeout, which the
+    read thread relies on to notice disconnections"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.pending = b""
+
+    def readline(self):
+        while b"\n" not in self.pending:
+            data = self.sock.recv(4096)
+            if not data:
+                line, self.pending = self.pending, b""
+                return line
+            self.pending += data
+        line, self.pending = self.pending.split(b"\n", 1)
+        return line + b"\n"
+
+    def write(self, data):
+        self.sock.sendall(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.sock.close()
+
 class printcore():
     def __init__(self, port = None, baud = None, dtr=None):
         """Initializes a printcore instance. Pass the port and baud rate to
@@ -72,29 +147,79 @@ class printcore():
         self.baud = None
         self.dtr = None
         self.port = None
-        self.analyzer = gcoder.GCode()
+        self.analyzer = gcoder.Analyzer()
         # Serial instance connected to the printer, should be None when
         # disconnected
         self.printer = None
+        # Protects the commands in flight, and wakes up the threads waiting
+        # to send when clear or printing change
+        self.window_lock = threading.RLock()
+        self.clear_cond = threading.Condition(self.window_lock)
         # clear to send, enabled after responses
-        # FIXME: should probably be changed to a sliding window approach
         self.clear = 0
+        # Number of commands sent ahead of the oks of the printer, only used
+        # once the firmware is known to buffer them (ping-pong otherwise)
+        self.send_window = 1
+        # Commands awaiting an ok, as line numbers (None when unnumbered)
+        # along with their size in bytes
+        self.inflight = deque()
+        self.inflight_bytes = 0
+        # Bytes the receive buffer of the firmware holds (RX_BUFFER_SIZE of
+        # Marlin): the commands sent ahead of their oks never add up to more,
+        # whatever send_window allows
+        self.rx_buffer_size = 128
+        # Free planner and command buffer slots of the last ADVANCED_OK
+        # reply, the latter lowered for each command sent since then
+        self.planner_free = None
+        self.buffer_free = None
+        # FIRMWARE_NAME of the M115 reply, None until it is seen
+        self.firmware_name = None
+        # Line the firmware last asked for and the number of further
+        # requests for it to ignore, one per line in flight behind it
+        self.resend_requested = None
+        self.resend_ignore = 0
         # The printer has responded to the initial command and is active
         self.online = False
         # is a print currently running, true if printing, false if paused
         self.printing = False
         self.mainqueue = None
+        # Compiled commands of the lines of mainqueue, see sendbuffer
+        self.sendbuffer = None
+        # Whether print lines sent from the send buffer go through the
+        # analyzer again. They were analyzed when loaded and are given to the
+        # send callbacks as such when not, the analyzer then catches up on the
+        # lines sent since unanalyzed_from when pausing or before a command
+        # which moves, and is left behind at the end of the print.
+        self.reanalyze = True
+        self.unanalyzed_from = None
         self.priqueue = Queue(0)
         self.queueindex = 0
         self.lineno = 0
         self.resendfrom = -1
         self.paused = False
-        self.sentlines = {}
+        # Number of sent lines kept for resends, firmwares only ask for the
+        # lines they did not process yet, at most those they buffer and the
+        # ones in flight (send_window)
+        self.resend_window = 1000
+        self.sentlines = SentLines(self.resend_window)
         self.log = deque(maxlen = 10000)
-        self.sent = []
+        # Seconds during which received lines are gathered before being
+        # given to the recv callbacks and handlers in one batch, by the
+        # dispatch thread, 0 to give them each line from the read thread.
+        # oks, resends and temperatures are handled at once either way.
+        self.recv_batch_interval = 0
+        # Lines received but not dispatched yet, the oldest ones are dropped
+        # (and counted in recv_dropped) when the callbacks fall behind
+        self.recv_ring = deque(maxlen = 10000)
+        self.recv_dropped = 0
+        self.recv_wake = threading.Event()
+        self.dispatch_thread = None
+        self.stop_dispatch_thread = False
+        self.sent = deque(maxlen = self.resend_window)
         self.writefailures = 0
         self.tempcb = None  # impl (wholeline)
         self.recvcb = None  # impl (wholeline)
+        self.recvbatchcb = None  # impl (lines), used over recvcb in batches
         self.sendcb = None  # impl (wholeline)
         self.preprintsendcb = None  # impl (wholeline)
         self.printsendcb = None  # impl (wholeline)
@@ -121,6 +246,37 @@ class printcore():
         self.xy_feedrate = None
         self.z_feedrate = None
 
+    @property
+    def clear(self):
+        return self._clear
+
+    @clear.setter
+    def clear(self, value):
+        self._clear = value
+        if value:
+            self._wakeup()
+
+    @property
+    def printing(self):
+        return self._printing
+
+    @printing.setter
+    def printing(self, value):
+        self._printing = value
+        if not value:
+            self._wakeup()
+
+    def _wakeup(self):
+        """Wake up the threads waiting to send"""
+        with self.clear_cond:
+            self.clear_cond.notify_all()
+
+    def _wait_clear(self):
+        """Wait until clear to send, or until the print stops"""
+        with self.clear_cond:
+            while self.printer and self.printing and not self.clear:
+                self.clear_cond.wait()
+
     def addEventHandler(self, handler):
         '''
         Adds an event handler.
@@ -153,6 +309,7 @@ class printcore():
                 self.printing = False
                 self.print_thread.join()
             self._stop_sender()
+            self._stop_dispatcher()
             try:
                 self.printer.close()
             except socket.error:
@@ -165,6 +322,7 @@ class printcore():
         self.printer = None
         self.online = False
         self.printing = False
+        self.firmware_name = None
 
     @locked
     def connect(self, port = None, baud = None, dtr=None):
@@ -180,20 +338,10 @@ class printcore():
             self.dtr = dtr
         if self.port is not None and self.baud is not None:
             # Connect to socket if "port" is an IP, device if not
-            host_regexp = re.compile("^(([0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])\.){3}([0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])$|^(([a-zA-Z0-9]|[a-zA-Z0-9][a-zA-Z0-9\-]*[a-zA-Z0-9])\.)*([A-Za-z0-9]|[A-Za-z0-9][A-Za-z0-9\-]*[A-Za-z0-9])$")
-            is_serial = True
-            if ":" in port:
-                bits = port.split(":")
-                if len(bits) == 2:
-                    hostname = bits[0]
-                    try:
-                        port = int(bits[1])
-                        if host_regexp.match(hostname) and 1 <= port <= 65535:
-                            is_serial = False
-                    except:
-                        pass
+            address = tcp_address(self.port)
             self.writefailures = 0
-            if not is_serial:
+            if address:
+                hostname, port = address
                 self.printer_tcp = socket.socket(socket.AF_INET,
                                                  socket.SOCK_STREAM)
                 self.printer_tcp.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
@@ -202,7 +350,7 @@ class printcore():
                 try:
                     self.printer_tcp.connect((hostname, port))
                     self.printer_tcp.settimeout(self.timeout)
-                    self.printer = self.printer_tcp.makefile()
+                    self.printer = SocketFile(self.printer_tcp)
                 except socket.error as e:
                     if(e.strerror is None): e.strerror=""
                     self.logError(_("Could not connect to %s:%s:") % (hostname, port) +
@@ -267,15 +415,7 @@ class printcore():
             except socket.timeout:
                 return ""
 
-            if len(line) > 1:
-                self.log.append(line)
-                for handler in self.event_handler:
-                    try: handler.on_recv(line)
-                    except: logging.error(traceback.format_exc())
-                if self.recvcb:
-                    try: self.recvcb(line)
-                    except: self.logError(traceback.format_exc())
-                if self.loud: logging.info("RECV: %s" % line.rstrip())
+            self._received(line)
             return line
         except SelectError as e:
             if 'Bad file descriptor' in e.args[1]:
@@ -296,6 +436,88 @@ class printcore():
             self.logError(_("Can't read from printer (disconnected?) (OS Error {0}): {1}").format(e.errno, e.strerror))
             return None
 
+    def _received(self, line):
+        if len(line) > 1:
+            if self.recv_batch_interval:
+                if len(self.recv_ring) == self.recv_ring.maxlen:
+                    self.recv_dropped += 1
+                self.recv_ring.append(line)
+                # Event.set() locks, only call it when the event is clear
+                if not self.recv_wake.is_set():
+                    self._recv_pending()
+                return
+            self.log.append(line)
+            for handler in self.event_handler:
+                try: handler.on_recv(line)
+                except: logging.error(traceback.format_exc())
+            if self.recvcb:
+                try: self.recvcb(line)
+                except: self.logError(traceback.format_exc())
+            if self.loud: logging.info("RECV: %s" % line.rstrip())
+
+    def _recv_pending(self):
+        """Have the lines of recv_ring dispatched within recv_batch_interval"""
+        if self.dispatch_thread is None:
+            self.stop_dispatch_thread = False
+            # Daemon so that scripts exiting without disconnect() do not
+            # hang at shutdown waiting for it
+            self.dispatch_thread = threading.Thread(target = self._dispatcher,
+                                                    daemon = True)
+            self.dispatch_thread.start()
+        self.recv_wake.set()
+
+    def _stop_dispatcher(self):
+        if self.dispatch_thread:
+            self.stop_dispatch_thread = True
+            self.recv_wake.set()
+            if threading.current_thread() != self.dispatch_thread:
+                self.dispatch_thread.join()
+            self.dispatch_thread = None
+
+    def _dispatcher(self):
+        while not self.stop_dispatch_thread:
+            self.recv_wake.wait()
+            time.sleep(self.recv_batch_interval)
+            # Lines appended before the clear are in this batch, the ones
+            # appended after it set the event again
+            self.recv_wake.clear()
+            self._dispatch_received()
+        self._dispatch_received()
+
+    def _dispatch_received(self):
+        """Give the lines of recv_ring to the recv callbacks and handlers"""
+        lines = []
+        try:
+            while True:
+                lines.append(self.recv_ring.popleft())
+        except IndexError:
+            pass
+        if self.recv_dropped:
+            dropped, self.recv_dropped = self.recv_dropped, 0
+            logging.warning(_("%d received lines dropped, the callbacks fell behind") % dropped)
+        if not lines:
+            return
+        self.log.extend(lines)
+        for handler in self.event_handler:
+            try:
+                on_recv_batch = getattr(handler, "on_recv_batch", None)
+                if on_recv_batch is not None:
+                    on_recv_batch(lines)
+                else:
+                    for line in lines:
+                        handler.on_recv(line)
+            except: logging.error(traceback.format_exc())
+        if self.recvbatchcb:
+            try: self.recvbatchcb(lines)
+            except: self.logError(traceback.format_exc())
+        elif self.recvcb:
+            for line in lines:
+                try: self.recvcb(line)
+                except: self.logError(traceback.format_exc())
+        if self.loud:
+            for line in lines:
+                logging.info("RECV: %s" % line.rstrip())
+
     def _listen_can_continue(self):
         if self.printer_tcp:
             return not self.stop_read_thread and self.printer
@@ -326,57 +548,149 @@ class printcore():
                     empty_lines += 1
                     if empty_lines == 15: break
                 else: empty_lines = 0
-                if line.startswith(tuple(self.greetings)) \
-                   or line.startswith('ok') or "T:" in line:
-                    self.online = True
-                    for handler in self.event_handler:
-                        try: handler.on_online()
-                        except: logging.error(traceback.format_exc())
-                    if self.onlinecb:
-                        try: self.onlinecb()
-                        except: self.logError(traceback.format_exc())
+                if self._is_online_reply(line):
+                    self._set_online()
                     return
 
+    def _is_online_reply(self, line):
+        return line.startswith(tuple(self.greetings)) \
+            or line.startswith('ok') or "T:" in line
+
+    def _set_online(self):
+        # Forget about the M105 sent until the printer answered
+        self._reset_window()
+        self.online = True
+        for handler in self.event_handler:
+            try: handler.on_online()
+            except: logging.error(traceback.format_exc())
+        if self.onlinecb:
+            try: self.onlinecb()
+            except: self.logError(traceback.format_exc())
+        if self.send_window > 1 and self.firmware_name is None:
+            # Find out whether more than one command can be sent ahead
+            self.send_now("M115")
+
+    def _window(self):
+        """Number of commands which may await an ok at once"""
+        if self.send_window > 1 and (self.buffer_free is not None or
+                                     (self.firmware_name or "").startswith(buffering_firmwares)):
+            return self.send_window
+        return 1
+
+    def _update_clear(self):
+        """Clear to send when the window and the firmware buffer have room,
+        must be called with window_lock held"""
+        self.clear = not self.inflight or (len(self.inflight) < self._window() and
+                                           self.inflight_bytes < self.rx_buffer_size and
+                                           (self.buffer_free is None or self.buffer_free > 0))
+
+    def _over_rx_buffer(self, size):
+        """Whether sending size more bytes before the oks of the commands in
+        flight could overflow the receive buffer of the firmware, must be
+        called with window_lock held. Firmwares reporting ADVANCED_OK move
+        the commands to their command buffer, which buffer_free bounds, and
+        without a window (ping-pong) a single command is ever in flight."""
+        return bool(self.inflight) and not self.printer_tcp \
+            and self.buffer_free is None and self._window() > 1 \
+            and self.inflight_bytes + size > self.rx_buffer_size
+
+    def _wait_rx_room(self, size):
+        """Wait until size more bytes fit in the receive buffer of the
+        firmware, must be called with window_lock held. The print thread
+        stops waiting once the print is paused or stopped."""
+        printing = self.printing
+        while self._over_rx_buffer(size) and self.printer and self.online \
+                and not self.stop_send_thread and (self.printing or not printing):
+            self.clear_cond.wait()
+
+    def _reset_window(self):
+        """Forget about the commands in flight, the printer (re)started"""
+        with self.window_lock:
+            self.inflight.clear()
+            self.inflight_bytes = 0
+            self.planner_free = None
+            self.buffer_free = None
+            self.resend_ignore = 0
+            self.clear = True
+
+    def _acknowledge(self, line):
+        with self.window_lock:
+            advanced = advanced_ok_exp.match(line)
+            if advanced:
+                self.planner_free = int(advanced.group(1))
+                self.buffer_free = int(advanced.group(2))
+            if self._window() == 1:
+                self.inflight.clear()
+                self.inflight_bytes = 0
+            elif self.inflight:
+                self.inflight_bytes -= self.inflight.popleft()[1]
+            if advanced:
+                # Commands still in flight may not be in the buffer yet
+                self.buffer_free -= len(self.inflight)
+            self._update_clear()
+            # Senders may be waiting for room in the receive buffer
+            self.clear_cond.notify_all()
+
+    def _request_resend(self, lineno):
+        with self.window_lock:
+            if self.resend_ignore and lineno == self.resend_requested:
+                # The firmware rejected a line sent after the one it wants
+                self.resend_ignore -= 1
+                return
+            self.resend_requested = lineno
+            self.resend_ignore = sum(1 for sent, size in self.inflight
+                                     if sent is not None and sent > lineno)
+            self.resendfrom = lineno
+            if self._window() == 1:
+                self.clear = True
+
     def _listen(self):
         """This function acts on messages from the firmware
         """
-        self.clear = True
+        self._reset_window()
         if not self.printing:
             self._listen_until_online()
         while self._listen_can_continue():
             line = self._readline()
             if line is None:
                 break
-            if line.startswith('DEBUG_'):
-                continue
-            if line.startswith(tuple(self.greetings)) or line.startswith('ok'):
-                self.clear = True
-            if line.startswith('ok') and "T:" in line:
-                for handler in self.event_handler:
-                    try: handler.on_temp(line)
-                    except: logging.error(traceback.format_exc())
-            if line.startswith('ok') and "T:" in line and self.tempcb:
-                # callback for temp, status, whatever
-                try: self.tempcb(line)
-                except: self.logError(traceback.format_exc())
-            elif line.startswith('Error'):
-                self.logError(line)
-            # Teststrings for resend parsing       # Firmware     exp. result
-            # line="rs N2 Expected checksum 67"    # Teacup       2
-            if line.lower().startswith("resend") or line.startswith("rs"):
-                for haystack in ["N:", "N", ":"]:
-                    line = line.replace(haystack, " ")
-                linewords = line.split()
-                while len(linewords) != 0:
-                    try:
-                        toresend = int(linewords.pop(0))
-                        self.resendfrom = toresend
-                        break
-                    except:
-                        pass
-                self.clear = True
+            self._process_line(line)
         self.clear = True
 
+    def _process_line(self, line):
+        """Acts on a line received from the firmware once online"""
+        if line.startswith('DEBUG_'):
+            return
+        if line.startswith(tuple(self.greetings)):
+            self._reset_window()
+        if line.startswith('ok'):
+            self._acknowledge(line)
+        if "FIRMWARE_NAME:" in line:
+            self.firmware_name = line.split("FIRMWARE_NAME:", 1)[1].strip()
+        if line.startswith('ok') and "T:" in line:
+            for handler in self.event_handler:
+                try: handler.on_temp(line)
+                except: logging.error(traceback.format_exc())
+        if line.startswith('ok') and "T:" in line and self.tempcb:
+            # callback for temp, status, whatever
+            try: self.tempcb(line)
+            except: self.logError(traceback.format_exc())
+        elif line.startswith('Error'):
+            self.logError(line)
+        # Teststrings for resend parsing       # Firmware     exp. result
+        # line="rs N2 Expected checksum 67"    # Teacup       2
+        if line.lower().startswith("resend") or line.startswith("rs"):
+            for haystack in ["N:", "N", ":"]:
+                line = line.replace(haystack, " ")
+            linewords = line.split()
+            while len(linewords) != 0:
+                try:
+                    toresend = int(linewords.pop(0))
+                    self._request_resend(toresend)
+                    break
+                except:
+                    pass
+
     def _start_sender(self):
         self.stop_send_thread = False
         self.send_thread = threading.Thread(target = self._sender)
@@ -385,20 +699,20 @@ class printcore():
     def _stop_sender(self):
         if self.send_thread:
             self.stop_send_thread = True
+            self._wakeup()
+            # Commands queued before the stop are still sent
+            self.priqueue.put_nowait(stop_sender)
             self.send_thread.join()
             self.send_thread = None
 
     def _sender(self):
-        while not self.stop_send_thread:
-            try:
-                command = self.priqueue.get(True, 0.1)
-            except QueueEmpty:
-                continue
-            while self.printer and self.printing and not self.clear:
-                time.sleep(0.001)
+        while True:
+            command = self.priqueue.get()
+            if command is stop_sender:
+                break
+            self._wait_clear()
             self._send(command)
-            while self.printer and self.printing and not self.clear:
-                time.sleep(0.001)
+            self._wait_clear()
 
     def _checksum(self, command):
         return reduce(lambda x, y: x ^ y, map(ord, command))
@@ -414,18 +728,32 @@ class printcore():
             return False
         self.queueindex = startindex
         self.mainqueue = gcode
+        # Streamed sources are only read as they get printed
+        if gcode and gcode.lines and not hasattr(gcode, "wait_for_line"):
+            # Views of a shared GCode come with its shared buffer
+            self.sendbuffer = getattr(gcode, "sendbuffer", None)
+            if self.sendbuffer is None:
+                self.sendbuffer = SendBuffer(gcode)
+        else:
+            self.sendbuffer = None
+        self.unanalyzed_from = None
+        if self.sentlines.size != self.resend_window:
+            self.sentlines = SentLines(self.resend_window)
+            self.sent = deque(self.sent, maxlen = self.resend_window)
         self.printing = True
         self.lineno = 0
         self.resendfrom = -1
         self._send("M110", -1, True)
         if not gcode or not gcode.lines:
             return True
-        self.clear = False
         resuming = (startindex != 0)
+        self._start_print(resuming)
+        return True
+
+    def _start_print(self, resuming):
         self.print_thread = threading.Thread(target = self._print,
                                              kwargs = {"resuming": resuming})
         self.print_thread.start()
-        return True
 
     def cancelprint(self):
         self.pause()
@@ -458,7 +786,7 @@ class printcore():
         try:
             self.print_thread.join()
         except RuntimeError as e:
-            if e.message == "cannot join current thread":
+            if str(e) == "cannot join current thread":
                 pass
             else:
                 self.logError(traceback.format_exc())
@@ -466,8 +794,10 @@ class printcore():
             self.logError(traceback.format_exc())
 
         self.print_thread = None
+        self._save_pause_position()
 
-        # saves the status
+    def _save_pause_position(self):
+        self._catch_up()
         self.pauseX = self.analyzer.abs_x
         self.pauseY = self.analyzer.abs_y
         self.pauseZ = self.analyzer.abs_z
@@ -479,6 +809,12 @@ class printcore():
         """Resumes a paused print.
         """
         if not self.paused: return False
+        self._restore_pause_position()
+        self.paused = False
+        self.printing = True
+        self._start_print(True)
+
+    def _restore_pause_position(self):
         if self.paused:
             # restores the status
             self.send_now("G90")  # go to absolute coordinates
@@ -500,12 +836,6 @@ class printcore():
             # reset old feed rate
             self.send_now("G1 F" + str(self.pauseF))
 
-        self.paused = False
-        self.printing = True
-        self.print_thread = threading.Thread(target = self._print,
-                                             kwargs = {"resuming": True})
-        self.print_thread.start()
-
     def send(self, command, wait = 0):
         """Adds a command to the checksummed main command queue if printing, or
         sends the command immediately if not printing"""
@@ -529,29 +859,10 @@ class printcore():
     def _print(self, resuming = False):
         self._stop_sender()
         try:
-            for handler in self.event_handler:
-                try: handler.on_start(resuming)
-                except: logging.error(traceback.format_exc())
-            if self.startcb:
-                # callback for printing started
-                try: self.startcb(resuming)
-                except:
-                    self.logError(_("Print start callback failed with:") +
-                                  "\n" + traceback.format_exc())
+            self._print_started(resuming)
             while self.printing and self.printer and self.online:
                 self._sendnext()
-            self.sentlines = {}
-            self.log.clear()
-            self.sent = []
-            for handler in self.event_handler:
-                try: handler.on_end()
-                except: logging.error(traceback.format_exc())
-            if self.endcb:
-                # callback for printing done
-                try: self.endcb()
-                except:
-                    self.logError(_("Print end callback failed with:") +
-                                  "\n" + traceback.format_exc())
+            self._print_ended()
         except:
             self.logError(_("Print thread died due to the following error:") +
                           "\n" + traceback.format_exc())
@@ -559,6 +870,33 @@ class printcore():
             self.print_thread = None
             self._start_sender()
 
+    def _print_started(self, resuming):
+        for handler in self.event_handler:
+            try: handler.on_start(resuming)
+            except: logging.error(traceback.format_exc())
+        if self.startcb:
+            # callback for printing started
+            try: self.startcb(resuming)
+            except:
+                self.logError(_("Print start callback failed with:") +
+                              "\n" + traceback.format_exc())
+
+    def _print_ended(self):
+        if not self.paused:
+            self.unanalyzed_from = None
+        self.sentlines = SentLines(self.resend_window)
+        self.log.clear()
+        self.sent.clear()
+        for handler in self.event_handler:
+            try: handler.on_end()
+            except: logging.error(traceback.format_exc())
+        if self.endcb:
+            # callback for printing done
+            try: self.endcb()
+            except:
+                self.logError(_("Print end callback failed with:") +
+                              "\n" + traceback.format_exc())
+
     def process_host_command(self, command):
         """only ;@pause command is implemented as a host command in printcore, but hosts are free to reimplement this method"""
         command = command.lstrip()
@@ -568,17 +906,21 @@ class printcore():
     def _sendnext(self):
         if not self.printer:
             return
-        while self.printer and self.printing and not self.clear:
-            time.sleep(0.001)
-        # Only wait for oks when using serial connections or when not using tcp
-        # in streaming mode
-        if not self.printer_tcp or not self.tcp_streaming_mode:
-            self.clear = False
+        self._wait_clear()
+        self._send_next_line()
+
+    def _send_next_line(self):
+        """Sends the next line to resend, of the priority queue or of the main
+        queue, once clear to send"""
         if not (self.printing and self.printer and self.online):
             self.clear = True
             return
         if self.resendfrom < self.lineno and self.resendfrom > -1:
-            self._send(self.sentlines[self.resendfrom], self.resendfrom, False)
+            command = self.sentlines.get(self.resendfrom)
+            if command is None:
+                self._resend_lost()
+                return
+            self._send(command, self.resendfrom, False)
             self.resendfrom += 1
             return
         self.resendfrom = -1
@@ -586,9 +928,8 @@ class printcore():
             self._send(self.priqueue.get_nowait())
             self.priqueue.task_done()
             return
-        if self.printing and self.queueindex < len(self.mainqueue):
+        if self.printing and self._queue_has(self.queueindex):
             (layer, line) = self.mainqueue.idxs(self.queueindex)
-            gline = self.mainqueue.all_layers[layer][line]
             if self.queueindex > 0:
                 (prev_layer, prev_line) = self.mainqueue.idxs(self.queueindex - 1)
                 if prev_layer != layer:
@@ -600,16 +941,40 @@ class printcore():
                 if prev_layer != layer:
                     try: self.layerchangecb(layer)
                     except: self.logError(traceback.format_exc())
+            if self.sendbuffer is not None and self.sendbuffer.revision \
+               != getattr(self.mainqueue, "revision", 0):
+                # Layers got edited (injected G-code), the lines to come are
+                # not the compiled ones anymore
+                self._catch_up()
+                self.sendbuffer = None
+            compiled = self.sendbuffer is not None \
+                and self.queueindex < len(self.sendbuffer) \
+                and self.sendbuffer.kind(self.queueindex) != UNENCODED
+            gline = None
+            if not compiled or self.event_handler or self.preprintsendcb \
+               or self.printsendcb or not self.reanalyze:
+                gline = self.mainqueue.all_layers[layer][line]
             for handler in self.event_handler:
                 try: handler.on_preprintsend(gline, self.queueindex, self.mainqueue)
                 except: logging.error(traceback.format_exc())
             if self.preprintsendcb:
-                if self.queueindex + 1 < len(self.mainqueue):
+                if self._queue_has(self.queueindex + 1):
                     (next_layer, next_line) = self.mainqueue.idxs(self.queueindex + 1)
                     next_gline = self.mainqueue.all_layers[next_layer][next_line]
                 else:
                     next_gline = None
-                gline = self.preprintsendcb(gline, next_gline)
+                edited = self.preprintsendcb(gline, next_gline)
+                # Edited lines do not match their compiled form anymore
+                if edited is not gline:
+                    compiled = False
+                    if edited is None:
+                        self.queueindex += 1
+                        self.clear = True
+                        return
+                gline = edited
+            if compiled:
+                self._send_compiled(gline)
+                return
             if gline is None:
                 self.queueindex += 1
                 self.clear = True
@@ -635,7 +1000,20 @@ class printcore():
             else:
                 self.clear = True
             self.queueindex += 1
+        elif self.printing and getattr(self.mainqueue, "error", None) is not None:
+            # The source of the print (streamed or loading) failed before its
+            # end, stop at its last line as for a pause
+            self.logError(_("Could not read the print past line %d: %s") %
+                          (self.queueindex, self.mainqueue.error))
+            self.pause()
         else:
+            with self.window_lock:
+                if self.inflight:
+                    # The firmware may still ask for the last lines again:
+                    # end the print once they are all acknowledged, the
+                    # oks clearing to send for another look at the resends
+                    self.clear = False
+                    return
             self.printing = False
             self.clear = True
             if not self.paused:
@@ -643,49 +1021,140 @@ class printcore():
                 self.lineno = 0
                 self._send("M110", -1, True)
 
+    def _send_compiled(self, gline):
+        """Sends line queueindex of the main queue from the send buffer"""
+        kind = self.sendbuffer.kind(self.queueindex)
+        if kind == HOST_COMMAND:
+            self.process_host_command(self.sendbuffer.host_command(self.queueindex))
+            self.clear = True
+        elif kind == EMPTY:
+            self.clear = True
+        else:
+            # Only add checksums if over serial, like _send
+            if self.printer_tcp:
+                data = self.sendbuffer.unnumbered(self.queueindex)
+            else:
+                data = self.sendbuffer.numbered(self.queueindex, self.lineno)
+            command = data[:-1].decode('ascii')
+            if not self.printer_tcp and "M110" not in command:
+                self._keep_sent(self.lineno, command)
+            if self.printer:
+                if self.reanalyze:
+                    sent_gline = self._analyze(command)
+                else:
+                    sent_gline = gline
+                    if self.unanalyzed_from is None:
+                        self.unanalyzed_from = self.queueindex
+                self._sending(command, self.lineno, sent_gline)
+                self._write(data)
+            self.lineno += 1
+            for handler in self.event_handler:
+                try: handler.on_printsend(gline)
+                except: logging.error(traceback.format_exc())
+            if self.printsendcb:
+                try: self.printsendcb(gline)
+                except: self.logError(traceback.format_exc())
+        self.queueindex += 1
+
+    def _catch_up(self):
+        """Run the print lines sent without analysis through the analyzer"""
+        start = self.unanalyzed_from
+        if start is None:
+            return
+        self.unanalyzed_from = None
+        buffer = self.sendbuffer
+        for i in range(start, min(self.queueindex, len(buffer))):
+            if buffer.kind(i) == COMMAND:
+                self._analyze(buffer.command(i).decode('ascii'))
+
+    def _queue_has(self, index):
+        """Whether the main queue has a line at index, waiting for streamed
+        sources to index it"""
+        wait_for_line = getattr(self.mainqueue, "wait_for_line", None)
+        if wait_for_line is not None:
+            return wait_for_line(index)
+        return index < len(self.mainqueue)
+
     def _send(self, command, lineno = 0, calcchecksum = False):
         # Only add checksums if over serial (tcp does the flow control itself)
         if calcchecksum and not self.printer_tcp:
             prefix = "N" + str(lineno) + " " + command
             command = prefix + "*" + str(self._checksum(prefix))
             if "M110" not in command:
-                self.sentlines[lineno] = command
+                self._keep_sent(lineno, command)
         if self.printer:
-            self.sent.append(command)
-            # run the command through the analyzer
-            gline = None
-            try:
-                gline = self.analyzer.append(command, store = False)
-            except:
-                logging.warning(_("Could not analyze command %s:") % command +
-                                "\n" + traceback.format_exc())
-            if self.loud:
-                logging.info("SENT: %s" % command)
+            gline = self._analyze(command)
+            self._sending(command, lineno, gline)
+            self._write((command + "\n").encode('ascii'))
 
-            for handler in self.event_handler:
-                try: handler.on_send(command, gline)
-                except: logging.error(traceback.format_exc())
-            if self.sendcb:
-                try: self.sendcb(command, gline)
-                except: self.logError(traceback.format_exc())
-            try:
-                self.printer.write((command + "\n").encode('ascii'))
-                if self.printer_tcp:
-                    try:
-                        self.printer.flush()
-                    except socket.timeout:
-                        pass
-                self.writefailures = 0
-            except socket.error as e:
-                if e.errno is None:
-                    self.logError(_("Can't write to printer (disconnected ?):") +
-                                  "\n" + traceback.format_exc())
-                else:
-                    self.logError(_("Can't write to printer (disconnected?) (Socket error {0}): {1}").format(e.errno, decode_utf8(e.strerror)))
-                self.writefailures += 1
-            except SerialException as e:
-                self.logError(_("Can't write to printer (disconnected?) (SerialException): {0}").format(decode_utf8(str(e))))
-                self.writefailures += 1
-            except RuntimeError as e:
-                self.logError(_("Socket connection broken, disconnected. ({0}): {1}").format(e.errno, decode_utf8(e.strerror)))
-                self.writefailures += 1
+    def _keep_sent(self, lineno, command):
+        self.sentlines[lineno] = command
+
+    def _resend_lost(self):
+        """The printer asked for a line out of the resend window: number the
+        lines after the last one sent and pause, the print is damaged"""
+        self.logError(_("The printer asked for line %d again, which is not among the last %d lines kept for resends (resend_window).") % (self.resendfrom, self.resend_window) +
+                      "\n" + _("Lines %d to %d may not have been printed, pausing the print.") % (self.resendfrom, self.lineno - 1))
+        self.resendfrom = -1
+        self._send("M110", self.lineno - 1, True)
+        self.pause()
+
+    def _analyze(self, command):
+        """Run command through the analyzer, returns its Line"""
+        if self.unanalyzed_from is not None:
+            code = command.lstrip("N0123456789- ")
+            # Commands which may move need the position of the print
+            if not code.startswith("M") or code.startswith(("M82", "M83")):
+                self._catch_up()
+        try:
+            return self.analyzer.append(command)
+        except:
+            logging.warning(_("Could not analyze command %s:") % command +
+                            "\n" + traceback.format_exc())
+            return None
+
+    def _sending(self, command, lineno, gline):
+        self.sent.append(command)
+        # Only wait for oks when using serial connections or when not
+        # using tcp in streaming mode
+        if not self.printer_tcp or not self.tcp_streaming_mode:
+            size = len(command) + 1
+            with self.window_lock:
+                self._wait_rx_room(size)
+                self.inflight.append((lineno if command.startswith("N") else None, size))
+                self.inflight_bytes += size
+                if self.buffer_free is not None:
+                    self.buffer_free -= 1
+                self._update_clear()
+        if self.loud:
+            logging.info("SENT: %s" % command)
+
+        for handler in self.event_handler:
+            try: handler.on_send(command, gline)
+            except: logging.error(traceback.format_exc())
+        if self.sendcb:
+            try: self.sendcb(command, gline)
+            except: self.logError(traceback.format_exc())
+
+    def _write(self, data):
+        try:
+            self.printer.write(data)
+            if self.printer_tcp:
+                try:
+                    self.printer.flush()
+                except socket.timeout:
+                    pass
+            self.writefailures = 0
+        except socket.error as e:
+            if e.errno is None:
+                self.logError(_("Can't write to printer (disconnected ?):") +
+                              "\n" + traceback.format_exc())
+            else:
+                self.logError(_("Can't write to printer (disconnected?) (Socket error {0}): {1}").format(e.errno, decode_utf8(e.strerror)))
+            self.writefailures += 1
+        except SerialException as e:
+            self.logError(_("Can't write to printer (disconnected?) (SerialException): {0}").format(decode_utf8(str(e))))
+            self.writefailures += 1
+        except RuntimeError as e:
+            self.logError(_("Socket connection broken, disconnected. ({0}): {1}").format(e.errno, decode_utf8(e.strerror)))
+            self.writefailures += 1
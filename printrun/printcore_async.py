@@ -0,0 +1,434 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""printcore driven by an asyncio event loop.
+
+AsyncPrintcore talks to the printer like printcore does (same line numbers,
+checksums, send window, resends and callbacks, the code is shared) but
+without any thread: the replies of the printer are handled as they arrive on
+a non blocking transport and a single task per printer sends the queued
+commands and the print, so that one event loop can drive many printers.
+
+    core = AsyncPrintcore()
+    core.on("temp", on_temp)  # may be a coroutine function
+    await core.connect("/dev/ttyUSB0", 115200)
+    if await core.wait_online(10):
+        core.startprint(gcode)
+        await core.wait_print()
+    await core.disconnect()
+
+Serial ports are driven through the pipe transports of the event loop, which
+needs a POSIX system; "host:port" addresses work everywhere."""
+
+import asyncio
+import logging
+import os
+import traceback
+
+from serial import Serial, SerialException, PARITY_ODD, PARITY_NONE
+
+from .printcore import printcore, tcp_address, disable_hup
+
+class _PrinterProtocol(asyncio.Protocol):
+    """Splits the data of the printer in lines for AsyncPrintcore, for both
+    the read and write transports of a serial port"""
+
+    def __init__(self, core):
+        self.core = core
+        self.pending = b""
+
+    def data_received(self, data):
+        *lines, self.pending = (self.pending + data).split(b"\n")
+        for line in lines:
+            self.core._line_received(line + b"\n")
+
+    def pause_writing(self):
+        self.core._set_writable(False)
+
+    def resume_writing(self):
+        self.core._set_writable(True)
+
+    def connection_lost(self, exc):
+        self.core._connection_lost(self, exc)
+
+class _SerialLink:
+    """Read and write pipe transports of a serial port, used as one"""
+
+    def __init__(self, serial, reader, writer):
+        self.serial = serial
+        self.reader = reader
+        self.writer = writer
+
+    def write(self, data):
+        self.writer.write(data)
+
+    def close(self):
+        self.writer.close()
+        self.reader.close()
+
+class _EventDispatcher:
+    """Event handler of an AsyncPrintcore forwarding every on_* event to the
+    functions registered with AsyncPrintcore.on()"""
+
+    def __init__(self, core):
+        self.core = core
+
+    def __getattr__(self, name):
+        if not name.startswith("on_"):
+            raise AttributeError(name)
+        event = name[3:]
+        return lambda *args: self.core._dispatch(event, args)
+
+    def on_recv_batch(self, lines):
+        # Listeners of "recv" still get every line
+        for line in lines:
+            self.core._dispatch("recv", (line,))
+        self.core._dispatch("recv_batch", (lines,))
+
+class AsyncPrintcore(printcore):
+    """printcore without threads, for asyncio event loops.
+
+    connect(), disconnect(), reset(), wait_online() and wait_print() are
+    coroutines. send(), send_now(), startprint(), pause(), resume() and
+    cancelprint() return right away, the commands being sent by the task of
+    the printer. Callbacks and event handlers are called from the event loop
+    and must not block it. All methods must be called from the thread of the
+    event loop."""
+
+    # Seconds to wait for an answer to M105 before sending another one
+    online_timeout = 3.75
+
+    # Set by the callbacks of printcore before __init__ creates the events
+    _wake = None
+
+    # Longest command the firmware takes (MAX_CMD_SIZE of Marlin), the room
+    # kept in its receive buffer before clearing to send
+    max_command_size = 96
+
+    def __init__(self):
+        self.printer_tcp = None
+        self._task = None
+        self._protocol = None
+        self._writable = True
+        self._print_pending = None
+        self._listeners = {}
+        self._tasks = set()
+        super().__init__()
+        # Own handlers, PRINTCORE_HANDLER is shared by all the printcores
+        self.event_handler = list(self.event_handler) + [_EventDispatcher(self)]
+
+    def on(self, event, callback):
+        """Call callback on event with the arguments of the matching
+        PrinterEventHandler method, event being its name without on_
+        ("recv", "temp", "end"...). Coroutine functions are run as tasks."""
+        self._listeners.setdefault(event, []).append(callback)
+
+    def _dispatch(self, event, args):
+        for callback in self._listeners.get(event, ()):
+            try:
+                result = callback(*args)
+            except:
+                logging.error(traceback.format_exc())
+                continue
+            if asyncio.iscoroutine(result):
+                task = asyncio.ensure_future(result)
+                self._tasks.add(task)
+                task.add_done_callback(self._callback_done)
+
+    def _callback_done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.error("".join(traceback.format_exception(
+                type(task.exception()), task.exception(),
+                task.exception().__traceback__)))
+
+    def _wakeup(self):
+        if self._wake is not None:
+            self._wake.set()
+
+    def _recv_pending(self):
+        # Dispatched from the event loop instead of a thread
+        self.recv_wake.set()
+        asyncio.get_running_loop().call_later(self.recv_batch_interval,
+                                              self._dispatch_batch)
+
+    def _dispatch_batch(self):
+        self.recv_wake.clear()
+        self._dispatch_received()
+
+    def _set_writable(self, writable):
+        self._writable = writable
+        if writable:
+            self._wakeup()
+
+    def _update_clear(self):
+        super()._update_clear()
+        # The event loop cannot wait for room in _sending: only clear to
+        # send when any command fits in the receive buffer of the firmware
+        if self.clear and self._over_rx_buffer(self.max_command_size):
+            self.clear = False
+
+    def _wait_rx_room(self, size):
+        pass
+
+    async def _wait_clear(self):
+        """Wait until clear to send and the transport takes more data, or
+        until the print stops"""
+        waited = False
+        while self.printer and self.printing and \
+              not (self.clear and self._writable):
+            self._wake.clear()
+            await self._wake.wait()
+            waited = True
+        if not waited:
+            # Let the other printers run while commands keep flowing
+            await asyncio.sleep(0)
+
+    async def connect(self, port = None, baud = None, dtr = None):
+        """Set port and baudrate if given, then connect to printer. Returns
+        once connected, wait_online() waits for the printer to answer"""
+        if self.printer:
+            await self.disconnect()
+        if port is not None:
+            self.port = port
+        if baud is not None:
+            self.baud = baud
+        if dtr is not None:
+            self.dtr = dtr
+        if self.port is None or self.baud is None:
+            return
+        loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        self._online = asyncio.Event()
+        self._writable = True
+        protocol = _PrinterProtocol(self)
+        address = tcp_address(self.port)
+        self.writefailures = 0
+        if address:
+            try:
+                transport = (await asyncio.wait_for(
+                    loop.create_connection(lambda: protocol, *address), 1.0))[0]
+            except (OSError, asyncio.TimeoutError) as e:
+                self.logError(_("Could not connect to %s:%s:") % address +
+                              "\n" + _("Socket error %s:") % getattr(e, "errno", None) +
+                              "\n" + (getattr(e, "strerror", None) or ""))
+                return
+            self.printer_tcp = transport.get_extra_info("socket")
+            self.printer = transport
+        else:
+            if os.name != "posix":
+                self.logError(_("Could not connect to %s: serial ports need a POSIX system") % self.port)
+                return
+            disable_hup(self.port)
+            self.printer_tcp = None
+            serial = None
+            try:
+                serial = Serial(port = self.port,
+                                baudrate = self.baud,
+                                timeout = 0,
+                                parity = PARITY_ODD)
+                serial.close()
+                serial.parity = PARITY_NONE
+                try:  # not supported everywhere, like in printcore
+                    serial.setDTR(self.dtr)
+                except:
+                    pass
+                serial.open()
+                reader = (await loop.connect_read_pipe(lambda: protocol, serial))[0]
+                writer = (await loop.connect_write_pipe(lambda: protocol, serial))[0]
+            except SerialException as e:
+                self.logError(_("Could not connect to %s at baudrate %s:") % (self.port, self.baud) +
+                              "\n" + _("Serial error: %s") % e)
+                return
+            except (IOError, ValueError) as e:
+                if serial is not None:
+                    serial.close()
+                self.logError(_("Could not connect to %s at baudrate %s:") % (self.port, self.baud) +
+                              "\n" + _("IO error: %s") % e)
+                return
+            self.printer = _SerialLink(serial, reader, writer)
+        self._protocol = protocol
+        for handler in self.event_handler:
+            try: handler.on_connect()
+            except: logging.error(traceback.format_exc())
+        self._task = loop.create_task(self._run())
+
+    async def disconnect(self):
+        """Disconnects from printer and pauses the print
+        """
+        if self.printer:
+            self.printing = False
+            self._protocol = None
+            if self._task:
+                self._task.cancel()
+                try:
+                    await self._task
+                except asyncio.CancelledError:
+                    pass
+                self._task = None
+            self.printer.close()
+        for handler in self.event_handler:
+            try: handler.on_disconnect()
+            except: logging.error(traceback.format_exc())
+        self.printer = None
+        self.printer_tcp = None
+        self.online = False
+        self.printing = False
+        self.firmware_name = None
+
+    async def reset(self):
+        """Reset the printer
+        """
+        if self.printer and not self.printer_tcp:
+            self.printer.serial.setDTR(1)
+            await asyncio.sleep(0.2)
+            self.printer.serial.setDTR(0)
+
+    async def wait_online(self, timeout = None):
+        """Wait until the printer answers, returns whether it did"""
+        if self.online:
+            return True
+        if not self.printer:
+            return False
+        try:
+            await asyncio.wait_for(self._online.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.online
+
+    async def wait_print(self):
+        """Wait until the print ends or gets paused"""
+        while self.printer and (self.printing or self._print_pending is not None):
+            self._wake.clear()
+            await self._wake.wait()
+
+    def _line_received(self, data):
+        try:
+            line = data.decode('ascii')
+        except UnicodeDecodeError:
+            self.logError(_("Got rubbish reply from %s at baudrate %s:") % (self.port, self.baud) +
+                          "\n" + _("Maybe a bad baudrate?"))
+            return
+        self._received(line)
+        if self.online:
+            self._process_line(line)
+        elif self._is_online_reply(line):
+            self._set_online()
+
+    def _set_online(self):
+        super()._set_online()
+        self._online.set()
+
+    def _connection_lost(self, protocol, exc):
+        if protocol is not self._protocol:
+            # disconnect() closed it
+            return
+        self._protocol = None
+        self.logError(_("Can't read from printer (disconnected?): {0}").format(
+            exc if exc is not None else _("connection closed")))
+        # Keep the position so that the print can be resumed on reconnection
+        self.pause()
+        self.online = False
+        self._wakeup()
+
+    async def _run(self):
+        try:
+            self._reset_window()
+            await self._until_online()
+            await self._pump()
+        except asyncio.CancelledError:
+            raise
+        except:
+            self.logError(_("Printer task died due to the following error:") +
+                          "\n" + traceback.format_exc())
+
+    async def _until_online(self):
+        while not self.online and self._protocol:
+            self._send("M105")
+            if self.writefailures >= 4:
+                logging.error(_("Aborting connection attempt after 4 failed writes."))
+                return
+            try:
+                await asyncio.wait_for(self._online.wait(), self.online_timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _pump(self):
+        """Sends the commands of the priority queue and the prints, in place
+        of the sender and print threads of printcore"""
+        while self.printer:
+            if self._print_pending is not None:
+                resuming = self._print_pending
+                self._print_pending = None
+                if self.printing:
+                    await self._print(resuming)
+                self._wakeup()
+                continue
+            if self.priqueue.empty():
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+            self._send(self.priqueue.get_nowait())
+            await self._wait_clear()
+
+    def _start_print(self, resuming):
+        self._print_pending = resuming
+        self._wakeup()
+
+    async def _print(self, resuming = False):
+        try:
+            self._print_started(resuming)
+            while self.printing and self.printer and self.online \
+                  and self._print_pending is None:
+                await self._sendnext()
+            self._print_ended()
+        except asyncio.CancelledError:
+            raise
+        except:
+            self.logError(_("Print thread died due to the following error:") +
+                          "\n" + traceback.format_exc())
+
+    async def _sendnext(self):
+        await self._wait_clear()
+        wait_for_line = getattr(self.mainqueue, "wait_for_line", None)
+        if wait_for_line is not None and self.queueindex + 1 >= len(self.mainqueue):
+            # Streamed sources may block until their next lines are indexed
+            await asyncio.get_running_loop().run_in_executor(
+                None, wait_for_line, self.queueindex + 1)
+        self._send_next_line()
+
+    def pause(self):
+        """Pauses the print, saving the current position.
+        """
+        if not self.printing: return False
+        self.paused = True
+        self.printing = False
+        self._save_pause_position()
+
+    def send(self, command, wait = 0):
+        super().send(command, wait)
+        self._wakeup()
+
+    def send_now(self, command, wait = 0):
+        super().send_now(command, wait)
+        self._wakeup()
+
+    def _write(self, data):
+        try:
+            self.printer.write(data)
+            self.writefailures = 0
+        except (OSError, RuntimeError) as e:
+            self.logError(_("Can't write to printer (disconnected?): {0}").format(e))
+            self.writefailures += 1
@@ -0,0 +1,68 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+
+class PrintProgress:
+    """Progress of a print, gathered for the views.
+
+    The sending thread records every move sent and every print move done,
+    and the GUI takes all of them at once at most every interval: the moves
+    to highlight since the last time, and the last vertex of the 3D view
+    printed. add_move and add_printed return True for the first record
+    after a take, when the caller should schedule the next one."""
+
+    # Milliseconds between two updates of the views
+    interval = 50
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.moves = []
+            self.printed_until = None
+            self.pending = False
+
+    def _record(self):
+        first = not self.pending
+        self.pending = True
+        return first
+
+    def add_move(self, gline):
+        """Record a move sent to the printer"""
+        with self.lock:
+            self.moves.append(gline)
+            return self._record()
+
+    def add_printed(self, gline):
+        """Record a move of the print sent to the printer"""
+        if gline.gcview_end_vertex is None:
+            return False
+        with self.lock:
+            self.printed_until = gline.gcview_end_vertex
+            return self._record()
+
+    def take(self):
+        """Return the moves sent since the last call and the last vertex
+        printed, None if there were none"""
+        with self.lock:
+            moves = self.moves
+            printed_until = self.printed_until
+            self.moves = []
+            self.printed_until = None
+            self.pending = False
+        return moves, printed_until
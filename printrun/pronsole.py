@@ -41,6 +41,9 @@ install_locale('pronterface')
 from .settings import Settings, BuildDimensionsSetting
 from .power import powerset_print_start, powerset_print_stop
 from printrun import gcoder
+from printrun.gcoder_columnar import ColumnarGCode
+from printrun.gcoder_estimator import MachineLimits, TrapezoidEstimator
+from printrun.gcodecache import GCodeCache
 from .rpc import ProntRPC
 from printrun.spoolmanager import spoolmanager
 
@@ -157,6 +160,9 @@ class pronsole(cmd.Cmd):
         self.settings._bedtemp_pla_cb = self.set_temp_preset
         self.update_build_dimensions(None, self.settings.build_dimensions)
         self.update_tcp_streaming_mode(None, self.settings.tcp_streaming_mode)
+        self.update_send_window(None, self.settings.send_window)
+        self.update_recv_batch_interval(None, self.settings.recv_batch_interval)
+        self.update_machine_limits(None, self.settings.machine_limits)
         self.monitoring = 0
         self.starttime = 0
         self.extra_print_time = 0
@@ -705,6 +711,17 @@ class pronsole(cmd.Cmd):
     def update_tcp_streaming_mode(self, param, value):
         self.p.tcp_streaming_mode = self.settings.tcp_streaming_mode
 
+    def update_send_window(self, param, value):
+        self.p.send_window = self.settings.send_window
+
+    def update_recv_batch_interval(self, param, value):
+        self.p.recv_batch_interval = self.settings.recv_batch_interval / 1000.
+
+    def update_machine_limits(self, param, value):
+        limits = MachineLimits.from_commands(self.settings.machine_limits)
+        # Given to the GCode objects of the files loaded from now on
+        self.estimator = TrapezoidEstimator(limits)
+
     def update_rpc_server(self, param, value):
         if value:
             if self.rpc_server is None:
@@ -924,14 +941,47 @@ class pronsole(cmd.Cmd):
         self.log(_("Loaded %s, %d lines.") % (filename, len(self.fgcode)))
         self.log(_("Estimated duration: %d layers, %s") % self.fgcode.estimate_duration())
 
-    def load_gcode(self, filename, layer_callback = None, gcode = None):
+    def new_gcode(self):
+        """Empty GCode of the class set to load files in"""
+        if self.settings.columnar_gcode:
+            return ColumnarGCode(deferred = True, estimator = self.estimator)
+        return gcoder.LightGCode(deferred = True, estimator = self.estimator)
+
+    def get_gcode_cache(self, gcode = None):
+        """Cache of preprocessed files, if enabled and gcode (if given) can
+        use it: the cache holds packed lines, only ColumnarGCode can"""
+        if not self.settings.gcode_cache_size:
+            return None
+        if gcode is not None and not isinstance(gcode, ColumnarGCode):
+            return None
+        return GCodeCache(os.path.join(self.cache_dir, "gcode"),
+                          self.settings.gcode_cache_size * 1024 * 1024)
+
+    def get_mesh_cache(self, gcode):
+        """Cache of the 3D view geometry of gcode, when it is the loaded file"""
+        cache = self.get_gcode_cache(gcode)
+        if cache is None or not self.filename:
+            return None
+        return cache.mesh_cache(self.filename, get_home_pos(self.build_dimensions_list))
+
+    def load_gcode(self, filename, layer_callback = None, gcode = None,
+                   loaded_callback = None):
         if gcode is None:
-            self.fgcode = gcoder.LightGCode(deferred = True)
-        else:
-            self.fgcode = gcode
-        self.fgcode.prepare(open(filename, "r", encoding="utf-8"),
-                            get_home_pos(self.build_dimensions_list),
-                            layer_callback = layer_callback)
+            gcode = self.new_gcode()
+        cache = self.get_gcode_cache(gcode)
+        self.fgcode = gcode
+        home_pos = get_home_pos(self.build_dimensions_list)
+        cached = cache is not None and cache.load(filename, home_pos, gcode,
+                                                  layer_callback = layer_callback)
+        if not cached:
+            self.fgcode.prepare(open(filename, "r", encoding="utf-8"),
+                                home_pos, layer_callback = layer_callback)
+        # Storing in the cache does not change gcode, which can be used from
+        # now on
+        if loaded_callback is not None:
+            loaded_callback()
+        if not cached and cache is not None:
+            cache.store(filename, home_pos, gcode)
         self.fgcode.estimate_duration()
         self.filename = filename
 
@@ -1203,7 +1253,8 @@ class pronsole(cmd.Cmd):
             self.log(_("Print resumed at: %s") % format_time(self.starttime))
         else:
             self.log(_("Print started at: %s") % format_time(self.starttime))
-            if not self.sdprinting:
+            # Layer durations are only known once the whole file is loaded
+            if not self.sdprinting and not hasattr(self.fgcode, "wait_for_line"):
                 self.compute_eta = RemainingTimeEstimator(self.fgcode)
             else:
                 self.compute_eta = None
@@ -15,7 +15,6 @@
 
 import os
 import platform
-import queue
 import sys
 import time
 import threading
@@ -37,7 +36,7 @@ from .utils import install_locale, setup_logging, dosify, \
     iconfile, configfile, format_time, format_duration, \
     hexcolor_to_float, parse_temperature_report, \
     prepare_command, check_rgb_color, check_rgba_color, compile_file, \
-    write_history_to, read_history_from
+    write_history_to, read_history_from, RemainingTimeEstimator
 install_locale('pronterface')
 
 try:
@@ -65,6 +64,8 @@ from .gui import MainWindow
 from .settings import wxSetting, HiddenSetting, StringSetting, SpinSetting, \
     FloatSpinSetting, BooleanSetting, StaticTextSetting
 from printrun import gcoder
+from printrun.gcoder_columnar import ColumnarGCode
+from printrun.printprogress import PrintProgress
 from .pronsole import REPORT_NONE, REPORT_POS, REPORT_TEMP, REPORT_MANUAL
 
 class ConsoleOutputHandler:
@@ -162,7 +163,7 @@ class PronterWindow(MainWindow, pronsole.pronsole):
         self.current_pos = [0, 0, 0]
         self.paused = False
         self.uploading = False
-        self.sentglines = queue.Queue(0)
+        self.print_progress = PrintProgress()
         self.cpbuttons = {
             "motorsoff": SpecialButton(_("Motors off"), ("M84"), (250, 250, 250), _("Switch all motors off")),
             "extrude": SpecialButton(_("Extrude"), ("pront_extrude"), (225, 200, 200), _("Advance extruder by set length")),
@@ -228,6 +229,7 @@ class PronterWindow(MainWindow, pronsole.pronsole):
         self.loading_gcode = False
         self.loading_gcode_message = ""
         self.mini = False
+        self.p.recvbatchcb = self.recvbatchcb
         self.p.sendcb = self.sentcb
         self.p.preprintsendcb = self.preprintsendcb
         self.p.printsendcb = self.printsentcb
@@ -366,6 +368,7 @@ class PronterWindow(MainWindow, pronsole.pronsole):
         global pronterface_quitting
         pronterface_quitting = True
         self.p.recvcb = None
+        self.p.recvbatchcb = None
         self.p.disconnect()
         if hasattr(self, "feedrates_changed"):
             self.save_in_rc("set xy_feedrate", "set xy_feedrate %d" % self.settings.xy_feedrate)
@@ -1099,13 +1102,6 @@ Printrun. If not, see <http://www.gnu.org/licenses/>."""
         # Call pronsole's statuschecker inner loop function to handle
         # temperature monitoring and status loop sleep
         pronsole.pronsole.statuschecker_inner(self, self.settings.monitor)
-        try:
-            while not self.sentglines.empty():
-                gc = self.sentglines.get_nowait()
-                wx.CallAfter(self.gviz.addgcodehighlight, gc)
-                self.sentglines.task_done()
-        except queue.Empty:
-            pass
 
     def statuschecker(self):
         pronsole.pronsole.statuschecker(self)
@@ -1479,13 +1475,19 @@ Printrun. If not, see <http://www.gnu.org/licenses/>."""
         threading.Thread(target = self.load_gcode_async_thread, args = (gcode,)).start()
 
     def load_gcode_async_thread(self, gcode):
+        # The first layers can be printed while the rest gets loaded
+        loader = gcoder.ProgressiveLoad(
+            gcode, self.layer_ready_cb,
+            ready_callback = lambda: wx.CallAfter(self.post_gcode_ready))
         try:
             self.load_gcode(self.filename,
-                            layer_callback = self.layer_ready_cb,
-                            gcode = gcode)
-        except PronterfaceQuitException:
+                            layer_callback = loader.layer_callback,
+                            gcode = gcode, loaded_callback = loader.finish)
+        except PronterfaceQuitException as e:
+            loader.finish(e)
             return
         except Exception as e:
+            loader.finish(e)
             self.log(str(e))
             wx.CallAfter(self.post_gcode_load,False,True)
             return
@@ -1510,15 +1512,26 @@ Printrun. If not, see <http://www.gnu.org/licenses/>."""
     def pre_gcode_load(self):
         self.loading_gcode = True
         self.loading_gcode_message = _("Loading %s...") % self.filename
-        if self.settings.mainviz == "None":
-            gcode = gcoder.LightGCode(deferred = True)
+        if self.settings.columnar_gcode:
+            gcode = ColumnarGCode(deferred = True, estimator = self.estimator)
+        elif self.settings.mainviz == "None":
+            gcode = gcoder.LightGCode(deferred = True, estimator = self.estimator)
         else:
-            gcode = gcoder.GCode(deferred = True)
+            gcode = gcoder.GCode(deferred = True, estimator = self.estimator)
         self.viz_last_yield = 0
         self.viz_last_layer = -1
         self.start_viz_thread(gcode)
+        # Enabled again once the first layers are loaded
+        if not self.p.printing:
+            self.printbtn.Disable()
         return gcode
 
+    def post_gcode_ready(self):
+        # Must be called in wx.CallAfter for safety
+        if self.loading_gcode and self.p.online and not self.p.printing:
+            self.log(_("First layers of %s loaded, printing can start") % self.filename)
+            self.printbtn.Enable()
+
     def post_gcode_load(self, print_stats = True, failed=False):
         # Must be called in wx.CallAfter for safety
         self.loading_gcode = False
@@ -1529,10 +1542,15 @@ Printrun. If not, see <http://www.gnu.org/licenses/>."""
             self.statusbar.SetStatusText(message)
             self.savebtn.Enable(True)
         self.loadbtn.SetLabel(_("Load File"))
-        self.printbtn.SetLabel(_("Print"))
-        self.pausebtn.SetLabel(_("Pause"))
-        self.pausebtn.Disable()
-        self.recoverbtn.Disable()
+        if self.p.printing and self.p.mainqueue is self.fgcode:
+            # Printing since the first layers got loaded
+            if failed == False and self.compute_eta is None:
+                self.resume_eta()
+        else:
+            self.printbtn.SetLabel(_("Print"))
+            self.pausebtn.SetLabel(_("Pause"))
+            self.pausebtn.Disable()
+            self.recoverbtn.Disable()
         if failed==False and self.p.online:
             self.printbtn.Enable()
         self.toolbarsizer.Layout()
@@ -1540,6 +1558,19 @@ Printrun. If not, see <http://www.gnu.org/licenses/>."""
         if print_stats:
             self.output_gcode_stats()
 
+    def resume_eta(self):
+        """Start estimating the remaining time of a print started before the
+        end of the load, from its current layer"""
+        queueindex = min(self.p.queueindex, len(self.fgcode) - 1)
+        if queueindex < 0:
+            return
+        layer = self.fgcode.idxs(queueindex)[0]
+        secondselapsed = int(time.time() - self.starttime + self.extra_print_time)
+        compute_eta = RemainingTimeEstimator(self.fgcode)
+        for i in range(1, layer + 1):
+            compute_eta.update_layer(i, secondselapsed)
+        self.compute_eta = compute_eta
+
     def calculate_remaining_filament(self, length, extruder = 0):
         """
         float calculate_remaining_filament( float length, int extruder )
@@ -1727,8 +1758,8 @@ Printrun. If not, see <http://www.gnu.org/licenses/>."""
         elif gline.command.startswith("T"):
             tool = gline.command[1:]
             if hasattr(self, "extrudersel"): wx.CallAfter(self.extrudersel.SetValue, tool)
-        if gline.is_move:
-            self.sentglines.put_nowait(gline)
+        if gline.is_move and self.print_progress.add_move(gline):
+            self.schedule_print_progress()
 
     def is_excluded_move(self, gline):
         """Check whether the given moves ends at a position specified as
@@ -1743,6 +1774,16 @@ Printrun. If not, see <http://www.gnu.org/licenses/>."""
     def preprintsendcb(self, gline, next_gline):
         """Callback when a printer gcode is about to be sent. We use it to
         exclude moves defined by the part excluder tool"""
+        plan = self.excluder.plan_for(self.p.mainqueue) if self.excluder else None
+        index = self.p.queueindex
+        if plan is not None and index < len(plan.skipped):
+            # Skip the lines planned ahead of the print, sending the
+            # commands planned in place of the skipped ones at the end
+            if not plan.skipped[index]:
+                return gline
+            for command in plan.fixups.get(index, ()):
+                self.p.send_now(command)
+            return None
         if not self.is_excluded_move(gline):
             return gline
         else:
@@ -1782,11 +1823,22 @@ Printrun. If not, see <http://www.gnu.org/licenses/>."""
 
     def printsentcb(self, gline):
         """Callback when a print gcode has been sent"""
-        if gline.is_move:
-            if hasattr(self.gwindow, "set_current_gline"):
-                wx.CallAfter(self.gwindow.set_current_gline, gline)
-            if hasattr(self.gviz, "set_current_gline"):
-                wx.CallAfter(self.gviz.set_current_gline, gline)
+        if gline.is_move and self.print_progress.add_printed(gline):
+            self.schedule_print_progress()
+
+    def schedule_print_progress(self):
+        """Update the views with the progress of the print in a while,
+        gathering the moves sent meanwhile"""
+        wx.CallAfter(wx.CallLater, self.print_progress.interval, self.update_print_progress)
+
+    def update_print_progress(self):
+        moves, printed_until = self.print_progress.take()
+        if printed_until is not None:
+            for view in (self.gwindow, self.gviz):
+                if hasattr(view, "set_printed_until"):
+                    view.set_printed_until(printed_until)
+        if moves:
+            self.gviz.addgcodehighlights(moves)
 
     def layer_change_cb(self, newlayer):
         """Callback when the printed layer changed"""
@@ -1877,19 +1929,33 @@ Printrun. If not, see <http://www.gnu.org/licenses/>."""
         return False
 
     def recvcb(self, l):
-        l = l.rstrip()
-        if not self.recvcb_actions(l):
-            report_type = self.recvcb_report(l)
-            isreport = report_type != REPORT_NONE
-            if report_type & REPORT_POS:
-                self.update_pos()
-            elif report_type & REPORT_TEMP:
-                wx.CallAfter(self.tempdisp.SetLabel, self.tempreadings.strip().replace("ok ", ""))
-                self.update_tempdisplay()
-            if not self.lineignorepattern.match(l) and not self.p.loud and (l not in ["ok", "wait"] and (not isreport or report_type & REPORT_MANUAL)):
-                self.log(l)
-        for listener in self.recvlisteners:
-            listener(l)
+        self.recvbatchcb([l])
+
+    def recvbatchcb(self, lines):
+        """Handle lines received from the printer, updating the position and
+        temperature displays once and logging the lines in one go"""
+        logged = []
+        pos_report = temp_report = False
+        for l in lines:
+            l = l.rstrip()
+            if not self.recvcb_actions(l):
+                report_type = self.recvcb_report(l)
+                isreport = report_type != REPORT_NONE
+                if report_type & REPORT_POS:
+                    pos_report = True
+                elif report_type & REPORT_TEMP:
+                    temp_report = True
+                if not self.lineignorepattern.match(l) and not self.p.loud and (l not in ["ok", "wait"] and (not isreport or report_type & REPORT_MANUAL)):
+                    logged.append(l)
+            for listener in self.recvlisteners:
+                listener(l)
+        if pos_report:
+            self.update_pos()
+        if temp_report:
+            wx.CallAfter(self.tempdisp.SetLabel, self.tempreadings.strip().replace("ok ", ""))
+            self.update_tempdisplay()
+        if logged:
+            self.log("\n".join(logged))
 
     def listfiles(self, line, ignored = False):
         if "Begin file list" in line:
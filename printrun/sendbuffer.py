@@ -0,0 +1,187 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Print jobs compiled to the bytes printcore sends.
+
+SendBuffer strips the comments of the lines of a job and encodes them by
+chunks, the first time the print thread sends a line of a chunk, keeping the
+XOR of the bytes of each command. The checksum of a numbered line is the XOR
+of its command with the one of its "N<lineno> " prefix, which comes from a
+table of digits, so that sending a line only takes a slice of the buffer and
+a formatting."""
+
+import re
+import threading
+from array import array
+from bisect import bisect_right
+from functools import reduce
+from itertools import accumulate
+from operator import xor
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Kinds of lines
+COMMAND = 0
+EMPTY = 1
+HOST_COMMAND = 2
+# Commands with non ASCII characters, left to printcore to send as text
+UNENCODED = 3
+
+# Lines compiled at once
+chunk_lines = 4096
+
+# gcoder.gcode_strip_comment_exp for lines joined by newlines
+strip_comment_exp = re.compile(r"\([^\(\)\n]*\)|;.*")
+
+# XOR of the digits of 0..9999, and of the same numbers written with four
+# digits, built on first use
+digits_xor = None
+padded_digits_xor = None
+prefix_xor = ord("N") ^ ord(" ")
+
+def _digit_tables():
+    global digits_xor, padded_digits_xor
+    digits_xor = bytes(reduce(xor, b"%d" % n) for n in range(10000))
+    padded_digits_xor = bytes(reduce(xor, b"%04d" % n) for n in range(10000))
+
+def lineno_xor(lineno):
+    """XOR of the bytes of "N<lineno> ", lineno being positive"""
+    if digits_xor is None:
+        _digit_tables()
+    value = prefix_xor
+    while lineno >= 10000:
+        lineno, low = divmod(lineno, 10000)
+        value ^= padded_digits_xor[low]
+    return value ^ digits_xor[lineno]
+
+def _raw_lines(gcode, start, stop):
+    """Raw text of lines start to stop of gcode, in print order"""
+    starts = getattr(gcode, "layer_starts", None)
+    if starts is None:
+        layers = gcode.all_layers
+        return [layers[layer][line].raw
+                for layer, line in map(gcode.idxs, range(start, stop))]
+    # The layers hold the lines in print order
+    raws = []
+    layer = bisect_right(starts, start) - 1
+    line = start - starts[layer]
+    while len(raws) < stop - start and layer < len(gcode.all_layers):
+        current = gcode.all_layers[layer]
+        end = min(len(current), line + stop - start - len(raws))
+        if hasattr(current, "raw_line"):
+            raws.extend(current.raw_line(i) for i in range(line, end))
+        else:
+            raws.extend(current[i].raw for i in range(line, end))
+        layer += 1
+        line = 0
+    return raws
+
+class Chunk:
+    """Compiled lines start to stop of gcode"""
+
+    def __init__(self, gcode, start, stop):
+        raws = _raw_lines(gcode, start, stop)
+        count = len(raws)
+        # ;@ host commands are run by printcore instead of being sent
+        self.host_commands = {i: raw for i, raw in enumerate(raws)
+                              if ";@" in raw and raw.lstrip().startswith(";@")}
+        commands = [command.strip() for command in
+                    strip_comment_exp.sub("", "\n".join(raws)).split("\n")]
+        self.kinds = bytearray(count)
+        try:
+            self.data = "".join(commands).encode("ascii")
+        except UnicodeEncodeError:
+            for i, command in enumerate(commands):
+                if not command.isascii():
+                    self.kinds[i] = UNENCODED
+                    commands[i] = ""
+            self.data = "".join(commands).encode("ascii")
+        lengths = [len(command) for command in commands]
+        self.offsets = array('Q', [0])
+        self.offsets.extend(accumulate(lengths))
+        for i, length in enumerate(lengths):
+            if not length and not self.kinds[i]:
+                self.kinds[i] = EMPTY
+        for i in self.host_commands:
+            self.kinds[i] = HOST_COMMAND
+        self.sums = self._sums(lengths)
+
+    def _sums(self, lengths):
+        """XOR of the bytes of each command"""
+        count = len(lengths)
+        if numpy is None or not self.data:
+            offsets = self.offsets
+            return bytes(reduce(xor, self.data[offsets[i]:offsets[i + 1]], 0)
+                         for i in range(count))
+        data = numpy.frombuffer(self.data, dtype = numpy.uint8)
+        starts = numpy.frombuffer(self.offsets, dtype = numpy.uint64)[:-1]
+        filled = numpy.array(lengths, dtype = numpy.int64) > 0
+        sums = numpy.zeros(count, dtype = numpy.uint8)
+        # Commands are contiguous, the XOR from one non empty command to the
+        # next one covers exactly the first one
+        sums[filled] = numpy.bitwise_xor.reduceat(data, starts[filled].astype(numpy.intp))
+        return sums.tobytes()
+
+    def command(self, i):
+        return self.data[self.offsets[i]:self.offsets[i + 1]]
+
+class SendBuffer:
+    """Comment stripped, encoded commands of the lines of gcode present when
+    the buffer is made, compiled by chunks as they get sent"""
+
+    def __init__(self, gcode):
+        self.gcode = gcode
+        self.count = len(gcode)
+        # Layer edits made afterwards are not compiled
+        self.revision = getattr(gcode, "revision", 0)
+        self.chunks = [None] * -(-self.count // chunk_lines)
+        # Printers of a farm may share a buffer
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    def _chunk(self, i):
+        chunk = self.chunks[i // chunk_lines]
+        if chunk is None:
+            with self.lock:
+                chunk = self.chunks[i // chunk_lines]
+                if chunk is None:
+                    start = i - i % chunk_lines
+                    chunk = Chunk(self.gcode, start, min(start + chunk_lines, self.count))
+                    self.chunks[i // chunk_lines] = chunk
+        return chunk
+
+    def kind(self, i):
+        return self._chunk(i).kinds[i % chunk_lines]
+
+    def host_command(self, i):
+        return self._chunk(i).host_commands[i % chunk_lines]
+
+    def command(self, i):
+        return self._chunk(i).command(i % chunk_lines)
+
+    def numbered(self, i, lineno):
+        """Line i as sent with line number lineno and its checksum"""
+        chunk = self._chunk(i)
+        i %= chunk_lines
+        return b"N%d %s*%d\n" % (lineno, chunk.command(i),
+                                 chunk.sums[i] ^ lineno_xor(lineno))
+
+    def unnumbered(self, i):
+        return self.command(i) + b"\n"
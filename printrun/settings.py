@@ -270,6 +270,9 @@ class Settings:
         self._add(StringSetting("port", "", _("Serial port"), _("Port used to communicate with printer")))
         self._add(ComboSetting("baudrate", 115200, self.__baudrate_list(), _("Baud rate"), _("Communications Speed")))
         self._add(BooleanSetting("tcp_streaming_mode", False, _("TCP streaming mode"), _("When using a TCP connection to the printer, the streaming mode will not wait for acks from the printer to send new commands. This will break things such as ETA prediction, but can result in smoother prints.")), root.update_tcp_streaming_mode)
+        self._add(SpinSetting("send_window", 1, 1, 64, _("Send window"), _("Number of commands sent to the printer ahead of its acknowledgements. Above 1, only used with firmwares reporting their free buffer space (ADVANCED_OK) or known to buffer commands, and should not exceed the firmware command buffer (BUFSIZE) otherwise"), "Printer"), root.update_send_window)
+        self._add(SpinSetting("recv_batch_interval", 0, 0, 1000, _("Received lines batching"), _("Milliseconds during which the lines received from the printer are gathered before being shown, 0 to show each line as it arrives. Gathering them keeps verbose firmwares from flooding the interface, acknowledgements and resend requests are still handled at once"), "Printer"), root.update_recv_batch_interval)
+        self._add(StringSetting("machine_limits", "", _("Machine limits"), _("Firmware commands setting the printer limits the print durations are estimated with (M201 maximum accelerations, M203 maximum feedrates, M204 accelerations, M205 jerks or J junction deviation), for instance \"M204 S1500 M205 J0.02\". Marlin defaults are used for the others, and the commands found in the G-code files apply on top"), "Printer"), root.update_machine_limits)
         self._add(BooleanSetting("rpc_server", True, _("RPC server"), _("Enable RPC server to allow remotely querying print status")), root.update_rpc_server)
         self._add(BooleanSetting("dtr", True, _("DTR"), _("Disabling DTR would prevent Arduino (RAMPS) from resetting upon connection"), "Printer"))
         self._add(SpinSetting("bedtemp_abs", 110, 0, 400, _("Bed temperature for ABS"), _("Heated Build Platform temp for ABS (deg C)"), "Printer"))
@@ -295,6 +298,8 @@ class Settings:
         self._add(StringSetting("final_command", "", _("Final command"), _("Executable to run when the print is finished"), "External"))
         self._add(StringSetting("error_command", "", _("Error command"), _("Executable to run when an error occurs"), "External"))
         self._add(StringSetting("log_path", "", _("Log path"), _("Path to the log file. An empty path will log to the console."), "UI"))
+        self._add(BooleanSetting("columnar_gcode", False, _("Columnar G-code storage"), _("Store loaded G-code files in compact NumPy columns (needed by the G-code cache)"), "UI"))
+        self._add(SpinSetting("gcode_cache_size", 0, 0, 1000000, _("G-code cache size"), _("Disk space used to keep preprocessed G-code files for faster reloading, with columnar G-code storage (MB, 0 to disable)"), "UI"))
 
         self._add(HiddenSetting("project_offset_x", 0.0))
         self._add(HiddenSetting("project_offset_y", 0.0))
@@ -167,7 +167,8 @@ setup(name = "Printrun",
       license = "GPLv3",
       data_files = data_files,
       packages = find_packages(),
-      scripts = ["pronsole.py", "pronterface.py", "plater.py", "printcore.py"],
+      scripts = ["pronsole.py", "pronterface.py", "plater.py", "printcore.py",
+                 "printfarm.py", "layerpreview.py"],
       cmdclass = cmdclass,
       ext_modules = extensions,
       classifiers=["Programming Language :: Python :: 3 :: Only"],
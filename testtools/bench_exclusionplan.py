@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Checks the exclusion plan of the part excluder and measures what it
+saves the sending thread.
+
+The check sends synthetic G-code with relative Z hops through the
+preprintsendcb pronterface used before the plan, deciding each line and
+the commands to send at send time, and through a lookup in the plan, for
+GCode and ColumnarGCode and random rectangles: both must send the same
+commands, which must be the G-code the plan exports.
+
+The benchmark times the two callbacks over nlines, and the plan itself.
+
+usage: bench_exclusionplan.py [nlines]"""
+
+import sys
+import os
+import io
+import math
+import random
+import time
+import logging
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from printrun import gcoder
+from printrun.gcoder_columnar import ColumnarGCode
+from printrun.exclusionplan import ExclusionPlan
+from synthgcode import generate
+
+class Sender:
+    """Sends the lines of gcode as printcore does with a preprintsendcb,
+    recording the lines sent and the commands sent now"""
+
+    def __init__(self, gcode):
+        self.mainqueue = gcode
+        self.queueindex = 0
+        self.sent = []
+
+    def send_now(self, command):
+        self.sent.append(command)
+
+    def run(self, preprintsendcb):
+        lines = [gline for layer in self.mainqueue.all_layers for gline in layer]
+        for self.queueindex, gline in enumerate(lines):
+            next_gline = lines[self.queueindex + 1] if self.queueindex + 1 < len(lines) else None
+            gline = preprintsendcb(gline, next_gline)
+            if gline is not None:
+                self.sent.append(gline.raw)
+        return self.sent
+
+class Tested:
+    """preprintsendcb of pronterface before the plan"""
+
+    def __init__(self, p, rectangles):
+        self.p = p
+        self.rectangles = rectangles
+        self.excluder_e = self.excluder_z_abs = self.excluder_z_rel = None
+
+    def is_excluded_move(self, gline):
+        if not gline.is_move:
+            return False
+        for (x0, y0, x1, y1) in self.rectangles:
+            if x0 <= gline.current_x <= x1 and y0 <= gline.current_y <= y1:
+                return True
+        return False
+
+    def preprintsendcb(self, gline, next_gline):
+        if not self.is_excluded_move(gline):
+            return gline
+        else:
+            if gline.z is not None:
+                if gline.relative:
+                    if self.excluder_z_abs is not None:
+                        self.excluder_z_abs += gline.z
+                    elif self.excluder_z_rel is not None:
+                        self.excluder_z_rel += gline.z
+                    else:
+                        self.excluder_z_rel = gline.z
+                else:
+                    self.excluder_z_rel = None
+                    self.excluder_z_abs = gline.z
+            if gline.e is not None and not gline.relative_e:
+                self.excluder_e = gline.e
+            if next_gline is not None and not self.is_excluded_move(next_gline):
+                if self.excluder_e is not None:
+                    self.p.send_now("G92 E%.5f" % self.excluder_e)
+                    self.excluder_e = None
+                if self.excluder_z_abs is not None:
+                    if gline.relative:
+                        self.p.send_now("G90")
+                    self.p.send_now("G1 Z%.5f" % self.excluder_z_abs)
+                    self.excluder_z_abs = None
+                    if gline.relative:
+                        self.p.send_now("G91")
+                if self.excluder_z_rel is not None:
+                    if not gline.relative:
+                        self.p.send_now("G91")
+                    self.p.send_now("G1 Z%.5f" % self.excluder_z_rel)
+                    self.excluder_z_rel = None
+                    if not gline.relative:
+                        self.p.send_now("G90")
+                return None
+
+class Planned:
+    """preprintsendcb of pronterface with the plan"""
+
+    def __init__(self, p, plan):
+        self.p = p
+        self.plan = plan
+
+    def preprintsendcb(self, gline, next_gline):
+        plan = self.plan
+        index = self.p.queueindex
+        if not plan.skipped[index]:
+            return gline
+        for command in plan.fixups.get(index, ()):
+            self.p.send_now(command)
+        return None
+
+def synthetic_gcode(nlines):
+    """Synthetic G-code with a relative Z hop at each travel"""
+    for line in generate(nlines, segments_per_layer = 500):
+        if line.startswith("G0 "):
+            yield "G91"
+            yield "G1 Z0.4 F9000"
+            yield "G90"
+            yield line
+            yield "G91"
+            yield "G1 Z-0.4"
+            yield "G90"
+        else:
+            yield line
+
+def both_sent(gcode, rectangles):
+    tested = Sender(gcode)
+    tested.run(Tested(tested, rectangles).preprintsendcb)
+    planned = Sender(gcode)
+    plan = ExclusionPlan(gcode, rectangles)
+    planned.run(Planned(planned, plan).preprintsendcb)
+    return tested.sent, planned.sent, plan
+
+def check():
+    rng = random.Random(0)
+    text = list(synthetic_gcode(20000))
+    for gcode_class in (gcoder.GCode, ColumnarGCode):
+        gcode = gcode_class(text)
+        for _ in range(5):
+            rectangles = []
+            for _ in range(rng.randint(1, 3)):
+                # Around a point of the spiral of the layers
+                angle = rng.uniform(0, 2 * math.pi)
+                x, y = 100 + 20 * math.cos(angle), 100 + 20 * math.sin(angle)
+                side = rng.uniform(2, 20)
+                rectangles.append((x - side, y - side, x + side, y + side))
+            tested, planned, plan = both_sent(gcode, rectangles)
+            assert planned == tested, "commands sent differ for %s" % rectangles
+            assert len(planned) < len(gcode), "nothing excluded"
+            exported = io.StringIO()
+            plan.write(exported)
+            assert exported.getvalue().splitlines() == planned, "exported G-code differs"
+    print("The plan sends and exports the commands sent by testing each line")
+
+def main():
+    logging.disable(logging.WARNING)
+    nlines = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    check()
+    rectangles = [(60, 60, 100, 100), (110, 110, 130, 150)]
+    for gcode_class in (gcoder.GCode, ColumnarGCode):
+        gcode = gcode_class(list(synthetic_gcode(nlines)))
+        start = time.process_time()
+        plan = ExclusionPlan(gcode, rectangles)
+        planning = time.process_time() - start
+        timings = []
+        for preprintsendcb in (Tested(None, rectangles).preprintsendcb, Planned(None, plan).preprintsendcb):
+            sender = Sender(gcode)
+            preprintsendcb.__self__.p = sender
+            lines = [gline for layer in gcode.all_layers for gline in layer]
+            start = time.process_time()
+            for sender.queueindex, gline in enumerate(lines):
+                preprintsendcb(gline, lines[sender.queueindex + 1] if sender.queueindex + 1 < len(lines) else None)
+            timings.append(time.process_time() - start)
+        print("%s, %d lines, %d skipped: planned in %.3fs, callbacks take %.3fs instead of %.3fs" %
+              (gcode_class.__name__, len(gcode), plan.skipped.sum(), planning, timings[1], timings[0]))
+
+if __name__ == '__main__':
+    main()
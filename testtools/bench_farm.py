@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Checks farm.PrinterFarm and measures it driving many printers.
+
+The check runs a farm of simulated printers (see simprinter.py) with jobs
+for any printer and pinned ones, cancels a job while it prints, and checks
+that every printer executed exactly the files of its jobs, one after the
+other, and that identical jobs shared their parsed file and send buffer.
+
+The benchmark queues two jobs per printer on N simulated printers, running
+in their own process so that the CPU time of this process is the one of the
+farm, and reports the aggregated throughput, the host CPU per printer and
+the memory used.
+
+usage: bench_farm.py [printers] [nlines] [latency] [window]"""
+
+import sys
+import os
+import asyncio
+import resource
+import subprocess
+import tempfile
+import logging
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from printrun import gcoder
+from printrun.farm import PrinterFarm, GCodePool, SharedGCode, format_status
+from simprinter import SimPrinter
+from synthgcode import write
+
+def maxrss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss / 1024. if sys.platform != "darwin" else rss / 1048576.
+
+def expected_lines(filename):
+    lines = [gcoder.gcode_strip_comment_exp.sub("", line).strip()
+             for line in open(filename)]
+    return [line for line in lines if line]
+
+def executed_lines(printer):
+    return [command for command in printer.executed
+            if not command.startswith(("M105", "M110", "M115"))]
+
+async def run_check(tmp):
+    files = []
+    for i, nlines in enumerate((1500, 800)):
+        filename = os.path.join(tmp, "check%d.gcode" % i)
+        write(filename, nlines, segments_per_layer = 500)
+        files.append(filename)
+    simulators = [SimPrinter(latency = 0.002, advanced_ok = True) for i in range(3)]
+    farm = PrinterFarm(send_window = 8)
+    farm.quit_when_done = True
+    for i, simulator in enumerate(simulators):
+        farm.add_printer("p%d" % i, simulator.port)
+    jobs = [farm.submit(files[0]), farm.submit(files[0]),
+            farm.submit(files[1], "p2"), farm.submit(files[0]),
+            farm.submit(files[1])]
+    async def cancel_last():
+        while jobs[-1].state != "printing" or jobs[-1].progress() < 0.2:
+            await asyncio.sleep(0.01)
+        farm.cancel(jobs[-1].id)
+    canceller = asyncio.ensure_future(cancel_last())
+    try:
+        await asyncio.wait_for(farm.run(), 120)
+        await canceller
+    finally:
+        for simulator in simulators:
+            simulator.close()
+    assert [job.state for job in jobs] == ["done"] * 4 + ["cancelled"], \
+        [job.state for job in jobs]
+    assert jobs[2].assigned.name == "p2", "pinned job on %s" % jobs[2].assigned.name
+    for i, simulator in enumerate(simulators):
+        expected = []
+        for job in jobs[:4]:
+            if job.assigned.name == "p%d" % i:
+                expected += expected_lines(job.filename)
+        executed = executed_lines(simulator)
+        cancelled = jobs[4]
+        if cancelled.assigned.name == "p%d" % i:
+            # The lines sent before the cancellation come last
+            tail = executed[len(expected):]
+            assert 0 < len(tail) < len(expected_lines(cancelled.filename)), \
+                "%d lines of the cancelled job executed" % len(tail)
+            assert tail == expected_lines(cancelled.filename)[:len(tail)], \
+                "cancelled job differs"
+            executed = executed[:len(expected)]
+        assert executed == expected, "p%d executed other lines" % i
+    status = farm.status()
+    assert status["parse_loads"] < len(jobs), "files not shared"
+
+async def shared_buffers(filename):
+    pool = GCodePool()
+    first = await pool.acquire(filename)
+    second = await pool.acquire(filename)
+    return first[1] is second[1] and first[2] is second[2]
+
+def check():
+    gcode = gcoder.LightGCode(["G28", "G1 X1 Y1"])
+    view = SharedGCode(gcode)
+    view.append("M400")
+    assert len(gcode) == 2 and len(view) == 3 and view[2].raw == "M400", \
+        "appended line leaked to the shared file"
+    with tempfile.TemporaryDirectory() as tmp:
+        asyncio.run(run_check(tmp))
+        filename = os.path.join(tmp, "shared.gcode")
+        write(filename, 1000)
+        assert asyncio.run(shared_buffers(filename)), "send buffer not shared"
+    print("PrinterFarm assigns, pins, cancels and shares jobs correctly")
+
+def start_simulators(count, latency):
+    simulator = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "simprinter.py"),
+                                  str(latency), "0", str(count)],
+                                 stdout = subprocess.PIPE, universal_newlines = True)
+    ports = [simulator.stdout.readline().split()[3].rstrip(",")
+             for i in range(count)]
+    return simulator, ports
+
+def main():
+    logging.disable(logging.WARNING)
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    nlines = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    latency = float(sys.argv[3]) if len(sys.argv) > 3 else 0.005
+    window = int(sys.argv[4]) if len(sys.argv) > 4 else 8
+    check()
+    print("%d printers, %d jobs of %d lines, %.1fms latency, window %d" %
+          (count, 2 * count, nlines, latency * 1000, window))
+    with tempfile.TemporaryDirectory() as tmp:
+        files = []
+        for i in range(2):
+            filename = os.path.join(tmp, "bench%d.gcode" % i)
+            write(filename, nlines)
+            files.append(filename)
+        simulator, ports = start_simulators(count, latency)
+        base_rss = maxrss_mb()
+        try:
+            farm = PrinterFarm(send_window = window)
+            farm.quit_when_done = True
+            for i, port in enumerate(ports):
+                farm.add_printer("printer%d" % i, port)
+            for i in range(2 * count):
+                farm.submit(files[i % 2])
+            asyncio.run(farm.run())
+        finally:
+            simulator.terminate()
+            simulator.wait()
+        print(format_status(farm.status()).splitlines()[-1])
+        print("peak memory +%.1f MB" % (maxrss_mb() - base_rss))
+
+if __name__ == '__main__':
+    main()
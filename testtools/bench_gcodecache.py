@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Times cold (parse and store) and warm (cached) loads of a G-code file
+through gcodecache.GCodeCache, checks the cached result matches a fresh
+parse, and checks the cache honours its size limit.
+
+usage: bench_gcodecache.py [nlines | file.gcode]"""
+
+import sys
+import os
+import time
+import glob
+import tempfile
+import logging
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from printrun.gcodecache import GCodeCache
+from printrun.gcoder_columnar import ColumnarGCode
+from synthgcode import write
+from bench_gcoder_parallel import compare
+
+home_pos = (0, 0, 0)
+
+def load(cache, path):
+    gcode = ColumnarGCode(deferred = True)
+    start = time.time()
+    if not cache.load(path, home_pos, gcode):
+        gcode.prepare(open(path, encoding = "utf-8"), home_pos)
+        cache.store(path, home_pos, gcode)
+    return gcode, time.time() - start
+
+def main():
+    logging.disable(logging.WARNING)
+    arg = sys.argv[1] if len(sys.argv) > 1 else "500000"
+    with tempfile.TemporaryDirectory() as tmp:
+        if os.path.exists(arg):
+            path = arg
+        else:
+            path = os.path.join(tmp, "bench.gcode")
+            write(path, int(arg))
+        cache = GCodeCache(os.path.join(tmp, "cache"), 1 << 40)
+        cold, cold_time = load(cache, path)
+        warm, warm_time = load(cache, path)
+        compare(cold, warm, "cached")
+        # Walk every line once, as printing does
+        start = time.time()
+        for line in warm.lines:
+            line.command
+        walk_time = time.time() - start
+        print("%d lines, %d layers: cold load %.2fs, warm load %.3fs (x%.0f), "
+              "walking the warm lines %.2fs" %
+              (len(cold), len(cold.all_layers), cold_time, warm_time,
+               cold_time / warm_time, walk_time))
+
+        # Touching the file makes the cache rehash it, and hit again
+        os.utime(path)
+        start = time.time()
+        gcode = ColumnarGCode(deferred = True)
+        assert cache.load(path, home_pos, gcode)
+        print("warm load after touch (rehash): %.3fs" % (time.time() - start))
+
+        # Round trip of the sample files
+        for name in sorted(glob.glob(os.path.join(os.path.dirname(__file__), "..", "testfiles", "*.gcode"))):
+            compare(load(cache, name)[0], load(cache, name)[0], name)
+
+        # A limit below one entry keeps nothing
+        small = GCodeCache(os.path.join(tmp, "small"), 1)
+        load(small, path)
+        assert not small.load(path, home_pos, ColumnarGCode(deferred = True))
+        # Room for two entries: the least recently used one goes
+        paths = []
+        for i in range(3):
+            paths.append(os.path.join(tmp, "lru%d.gcode" % i))
+            write(paths[-1], 5000 + i)
+        lru = GCodeCache(os.path.join(tmp, "lru"), 1 << 40)
+        load(lru, paths[0])
+        lru.max_size = 2.5 * sum(entry.stat().st_size for entry in
+                                 os.scandir(os.path.join(lru.entries_dir, os.listdir(lru.entries_dir)[0])))
+        load(lru, paths[1])
+        time.sleep(0.01)
+        load(lru, paths[0])
+        time.sleep(0.01)
+        load(lru, paths[2])
+        hits = [lru.load(p, home_pos, ColumnarGCode(deferred = True)) for p in paths]
+        assert hits == [True, False, True], hits
+        print("size limit and LRU eviction honoured")
+
+if __name__ == '__main__':
+    main()
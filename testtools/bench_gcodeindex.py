@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Checks the spatial index of G-code and measures its queries.
+
+The check compares, for GCode and ColumnarGCode, the lines the index finds
+touching random rectangles and nearest to random points with a scan of
+every move of the layer, and the lines it finds excluded by rectangles of
+the part excluder with the test pronterface ran on each line sent.
+
+The benchmark builds the index of nlines of synthetic G-code and times its
+queries against the scans, and the exclusion of a whole file against the
+test of each of its lines.
+
+usage: bench_gcodeindex.py [nlines]"""
+
+import sys
+import os
+import math
+import random
+import time
+import logging
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from printrun import gcoder
+from printrun.gcoder_columnar import ColumnarGCode
+from synthgcode import generate
+
+def layer_segments(gcode):
+    """(line index, start, end) of the moves of each layer, positions being
+    carried from the previous move"""
+    x = y = 0.
+    layers = []
+    for layer in gcode.all_layers:
+        segments = []
+        for i, gline in enumerate(layer):
+            if not gline.is_move:
+                continue
+            start = (x, y)
+            if gline.current_x is not None:
+                x = gline.current_x
+            if gline.current_y is not None:
+                y = gline.current_y
+            segments.append((i, start, (x, y)))
+        layers.append(segments)
+    return layers
+
+def crosses(a, b, c, d):
+    """Whether segments ab and cd meet"""
+    def side(p, q, r):
+        return (q[0] - p[0]) * (r[1] - p[1]) - (q[1] - p[1]) * (r[0] - p[0])
+
+    def within(p, q, r):
+        return min(p[0], q[0]) <= r[0] <= max(p[0], q[0]) and min(p[1], q[1]) <= r[1] <= max(p[1], q[1])
+    d1, d2, d3, d4 = side(c, d, a), side(c, d, b), side(a, b, c), side(a, b, d)
+    if ((d1 > 0) != (d2 > 0) and d1 and d2) and ((d3 > 0) != (d4 > 0) and d3 and d4):
+        return True
+    return (d1 == 0 and within(c, d, a)) or (d2 == 0 and within(c, d, b)) \
+        or (d3 == 0 and within(a, b, c)) or (d4 == 0 and within(a, b, d))
+
+def touches(start, end, x0, y0, x1, y1):
+    if any(x0 <= x <= x1 and y0 <= y <= y1 for x, y in (start, end)):
+        return True
+    corners = [(x0, y0), (x1, y0), (x1, y1), (x0, y1)]
+    return any(crosses(start, end, corners[i], corners[i - 1]) for i in range(4))
+
+def distance(start, end, x, y):
+    dx, dy = end[0] - start[0], end[1] - start[1]
+    length2 = dx * dx + dy * dy
+    t = 0. if not length2 else max(0., min(1., ((x - start[0]) * dx + (y - start[1]) * dy) / length2))
+    return math.hypot(x - start[0] - t * dx, y - start[1] - t * dy)
+
+def excluded_by_test(gcode, rectangles):
+    """Lines excluded as pronterface tested them while sending"""
+    return [i for i, gline in enumerate(gcode.lines)
+            if gline.is_move and any(x0 <= gline.current_x <= x1 and y0 <= gline.current_y <= y1
+                                     for x0, y0, x1, y1 in rectangles)]
+
+def random_rectangle(rng, side):
+    x, y = rng.uniform(-10, 210), rng.uniform(-10, 210)
+    return (x, y, x + rng.uniform(0, side), y + rng.uniform(0, side))
+
+def check():
+    rng = random.Random(0)
+    text = list(generate(20000, segments_per_layer = 300))
+    for gcode_class in (gcoder.GCode, ColumnarGCode):
+        gcode = gcode_class(text)
+        index = gcode.spatial_index()
+        assert gcode.spatial_index() is index, "index built twice"
+        layers = layer_segments(gcode)
+        for _ in range(200):
+            layer = rng.randrange(len(layers))
+            segments = layers[layer]
+            rectangle = random_rectangle(rng, 40)
+            found = index.lines_touching(layer, *rectangle).tolist()
+            expected = sorted(i for i, start, end in segments if touches(start, end, *rectangle))
+            assert found == expected, "lines touching %s in layer %d differ" % (rectangle, layer)
+            x, y = rng.uniform(0, 200), rng.uniform(0, 200)
+            found = index.nearest_line(layer, x, y, 10.)
+            distances = [(distance(start, end, x, y), i) for i, start, end in segments]
+            best = min(distances, default = (math.inf, None))
+            if best[0] > 10.:
+                assert found is None, "line found farther than the radius"
+            else:
+                assert found is not None and abs(found[1] - best[0]) < 1e-6, \
+                    "nearest line to (%f, %f) in layer %d differs" % (x, y, layer)
+                start, end = index.segment(layer, found[0])
+                assert abs(distance(start, end, x, y) - found[1]) < 1e-6, "segment differs"
+        rectangles = [random_rectangle(rng, 60) for _ in range(3)]
+        excluded = index.ends_in_rectangles(rectangles)
+        assert excluded.nonzero()[0].tolist() == excluded_by_test(gcode, rectangles), \
+            "excluded lines differ"
+        gcode.append("G1 X1 Y1")
+        assert gcode.spatial_index() is not index, "index not rebuilt after edit"
+    print("Queries and excluded lines match a scan of every move")
+
+def main():
+    logging.disable(logging.WARNING)
+    nlines = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    check()
+    rng = random.Random(1)
+    text = list(generate(nlines))
+    for gcode_class in (gcoder.GCode, ColumnarGCode):
+        gcode = gcode_class(text)
+        layers = layer_segments(gcode)
+        start = time.process_time()
+        index = gcode.spatial_index()
+        for layer in range(len(layers)):
+            index.layer(layer)
+        build = time.process_time() - start
+        queries = [(rng.randrange(len(layers)), rng.uniform(0, 200), rng.uniform(0, 200))
+                   for _ in range(200)]
+        start = time.process_time()
+        for layer, x, y in queries:
+            index.nearest_line(layer, x, y, 5.)
+        indexed = time.process_time() - start
+        start = time.process_time()
+        for layer, x, y in queries:
+            min(((distance(s, e, x, y), i) for i, s, e in layers[layer]), default = None)
+        scanned = time.process_time() - start
+        print("%s, %d lines in %d layers: index built in %.3fs, %d nearest lines in %.4fs "
+              "instead of %.3fs" % (gcode_class.__name__, len(gcode), len(layers), build,
+                                    len(queries), indexed, scanned))
+        rectangles = [(20, 20, 80, 80), (120, 120, 160, 170)]
+        start = time.process_time()
+        index.ends_in_rectangles(rectangles)
+        indexed = time.process_time() - start
+        start = time.process_time()
+        excluded_by_test(gcode, rectangles)
+        scanned = time.process_time() - start
+        print("  excluded lines found in %.4fs instead of %.3fs tested while sending" %
+              (indexed, scanned))
+
+if __name__ == '__main__':
+    main()
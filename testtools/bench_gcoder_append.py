@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Checks gcoder.Analyzer against GCode.append and times both.
+
+printcore runs every command it sends through its analyzer.  The check
+feeds the files in testfiles/ and synthetic G-code (with relative moves and
+extrusion, tool changes, inches, G92 shifts and homing) one line at a time
+to GCode.append and to an Analyzer, comparing the returned lines and the
+state after each of them.
+
+usage: bench_gcoder_append.py [nlines]"""
+
+import sys
+import os
+import glob
+import time
+import logging
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from printrun import gcoder
+from synthgcode import generate
+
+state_fields = ("imperial", "relative", "relative_e", "current_tool",
+                "current_x", "current_y", "current_z", "current_f",
+                "offset_x", "offset_y", "offset_z", "current_e", "offset_e",
+                "total_e", "max_e", "current_e_multi", "offset_e_multi",
+                "total_e_multi", "max_e_multi", "abs_pos", "abs_e")
+
+line_fields = ("command", "is_move", "x", "y", "z", "e", "f", "relative",
+               "relative_e", "current_x", "current_y", "current_z",
+               "extruding", "current_tool")
+
+def samples():
+    for filename in sorted(glob.glob(os.path.join(os.path.dirname(__file__), "..", "testfiles", "*.gcode"))):
+        yield os.path.basename(filename), open(filename, encoding = "utf-8").read().splitlines()
+    lines = list(generate(5000, segments_per_layer = 300))
+    yield "synthetic", lines
+    mixed = []
+    for line in lines:
+        if line.startswith(";LAYER"):
+            layer = int(line[7:])
+            mixed += ["T%d" % (layer % 3), "G92 E0", "M83" if layer % 2 else "M82",
+                      "G92 X10 Y-5", "G91", "G1 Z0.2 E-1 F600", "G90",
+                      "G20" if layer % 4 == 1 else "G21", "G28 X", "T?", "M117 hello"]
+        mixed.append(line)
+    yield "synthetic, mixed modes", mixed
+
+def check():
+    for name, lines in samples():
+        gcode = gcoder.GCode()
+        gcode.home_pos = (10, 20, 0)
+        analyzer = gcoder.Analyzer((10, 20, 0))
+        for line in lines:
+            expected = gcode.append(line, store = False)
+            got = analyzer.append(line)
+            assert (expected is None) == (got is None), "%s: %r" % (name, line)
+            if expected is None:
+                continue
+            for field in line_fields:
+                assert getattr(expected, field) == getattr(got, field), \
+                    "%s: %r %s" % (name, line, field)
+            for field in state_fields:
+                assert getattr(gcode, field) == getattr(analyzer, field), \
+                    "%s: %r %s %r vs %r" % (name, line, field,
+                                            getattr(gcode, field), getattr(analyzer, field))
+    print("Analyzer follows the same state as GCode.append")
+
+def bench(append, lines):
+    start = time.process_time()
+    for line in lines:
+        append(line)
+    return time.process_time() - start
+
+def main():
+    logging.disable(logging.WARNING)
+    nlines = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    check()
+    lines = list(generate(nlines))
+    gcode = gcoder.GCode()
+    before = bench(lambda line: gcode.append(line, store = False), lines)
+    analyzer = gcoder.Analyzer()
+    after = bench(analyzer.append, lines)
+    print("%d lines: GCode.append %.2f us/line, Analyzer.append %.2f us/line (x%.1f)" %
+          (len(lines), 1e6 * before / len(lines), 1e6 * after / len(lines),
+           before / after))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Checks the duration estimation of gcoder and measures its speed.
+
+The check compares the estimates of single moves, corners, reversals, split
+moves, per axis limits and dwells with their analytic durations, checks that
+a short lookahead slows short moves down, that the firmware commands in the
+file change the limits, that the NumPy planner, fed by blocks of any size,
+and the pure Python planner agree and that the layer durations add up to
+the total.
+
+The benchmark plans nmoves moves of a random walk with NumPy, collected by
+batches of 1000 as G-code loading does, then with the pure Python planner,
+and reports the time per move and the memory the NumPy planner peaks at,
+then loads synthetic G-code to compare the whole preprocessing time with the
+planning time.
+
+usage: bench_gcoder_estimate.py [nmoves]"""
+
+import sys
+import os
+import math
+import time
+import tracemalloc
+import logging
+
+import numpy
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from printrun import gcoder
+from printrun import gcoder_estimator
+from printrun.gcoder_estimator import BlockPlanner, MachineLimits, Moves, TrapezoidEstimator
+from synthgcode import generate
+
+# Limits making the analytic durations easy to compute
+setup = ["M201 X10000 Y10000 Z10000 E10000", "M203 X1000 Y1000 Z5 E100",
+         "M204 P1000 R1000 T1000", "M205 J0.02", "G90", "M82", "G92 E0"]
+
+def estimate(lines, estimator = None):
+    gcode = gcoder.GCode(deferred = True, estimator = estimator)
+    gcode.prepare(setup + lines)
+    return sum(layer.duration for layer in gcode.all_layers)
+
+def assert_close(value, expected, what):
+    assert math.isclose(value, expected, rel_tol = 1e-4), \
+        "%s: %.6fs, expected %.6fs" % (what, value, expected)
+
+def trapezoid(length, speed, accel, entry = 0.0, exit = 0.0):
+    ramps = (2 * speed ** 2 - entry ** 2 - exit ** 2) / (2 * accel)
+    if ramps <= length:
+        return (2 * speed - entry - exit) / accel + (length - ramps) / speed
+    peak = math.sqrt((2 * accel * length + entry ** 2 + exit ** 2) / 2)
+    return (2 * peak - entry - exit) / accel
+
+class TimedPlanner(BlockPlanner):
+
+    cpu = 0
+
+    def plan(self, data, stops, first):
+        start = time.process_time()
+        super(TimedPlanner, self).plan(data, stops, first)
+        TimedPlanner.cpu += time.process_time() - start
+
+    def finish(self):
+        start = time.process_time()
+        durations = super(TimedPlanner, self).finish()
+        TimedPlanner.cpu += time.process_time() - start
+        return durations
+
+class TimedEstimator(TrapezoidEstimator):
+
+    def moves(self, x = 0, y = 0, z = 0, e = 0):
+        moves = super(TimedEstimator, self).moves(x, y, z, e)
+        moves.planner = TimedPlanner(moves)
+        return moves
+
+def random_moves(count, seed = 0):
+    random = numpy.random.default_rng(seed)
+    x = numpy.cumsum(random.normal(0, 2, count)) + 100
+    y = numpy.cumsum(random.normal(0, 2, count)) + 100
+    z = numpy.repeat(numpy.arange(count // 1000 + 1) * 0.2, 1000)[:count]
+    e = numpy.cumsum(numpy.abs(random.normal(0, 0.05, count)))
+    f = random.choice([1800.0, 3600.0, 9000.0], count)
+    stop = random.random(count) < 0.001
+    dwell = numpy.where(stop, 0.1, 0.0)
+    return x, y, z, e, f, dwell, stop
+
+def check():
+    single = trapezoid(100, 100, 1000)
+    assert_close(estimate(["G1 X100 F6000"]), single, "single move")
+    assert_close(estimate(["G1 X4 F6000"]), trapezoid(4, 100, 1000), "short move")
+    assert_close(estimate(["G1 X50 F6000", "G1 X100"]), single, "split move")
+    assert_close(estimate(["G1 X100 F6000", "G1 X0"]), 2 * single, "reversal")
+    assert_close(estimate(["G1 X100 F6000", "G4 P500", "G4 S1", "G1 X0"]),
+                 2 * single + 1.5, "dwells")
+    assert_close(estimate(["G1 Z10 F6000"]), trapezoid(10, 5, 1000), "Z feedrate")
+    assert_close(estimate(["M204 T500", "G1 X100 F6000"]), trapezoid(100, 100, 500),
+                 "travel acceleration")
+    assert_close(estimate(["G1 X100 E10 F6000"]), single, "printing acceleration")
+
+    # Junction deviation: v^2 = a * J * sin(theta/2) / (1 - sin(theta/2))
+    corner = math.sqrt(1000 * 0.02 * math.sqrt(0.5) / (1 - math.sqrt(0.5)))
+    assert_close(estimate(["G1 X100 F6000", "G1 Y100"]),
+                 2 * trapezoid(100, 100, 1000, exit = corner), "corner")
+    # Classic jerk: X stops and Y starts at the jerk speed
+    assert_close(estimate(["M205 X10 Y10", "G1 X100 F6000", "G1 Y100"]),
+                 2 * trapezoid(100, 100, 1000, exit = 10), "jerk corner")
+
+    # A full planner goes through collinear moves at full speed, a 4 moves
+    # buffer must be able to stop within 4mm
+    lines = ["G1 X%d F6000" % i for i in range(1, 101)]
+    limits = MachineLimits(lookahead = 4)
+    unbuffered = MachineLimits(lookahead = None)
+    assert_close(estimate(lines, TrapezoidEstimator(unbuffered)), single, "full lookahead")
+    assert_close(estimate(lines[:4], TrapezoidEstimator(limits)),
+                 trapezoid(4, 100, 1000), "lookahead start")
+    # Junctions at sqrt(2 * a * 4mm), each 1mm move peaking in between
+    junction = 2 * 1000 * 4
+    middle = 2 * (math.sqrt((2 * 1000 * 1 + 2 * junction) / 2) - math.sqrt(junction)) / 1000
+    buffered = estimate(lines, TrapezoidEstimator(limits))
+    assert buffered > single + 80 * (middle - 0.01), \
+        "short lookahead not slowing down: %.3fs" % buffered
+
+    # Both planners, in every mode
+    x, y, z, e, f, dwell, stop = random_moves(20000)
+    block_moves = gcoder_estimator.block_moves
+    for text in ("", "M205 X8 Y8 E2", "M204 S500 M203 X80"):
+        for lookahead in (16, 3, None):
+            for gcoder_estimator.block_moves in (block_moves, 7):
+                limits = MachineLimits.from_commands(text, MachineLimits(lookahead = lookahead))
+                estimator = TrapezoidEstimator(limits)
+                planned = estimator.moves()
+                moves = Moves(limits)
+                for target in (planned, moves):
+                    target.extend(x[:10000], y[:10000], z[:10000], e[:10000], f[:10000],
+                                  dwell[:10000], stop[:10000])
+                    target.set_limits("M204", "M204 P700 ; mid print")
+                    target.move(x[10000], y[10000], z[10000], e[10000], f[10000])
+                    target.extend(x[10001:], y[10001:], z[10001:], e[10001:], f[10001:],
+                                  dwell[10001:], stop[10001:])
+                fast = estimator._durations_numpy(planned)
+                slow = numpy.array(estimator._durations_python(moves))
+                assert numpy.allclose(fast, slow, rtol = 1e-9, atol = 1e-12), \
+                    "planners differ (%r, lookahead %s, blocks of %d)" % \
+                    (text, lookahead, gcoder_estimator.block_moves)
+                assert numpy.all(fast >= 0) and numpy.all(numpy.isfinite(fast)), \
+                    "bad durations (%r, lookahead %s)" % (text, lookahead)
+    gcoder_estimator.block_moves = block_moves
+
+    gcode = gcoder.LightGCode(list(generate(20000, segments_per_layer = 500)))
+    total = sum(layer.duration for layer in gcode.all_layers)
+    assert len(gcode.all_layers) > 10 and gcode.duration.seconds == int(total), \
+        "layer durations do not add up"
+    print("Estimates match the analytic durations, both planners agree")
+
+def main():
+    logging.disable(logging.WARNING)
+    nmoves = int(sys.argv[1]) if len(sys.argv) > 1 else 2000000
+    check()
+    estimator = TrapezoidEstimator()
+    walk = random_moves(nmoves)
+    tracemalloc.start()
+    start = time.process_time()
+    moves = estimator.moves()
+    for first in range(0, nmoves, 1000):
+        moves.extend(*[values[first:first + 1000] for values in walk])
+    durations = estimator.durations(moves)
+    cpu = time.process_time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print("%d moves, %.1fh: NumPy planner %.2fs, %.2f us/move, peak %.1f MB" %
+          (nmoves, durations.sum() / 3600, cpu, 1e6 * cpu / nmoves, peak / 1e6))
+    del moves, durations
+    subset = Moves(estimator.limits)
+    subset.extend(*[values[:100000] for values in random_moves(nmoves)])
+    start = time.process_time()
+    estimator._durations_python(subset)
+    cpu = time.process_time() - start
+    print("%d moves: pure Python planner %.2fs, %.2f us/move" %
+          (len(subset), cpu, 1e6 * cpu / len(subset)))
+
+    lines = list(generate(nmoves // 4))
+    timed = TimedEstimator()
+    gcode = gcoder.LightGCode(deferred = True, estimator = timed)
+    start = time.process_time()
+    gcode.prepare(lines)
+    cpu = time.process_time() - start
+    print("%d lines: preprocessing %.2fs, planning %.3fs (%.1f%%), estimate %s" %
+          (len(lines), cpu, TimedPlanner.cpu, 100 * TimedPlanner.cpu / cpu, gcode.duration))
+
+if __name__ == '__main__':
+    main()
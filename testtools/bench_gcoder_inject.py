@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Checks G-code injection in layers and measures its cost.
+
+The check injects and rewrites layers of GCode, LightGCode and ColumnarGCode
+objects, comparing their lines, len() and idxs() with a plain list of the
+expected lines after each edit, then prints to a fake printer injecting in a
+layer to come while printing, which must send the injected lines.
+
+The benchmark loads nlines of synthetic G-code, then injects in and rewrites
+a layer in the middle of the file, and does the same on a flat list of lines
+with the layer and line index arrays, as GCode used to store them.
+
+usage: bench_gcoder_inject.py [nlines]"""
+
+import sys
+import os
+import random
+import threading
+import time
+import logging
+from array import array
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from printrun import gcoder
+from printrun.gcoder_columnar import ColumnarGCode
+from printrun.printcore import printcore
+from synthgcode import generate
+
+def compare(gcode, layers, what):
+    expected = [raw for layer in layers for raw in layer]
+    assert len(gcode) == len(expected), "%s: %d lines, expected %d" % \
+        (what, len(gcode), len(expected))
+    assert [line.raw for line in gcode.lines] == expected, "%s: lines differ" % what
+    i = 0
+    for layer_idx, layer in enumerate(layers):
+        for line_idx in range(len(layer)):
+            assert gcode.idxs(i) == (layer_idx, line_idx), "%s: idxs(%d)" % (what, i)
+            assert gcode.lines[i].raw == layer[line_idx], "%s: lines[%d]" % (what, i)
+            i += 1
+    assert list(gcode.layer_idxs) == [gcode.idxs(i)[0] for i in range(len(gcode))]
+    assert list(gcode.line_idxs) == [gcode.idxs(i)[1] for i in range(len(gcode))]
+    if expected:
+        assert gcode.lines[-1].raw == expected[-1], "%s: lines[-1]" % what
+    try:
+        gcode.idxs(len(gcode))
+    except IndexError:
+        pass
+    else:
+        raise AssertionError("%s: idxs past the end" % what)
+
+def check_edits():
+    lines = list(generate(20000, segments_per_layer = 300))
+    for gcode_class in (gcoder.GCode, gcoder.LightGCode, ColumnarGCode):
+        what = gcode_class.__name__
+        gcode = gcode_class(lines)
+        layers = [[line.raw for line in layer] for layer in gcode.all_layers]
+        compare(gcode, layers, what)
+        rand = random.Random(0)
+        for step in range(60):
+            layer_idx = rand.randrange(len(layers) - 1)
+            commands = ["M117 edit %d.%d" % (step, i) for i in range(rand.randrange(4))]
+            if step % 3:
+                injected = gcode.prepend_to_layer(commands + ["  "], layer_idx)
+                layers[layer_idx][0:0] = commands
+            else:
+                injected = gcode.rewrite_layer(commands, layer_idx)
+                layers[layer_idx] = commands
+            assert injected == commands, "%s: returned %r" % (what, injected)
+            compare(gcode, layers, "%s after edit %d" % (what, step))
+        gcode.append("G1 X1 Y1")
+        layers[-1].append("G1 X1 Y1")
+        compare(gcode, layers, "%s after append" % what)
+        assert gcode.revision == 60, "%s: revision %d" % (what, gcode.revision)
+
+class Printer:
+    """Serial port stand-in acknowledging every line, running on_send on
+    each of them before"""
+
+    def __init__(self, core, on_send):
+        self.core = core
+        self.on_send = on_send
+        self.lines = []
+
+    def write(self, data):
+        command = data.decode().split(" ", 1)[1].rsplit("*", 1)[0]
+        self.lines.append(command)
+        self.on_send(command)
+        self.core._acknowledge("ok")
+
+def check_print():
+    lines = ["G28", "G1 Z0.2 F600"] + list(generate(3000, segments_per_layer = 200))
+    gcode = gcoder.LightGCode(lines)
+    target = len(gcode.all_layers) // 2
+    injection = ["M117 injected %d" % i for i in range(3)]
+
+    def on_send(command):
+        if command == "M117 inject now":
+            gcode.prepend_to_layer(injection, target)
+    gcode.prepend_to_layer(["M117 inject now"], 2)
+    expected = [gcoder.gcode_strip_comment_exp.sub("", line.raw).strip()
+                for line in gcode.lines]
+    start = gcode.layer_starts[target]
+    expected[start:start] = injection
+
+    core = printcore()
+    core.printer_tcp = None
+    core.printer = Printer(core, on_send)
+    core.online = True
+    core._start_sender = lambda: None
+    done = threading.Event()
+    core.endcb = done.set
+    core.startprint(gcode)
+    done.wait()
+    sent = [command for command in core.printer.lines if not command.startswith("M110")]
+    assert sent == [command for command in expected if command], \
+        "injected lines not sent as expected"
+
+def check():
+    check_edits()
+    check_print()
+    print("Edited layers match the expected lines, injections are printed")
+
+def flat_prepend(lines, layer_idxs, line_idxs, commands, layer_idx):
+    """prepend_to_layer on a flat list of lines and index arrays"""
+    start_index = layer_idxs.index(layer_idx)
+    for i in range(start_index, len(layer_idxs)):
+        if layer_idxs[i] != layer_idx:
+            end_index = i
+            break
+    else:
+        end_index = i + 1
+    end_line = line_idxs[end_index - 1]
+    for i, command in enumerate(reversed(commands)):
+        lines.insert(start_index, gcoder.Line(command))
+        layer_idxs.insert(end_index + i, layer_idx)
+        line_idxs.insert(end_index + i, end_line + i + 1)
+
+def flat_rewrite(lines, layer_idxs, line_idxs, commands, layer_idx):
+    """rewrite_layer on a flat list of lines and index arrays"""
+    start_index = layer_idxs.index(layer_idx)
+    for i in range(start_index, len(layer_idxs)):
+        if layer_idxs[i] != layer_idx:
+            end_index = i
+            break
+    else:
+        end_index = i + 1
+    layer_idxs = layer_idxs[:start_index] + array('I', len(commands) * [layer_idx]) + layer_idxs[end_index:]
+    line_idxs = line_idxs[:start_index] + array('I', range(len(commands))) + line_idxs[end_index:]
+    del lines[start_index:end_index]
+    for command in reversed(commands):
+        lines.insert(start_index, gcoder.Line(command))
+    return layer_idxs, line_idxs
+
+def timed(function, *args):
+    start = time.process_time()
+    function(*args)
+    return 1e3 * (time.process_time() - start)
+
+def main():
+    logging.disable(logging.WARNING)
+    nlines = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    check()
+    gcode = gcoder.LightGCode(generate(nlines))
+    layer_idx = len(gcode.all_layers) // 2
+    commands = ["M117 injected", "M106 S255", "G4 P100"]
+    rewrite = [line.raw for line in gcode.all_layers[layer_idx]][::2]
+    print("%d lines, %d layers, editing layer %d (%d lines)" %
+          (len(gcode), len(gcode.all_layers), layer_idx,
+           len(gcode.all_layers[layer_idx])))
+
+    lines = list(gcode.lines)
+    # Copies, the flat versions edit them in place
+    layer_idxs = array('I', gcode.layer_idxs)
+    line_idxs = array('I', gcode.line_idxs)
+    print("flat lines:   inject %7.2f ms, rewrite %7.2f ms" %
+          (timed(flat_prepend, lines, layer_idxs, line_idxs, commands, layer_idx),
+           timed(flat_rewrite, lines, layer_idxs, line_idxs, rewrite, layer_idx)))
+    print("layer chunks: inject %7.2f ms, rewrite %7.2f ms" %
+          (timed(gcode.prepend_to_layer, commands, layer_idx),
+           timed(gcode.rewrite_layer, rewrite, layer_idx)))
+
+    start = time.process_time()
+    for i in range(0, len(gcode), 7):
+        gcode.idxs(i)
+    cpu = time.process_time() - start
+    print("idxs(): %.2f us/call" % (1e6 * cpu / len(range(0, len(gcode), 7))))
+
+if __name__ == '__main__':
+    main()
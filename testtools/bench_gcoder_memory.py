@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compares load time and peak memory of the GCode storage backends.
+
+Each backend is loaded in its own subprocess so that peak RSS figures do not
+leak from one run into the next.
+
+usage: bench_gcoder_memory.py [nlines | file.gcode]"""
+
+import sys
+import os
+import time
+import resource
+import subprocess
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+backends = ["GCode", "LightGCode", "ColumnarGCode"]
+
+def maxrss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss / 1024. if sys.platform != "darwin" else rss / 1048576.
+
+def run_backend(name, filename):
+    from printrun import gcoder
+    from printrun import gcoder_columnar
+    gcode_class = getattr(gcoder, name, None) or getattr(gcoder_columnar, name)
+    base_rss = maxrss_mb()
+    start = time.time()
+    gcode = gcode_class(open(filename))
+    duration = time.time() - start
+    # Walk all the lines the way printcore does to check views are usable
+    start = time.time()
+    for i in range(len(gcode)):
+        layer, line = gcode.idxs(i)
+        gcode.all_layers[layer][line].raw
+    walk = time.time() - start
+    print("%-14s %9d lines  load %6.2fs  walk %6.2fs  peak +%7.1f MB" %
+          (name, len(gcode), duration, walk, maxrss_mb() - base_rss))
+
+def main():
+    if len(sys.argv) == 3 and sys.argv[1] == "--backend":
+        run_backend(sys.argv[2], os.environ["BENCH_GCODE_FILE"])
+        return
+    arg = sys.argv[1] if len(sys.argv) > 1 else "2000000"
+    tmp = None
+    if os.path.exists(arg):
+        filename = arg
+    else:
+        from synthgcode import write
+        tmp = tempfile.NamedTemporaryFile(suffix = ".gcode", delete = False)
+        tmp.close()
+        filename = tmp.name
+        print("Generating %s synthetic lines..." % arg)
+        write(filename, int(arg))
+    print("File size: %.1f MB" % (os.path.getsize(filename) / 1048576.))
+    env = dict(os.environ, BENCH_GCODE_FILE = filename)
+    try:
+        for name in backends:
+            subprocess.check_call([sys.executable, os.path.abspath(__file__),
+                                   "--backend", name], env = env)
+    finally:
+        if tmp:
+            os.unlink(filename)
+
+if __name__ == '__main__':
+    main()
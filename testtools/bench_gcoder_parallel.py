@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Checks gcoder_parallel.ParallelGCode against the serial ColumnarGCode
+preprocessing and times both.
+
+The check cuts the files in testfiles/ and synthetic variants (relative
+extrusion, tool changes, inches, G92 shifts, dwells, relative Z lifts) in
+various numbers of chunks.  Layers, indices, per line fields and bounding box
+must be identical; extrusion totals are summed in a different order and
+compared with a tolerance, like the durations which depend on them.
+
+usage: bench_gcoder_parallel.py [nlines | file.gcode] [workers]"""
+
+import sys
+import os
+import glob
+import re
+import math
+import time
+import tempfile
+import logging
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from printrun import gcoder_parallel
+from printrun.gcoder_columnar import ColumnarGCode, ColumnarLayer
+from printrun.gcoder_parallel import ParallelGCode
+from synthgcode import generate, write
+
+def variant(lines, kind):
+    for i, line in enumerate(lines):
+        if kind == "relative_e":
+            if line == "M82":
+                line = "M83"
+            elif line.startswith("G1"):
+                line = re.sub(r" E[-\d.]+", " E0.0125", line)
+        elif kind == "tools" and line.startswith(";LAYER"):
+            line = "T%d\nG92 E0" % (int(line[7:]) % 3)
+        elif kind == "inches" and i == 1:
+            line = "G20"
+        elif kind == "shifts" and line.startswith(";LAYER"):
+            line = "G92 X10 Y-5\nG4 P150\nG1 Z0.4\nG91\nG1 Z-0.3\nG90"
+        yield line
+
+def samples():
+    for filename in sorted(glob.glob(os.path.join(os.path.dirname(__file__), "..", "testfiles", "*.gcode"))):
+        yield os.path.basename(filename), open(filename, encoding = "utf-8").read()
+    lines = list(generate(20000, segments_per_layer = 700))
+    for kind in ("plain", "relative_e", "tools", "inches", "shifts"):
+        yield "synthetic " + kind, "\n".join(variant(lines, kind)) + "\n"
+
+def close(a, b):
+    return math.isclose(a, b, rel_tol = 1e-9, abs_tol = 1e-6)
+
+def commands(layer):
+    return [line.command for line in layer]
+
+def layer_raw(layer):
+    return layer.raw[layer.offsets[0]:layer.offsets[-1]]
+
+def compare(serial, parallel, what):
+    assert len(serial) == len(parallel), "%s: line count" % what
+    assert serial.layer_starts == parallel.layer_starts, "%s: layer_starts" % what
+    assert len(serial.all_layers) == len(parallel.all_layers), "%s: layers" % what
+    for i, (a, b) in enumerate(zip(serial.all_layers, parallel.all_layers)):
+        if not isinstance(a, ColumnarLayer):
+            continue
+        assert a.z == b.z, "%s: layer %d z %r vs %r" % (what, i, a.z, b.z)
+        # E deltas are summed in another order, durations may differ slightly
+        assert close(a.duration, b.duration), "%s: layer %d duration" % (what, i)
+        assert layer_raw(a) == layer_raw(b), "%s: layer %d raw" % (what, i)
+        assert commands(a) == commands(b), "%s: layer %d commands" % (what, i)
+        fields = [name for name in a.data.dtype.names if name != "command"]
+        for name in fields:
+            assert a.data[name].tobytes() == b.data[name].tobytes(), \
+                "%s: layer %d %s" % (what, i, name)
+    assert abs((serial.duration - parallel.duration).total_seconds()) <= 1, \
+        "%s: duration" % what
+    for name in ("all_zs", "est_layer_height", "xmin", "xmax",
+                 "ymin", "ymax", "zmin", "zmax", "imperial", "relative",
+                 "relative_e", "current_tool", "current_x", "current_y",
+                 "current_z", "offset_x", "offset_y", "offset_z"):
+        assert getattr(serial, name) == getattr(parallel, name), \
+            "%s: %s %r vs %r" % (what, name, getattr(serial, name), getattr(parallel, name))
+    for name in ("filament_length", "total_e", "current_e"):
+        assert close(getattr(serial, name), getattr(parallel, name)), "%s: %s" % (what, name)
+    for name in ("filament_length_multi", "total_e_multi"):
+        a = getattr(serial, name)
+        b = getattr(parallel, name)
+        assert len(a) == len(b) and all(map(close, a, b)), "%s: %s" % (what, name)
+
+def main():
+    logging.disable(logging.WARNING)
+    gcoder_parallel.min_parallel_size = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "sample.gcode")
+        for what, text in samples():
+            with open(path, "w", encoding = "utf-8") as f:
+                f.write(text)
+            serial = ColumnarGCode(open(path, encoding = "utf-8"))
+            for workers in (1, 2, 3, 7):
+                ParallelGCode.workers = workers
+                compare(serial, ParallelGCode(path), "%s, %d chunks" % (what, workers))
+    print("ParallelGCode matches ColumnarGCode")
+
+    arg = sys.argv[1] if len(sys.argv) > 1 else "1000000"
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+    gcoder_parallel.min_parallel_size = 4 * 1024 * 1024
+    ParallelGCode.workers = workers
+    with tempfile.TemporaryDirectory() as tmp:
+        if os.path.exists(arg):
+            path = arg
+        else:
+            path = os.path.join(tmp, "bench.gcode")
+            write(path, int(arg))
+        start = time.time()
+        serial = ColumnarGCode(open(path, encoding = "utf-8"))
+        serial_time = time.time() - start
+        start = time.time()
+        ParallelGCode(path)
+        parallel_time = time.time() - start
+    print("%d lines: serial %.2fs, %d workers %.2fs (x%.1f)" %
+          (len(serial), serial_time, workers, parallel_time,
+           serial_time / parallel_time))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Checks gcoder.batch_parse against split()/parse_coordinates() and times
+both.
+
+The check runs over the files in testfiles/ and over randomly generated
+lines mixing codes, comments, line numbers, unit changes and malformed
+numbers; every parsed field must be identical, NaN standing for None.
+
+usage: bench_gcoder_parse.py [nlines | file.gcode]"""
+
+import sys
+import os
+import glob
+import math
+import time
+import random
+import logging
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from printrun import gcoder
+
+def reference_parse(raws, imperial = False):
+    commands = []
+    coordinates = dict((code, []) for code in gcoder.gcode_parsed_args)
+    for raw in raws:
+        line = gcoder.PyLine(raw)
+        split_raw = gcoder.split(line)
+        if line.command == "G20":
+            imperial = True
+        elif line.command == "G21":
+            imperial = False
+        if line.command[:1] == "G":
+            gcoder.parse_coordinates(line, split_raw, imperial)
+        commands.append(line.command)
+        for code in gcoder.gcode_parsed_args:
+            value = getattr(line, code)
+            coordinates[code].append(float("nan") if value is None else value)
+    return commands, coordinates, imperial
+
+def same(a, b):
+    return a == b or (math.isnan(a) and math.isnan(b))
+
+def check(raws, what):
+    ref = reference_parse(raws)
+    try:
+        res = gcoder.batch_parse(raws)
+    except ValueError:
+        # Malformed numbers such as "X-" make both parsers fail
+        try:
+            reference_parse(raws)
+        except ValueError:
+            return
+        raise
+    assert ref[0] == res[0], "%s: commands differ" % what
+    assert ref[2] == res[2], "%s: unit state differs" % what
+    for code in gcoder.gcode_parsed_args:
+        for i, (a, b) in enumerate(zip(ref[1][code], res[1][code].tolist())):
+            assert same(a, b), "%s: %s differs on %r: %r vs %r" % (what, code, raws[i], a, b)
+
+def fuzz_line(rnd):
+    bits = []
+    if rnd.random() < 0.1:
+        bits.append("N%d" % rnd.randint(0, 1000))
+    for _ in range(rnd.randint(0, 6)):
+        kind = rnd.random()
+        if kind < 0.1:
+            bits.append("(%s)" % rnd.choice(["comment", "x1 y2", "", "G1 X5"]))
+        elif kind < 0.15:
+            bits.append(";" + rnd.choice(["", "G1 X1", "layer"]))
+        elif kind < 0.2:
+            bits.append(rnd.choice(["/", "*12", "G20", "G21", "M117 héllo", "°"]))
+        else:
+            letter = rnd.choice("GMTNXYZEFIJgxyzeSPK")
+            number = rnd.choice(["", "0", "1", "-1", "+2.5", "10.", ".125", "-0.0",
+                                 "%.3f" % rnd.uniform(-300, 300)])
+            bits.append(letter + number)
+    line = rnd.choice([" ", "", "  "]).join(bits).strip()
+    return line or "G1"
+
+def main():
+    logging.disable(logging.WARNING)
+    for filename in sorted(glob.glob(os.path.join(os.path.dirname(__file__), "..", "testfiles", "*.gcode"))):
+        raws = [l.strip() for l in open(filename) if l.strip()]
+        check(raws, os.path.basename(filename))
+    rnd = random.Random(42)
+    for i in range(200):
+        check([fuzz_line(rnd) for _ in range(rnd.randint(1, 200))], "fuzz %d" % i)
+    print("batch_parse matches split/parse_coordinates")
+
+    arg = sys.argv[1] if len(sys.argv) > 1 else "500000"
+    if os.path.exists(arg):
+        raws = [l.strip() for l in open(arg) if l.strip()]
+    else:
+        from synthgcode import generate
+        raws = list(generate(int(arg)))
+    start = time.time()
+    reference_parse(raws)
+    per_line = time.time() - start
+    start = time.time()
+    for i in range(0, len(raws), gcoder.batch_size):
+        gcoder.batch_parse(raws[i:i + gcoder.batch_size])
+    batch = time.time() - start
+    print("%d lines: per line %.2fs, batch %.2fs (x%.1f)" %
+          (len(raws), per_line, batch, per_line / batch))
+    for gcode_class in (gcoder.GCode, gcoder.LightGCode):
+        start = time.time()
+        gcode_class(raws)
+        print("%s load: %.2fs" % (gcode_class.__name__, time.time() - start))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Checks printing from a G-code file while it loads and measures how soon
+it can start.
+
+The check loads synthetic G-code in a thread with gcoder.ProgressiveLoad,
+starts printing to a fake printer as soon as the first layers are parsed
+and compares the sent lines with the file, then does the same with a load
+failing midway, which must pause the print after the parsed lines.
+
+The benchmark loads nlines of synthetic G-code and reports when the first
+layers were ready to print and when the whole file was loaded.
+
+usage: bench_gcoder_progressive.py [nlines]"""
+
+import sys
+import os
+import threading
+import time
+import logging
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from printrun import gcoder
+from printrun.printcore import printcore
+from synthgcode import generate
+
+class Printer:
+    """Serial port stand-in acknowledging every line"""
+
+    def __init__(self, core):
+        self.core = core
+        self.lines = []
+
+    def write(self, data):
+        command = data.decode().split(" ", 1)[1].rsplit("*", 1)[0]
+        self.lines.append(command)
+        self.core._acknowledge("ok")
+
+def load(gcode, data, **kwargs):
+    """Start loading data into gcode in a thread, returns the loader"""
+    loader = gcoder.ProgressiveLoad(gcode, **kwargs)
+
+    def run():
+        try:
+            gcode.prepare(data, layer_callback = loader.layer_callback)
+        except Exception as e:
+            loader.finish(e)
+        else:
+            loader.finish()
+    threading.Thread(target = run, daemon = True).start()
+    return loader
+
+def failing(lines, count):
+    for i, line in enumerate(lines):
+        if i == count:
+            raise IOError("read error")
+        yield line
+
+def print_while_loading(data):
+    gcode = gcoder.LightGCode(deferred = True)
+    ready = threading.Event()
+    loader = load(gcode, data, ready_callback = ready.set)
+    assert ready.wait(30), "first layers never loaded"
+    started_at = loader.parsed
+    core = printcore()
+    core.printer_tcp = None
+    core.printer = Printer(core)
+    core.online = True
+    core._start_sender = lambda: None
+    errors = []
+    core.errorcb = errors.append
+    done = threading.Event()
+    core.endcb = done.set
+    core.startprint(gcode)
+    assert done.wait(60), "print did not end"
+    sent = [command for command in core.printer.lines if not command.startswith("M110")]
+    return gcode, loader, started_at, core, sent, errors
+
+def expected_commands(gcode):
+    commands = [gcoder.gcode_strip_comment_exp.sub("", line.raw).strip()
+                for line in gcode.lines]
+    return [command for command in commands if command]
+
+def check():
+    lines = list(generate(100000, segments_per_layer = 500))
+    gcode, loader, started_at, core, sent, errors = print_while_loading(lines)
+    assert loader.done and loader.error is None, "load failed"
+    assert started_at < len(gcode), "print started after the load"
+    assert not core.paused and not errors, "print paused: %s" % errors
+    assert sent == expected_commands(gcode), "sent lines differ"
+
+    gcode, loader, started_at, core, sent, errors = print_while_loading(failing(lines, 60000))
+    assert isinstance(loader.error, IOError), "load did not fail"
+    assert core.paused and errors and "read error" in errors[0], \
+        "print not paused on the failed load: %s" % errors
+    assert sent == expected_commands(gcode), "sent lines differ after a failed load"
+    assert 0 < len(gcode) <= 60000
+    print("Prints follow their load, a failed load pauses them")
+
+def main():
+    logging.disable(logging.WARNING)
+    nlines = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    check()
+    lines = list(generate(nlines))
+    for gcode_class in (gcoder.GCode, gcoder.LightGCode):
+        gcode = gcode_class(deferred = True)
+        ready = threading.Event()
+        start = time.time()
+        loader = load(gcode, lines, ready_callback = ready.set)
+        ready.wait()
+        ready_time = time.time() - start
+        with loader._cond:
+            while not loader.done:
+                loader._cond.wait()
+        print("%-10s %d lines: first %d layers printable after %.3fs, loaded after %.2fs" %
+              (gcode_class.__name__, len(gcode), loader.ready_layers, ready_time,
+               time.time() - start))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Checks gcoder_stream.StreamGCode and measures printing from it.
+
+The check compares the lines of StreamGCode with those of LightGCode on the
+files in testfiles/ and on edge cases (blank lines, CRLF, missing final
+newline), reuses the sidecar index, then prints through printcore to a fake
+printer which acknowledges every line, from the start and from a resume
+index, comparing what was sent with a LightGCode print.
+
+The benchmark prints synthetic files of growing sizes both ways, each print
+in its own subprocess, and reports the peak memory: it grows with the file
+for LightGCode and stays flat for StreamGCode.
+
+usage: bench_gcoder_stream.py [nlines]"""
+
+import sys
+import os
+import glob
+import time
+import resource
+import subprocess
+import tempfile
+import threading
+import logging
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from printrun import gcoder
+from printrun.gcoder_stream import StreamGCode
+from printrun.printcore import printcore
+from synthgcode import write
+
+class FakePrinter:
+    """Serial port stand-in acknowledging every line it gets"""
+
+    def __init__(self, core):
+        self.core = core
+        self.lines = []
+        self.count = 0
+        self.keep = True
+
+    def write(self, data):
+        self.count += 1
+        if self.keep:
+            self.lines.append(data)
+        self.core._acknowledge("ok")
+
+def maxrss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss / 1024. if sys.platform != "darwin" else rss / 1048576.
+
+def load(kind, filename):
+    if kind == "stream":
+        return StreamGCode(filename)
+    return gcoder.LightGCode([line.strip() for line in open(filename)])
+
+def print_file(gcode, startindex = 0, keep = True):
+    core = printcore()
+    core.printer_tcp = None
+    core.printer = FakePrinter(core)
+    core.printer.keep = keep
+    core.online = True
+    # Nothing is sent outside of the print
+    core._start_sender = lambda: None
+    done = threading.Event()
+    core.endcb = done.set
+    core.startprint(gcode, startindex)
+    done.wait()
+    return core.printer
+
+def check():
+    edge_cases = ["G28\n\n  \nG1 X1\r\nG1 Y2 ; comment\n\t\nM84",
+                  "\n\nG1 X1\n", "G1 X1", "", "\n \n"]
+    with tempfile.TemporaryDirectory() as tmp:
+        files = sorted(glob.glob(os.path.join(os.path.dirname(__file__), "..", "testfiles", "*.gcode")))
+        for i, text in enumerate(edge_cases):
+            path = os.path.join(tmp, "edge%d.gcode" % i)
+            with open(path, "w", newline = "") as f:
+                f.write(text)
+            files.append(path)
+        for path in files:
+            index = os.path.join(tmp, os.path.basename(path) + ".lineidx")
+            light = load("light", path)
+            expected = [line.raw for line in light]
+            for reuse in (False, True):
+                stream = StreamGCode(path, index)
+                assert stream.done or not reuse, "%s: sidecar reuse" % path
+                got = [line.raw for line in stream]
+                stream.close()
+                assert got == expected, "%s: lines differ" % path
+            if not expected:
+                continue
+            stream = StreamGCode(path, index)
+            for startindex in (0, len(expected) // 2):
+                sent = print_file(stream, startindex).lines
+                assert sent == print_file(light, startindex).lines, \
+                    "%s: print from %d differs" % (path, startindex)
+            stream.close()
+        # Sidecars go to the cache directory by default, not next to the file
+        cache = os.environ["XDG_CACHE_HOME"] = os.path.join(tmp, "cache")
+        path = os.path.join(tmp, "default.gcode")
+        with open(path, "w") as f:
+            f.write(edge_cases[0])
+        stream = StreamGCode(path)
+        stream.close()
+        del os.environ["XDG_CACHE_HOME"]
+        assert stream.index_filename.startswith(cache), "sidecar not in cache"
+        assert not os.path.exists(path + ".lineidx"), "sidecar next to the file"
+    print("StreamGCode matches LightGCode")
+
+def run(kind, filename):
+    base_rss = maxrss_mb()
+    start = time.time()
+    gcode = load(kind, filename)
+    printer = print_file(gcode, keep = False)
+    duration = time.time() - start
+    print("%-6s %9d lines  %6.1fs  %8d lines/s  peak +%7.1f MB" %
+          (kind, printer.count - 2, duration, printer.count / duration,
+           maxrss_mb() - base_rss))
+    if kind == "stream":
+        gcode.close()
+
+def main():
+    logging.disable(logging.WARNING)
+    if len(sys.argv) == 3 and sys.argv[1] == "--run":
+        run(sys.argv[2], os.environ["BENCH_GCODE_FILE"])
+        return
+    check()
+    nlines = int(sys.argv[1]) if len(sys.argv) > 1 else 250000
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in (nlines, 4 * nlines):
+            filename = os.path.join(tmp, "bench%d.gcode" % size)
+            write(filename, size)
+            print("File size: %.1f MB" % (os.path.getsize(filename) / 1048576.))
+            env = dict(os.environ, BENCH_GCODE_FILE = filename)
+            for kind in ("light", "stream"):
+                subprocess.check_call([sys.executable, os.path.abspath(__file__),
+                                       "--run", kind], env = env)
+
+if __name__ == '__main__':
+    main()
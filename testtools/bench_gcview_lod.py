@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Checks the level of detail and frustum culling of the 3D G-code view
+and measures what they save.
+
+The check makes sure the lines drawn for simplified layers follow the boxes
+of the full geometry, that no layer with a vertex in view gets culled for
+random views, and that the ranges GcodeModel draws cover the moves of the
+layers in view.
+
+The benchmark loads nlines of synthetic G-code and counts the indices sent
+to the GPU per frame for a few views, with and without the level of detail
+and the culling, along with the CPU time spent planning them. Actual frame
+times are logged by the 3D view when pressing T. No OpenGL context is needed.
+
+usage: bench_gcview_lod.py [nlines]"""
+
+import sys
+import os
+import math
+import random
+import time
+import logging
+
+import numpy
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pyglet
+pyglet.options['shadow_window'] = False
+
+from printrun import gcoder
+from printrun.gl.libtatlin import actors
+from printrun.gl.libtatlin.actors import GcodeModel, ViewFrustum
+from synthgcode import generate
+from bench_gcview_model import random_moves
+
+viewport = (0, 0, 800, 600)
+build_dimensions = (200, 200, 100)
+
+def perspective(fovy, aspect, near, far):
+    f = 1 / math.tan(math.radians(fovy) / 2)
+    return numpy.array([[f / aspect, 0, 0, 0],
+                        [0, f, 0, 0],
+                        [0, 0, (far + near) / (near - far), 2 * far * near / (near - far)],
+                        [0, 0, -1, 0]])
+
+def translation(x, y, z):
+    matrix = numpy.identity(4)
+    matrix[:3, 3] = (x, y, z)
+    return matrix
+
+def rotation(angle, x, y, z):
+    axis = numpy.array((x, y, z), dtype = numpy.float64)
+    axis /= numpy.linalg.norm(axis)
+    c, s = math.cos(math.radians(angle)), math.sin(math.radians(angle))
+    matrix = numpy.identity(4)
+    matrix[:3, :3] = c * numpy.identity(3) + s * numpy.array(
+        [[0, -axis[2], axis[1]], [axis[2], 0, -axis[0]], [-axis[1], axis[0], 0]]) \
+        + (1 - c) * numpy.outer(axis, axis)
+    return matrix
+
+def view(zoom = 1.0, tilt = 0, turn = 0, center = None):
+    """Matrices as GcodeViewPanel sets them up, looking at center (the
+    middle of the platform by default), in OpenGL order"""
+    dist = max(build_dimensions[:2])
+    projection = perspective(60, viewport[2] / viewport[3], 10, 3 * dist) \
+        @ translation(0, 0, -dist)
+    if center is None:
+        center = (build_dimensions[0] / 2, build_dimensions[1] / 2, 0)
+    modelview = numpy.diag((zoom, zoom, zoom, 1)) @ rotation(tilt, 1, 0, 0) \
+        @ rotation(turn, 0, 0, 1) @ translation(-center[0], -center[1], -center[2])
+    return ViewFrustum(projection.T.flatten(), modelview.T.flatten(), viewport)
+
+def load(lines):
+    model = GcodeModel()
+    for _ in model.load_data(gcoder.GCode(lines)):
+        pass
+    # What init() does besides creating the buffers
+    model.layers_loaded = model.max_layers
+    model.layer_bounds = actors.layer_bounds(model.vertices, model.count_print_vertices,
+                                             model.layer_stops, model.layers_loaded)
+    return model
+
+def check_lines(model):
+    indices = model.indices
+    triangles = set(zip(indices[0::3].tolist(), indices[1::3].tolist(),
+                        indices[2::3].tolist()))
+    normals = model.normals.reshape(-1, 3)
+    lines = model.lod_indices.reshape(-1, 2)
+    assert (normals[lines.reshape(-1)] == (0, 0, 1)).all(), "lines not along the top of paths"
+    for first, second in lines.tolist():
+        # First triangle of triangulate_box
+        assert (first, first + 1, second + 1) in triangles, "line %d-%d not along a box" % (first, second)
+    counts = numpy.diff(numpy.asarray(model.count_lod_indices, dtype = numpy.int64))
+    index_counts = numpy.diff(numpy.asarray(model.count_print_indices, dtype = numpy.int64))
+    # 24 indices per box, one line each, and 6 per rectangle closing a path
+    rectangles = index_counts - 12 * counts
+    assert (rectangles >= 0).all() and (rectangles % 6 == 0).all() and (rectangles <= 12).all(), \
+        "lines do not match the boxes"
+
+def layer_in_view(model, frustum, layer):
+    start = model.count_print_vertices[model.layer_stops[layer - 1]]
+    end = model.count_print_vertices[model.layer_stops[layer]]
+    points = model.vertices.reshape(-1, 3)[start:end]
+    clip = numpy.c_[points, numpy.ones(len(points))] @ frustum.clip.T
+    w = clip[:, 3:]
+    return bool(((numpy.abs(clip[:, :3]) <= w) & (w > 0)).all(axis = 1).any())
+
+def check_culling(model, rand):
+    for i in range(30):
+        frustum = view(zoom = rand.uniform(0.5, 8), tilt = rand.uniform(-80, 80),
+                       turn = rand.uniform(0, 360),
+                       center = (rand.uniform(0, 200), rand.uniform(0, 200), rand.uniform(0, 20)))
+        visible = frustum.visible(*model.layer_bounds)
+        for layer in range(1, model.max_layers + 1):
+            if not visible[layer]:
+                assert not layer_in_view(model, frustum, layer), "layer %d culled while in view" % layer
+    away = view(center = (5000, 5000, 0))
+    assert not away.visible(*model.layer_bounds)[1:].any(), "layers out of view kept"
+
+def check_ranges(model, rand):
+    for i in range(30):
+        frustum = view(zoom = rand.uniform(0.5, 8), tilt = rand.uniform(-80, 80),
+                       turn = rand.uniform(0, 360),
+                       center = (rand.uniform(0, 200), rand.uniform(0, 200), 0))
+        model.num_layers_to_draw = rand.randint(1, model.max_layers + 1)
+        model.layer_modes = modes = model.plan_layers(frustum)
+        stops = model.layer_stops
+        start = rand.randint(1, stops[-1])
+        end = rand.randint(start, stops[-1])
+        expected = {}
+        for layer in range(1, model.max_layers + 1):
+            for move in range(stops[layer - 1] + 1, stops[layer] + 1):
+                if start <= move <= end and modes[layer] != actors.draw_none:
+                    expected[move] = modes[layer]
+        got = {}
+        previous_end = 0
+        for mode, range_start, range_end in model.plan_ranges(start, end):
+            assert previous_end < range_start <= range_end, "ranges overlap"
+            previous_end = range_end
+            for move in range(range_start, range_end + 1):
+                got[move] = mode
+        assert got == expected, "drawn ranges do not match the layers"
+
+def check():
+    rand = random.Random(0)
+    for name, lines in (("synthetic", list(generate(30000, segments_per_layer = 300))),
+                        ("random moves", random_moves(10000))):
+        model = load(lines)
+        check_lines(model)
+        check_culling(model, rand)
+        check_ranges(model, rand)
+    print("Simplified layers follow the paths, layers in view are drawn")
+
+def frame_cost(model, frustum, lod, frustum_culling):
+    """Indices sent and CPU time planning for a frame drawing every layer"""
+    model.lod = lod
+    model.frustum_culling = frustum_culling
+    start = time.perf_counter()
+    if lod or frustum_culling:
+        model.layer_modes = model.plan_layers(frustum)
+    else:
+        model.layer_modes = None
+    ranges = model.plan_ranges(1, model.layer_stops[model.max_layers])
+    cpu = time.perf_counter() - start
+    triangles = lines = 0
+    for mode, range_start, range_end in ranges:
+        if mode == actors.draw_lines:
+            lines += model.count_lod_indices[range_end] - model.count_lod_indices[range_start - 1]
+        else:
+            triangles += model.count_print_indices[range_end] - model.count_print_indices[range_start - 1]
+    return triangles, lines, cpu
+
+def main():
+    logging.disable(logging.WARNING)
+    nlines = int(sys.argv[1]) if len(sys.argv) > 1 else 600000
+    check()
+    model = load(generate(nlines))
+    model.num_layers_to_draw = model.max_layers + 1
+    views = (("whole print", view(tilt = -50)),
+             ("zoomed out", view(zoom = 0.2, tilt = -50)),
+             ("zoomed on a side", view(zoom = 6, tilt = -50, center = (70, 100, 10))),
+             ("top layers", view(zoom = 3, tilt = -20, center = (100, 100, model.dims[2][1]))))
+    print("%d lines, %d layers, %d triangle indices" %
+          (nlines, model.max_layers, len(model.indices)))
+    for name, frustum in views:
+        full, _, _ = frame_cost(model, frustum, False, False)
+        triangles, lines, cpu = frame_cost(model, frustum, True, True)
+        print("%-17s full: %9d indices, with lod and culling: %9d triangle + %8d line indices (x%.1f less), planned in %.2f ms" %
+              (name, full, triangles, lines, full / max(1, triangles + lines), 1000 * cpu))
+
+if __name__ == '__main__':
+    main()
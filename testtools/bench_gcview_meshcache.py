@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Checks the 3D view geometry stored in the G-code cache and times cold
+and warm loads of the 3D view.
+
+The check loads a file through gcodecache.GCodeCache, builds its GcodeModel
+(storing it), then loads both again and compares the cached geometry and
+the gcview_end_vertex of every line with the built ones. A different path
+size must not hit the cache, nor edited G-code.
+
+The benchmark does the same with nlines of synthetic G-code, timing the
+load of the model up to its buffers being read once, as their upload to
+the GPU does. No OpenGL context is needed.
+
+usage: bench_gcview_meshcache.py [nlines | file.gcode]"""
+
+import sys
+import os
+import time
+import tempfile
+import logging
+
+import numpy
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pyglet
+pyglet.options['shadow_window'] = False
+
+from printrun.gcodecache import GCodeCache, mesh_buffers, mesh_counts
+from printrun.gcoder_columnar import ColumnarGCode
+from printrun.gl.libtatlin.actors import GcodeModel
+from synthgcode import write
+
+home_pos = (0, 0, 0)
+
+def load_gcode(cache, path):
+    gcode = ColumnarGCode(deferred = True)
+    if not cache.load(path, home_pos, gcode):
+        gcode.prepare(open(path, encoding = "utf-8"), home_pos)
+        cache.store(path, home_pos, gcode)
+    return gcode
+
+def load_model(cache, path, gcode, path_halfwidth = 0.2):
+    model = GcodeModel()
+    model.set_path_size(path_halfwidth, 0.2)
+    for _ in model.load_data(gcode, mesh_cache = cache.mesh_cache(path, home_pos)):
+        pass
+    # What numpy2vbo reads
+    upload = bytearray(max(getattr(model, name).nbytes for name in mesh_buffers))
+    for name in mesh_buffers:
+        data = getattr(model, name)
+        upload[:data.nbytes] = data.tobytes()
+    return model
+
+def end_vertices(gcode):
+    return [line.gcview_end_vertex for line in gcode.lines]
+
+def compare(built, cached, what):
+    for name in mesh_buffers:
+        assert numpy.array_equal(getattr(built, name), getattr(cached, name)), \
+            "%s: %s differ" % (what, name)
+    for name in mesh_counts:
+        assert list(getattr(built, name)) == list(getattr(cached, name)), \
+            "%s: %s differ" % (what, name)
+    assert built.layer_idxs_map == cached.layer_idxs_map, "%s: layer_idxs_map" % what
+    assert built.dims == cached.dims, "%s: dims" % what
+    assert built.max_layers == cached.max_layers, "%s: max_layers" % what
+
+def entries(cache):
+    return len(os.listdir(cache.entries_dir))
+
+def check(tmp):
+    path = os.path.join(tmp, "check.gcode")
+    write(path, 30000, segments_per_layer = 300)
+    cache = GCodeCache(os.path.join(tmp, "check-cache"), 1 << 40)
+    gcode = load_gcode(cache, path)
+    built = load_model(cache, path, gcode)
+    assert entries(cache) == 2, "3D view not stored"
+    built_ends = end_vertices(gcode)
+    gcode = load_gcode(cache, path)
+    cached = load_model(cache, path, gcode)
+    assert isinstance(cached.vertices, numpy.memmap), "3D view not loaded from the cache"
+    compare(built, cached, "cached")
+    assert end_vertices(gcode) == built_ends, "gcview_end_vertex differ"
+
+    wider = load_model(cache, path, load_gcode(cache, path), path_halfwidth = 0.3)
+    assert not isinstance(wider.vertices, numpy.memmap), "path size ignored"
+    assert not numpy.array_equal(wider.vertices, built.vertices)
+    assert entries(cache) == 3
+
+    gcode = load_gcode(cache, path)
+    gcode.prepend_to_layer(["M117 edited"], 3)
+    edited = load_model(cache, path, gcode, path_halfwidth = 0.4)
+    assert not isinstance(edited.vertices, numpy.memmap), "edited G-code loaded from the cache"
+    assert entries(cache) == 3, "edited G-code stored"
+    print("Cached 3D views match the built ones")
+
+def main():
+    logging.disable(logging.WARNING)
+    arg = sys.argv[1] if len(sys.argv) > 1 else "500000"
+    with tempfile.TemporaryDirectory() as tmp:
+        check(tmp)
+        if os.path.exists(arg):
+            path = arg
+        else:
+            path = os.path.join(tmp, "bench.gcode")
+            write(path, int(arg))
+        cache = GCodeCache(os.path.join(tmp, "cache"), 1 << 40)
+        gcode = load_gcode(cache, path)
+        start = time.time()
+        load_model(cache, path, gcode)
+        cold_time = time.time() - start
+        gcode = load_gcode(cache, path)
+        start = time.time()
+        model = load_model(cache, path, gcode)
+        warm_time = time.time() - start
+        print("%d lines, %d vertices: 3D view built in %.2fs, loaded from the cache in %.2fs (x%.1f)" %
+              (len(gcode), len(model.vertices) // 3, cold_time, warm_time,
+               cold_time / warm_time))
+
+if __name__ == '__main__':
+    main()
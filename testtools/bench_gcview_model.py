@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Checks the geometry of the 3D G-code view and measures how long it takes
+to build.
+
+The check loads the files in testfiles/, synthetic G-code and random moves
+(sharp and U turns, Z and E only moves, feedrate changes between extrusions,
+tool changes) into GcodeModel, and compares its buffers with the ones built
+one move at a time, as GcodeModel used to.
+
+The benchmark builds the geometry of nlines of synthetic G-code both ways.
+No OpenGL context is needed.
+
+usage: bench_gcview_model.py [nlines]"""
+
+import sys
+import os
+import glob
+import math
+import random
+import time
+import logging
+
+import numpy
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pyglet
+pyglet.options['shadow_window'] = False
+
+from printrun import gcoder
+from printrun.gl.libtatlin.actors import GcodeModel, get_next_move, \
+    triangulate_box, triangulate_rectangle
+from synthgcode import generate
+
+def per_move_buffers(model, model_data):
+    """The geometry of model_data built one move at a time"""
+    travels = []
+    vertices = []
+    normals = []
+    colors = []
+    indices = []
+    count_travel_indices = [0]
+    count_print_indices = [0]
+    count_print_vertices = [0]
+    layer_stops = [0]
+    end_vertices = []
+    prev_is_extruding = False
+    prev_move_normal_x = None
+    prev_move_normal_y = None
+    prev_move_angle = None
+    prev_pos = (0, 0, 0)
+    twopi = 2 * math.pi
+    path_halfwidth = model.path_halfwidth * 1.2
+    path_halfheight = model.path_halfheight * 1.2
+
+    def rectangle(pos, normal_x, normal_y, hw):
+        vertices.extend((pos[0], pos[1], pos[2] + path_halfheight))
+        vertices.extend((pos[0] - hw * normal_x, pos[1] - hw * normal_y, pos[2]))
+        vertices.extend((pos[0], pos[1], pos[2] - path_halfheight))
+        vertices.extend((pos[0] + hw * normal_x, pos[1] + hw * normal_y, pos[2]))
+        normals.extend((0, 0, 1))
+        normals.extend((-normal_x, -normal_y, 0))
+        normals.extend((0, 0, -1))
+        normals.extend((normal_x, normal_y, 0))
+
+    for layer_idx, layer in enumerate(model_data.all_layers):
+        has_movement = False
+        for gline_idx, gline in enumerate(layer):
+            if not gline.is_move:
+                continue
+            if gline.x is None and gline.y is None and gline.z is None:
+                continue
+            has_movement = True
+            current_pos = (gline.current_x, gline.current_y, gline.current_z)
+            if not gline.extruding:
+                travels.extend(prev_pos + current_pos)
+                prev_is_extruding = False
+            else:
+                vertex_k = len(vertices)
+                next_move = get_next_move(model_data, layer_idx, gline_idx)
+                next_is_extruding = (next_move.extruding
+                                     if next_move is not None else False)
+                delta_x = current_pos[0] - prev_pos[0]
+                delta_y = current_pos[1] - prev_pos[1]
+                norm = delta_x * delta_x + delta_y * delta_y
+                if norm == 0:
+                    continue
+                norm = math.sqrt(norm)
+                move_normal_x = - delta_y / norm
+                move_normal_y = delta_x / norm
+                move_angle = math.atan2(delta_y, delta_x)
+                if prev_is_extruding:
+                    prev_id = vertex_k // 3 - 4
+                    avg_move_normal_x = (prev_move_normal_x + move_normal_x) / 2
+                    avg_move_normal_y = (prev_move_normal_y + move_normal_y) / 2
+                    norm = avg_move_normal_x * avg_move_normal_x + avg_move_normal_y * avg_move_normal_y
+                    if norm == 0:
+                        avg_move_normal_x = move_normal_x
+                        avg_move_normal_y = move_normal_y
+                    else:
+                        norm = math.sqrt(norm)
+                        avg_move_normal_x /= norm
+                        avg_move_normal_y /= norm
+                    delta_angle = move_angle - prev_move_angle
+                    delta_angle = (delta_angle + twopi) % twopi
+                    fact = abs(math.cos(delta_angle / 2))
+                    first = vertex_k // 3
+                    if fact < 0.5:
+                        rectangle(prev_pos, prev_move_normal_x, prev_move_normal_y, path_halfwidth)
+                        indices.extend(triangulate_box(prev_id, prev_id + 1, prev_id + 2, prev_id + 3,
+                                                       first, first + 1, first + 2, first + 3))
+                        rectangle(prev_pos, move_normal_x, move_normal_y, path_halfwidth)
+                        prev_id += 4
+                        first += 4
+                    else:
+                        rectangle(prev_pos, avg_move_normal_x, avg_move_normal_y,
+                                  path_halfwidth / fact)
+                    indices.extend(triangulate_box(prev_id, prev_id + 1, prev_id + 2, prev_id + 3,
+                                                   first, first + 1, first + 2, first + 3))
+                else:
+                    rectangle(prev_pos, move_normal_x, move_normal_y, path_halfwidth)
+                    first = vertex_k // 3
+                    indices.extend(triangulate_rectangle(first, first + 1, first + 2, first + 3))
+                if not next_is_extruding:
+                    rectangle(current_pos, move_normal_x, move_normal_y, path_halfwidth)
+                    end_first = len(vertices) // 3 - 4
+                    indices.extend(triangulate_rectangle(end_first + 3, end_first + 2,
+                                                         end_first + 1, end_first))
+                    indices.extend(triangulate_box(first, first + 1, first + 2, first + 3,
+                                                   end_first, end_first + 1,
+                                                   end_first + 2, end_first + 3))
+                colors.extend(list(model.movement_color(gline))[:-1] *
+                              ((len(vertices) - vertex_k) // 3))
+                prev_is_extruding = True
+                prev_move_normal_x = move_normal_x
+                prev_move_normal_y = move_normal_y
+                prev_move_angle = move_angle
+            prev_pos = current_pos
+            count_travel_indices.append(len(travels) // 3)
+            count_print_indices.append(len(indices))
+            count_print_vertices.append(len(vertices) // 3)
+            end_vertices.append((gline, len(count_print_indices) - 1))
+        if has_movement:
+            layer_stops.append(len(count_print_indices) - 1)
+    return {"travels": numpy.array(travels, dtype = numpy.float32),
+            "vertices": numpy.array(vertices, dtype = numpy.float32),
+            "normals": numpy.array(normals, dtype = numpy.float32),
+            "colors": numpy.array(colors, dtype = numpy.float32),
+            "indices": numpy.array(indices, dtype = numpy.uint32),
+            "count_travel_indices": count_travel_indices,
+            "count_print_indices": count_print_indices,
+            "count_print_vertices": count_print_vertices,
+            "layer_stops": layer_stops,
+            "end_vertices": end_vertices}
+
+def load(model_data):
+    model = GcodeModel()
+    for _ in model.load_data(model_data):
+        pass
+    return model
+
+def random_moves(count, seed = 0):
+    rand = random.Random(seed)
+    lines = ["G28", "G92 E0", "M82"]
+    x, y, z, e = 100, 100, 0.2, 0
+    for i in range(count):
+        kind = rand.random()
+        if kind < 0.05:
+            z += 0.2
+            lines.append("G1 Z%.2f F9000" % z)
+        elif kind < 0.08:
+            e += 0.1
+            lines.append("G1 E%.4f" % e)
+        elif kind < 0.1:
+            e += 0.1
+            lines.append("G1 Z%.2f E%.4f" % (z, e))
+        elif kind < 0.12:
+            lines.append("G1 F%d" % rand.choice((1200, 1800)))
+        elif kind < 0.14:
+            lines.append("T%d" % rand.randrange(6))
+        elif kind < 0.16:
+            lines.append("G1 E%.4f" % (e - 1))
+        elif kind < 0.2:
+            x, y = rand.uniform(0, 200), rand.uniform(0, 200)
+            lines.append("G0 X%.3f Y%.3f" % (x, y))
+        elif kind < 0.25:
+            # U turn
+            e += 0.1
+            lines.append("G1 X%.3f Y%.3f E%.4f" % (x, y, e))
+            x, y = x - 1, y
+            e += 0.1
+            lines.append("G1 X%.3f Y%.3f E%.4f" % (x + 2, y, e))
+        else:
+            x += rand.uniform(-2, 2)
+            y += rand.uniform(-2, 2)
+            e += 0.05
+            lines.append("G1 X%.3f Y%.3f E%.4f" % (x, y, e))
+    return lines
+
+def samples():
+    for filename in sorted(glob.glob(os.path.join(os.path.dirname(__file__), "..", "testfiles", "*.gcode"))):
+        yield os.path.basename(filename), open(filename, encoding = "utf-8").read().splitlines()
+    yield "synthetic", list(generate(20000, segments_per_layer = 300))
+    yield "random moves", random_moves(20000)
+
+def check():
+    for name, lines in samples():
+        model_data = gcoder.GCode(lines)
+        model = load(model_data)
+        expected = per_move_buffers(model, model_data)
+        for field in ("travels", "vertices", "normals", "colors", "indices"):
+            got = getattr(model, field)
+            assert got.dtype == expected[field].dtype, "%s: %s dtype" % (name, field)
+            assert numpy.array_equal(got, expected[field]), "%s: %s differ" % (name, field)
+        for field in ("count_travel_indices", "count_print_indices",
+                      "count_print_vertices", "layer_stops"):
+            assert list(getattr(model, field)) == expected[field], "%s: %s differ" % (name, field)
+        for gline, end_vertex in expected["end_vertices"]:
+            assert gline.gcview_end_vertex == end_vertex, "%s: gcview_end_vertex" % name
+    print("GcodeModel geometry matches the one built move by move")
+
+def main():
+    logging.disable(logging.WARNING)
+    nlines = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    check()
+    model_data = gcoder.GCode(generate(nlines))
+    model = GcodeModel()
+    start = time.process_time()
+    per_move_buffers(model, model_data)
+    before = time.process_time() - start
+    start = time.process_time()
+    load(model_data)
+    after = time.process_time() - start
+    print("%d lines: 3D view built in %.2fs move by move, %.2fs by layer (x%.1f)" %
+          (len(model_data), before, after, before / after))
+
+if __name__ == '__main__':
+    main()
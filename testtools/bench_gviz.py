@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Checks the moves the 2D view draws and measures how fast it gets them
+and scrubs through layers.
+
+The check compares the lines and arcs computed for all layers at once by
+layerpreview.layer_moves with the ones of a copy of the per-line loop Gviz
+used, on GCode and ColumnarGCode objects, in one go or a few layers at a
+time as while loading.
+
+The benchmark computes the moves of nlines of synthetic G-code both ways,
+then, if wx is available, shows the layers one after the other in a Gviz
+panel, twice, and reports the frame times.
+
+usage: bench_gviz.py [nlines]"""
+
+import sys
+import os
+import time
+import logging
+
+import numpy
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from printrun import gcoder
+from printrun.gcoder_columnar import ColumnarGCode
+from printrun.layerpreview import layer_moves
+from synthgcode import generate
+
+def per_gline_moves(layers, lastpos):
+    """Lines, extruding flags, arcs and clockwise flags of each layer with
+    moves, as Gviz.add_parsed_gcodes and Gviz._get_movement computed them
+    one line at a time, in mm"""
+    moves = []
+    for layer in layers:
+        if not any(gline.is_move for gline in layer):
+            moves.append(None)
+            continue
+        lines, extruding, arcs, clockwise = [], [], [], []
+        for gline in layer:
+            if not gline.is_move:
+                continue
+            target = lastpos[:]
+            target[5] = 0.0
+            target[6] = 0.0
+            if gline.current_x is not None: target[0] = gline.current_x
+            if gline.current_y is not None: target[1] = gline.current_y
+            if gline.current_z is not None: target[2] = gline.current_z
+            if gline.e is not None:
+                if gline.relative_e:
+                    target[3] += gline.e
+                else:
+                    target[3] = gline.e
+            if gline.f is not None: target[4] = gline.f
+            if gline.i is not None: target[5] = gline.i
+            if gline.j is not None: target[6] = gline.j
+            if gline.command in ["G0", "G1"]:
+                lines.append([lastpos[0], lastpos[1], target[0], target[1]])
+                extruding.append(target[3] != lastpos[3])
+            elif gline.command in ["G2", "G3"]:
+                arcs.append([lastpos[0], lastpos[1], target[0], target[1],
+                             lastpos[0] + target[5], lastpos[1] + target[6]])
+                clockwise.append(gline.command == "G2")
+            lastpos = target
+        moves.append((numpy.array(lines, dtype = numpy.float32).reshape(-1, 4), extruding,
+                      numpy.array(arcs, dtype = numpy.float32).reshape(-1, 6), clockwise))
+    return moves
+
+def compare(gcode, what, batch = None):
+    expected = per_gline_moves(gcode.all_layers, [0, 0, 0, 0, 0, 0, 0])
+    if batch is None:
+        moves = layer_moves(gcode.all_layers)[0]
+    else:
+        moves = []
+        position = [0, 0, 0, 0]
+        for start in range(0, len(gcode.all_layers), batch):
+            batch_moves, position = layer_moves(gcode.all_layers[start:start + batch], position)
+            moves += batch_moves
+    assert len(moves) == len(expected), "%s: %d layers" % (what, len(moves))
+    for layer_idx, (movement, reference) in enumerate(zip(moves, expected)):
+        where = "%s, layer %d" % (what, layer_idx)
+        if reference is None:
+            assert movement is None, "%s: moves in a layer without any" % where
+            continue
+        lines, extruding, arcs, clockwise = reference
+        assert numpy.allclose(movement.lines, lines, atol = 1e-4), "%s: lines differ" % where
+        assert movement.extruding.tolist() == extruding, "%s: extrusions differ" % where
+        assert numpy.allclose(movement.arcs, arcs, atol = 1e-4), "%s: arcs differ" % where
+        assert movement.clockwise.tolist() == clockwise, "%s: arc directions differ" % where
+
+sample = ["G28", "G90", "M82", "G92 E0", "G1 Z0.2 F1200", "G1 X10 Y10",
+          "G1 X20 Y10 E1", "G1 X20 Y20 E1", "G2 X40 Y20 I10 J0 E2",
+          "G3 X40 Y40 I0 J10", "G1 E1.5", "G92 E0", "G1 X30 E0.5",
+          "G1 Z0.4", "M83", "G1 X35 E0.3", "G1 X36 E0", "G91", "G1 Y5 E0.1",
+          "G3 X-10 Y0 I-5 J0 E0.2", "G90", "M82", "G1 X50 Y50 E3", "M107",
+          "G1 Z0.6", "M117 layer without lines", "G1 Z0.8", "G0 X0 Y0"]
+
+def check():
+    lines = sample + list(generate(20000, segments_per_layer = 700))
+    for gcode_class in (gcoder.GCode, ColumnarGCode):
+        gcode = gcode_class(lines)
+        compare(gcode, gcode_class.__name__)
+        compare(gcode, gcode_class.__name__ + " by 3 layers", 3)
+    print("Moves computed for all layers at once match the per-line ones")
+
+def scrub(gcode):
+    """Frame times (ms) of showing each layer of gcode in a Gviz panel, then
+    again, or None without wx"""
+    try:
+        import wx
+    except ImportError:
+        return None
+    from printrun import gviz
+    app = wx.App(False)
+    frame = wx.Frame(None, size = (640, 640))
+    panel = gviz.Gviz(frame, size = (600, 600))
+    frame.Show()
+    panel.addfile(gcode)
+    times = []
+    for scrub_pass in range(2):
+        pass_times = []
+        for layer in list(range(len(panel.layers))) + list(reversed(range(len(panel.layers)))):
+            start = time.perf_counter()
+            panel.layerindex = layer
+            panel.dirty = True
+            panel.Refresh()
+            panel.Update()
+            pass_times.append(1e3 * (time.perf_counter() - start))
+        times.append(pass_times)
+    frame.Destroy()
+    app.Destroy()
+    return times
+
+def main():
+    logging.disable(logging.WARNING)
+    nlines = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    check()
+    lines = list(generate(nlines))
+    for gcode_class in (gcoder.GCode, ColumnarGCode):
+        gcode = gcode_class(lines)
+        start = time.process_time()
+        per_gline_moves(gcode.all_layers, [0, 0, 0, 0, 0, 0, 0])
+        per_gline = time.process_time() - start
+        start = time.process_time()
+        layer_moves(gcode.all_layers)
+        vectorized = time.process_time() - start
+        print("%-13s %d lines, %d layers: per line %.2fs, all layers at once %.2fs (x%.1f)" %
+              (gcode_class.__name__, len(gcode), len(gcode.all_layers),
+               per_gline, vectorized, per_gline / vectorized))
+    times = scrub(gcoder.GCode(lines[:200000]))
+    if times is None:
+        print("wx is not available, frame times not measured")
+        return
+    for name, pass_times in zip(("first pass", "second pass"), times):
+        print("scrubbing, %s: median %.1f ms, max %.1f ms per frame" %
+              (name, numpy.median(pass_times), max(pass_times)))
+
+if __name__ == '__main__':
+    main()
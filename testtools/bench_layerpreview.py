@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Checks the headless layer previews and measures their rendering time.
+
+The check decodes the PNG files written by layerpreview.encode_png, draws
+single segments and compares the covered pixels with the expected lines,
+follows the moves and arcs of a small file, and compares the layers
+rendered in a process pool with the ones rendered one by one.
+
+The benchmark renders the layers of nlines of synthetic G-code one by one,
+then in a pool of processes.
+
+usage: bench_layerpreview.py [nlines]"""
+
+import sys
+import os
+import struct
+import time
+import zlib
+import logging
+import multiprocessing
+
+import numpy
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from printrun import gcoder
+from printrun import layerpreview
+from synthgcode import generate
+
+def decode_png(data):
+    """Pixels of a PNG file as written by encode_png"""
+    assert data[:8] == b"\x89PNG\r\n\x1a\n", "bad signature"
+    pos = 8
+    chunks = {}
+    while pos < len(data):
+        length, = struct.unpack(">I", data[pos:pos + 4])
+        kind = data[pos + 4:pos + 8]
+        body = data[pos + 8:pos + 8 + length]
+        crc, = struct.unpack(">I", data[pos + 8 + length:pos + 12 + length])
+        assert crc == zlib.crc32(kind + body) & 0xffffffff, "bad crc in %r" % kind
+        chunks[kind] = chunks.get(kind, b"") + body
+        pos += 12 + length
+    width, height, depth, color_type = struct.unpack(">IIBB", chunks[b"IHDR"][:10])
+    assert (depth, color_type) == (8, 2), "not 8 bit RGB"
+    rows = numpy.frombuffer(zlib.decompress(chunks[b"IDAT"]), dtype = numpy.uint8)
+    rows = rows.reshape(height, 1 + 3 * width)
+    assert not rows[:, 0].any(), "filtered rows"
+    return rows[:, 1:].reshape(height, width, 3)
+
+def check_png():
+    image = numpy.random.RandomState(0).randint(0, 256, (37, 53, 3)).astype(numpy.uint8)
+    assert (decode_png(layerpreview.encode_png(image)) == image).all(), "PNG differs"
+
+def full_coverage(canvas, segments):
+    """Coverage of the whole canvas"""
+    window, coverage = canvas.coverage(numpy.array(segments, dtype = numpy.float64))
+    full = numpy.zeros((canvas.height, canvas.width), dtype = numpy.float32)
+    full[window] = coverage
+    return full
+
+def check_coverage():
+    canvas = layerpreview.Canvas((101, 101), [100, 100, 100, 0, 0, 0], extrusion_width = 4)
+    assert canvas.scale == 1 and canvas.pen_width == 4
+    # A horizontal line 4 pixels wide at y = 50 from x = 20 to 80
+    coverage = full_coverage(canvas, [[20, 50, 80, 50]])
+    assert (coverage[49:52, 20:81] == 1).all(), "line not covered"
+    assert (coverage[:48] == 0).all() and (coverage[53:] == 0).all(), "line too wide"
+    assert (coverage[:, :18] == 0).all() and (coverage[:, 83:] == 0).all(), "line too long"
+    assert coverage[48, 50] == coverage[52, 50] == 0.5, "edges not smoothed"
+    # A diagonal covers the pixels close to it, and only them
+    segment = numpy.array([[10, 10, 90, 60]], dtype = numpy.float64)
+    coverage = full_coverage(canvas, segment)
+    y, x = numpy.mgrid[0:101, 0:101]
+    direction = (segment[0, 2:] - segment[0, :2]) / numpy.hypot(80, 50)
+    along = (x - 10) * direction[0] + (y - 10) * direction[1]
+    across = abs((x - 10) * direction[1] - (y - 10) * direction[0])
+    inside = (along >= 0) & (along <= numpy.hypot(80, 50))
+    assert (coverage[inside & (across <= 1.5)] == 1).all(), "diagonal not covered"
+    assert (coverage[across >= 2.5] == 0).all(), "diagonal too wide"
+    # Y goes down in images, up on the platform
+    canvas.draw(numpy.array([[0, 90, 10, 90]], dtype = numpy.float32), (0, 0, 0))
+    assert (canvas.pixels()[10, 2:9] == 0).all(), "line not drawn at the top"
+    # Lines off the canvas only cover its edges
+    coverage = full_coverage(canvas, [[-50, -5, 150, -5], [-20, 20, -3, 20]])
+    assert not coverage.any(), "lines off the canvas drawn"
+    coverage = full_coverage(canvas, [[-50, 100, 150, 100]])
+    assert (coverage[99:] > 0).all() and not coverage[:98].any(), "bottom edge line"
+
+def check_paths():
+    gcode = gcoder.GCode(["G28", "G1 Z0.2 F1200", "G1 X10 Y10", "G1 X20 Y10 E1",
+                          "G2 X40 Y10 I10 J0 E2", "G1 Z0.4", "G91", "G1 X5 E1",
+                          "G3 X-10 Y0 I-5 J0"])
+    paths = layerpreview.layer_paths(gcode)
+    assert len(paths) == 2, "%d layers" % len(paths)
+    first, second = paths
+    assert first.kinds[:3].tolist() == [layerpreview.travel, layerpreview.travel,
+                                        layerpreview.extrusion]
+    assert first.segments[2].tolist() == [10, 10, 20, 10]
+    arc = first.segments[first.kinds == layerpreview.arc]
+    assert len(arc) > 10 and arc[0, :2].tolist() == [20, 10] and arc[-1, 2:].tolist() == [40, 10]
+    # Clockwise from the left of the center goes over it
+    assert arc[:, 1].max() > 19.9 and arc[:, 1].min() >= 9.99, "G2 on the wrong side"
+    assert numpy.allclose(numpy.hypot(arc[:, 0] - 30, arc[:, 1] - 10), 10, atol = 1e-4)
+    assert second.kinds[1] == layerpreview.extrusion
+    assert numpy.allclose(second.segments[1], [40, 10, 45, 10])
+    arc = second.segments[second.kinds == layerpreview.arc]
+    assert arc[-1, 2:].tolist() == [35, 10] and arc[:, 1].max() > 14.9, "G3 on the wrong side"
+
+def check_pool(paths):
+    serial = list(layerpreview.render_layers(paths, processes = 1, size = (200, 200)))
+    pooled = list(layerpreview.render_layers(paths, processes = 2, size = (200, 200)))
+    assert [layer for layer, png in serial] == list(range(len(paths)))
+    assert serial == pooled, "pooled layers differ"
+    for layer, png in serial:
+        image = decode_png(png)
+        expected = layerpreview.render(paths, layer, size = (200, 200))
+        assert (image == expected).all(), "layer %d differs" % layer
+
+def check():
+    check_png()
+    check_coverage()
+    check_paths()
+    check_pool(layerpreview.layer_paths(gcoder.GCode(generate(5000, segments_per_layer = 400))))
+    print("PNG files decode, lines cover the expected pixels, pooled layers match")
+
+def main():
+    logging.disable(logging.WARNING)
+    nlines = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    check()
+    start = time.time()
+    paths = layerpreview.layer_paths(gcoder.GCode(generate(nlines)))
+    print("%d lines, %d layers: segments built in %.2fs" %
+          (nlines, len(paths), time.time() - start))
+    start = time.time()
+    layerpreview.render(paths)
+    print("composite:    %.2fs" % (time.time() - start))
+    start = time.time()
+    for layer, png in layerpreview.render_layers(paths, processes = 1):
+        pass
+    serial = time.time() - start
+    print("layers, serial: %.2fs (%.1f ms/layer)" % (serial, 1e3 * serial / len(paths)))
+    start = time.time()
+    for layer, png in layerpreview.render_layers(paths):
+        pass
+    pooled = time.time() - start
+    print("layers, %d processes: %.2fs (%.1f ms/layer)" %
+          (multiprocessing.cpu_count(), pooled, 1e3 * pooled / len(paths)))
+
+if __name__ == '__main__':
+    main()
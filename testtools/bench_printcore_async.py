@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Checks printcore_async.AsyncPrintcore and measures it driving many
+printers from one event loop.
+
+The check prints to simulated printers (see simprinter.py) over a pty and
+over TCP, with garbled lines forcing resends, through pause and resume, and
+compares the lines the printer executed with the file.
+
+The benchmark prints to N simulated printers at once, running in their own
+process so that the CPU time of this process is the one of the host, first
+with N threaded printcores then with N AsyncPrintcores on a single event
+loop, and reports the CPU use, the threads and the throughput per printer.
+
+usage: bench_printcore_async.py [printers] [nlines] [latency] [window]"""
+
+import sys
+import os
+import time
+import asyncio
+import threading
+import subprocess
+import logging
+import re
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from printrun import gcoder
+from printrun.printcore import printcore
+from printrun.printcore_async import AsyncPrintcore
+from simprinter import SimPrinter
+from synthgcode import generate
+
+# Command of a numbered line
+line_exp = re.compile(r"^N-?\d+ (.*)\*\d+$")
+
+def load(nlines):
+    return gcoder.LightGCode(list(generate(nlines, segments_per_layer = 500)))
+
+def expected_lines(gcode):
+    lines = [gcoder.gcode_strip_comment_exp.sub("", line.raw).strip()
+             for line in gcode]
+    return [line for line in lines if line]
+
+def executed_lines(printer):
+    return [command for command in printer.executed
+            if not command.startswith(("M105", "M110", "M115"))]
+
+async def check_print(nlines, pause = False, **kwargs):
+    printer = SimPrinter(latency = 0.002, advanced_ok = True, **kwargs)
+    core = AsyncPrintcore()
+    core.send_window = 8
+    gcode = load(nlines)
+    temperatures = []
+    async def on_temp(line):
+        temperatures.append(line)
+    core.on("temp", on_temp)
+    printed = []
+    core.printsendcb = lambda gline: printed.append(gline.raw)
+    sent = []
+    core.sendcb = lambda command, gline: sent.append(command)
+    try:
+        await core.connect(printer.port, 115200)
+        assert await core.wait_online(10), "printer not online"
+        while core.firmware_name is None:
+            await asyncio.sleep(0.01)
+        core.send_now("M105")
+        core.startprint(gcode)
+        if pause:
+            await asyncio.sleep(0.05)
+            core.pause()
+            await core.wait_print()
+            assert core.paused and 0 < core.queueindex < len(gcode), \
+                "pause at %d" % core.queueindex
+            core.resume()
+        await core.wait_print()
+        while core.inflight:
+            await asyncio.sleep(0.01)
+    finally:
+        await core.disconnect()
+        printer.close()
+    assert printer.lost == 0, "%d lines lost" % printer.lost
+    expected = expected_lines(gcode)
+    assert expected_lines(gcoder.LightGCode(printed)) == expected, \
+        "printed lines differ"
+    if pause:
+        # The position restored on resume gets executed as well
+        sent = [line_exp.sub(r"\1", command) for command in sent]
+        expected = [command for command in sent
+                    if not command.startswith(("M105", "M110", "M115"))]
+    assert executed_lines(printer) == expected, "executed lines differ"
+    assert temperatures, "no temperature event"
+    return printer.resends
+
+def check():
+    asyncio.run(check_print(2000))
+    asyncio.run(check_print(2000, tcp = True))
+    resends = asyncio.run(check_print(2000, corrupt_every = 100))
+    assert resends, "no resends"
+    asyncio.run(check_print(2000, pause = True))
+    print("AsyncPrintcore prints correctly over pty and TCP, with %d resends "
+          "and through pause/resume" % resends)
+
+def start_simulators(count, latency):
+    simulator = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "simprinter.py"),
+                                  str(latency), "0", str(count)],
+                                 stdout = subprocess.PIPE, universal_newlines = True)
+    ports = [simulator.stdout.readline().split()[3].rstrip(",")
+             for i in range(count)]
+    return simulator, ports
+
+def wait_for(condition, timeout):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise RuntimeError("timed out")
+        time.sleep(0.01)
+
+def run_threaded(ports, nlines, window):
+    cores = []
+    for port in ports:
+        core = printcore()
+        core.send_window = window
+        core.connect(port, 115200)
+        cores.append(core)
+    try:
+        wait_for(lambda: all(core.online for core in cores), 30)
+        if window > 1:
+            wait_for(lambda: all(core.firmware_name for core in cores), 30)
+        threads = threading.active_count()
+        durations = []
+        done = threading.Semaphore(0)
+        def print_ended():
+            durations.append(time.time() - start)
+            done.release()
+        for core in cores:
+            core.endcb = print_ended
+        gcodes = [load(nlines) for core in cores]
+        cpu = time.process_time()
+        start = time.time()
+        for core, gcode in zip(cores, gcodes):
+            core.startprint(gcode)
+        for core in cores:
+            done.acquire()
+        wall = time.time() - start
+        cpu = time.process_time() - cpu
+    finally:
+        for core in cores:
+            core.disconnect()
+    return wall, cpu, threads, durations
+
+async def run_async(ports, nlines, window):
+    cores = []
+    for port in ports:
+        core = AsyncPrintcore()
+        core.send_window = window
+        await core.connect(port, 115200)
+        cores.append(core)
+    try:
+        online = await asyncio.gather(*[core.wait_online(30) for core in cores])
+        assert all(online), "printers not online"
+        while window > 1 and not all(core.firmware_name for core in cores):
+            await asyncio.sleep(0.01)
+        threads = threading.active_count()
+        gcodes = [load(nlines) for core in cores]
+        cpu = time.process_time()
+        start = time.time()
+        async def print_one(core, gcode):
+            core.startprint(gcode)
+            await core.wait_print()
+            return time.time() - start
+        durations = await asyncio.gather(*[print_one(core, gcode)
+                                           for core, gcode in zip(cores, gcodes)])
+        wall = time.time() - start
+        cpu = time.process_time() - cpu
+    finally:
+        for core in cores:
+            await core.disconnect()
+    return wall, cpu, threads, durations
+
+def report(name, nlines, result):
+    wall, cpu, threads, durations = result
+    rates = [nlines / duration for duration in durations]
+    print("%-9s %4d threads  %5.1f%% CPU  %6.0f lines/s total  "
+          "per printer %5.0f min %5.0f mean" %
+          (name, threads, 100 * cpu / wall, len(durations) * nlines / wall,
+           min(rates), sum(rates) / len(rates)))
+
+def main():
+    logging.disable(logging.ERROR)
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    nlines = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    latency = float(sys.argv[3]) if len(sys.argv) > 3 else 0.005
+    window = int(sys.argv[4]) if len(sys.argv) > 4 else 8
+    check()
+    print("%d printers, %d lines each, %.1fms latency, window %d" %
+          (count, nlines, latency * 1000, window))
+    for name, run in (("threaded", run_threaded),
+                      ("asyncio", lambda *args: asyncio.run(run_async(*args)))):
+        simulator, ports = start_simulators(count, latency)
+        try:
+            report(name, nlines, run(ports, nlines, window))
+        finally:
+            simulator.terminate()
+            simulator.wait()
+
+if __name__ == '__main__':
+    main()
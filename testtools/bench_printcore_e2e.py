@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Streams G-code end to end through printcore to simulated printers.
+
+The check prints heating commands to a simulated printer (see simprinter.py)
+which heats up slowly, and garbled lines, checking that printcore waits for
+the heaters, gets the temperature reports and recovers from every resend.
+
+The benchmark prints the files in testfiles/ and synthetic dense G-code with
+several send setups, the simulated printer running in its own process so
+that the CPU time of this process is the one of printcore, and reports for
+each print:
+
+- lines/s, from the first line reaching the printer to the last executed,
+- the parse time and the time to first byte, from startprint() to the first
+  line reaching the printer,
+- the resends and the mean and worst resend recovery time, from the error to
+  the execution of the line sent again,
+- the host CPU time per line, parsing included.
+
+Every print checks that the printer executed exactly the lines of the file.
+
+usage: bench_printcore_e2e.py [nlines] [latency] [move_time]"""
+
+import sys
+import os
+import glob
+import hashlib
+import json
+import subprocess
+import time
+import logging
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from printrun import gcoder
+from printrun.printcore import printcore
+from simprinter import SimPrinter
+from synthgcode import generate
+
+def wait_for(condition, timeout):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise RuntimeError("timed out")
+        time.sleep(0.01)
+
+def expected_digest(lines):
+    commands = [gcoder.gcode_strip_comment_exp.sub("", line).strip() for line in lines]
+    commands = [command for command in commands
+                if command and not command.startswith(("M105", "M110", "M115"))]
+    return len(commands), hashlib.sha1("\n".join(commands).encode()).hexdigest()
+
+def connect(port, window):
+    core = printcore()
+    core.send_window = window
+    core.connect(port, 115200)
+    wait_for(lambda: core.online, 10)
+    if window > 1:
+        # Let the firmware identify itself
+        wait_for(lambda: core.firmware_name is not None, 10)
+    return core
+
+def print_lines(core, lines, stats):
+    """Print lines, returning the stats of the printer, the parse time, the
+    time startprint() was called and the CPU time taken"""
+    stats()  # reset
+    cpu = time.process_time()
+    start = time.time()
+    gcode = gcoder.LightGCode(lines)
+    parse = time.time() - start
+    started = time.time()
+    core.startprint(gcode)
+    wait_for(lambda: not core.printing, 600)
+    wait_for(lambda: not core.inflight, 10)
+    cpu = time.process_time() - cpu
+    return stats(), parse, started, cpu
+
+def check():
+    printer = SimPrinter(latency = 0.001, heat_rate = 400, advanced_ok = True,
+                         corrupt_every = 50)
+    received = []
+    core = connect(printer.port, 8)
+    core.recvcb = received.append
+    try:
+        lines = ["M140 S60", "M104 S200", "M190 S60", "M109 S200", "M155 S1"]
+        lines += list(generate(400, segments_per_layer = 100))
+        lines += ["M400", "G4 P1200", "M155 S0", "M105"]
+        stats, parse, started, cpu = print_lines(core, lines,
+                                                 lambda: printer.stats(reset = True))
+        wait_for(lambda: any(line.startswith("ok T:") for line in received), 10)
+    finally:
+        core.disconnect()
+        printer.close()
+    assert (stats["executed"], stats["digest"]) == expected_digest(lines), \
+        "executed lines differ"
+    assert stats["lost"] == 0, "%d lines lost" % stats["lost"]
+    assert stats["resends"] and stats["recoveries"], "no resend"
+    assert all(0 < recovery < 1 for recovery in stats["recoveries"]), \
+        "resend recovery times %s" % stats["recoveries"]
+    assert started <= stats["first_line_time"] <= stats["last_executed_time"], \
+        "bad timings"
+    waits = [line for line in received if "W:?" in line]
+    assert waits and all(float(line.split()[0][2:]) < 200 for line in waits), \
+        "no temperature report while heating"
+    assert any(line.startswith("T:") and "W:" not in line for line in received), \
+        "no automatic temperature report"
+    final = [line for line in received if line.startswith("ok T:")][-1]
+    assert final.startswith("ok T:200.0 /200.0 B:60.0 /60.0"), final
+    print("printcore waits for the heaters and recovers from resends correctly")
+
+def start_simulator(latency, move_time, options):
+    simulator = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "simprinter.py"),
+                                  "--control"] + options + [str(latency), str(move_time)],
+                                 stdin = subprocess.PIPE, stdout = subprocess.PIPE,
+                                 universal_newlines = True)
+    port = simulator.stdout.readline().split()[3].rstrip(",")
+    def stats():
+        simulator.stdin.write("stats\n")
+        simulator.stdin.flush()
+        return json.loads(simulator.stdout.readline())[0]
+    return simulator, port, stats
+
+def main():
+    # Garbled lines make printcore log the firmware errors
+    logging.disable(logging.ERROR)
+    nlines = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.001
+    move_time = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+    check()
+    sources = [(os.path.basename(path), [line.rstrip("\r\n") for line in open(path, encoding = "utf-8")])
+               for path in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "testfiles", "*.gcode")))]
+    sources.append(("synthetic, %d lines" % nlines, list(generate(nlines))))
+    setups = [("ping-pong", 1, ["--basic-ok"]),
+              ("window 8, ADVANCED_OK", 8, []),
+              ("window 8, ADVANCED_OK, TCP", 8, ["--tcp"]),
+              ("window 8, ADVANCED_OK, garbled", 8, ["--corrupt-every", "200"])]
+    print("%.1fms latency, %.2fms per move" % (latency * 1000, move_time * 1000))
+    print("%-32s %7s %8s %8s %8s %8s %11s %8s" %
+          ("", "lines", "lines/s", "parse", "ttfb", "resends", "recovery",
+           "CPU/line"))
+    for name, window, options in setups:
+        simulator, port, stats = start_simulator(latency, move_time, options)
+        core = None
+        try:
+            core = connect(port, window)
+            print(name)
+            for source, lines in sources:
+                result, parse, started, cpu = print_lines(core, lines, stats)
+                assert (result["executed"], result["digest"]) == expected_digest(lines), \
+                    "%s: executed lines differ" % source
+                assert result["lost"] == 0, "%s: %d lines lost" % (source, result["lost"])
+                executed = result["executed"]
+                duration = result["last_executed_time"] - result["first_line_time"]
+                recoveries = result["recoveries"]
+                recovery = "%4.1f/%4.1fms" % (1000 * sum(recoveries) / len(recoveries),
+                                              1000 * max(recoveries)) if recoveries else "-"
+                print("  %-30s %7d %8.0f %6.1fms %6.1fms %8d %11s %6.1fus" %
+                      (source, executed, executed / duration if duration else 0,
+                       1000 * parse, 1000 * (result["first_line_time"] - started),
+                       result["resends"], recovery, 1e6 * cpu / executed))
+        finally:
+            if core:
+                core.disconnect()
+            simulator.stdin.close()
+            simulator.wait()
+
+if __name__ == '__main__':
+    main()
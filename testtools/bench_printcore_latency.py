@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measures the per line latency and the idle CPU use of printcore.
+
+A simulated printer (simprinter.py) answering without delay runs in its own
+process, so that the CPU time of this process is the one of printcore.  The
+benchmark measures the CPU used while connected and idle, then prints
+synthetic G-code in ping-pong mode and reports the time and CPU per line.
+
+usage: bench_printcore_latency.py [nlines] [idle seconds]"""
+
+import sys
+import os
+import time
+import subprocess
+import logging
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from printrun import gcoder
+from printrun.printcore import printcore
+from synthgcode import generate
+
+def wait_for(condition, timeout):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise RuntimeError("timed out")
+        time.sleep(0.01)
+
+def main():
+    logging.disable(logging.WARNING)
+    nlines = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    idle = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    gcode = gcoder.LightGCode(list(generate(nlines, segments_per_layer = 500)))
+    simulator = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "simprinter.py"), "0", "0"],
+                                 stdout = subprocess.PIPE, universal_newlines = True)
+    core = printcore()
+    try:
+        port = simulator.stdout.readline().split()[3].rstrip(",")
+        core.connect(port, 115200)
+        wait_for(lambda: core.online, 10)
+        time.sleep(0.5)
+
+        cpu = time.process_time()
+        time.sleep(idle)
+        idle_cpu = (time.process_time() - cpu) / idle
+        print("idle: %.2f%% CPU" % (100 * idle_cpu))
+
+        sent = []
+        core.sendcb = lambda command, gline: sent.append(command)
+        cpu = time.process_time()
+        start = time.time()
+        core.startprint(gcode)
+        wait_for(lambda: not core.printing, 600)
+        duration = time.time() - start
+        cpu = time.process_time() - cpu
+        print("print: %d lines, %.1f us/line, %.1f us CPU/line, %.0f lines/s" %
+              (len(sent), 1e6 * duration / len(sent), 1e6 * cpu / len(sent),
+               len(sent) / duration))
+    finally:
+        core.disconnect()
+        simulator.terminate()
+        simulator.wait()
+
+if __name__ == '__main__':
+    main()
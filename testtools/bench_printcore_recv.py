@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measures the received lines dispatch of printcore with a verbose printer.
+
+Prints to a simulated printer (see simprinter.py) echoing every command
+before its ok, with a receive callback posting one event per call to a
+user interface thread taking ui_cost seconds per event, like wx.CallAfter
+does for pronterface.  Lines are dispatched as they arrive, then in batches
+(printcore.recv_batch_interval).  The check makes sure that batches deliver
+every line once and in order, to the callbacks and to the event handlers.
+
+Reports the print throughput, the events posted to the user interface, the
+longest event backlog and how late the user interface showed the lines.
+
+usage: bench_printcore_recv.py [nlines] [latency] [ui_cost]"""
+
+import sys
+import os
+import queue
+import threading
+import time
+import logging
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from printrun import gcoder
+from printrun.eventhandler import PrinterEventHandler
+from printrun.printcore import printcore
+from simprinter import SimPrinter
+from synthgcode import generate
+
+def wait_for(condition, timeout):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise RuntimeError("timed out")
+        time.sleep(0.01)
+
+class UserInterface:
+    """Event queue consumed by a thread spending cost seconds per event"""
+
+    def __init__(self, cost):
+        self.cost = cost
+        self.events = queue.Queue()
+        self.posted = 0
+        self.backlog = 0
+        self.lines = 0
+        self.lag = 0
+        self.thread = threading.Thread(target = self._run, daemon = True)
+        self.thread.start()
+
+    def post(self, lines):
+        self.posted += 1
+        self.events.put((time.time(), len(lines)))
+        self.backlog = max(self.backlog, self.events.qsize())
+
+    def _run(self):
+        while True:
+            posted, count = self.events.get()
+            end = time.perf_counter() + self.cost
+            while time.perf_counter() < end:
+                pass
+            self.lines += count
+            self.lag = max(self.lag, time.time() - posted)
+            self.events.task_done()
+
+class Recorder(PrinterEventHandler):
+
+    def __init__(self):
+        self.lines = []
+
+    def on_recv(self, line):
+        self.lines.append(line)
+
+def run(gcode, interval, latency, ui_cost = 0, batch_callback = True):
+    printer = SimPrinter(latency = latency, advanced_ok = True, echo = True)
+    ui = UserInterface(ui_cost)
+    received = []
+    recorder = Recorder()
+    core = printcore()
+    core.addEventHandler(recorder)
+    core.send_window = 8
+    core.recv_batch_interval = interval
+    if batch_callback:
+        core.recvcb = lambda line: (received.append(line), ui.post([line]))
+        core.recvbatchcb = lambda lines: (received.extend(lines), ui.post(lines))
+    else:
+        core.recvcb = received.append
+    core.connect(printer.port, 115200)
+    try:
+        wait_for(lambda: core.online and core.firmware_name is not None, 10)
+        start = time.time()
+        core.startprint(gcode)
+        wait_for(lambda: not core.printing, 600)
+        wait_for(lambda: not core.inflight, 10)
+        duration = time.time() - start
+    finally:
+        core.disconnect()
+        printer.close()
+        core.event_handler.remove(recorder)
+    ui.events.join()
+    return received, recorder.lines, len(gcode) / duration, ui
+
+def echoed(lines):
+    return [line for line in lines if line.startswith("echo:")]
+
+def check():
+    gcode = gcoder.LightGCode(list(generate(3000, segments_per_layer = 500)))
+    expected = echoed(run(gcode, 0, 0.001)[0])
+    assert sum(1 for line in expected if line.startswith("echo:G1")) > len(gcode) // 2, \
+        "commands not echoed"
+    for batch_callback in (True, False):
+        received, handled = run(gcode, 0.02, 0.001, batch_callback = batch_callback)[:2]
+        # The oks differ from run to run (free buffer slots), not the echoes
+        assert echoed(received) == expected, "batched lines differ"
+        assert handled == received, "handler lines differ"
+    print("Batched dispatch delivers every received line once and in order")
+
+def main():
+    logging.disable(logging.WARNING)
+    nlines = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.001
+    ui_cost = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0005
+    check()
+    gcode = gcoder.LightGCode(list(generate(nlines)))
+    print("%d lines, %.1fms latency, %.2fms per user interface event" %
+          (len(gcode), latency * 1000, ui_cost * 1000))
+    for interval in (0, 0.02, 0.1):
+        received, handled, rate, ui = run(gcode, interval, latency, ui_cost)
+        name = "batches of %dms" % (interval * 1000) if interval else "each line"
+        print("%-18s %6.0f lines/s  %6d lines  %6d events  backlog %5d  lag %7.1fms" %
+              (name, rate, len(received), ui.posted, ui.backlog, ui.lag * 1000))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Checks the resend window of printcore and measures its memory use.
+
+The check prints to a simulated printer (see simprinter.py) garbling lines,
+which must all be resent from the window, the last lines of the print
+included, then to a printer asking for a line older than the window, which must pause the print with an error and
+number the next lines after the last one sent.
+
+The benchmark streams a multi-million line file (gcoder_stream) to a fake
+printer acknowledging every line at once, in a process of its own, keeping
+the sent lines for resends in the default window then in one as large as
+the print, as printcore used to, and reports the peak memory.
+
+usage: bench_printcore_resend.py [nlines]"""
+
+import sys
+import os
+import subprocess
+import tempfile
+import threading
+import time
+import resource
+import logging
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from printrun import gcoder
+from printrun.gcoder_stream import StreamGCode
+from printrun.printcore import printcore
+from simprinter import SimPrinter
+from synthgcode import generate, write
+
+class FakePrinter:
+    """Serial port stand-in acknowledging every line it gets, asking for
+    line resend once line ask_at got sent"""
+
+    def __init__(self, core, ask_at = None, resend = 0):
+        self.core = core
+        self.count = 0
+        self.lines = []
+        self.keep = ask_at is not None
+        self.ask_at = ask_at
+        self.resend = resend
+
+    def write(self, data):
+        self.count += 1
+        if self.keep:
+            self.lines.append(data)
+            if self.ask_at is not None and data.startswith(b"N%d " % self.ask_at):
+                self.ask_at = None
+                self.core._process_line("Resend: %d\n" % self.resend)
+        self.core._acknowledge("ok")
+
+def maxrss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss / 1024. if sys.platform != "darwin" else rss / 1048576.
+
+def fake_print(gcode, window, **kwargs):
+    core = printcore()
+    core.printer_tcp = None
+    core.printer = FakePrinter(core, **kwargs)
+    core.online = True
+    core.resend_window = window
+    # Nothing is sent outside of the print
+    core._start_sender = lambda: None
+    errors = []
+    core.errorcb = errors.append
+    done = threading.Event()
+    core.endcb = done.set
+    core.startprint(gcode)
+    done.wait()
+    return core, errors
+
+def sim_print(lines, **kwargs):
+    """Lines executed by a simulated printer and its resend count"""
+    printer = SimPrinter(latency = 0.001, **kwargs)
+    core = printcore()
+    core.send_window = 8
+    core.resend_window = 64
+    core.connect(printer.port, 115200)
+    try:
+        deadline = time.time() + 10
+        while not (core.online and core.firmware_name):
+            assert time.time() < deadline, "printer not online"
+            time.sleep(0.01)
+        core.startprint(gcoder.LightGCode(lines))
+        while core.printing or core.inflight:
+            time.sleep(0.01)
+        assert not core.paused, "resend out of the window"
+    finally:
+        core.disconnect()
+        printer.close()
+    executed = [command for command in printer.executed
+                if not command.startswith(("M105", "M110", "M115"))]
+    return executed, printer.resends
+
+def check():
+    lines = list(generate(5000, segments_per_layer = 500))
+    executed, resends = sim_print(lines, advanced_ok = True, corrupt_every = 97)
+    expected = [gcoder.gcode_strip_comment_exp.sub("", line).strip() for line in lines]
+    assert resends > 40, "%d resends" % resends
+    assert executed == [line for line in expected if line], "executed lines differ"
+    # The last line garbled, its resend arriving once the print is sent
+    short = ["G1 X%d" % i for i in range(10)]
+    executed, resends = sim_print(short, corrupt_every = 10)
+    assert resends and executed == short, "last lines not resent"
+
+    core, errors = fake_print(gcoder.LightGCode(lines), 1000, ask_at = 3000, resend = 1500)
+    assert core.paused and core.queueindex < len(lines), "print not paused"
+    assert errors and "1500" in errors[0], "no resend error: %s" % errors
+    renumber = [line for line in core.printer.lines if b"M110" in line][-1]
+    assert renumber.startswith(b"N3000 M110*"), renumber
+    print("printcore resends from its window and pauses beyond it")
+
+def run(window, filename):
+    gcode = StreamGCode(filename)
+    base_rss = maxrss_mb()
+    start = time.process_time()
+    core = fake_print(gcode, int(window) if window != "print" else gcode.line_count() + 1)[0]
+    cpu = time.process_time() - start
+    print("window %-10s %9d lines  %5.1f us/line  peak +%7.1f MB" %
+          (window, core.printer.count - 1, 1e6 * cpu / core.printer.count,
+           maxrss_mb() - base_rss))
+    gcode.close()
+
+def main():
+    # Garbled lines make printcore log the firmware errors
+    logging.disable(logging.ERROR)
+    if len(sys.argv) == 3 and sys.argv[1] == "--run":
+        run(sys.argv[2], os.environ["BENCH_GCODE_FILE"])
+        return
+    check()
+    nlines = int(sys.argv[1]) if len(sys.argv) > 1 else 2000000
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, "bench.gcode")
+        write(filename, nlines)
+        # Index the file once for both runs
+        stream = StreamGCode(filename)
+        stream.line_count()
+        stream.close()
+        env = dict(os.environ, BENCH_GCODE_FILE = filename)
+        for window in ("1000", "print"):
+            subprocess.check_call([sys.executable, os.path.abspath(__file__),
+                                   "--run", window], env = env)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Checks the send buffer of printcore and measures the CPU time per line.
+
+Prints to a fake printer acknowledging every line at once, so that only the
+host side is measured: once formatting every line as it is sent (the send
+buffer disabled), once from the send buffer and once from the send buffer
+without analyzing the sent lines again. The check compares the bytes
+written in each mode on the files in testfiles/ and on synthetic G-code,
+over serial (numbered lines) and TCP, and the pause position with and
+without analysis. Non ASCII commands must be left to printcore.
+
+usage: bench_printcore_send.py [nlines]"""
+
+import sys
+import os
+import glob
+import time
+import threading
+import logging
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from printrun import gcoder
+from printrun import printcore as printcore_module
+from printrun.printcore import printcore
+from printrun.gcoder_columnar import ColumnarGCode
+from printrun.sendbuffer import UNENCODED
+from synthgcode import generate
+
+compile_job = printcore_module.SendBuffer
+
+class FakePrinter:
+    """Serial port stand-in acknowledging every line it gets"""
+
+    def __init__(self, core):
+        self.core = core
+        self.data = []
+
+    def write(self, data):
+        self.data.append(data)
+        self.core._acknowledge("ok")
+
+    def flush(self):
+        pass
+
+def print_gcode(gcode, compiled = True, reanalyze = True, tcp = False,
+                pause_at = None):
+    printcore_module.SendBuffer = compile_job if compiled else lambda gcode: None
+    core = printcore()
+    core.printer_tcp = object() if tcp else None
+    core.printer = FakePrinter(core)
+    core.online = True
+    core.reanalyze = reanalyze
+    core._start_sender = lambda: None
+    done = threading.Event()
+    core.endcb = done.set
+    if pause_at is not None:
+        def pause(gline):
+            if core.queueindex == pause_at:
+                core.printing = False
+                core.paused = True
+        core.printsendcb = pause
+    start = time.process_time()
+    core.startprint(gcode)
+    done.wait()
+    cpu = time.process_time() - start
+    if pause_at is not None:
+        core._save_pause_position()
+        position = (core.pauseX, core.pauseY, core.pauseZ, core.pauseE,
+                    core.pauseF, core.pauseRelative)
+        return core.printer.data, position
+    printcore_module.SendBuffer = compile_job
+    return core.printer.data, cpu
+
+def check():
+    sources = [[line.strip() for line in open(path, encoding = "utf-8")]
+               for path in glob.glob(os.path.join(os.path.dirname(__file__), "..", "testfiles", "*.gcode"))]
+    sources.append(list(generate(20000, segments_per_layer = 500)))
+    sources.append(["G28 ; home", "(comment) G1 X1", ";@host", "",
+                    "G1 X2 (a) Y3 (b)", "M117 done", "G1 Z1 ; (x)"])
+    for lines in sources:
+        for gcode_class in (gcoder.LightGCode, gcoder.GCode, ColumnarGCode):
+            for tcp in (False, True):
+                gcode = gcode_class(lines)
+                expected = print_gcode(gcode, compiled = False, tcp = tcp)[0]
+                for reanalyze in (True, False):
+                    sent = print_gcode(gcode, reanalyze = reanalyze, tcp = tcp)[0]
+                    assert sent == expected, "sent bytes differ"
+        gcode = gcoder.GCode(lines)
+        pause_at = len(gcode) * 2 // 3
+        expected = print_gcode(gcode, compiled = False, pause_at = pause_at)[1]
+        position = print_gcode(gcode, reanalyze = False, pause_at = pause_at)[1]
+        assert position == expected, "pause position %s, expected %s" % (position, expected)
+    # Non ASCII commands are sent as text, which fails as without the buffer
+    buffer = compile_job(gcoder.LightGCode(["M117 Temp\u00e9rature", "G1 X1 ; \u00e9"]))
+    assert buffer.kind(0) == UNENCODED and buffer.command(1) == b"G1 X1", \
+        "non ASCII command compiled"
+    print("The send buffer writes the same bytes and pause positions")
+
+def main():
+    logging.disable(logging.WARNING)
+    nlines = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    check()
+    gcode = gcoder.LightGCode(list(generate(nlines)))
+    for name, kwargs in (("per line", {"compiled": False}),
+                         ("send buffer", {}),
+                         ("send buffer, no reanalysis", {"reanalyze": False})):
+        data, cpu = print_gcode(gcode, **kwargs)
+        print("%-28s %6.1f us CPU/line  %8.0f lines/s" %
+              (name, 1e6 * cpu / len(data), len(data) / cpu))
+
+if __name__ == '__main__':
+    main()
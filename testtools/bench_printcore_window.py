@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measures printcore throughput with various send windows.
+
+Prints synthetic G-code to simulated printers (see simprinter.py) with an
+injected reply latency, with and without ADVANCED_OK, with an unknown
+firmware (which must fall back to ping-pong) and with garbled lines forcing
+resends, and with a window of lines overflowing the receive buffer of
+the firmware.  Every run checks that the printer executed exactly the lines of
+the file, in order, and that no line was lost to a buffer overflow.
+
+usage: bench_printcore_window.py [nlines] [latency] [move_time]"""
+
+import sys
+import os
+import time
+import logging
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from printrun import gcoder
+from printrun.printcore import printcore
+from simprinter import SimPrinter
+from synthgcode import generate
+
+def wait_for(condition, timeout):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise RuntimeError("timed out")
+        time.sleep(0.01)
+
+def run(gcode, expected, window, **kwargs):
+    printer = SimPrinter(**kwargs)
+    core = printcore()
+    core.send_window = window
+    core.connect(printer.port, 115200)
+    try:
+        wait_for(lambda: core.online, 10)
+        if window > 1:
+            # Let the firmware identify itself
+            wait_for(lambda: core.firmware_name is not None, 10)
+        start = time.time()
+        core.startprint(gcode)
+        wait_for(lambda: not core.printing, 600)
+        wait_for(lambda: not core.inflight, 10)
+        duration = time.time() - start
+    finally:
+        core.disconnect()
+        printer.close()
+    executed = [command for command in printer.executed
+                if not command.startswith(("M105", "M110", "M115"))]
+    assert printer.lost == 0, "%d lines lost" % printer.lost
+    assert executed == expected, "executed lines differ"
+    return len(expected) / duration, printer.resends
+
+def main():
+    # Garbled lines make printcore log the firmware errors
+    logging.disable(logging.ERROR)
+    nlines = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.005
+    move_time = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0005
+    gcode = gcoder.LightGCode(list(generate(nlines, segments_per_layer = 500)))
+    expected = [gcoder.gcode_strip_comment_exp.sub("", line.raw).strip()
+                for line in gcode]
+    expected = [line for line in expected if line]
+    print("%d lines, %.1fms latency, %.2fms per move" %
+          (len(expected), latency * 1000, move_time * 1000))
+    setups = [("ping-pong", 1, {}),
+              ("window 4, Marlin", 4, {}),
+              ("window 8, ADVANCED_OK", 8, {"advanced_ok": True}),
+              ("window 16, ADVANCED_OK", 16, {"advanced_ok": True}),
+              ("window 16, ADVANCED_OK, BUFSIZE 16", 16,
+               {"advanced_ok": True, "bufsize": 16}),
+              ("window 16, Marlin, BUFSIZE 1", 16, {"bufsize": 1}),
+              ("window 8, unknown firmware", 8, {"firmware": "Unknown"}),
+              ("window 8, ADVANCED_OK, garbled", 8,
+               {"advanced_ok": True, "corrupt_every": 200})]
+    for name, window, kwargs in setups:
+        rate, resends = run(gcode, expected, window, latency = latency,
+                            move_time = move_time, **kwargs)
+        print("%-36s %7.0f lines/s  %3d resends" % (name, rate, resends))
+
+if __name__ == '__main__':
+    main()
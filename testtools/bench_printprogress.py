@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Checks the print progress gathered for the views and measures how much
+work it saves the GUI.
+
+The check prints synthetic G-code to a fake printer, recording the sent and
+printed moves in a PrintProgress as pronterface does, while a thread
+standing for the GUI takes them every PrintProgress.interval once
+scheduled. Every move must be taken once and in order, the last vertex
+printed must be the one of the last move, and the lines highlighted in
+batches must be the ones highlighted a move at a time.
+
+The benchmark prints nlines the same way and reports how many updates the
+GUI ran instead of three calls per move, and the time spent computing the
+highlighted lines of the batches.
+
+usage: bench_printprogress.py [nlines]"""
+
+import sys
+import os
+import threading
+import time
+import logging
+
+import numpy
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from printrun import gcoder
+from printrun.layerpreview import layer_moves
+from printrun.printcore import printcore
+from printrun.printprogress import PrintProgress
+from synthgcode import generate
+
+class Printer:
+    """Serial port stand-in acknowledging every line"""
+
+    def __init__(self, core):
+        self.core = core
+
+    def write(self, data):
+        self.core._acknowledge("ok")
+
+class GUI:
+    """Thread running the updates scheduled by the printing thread after
+    PrintProgress.interval, as wx.CallLater does"""
+
+    def __init__(self, progress):
+        self.progress = progress
+        self.scheduled = threading.Semaphore(0)
+        self.batches = []
+        self.printed_until = []
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+
+    def schedule(self):
+        self.scheduled.release()
+
+    def run(self):
+        while True:
+            self.scheduled.acquire()
+            time.sleep(self.progress.interval / 1000)
+            moves, printed_until = self.progress.take()
+            if moves:
+                self.batches.append(moves)
+            if printed_until is not None:
+                self.printed_until.append(printed_until)
+
+def print_gcode(gcode):
+    progress = PrintProgress()
+    gui = GUI(progress)
+    core = printcore()
+    core.printer_tcp = None
+    core.printer = Printer(core)
+    core.online = True
+    core._start_sender = lambda: None
+
+    def sent(command, gline):
+        if gline is not None and gline.is_move and progress.add_move(gline):
+            gui.schedule()
+
+    def printed(gline):
+        if gline.is_move and progress.add_printed(gline):
+            gui.schedule()
+    core.sendcb = sent
+    core.printsendcb = printed
+    done = threading.Event()
+    core.endcb = done.set
+    start = time.time()
+    core.startprint(gcode)
+    assert done.wait(600), "print did not end"
+    duration = time.time() - start
+    time.sleep(3 * progress.interval / 1000)
+    gui.schedule()
+    time.sleep(3 * progress.interval / 1000)
+    return gui, duration
+
+def synthetic_gcode(nlines):
+    gcode = gcoder.GCode(generate(nlines, segments_per_layer = 500))
+    moves = [gline for gline in gcode.lines if gline.is_move]
+    for vertex, gline in enumerate(moves):
+        gline.gcview_end_vertex = vertex
+    return gcode, moves
+
+def check():
+    gcode, moves = synthetic_gcode(20000)
+    gui, duration = print_gcode(gcode)
+    taken = [gline for batch in gui.batches for gline in batch]
+    assert len(taken) == len(moves), "%d moves taken, %d sent" % (len(taken), len(moves))
+    # The moves sent are the ones analyzed by printcore, not the file ones
+    position = lambda gline: (gline.current_x, gline.current_y, gline.current_z, gline.e)
+    assert list(map(position, taken)) == list(map(position, moves)), "moves taken out of order"
+    assert gui.printed_until == sorted(gui.printed_until), "printed vertex went back"
+    assert gui.printed_until[-1] == len(moves) - 1, "last vertex not printed"
+    assert numpy.array_equal(highlights(gui.batches), highlights([[gline] for gline in taken])), \
+        "batched highlights differ"
+    print("Every move is taken once and in order, the last vertex is printed")
+
+def highlights(batches):
+    """Highlighted lines of the batches of moves, as Gviz computes them"""
+    position = [0, 0, 0, 0]
+    lines = []
+    for batch in batches:
+        moves, position = layer_moves([batch], position)
+        if moves[0] is not None:
+            lines.append(moves[0].lines)
+    return numpy.concatenate(lines)
+
+def main():
+    logging.disable(logging.WARNING)
+    nlines = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    check()
+    gcode, moves = synthetic_gcode(nlines)
+    gui, duration = print_gcode(gcode)
+    print("%d moves printed in %.2fs: %d GUI updates instead of %d calls (%.0f per second)" %
+          (len(moves), duration, len(gui.batches), 3 * len(moves),
+           len(gui.batches) / duration))
+    start = time.process_time()
+    highlights(gui.batches)
+    print("highlights of the batches: %.3fs" % (time.process_time() - start))
+
+if __name__ == '__main__':
+    main()
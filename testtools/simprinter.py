@@ -0,0 +1,423 @@
+#!/usr/bin/env python3
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Simulated printer behind a pseudo terminal, for printcore benchmarks.
+
+SimPrinter opens a pty whose slave end (SimPrinter.port) printcore connects
+to like to a serial port.  It behaves like a Marlin style firmware:
+
+- numbered lines are checked (line number and checksum) and the firmware asks
+  for a resend ("Resend: N" then "ok") on errors,
+- received commands wait in a command buffer of bufsize entries, a further
+  rx_buffer bytes wait in the serial buffer, anything beyond that is lost,
+- moves go into a planner of planner_size blocks executing in move_time
+  seconds each, the ok of a move is sent once it made it into the planner,
+- every reply reaches the host latency seconds after it was sent,
+- with advanced_ok, oks report the free planner and command buffer slots
+  ("ok N12 P15 B3"), M115 reports firmware as FIRMWARE_NAME,
+- every corrupt_every numbered line gets a bad checksum, as if garbled,
+- G4 waits for the planned moves and P milliseconds or S seconds,
+- M104/M140 set the hotend and bed targets, which are reached at heat_rate
+  degrees per second (at once if 0), M109/M190 also wait for them while
+  reporting the temperatures every second, M105 answers "ok T:... B:..."
+  and M155 S<seconds> reports them periodically,
+- with echo, every command is echoed back ("echo:G1 X1") before its ok, like
+  Marlin does in debug echo mode (M111 S1).
+
+Commands executed in order (numbers and checksums removed) are kept in
+SimPrinter.executed.  stats() also reports when the first line arrived and
+when the last command executed since the last reset, and how long each
+resend took, from the error to the execution of the line sent again.  With tcp, the
+printer listens on a local TCP port instead and SimPrinter.port is its
+"127.0.0.1:port" address.  Needs a POSIX system.
+
+usage: simprinter.py [OPTIONS] [latency] [move_time] [count]
+    runs count simulated printers and prints the ports to connect to
+
+    -t, --tcp               listen on local TCP ports instead of ptys
+    -b, --bufsize=N         command buffer entries (4)
+    -r, --rx-buffer=N       serial buffer bytes (128)
+    -p, --planner=N         planner blocks (16)
+    -c, --corrupt-every=N   garble every Nth numbered line
+    -H, --heat-rate=N       degrees per second, 0 to heat at once (0)
+    -f, --firmware=NAME     name reported to M115 (Marlin)
+    -B, --basic-ok          plain oks, no ADVANCED_OK
+    -e, --echo              echo every command back before its ok
+    -C, --control           answer "stats" lines on stdin with the stats()
+                            of every printer as a JSON list, quit on EOF"""
+
+import getopt
+import hashlib
+import json
+import os
+import re
+import select
+import socket
+import sys
+import threading
+import time
+import tty
+from collections import deque
+from functools import reduce
+
+line_exp = re.compile(r"N(-?\d+)\s*(.*?)\*(\d+)\s*$")
+move_exp = re.compile(r"G[0-3](?!\d)")
+s_param_exp = re.compile(r"S(-?\d+\.?\d*)")
+dwell_exp = re.compile(r"G4(?!\d)")
+p_param_exp = re.compile(r"P(\d+\.?\d*)")
+
+AMBIENT = 20.0
+
+def checksum(text):
+    return reduce(lambda x, y: x ^ y, map(ord, text), 0)
+
+class SimPrinter:
+
+    def __init__(self, latency = 0.0, move_time = 0.0, bufsize = 4,
+                 rx_buffer = 128, planner_size = 16, advanced_ok = False,
+                 firmware = "Marlin", corrupt_every = 0, tcp = False,
+                 heat_rate = 0.0, echo = False):
+        self.latency = latency
+        self.move_time = move_time
+        self.bufsize = bufsize
+        self.rx_buffer = rx_buffer
+        self.planner_size = planner_size
+        self.advanced_ok = advanced_ok
+        self.firmware = firmware
+        self.corrupt_every = corrupt_every
+        self.heat_rate = heat_rate
+        self.echo = echo
+        self.executed = []
+        self.resends = 0
+        self.lost = 0
+        self.recoveries = []  # seconds from each resend request to the line
+        self.resend_since = None
+        self.first_line_time = None
+        self.last_executed_time = None
+        self.stats_from = 0
+        # Heater: [temperature when target was set, time it was set, target]
+        self.heaters = {"T": [AMBIENT, 0.0, 0.0], "B": [AMBIENT, 0.0, 0.0]}
+        self.autoreport = 0
+        self.last_line = -1
+        self.numbered = 0
+        self.queue = deque()  # received lines, the head being processed
+        self.planner = deque()  # end times of the planned moves
+        self.replies = deque()  # (due time, bytes)
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.server = self.connection = self.slave = None
+        if tcp:
+            # The master end is the socket accepted by _receive
+            self.master = None
+            self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server.bind(("127.0.0.1", 0))
+            self.server.listen(1)
+            self.port = "127.0.0.1:%d" % self.server.getsockname()[1]
+        else:
+            self.master, self.slave = os.openpty()
+            tty.setraw(self.slave)
+            self.port = os.ttyname(self.slave)
+        self.threads = [threading.Thread(target = target, daemon = True)
+                        for target in (self._receive, self._execute, self._reply,
+                                       self._autoreport)]
+        for thread in self.threads:
+            thread.start()
+
+    def close(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join()
+        if self.server:
+            self.server.close()
+            if self.connection:
+                self.connection.close()
+        else:
+            os.close(self.master)
+            os.close(self.slave)
+
+    def stats(self, reset = False):
+        """Counters and timings since the printer started or since the last
+        reset, with the SHA-1 of the executed commands but M105/M110/M115"""
+        with self.cond:
+            commands = [command for command in self.executed[self.stats_from:]
+                        if not command.startswith(("M105", "M110", "M115"))]
+            stats = {"executed": len(commands),
+                     "digest": hashlib.sha1("\n".join(commands).encode()).hexdigest(),
+                     "resends": self.resends,
+                     "lost": self.lost,
+                     "recoveries": list(self.recoveries),
+                     "first_line_time": self.first_line_time,
+                     "last_executed_time": self.last_executed_time}
+            if reset:
+                self.stats_from = len(self.executed)
+                self.resends = self.lost = 0
+                self.recoveries = []
+                self.first_line_time = self.last_executed_time = None
+        return stats
+
+    def temperature(self, heater, now = None):
+        start, since, target = self.heaters[heater]
+        goal = target if target > 0 else AMBIENT
+        if not self.heat_rate:
+            return goal
+        change = self.heat_rate * ((now or time.time()) - since)
+        return min(goal, start + change) if goal > start else max(goal, start - change)
+
+    def _set_target(self, heater, command):
+        match = s_param_exp.search(command)
+        if match:
+            now = time.time()
+            self.heaters[heater] = [self.temperature(heater, now), now, float(match.group(1))]
+
+    def _temperatures(self):
+        now = time.time()
+        return "T:%.1f /%.1f B:%.1f /%.1f @:0 B@:0" % (
+            self.temperature("T", now), self.heaters["T"][2],
+            self.temperature("B", now), self.heaters["B"][2])
+
+    def _wait_heater(self, heater):
+        """Wait for heater to get within a degree of its target when heating,
+        reporting the temperatures every second like Marlin does"""
+        target = self.heaters[heater][2]
+        while not self.stopped and self.temperature(heater) < target - 1:
+            self._send(self._temperatures() + " W:?\n")
+            self.cond.wait(min(1.0, (target - 1 - self.temperature(heater)) / self.heat_rate))
+
+    def _dwell(self, command):
+        """G4: wait for the planned moves then P milliseconds or S seconds"""
+        match = p_param_exp.search(command)
+        seconds = float(match.group(1)) / 1000 if match else 0
+        match = s_param_exp.search(command)
+        if match:
+            seconds = float(match.group(1))
+        end = max(self.planner[-1] if self.planner else 0, time.time()) + seconds
+        while not self.stopped and time.time() < end:
+            self.cond.wait(end - time.time())
+
+    def _queued_bytes(self):
+        return sum(len(line) + 1 for line in list(self.queue)[self.bufsize:])
+
+    def _receive(self):
+        pending = b""
+        while self.master is None and not self.stopped:
+            if select.select([self.server], [], [], 0.05)[0]:
+                self.connection = self.server.accept()[0]
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.master = self.connection.fileno()
+        while not self.stopped:
+            if not select.select([self.master], [], [], 0.05)[0]:
+                continue
+            try:
+                data = os.read(self.master, 65536)
+            except OSError:
+                return
+            if not data:
+                return
+            pending += data
+            *lines, pending = pending.split(b"\n")
+            with self.cond:
+                for line in lines:
+                    line = line.decode("ascii", "replace").strip()
+                    if not line:
+                        continue
+                    if self.first_line_time is None:
+                        self.first_line_time = time.time()
+                    if len(self.queue) >= self.bufsize and \
+                       self._queued_bytes() + len(line) + 1 > self.rx_buffer:
+                        self.lost += 1
+                        continue
+                    self.queue.append(line)
+                self.cond.notify_all()
+
+    def _send(self, text):
+        with self.cond:
+            self.replies.append((time.time() + self.latency, text.encode("ascii")))
+            self.cond.notify_all()
+
+    def _reply(self):
+        while True:
+            with self.cond:
+                while not self.replies and not self.stopped:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                due, text = self.replies.popleft()
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                os.write(self.master, text)
+            except OSError:
+                # The host went away
+                return
+
+    def _autoreport(self):
+        due = None
+        with self.cond:
+            while not self.stopped:
+                if not self.autoreport:
+                    due = None
+                    self.cond.wait()
+                    continue
+                now = time.time()
+                if due is None:
+                    due = now + self.autoreport
+                elif now >= due:
+                    self._send(self._temperatures() + "\n")
+                    due = now + self.autoreport
+                self.cond.wait(due - now)
+
+    def _ok(self):
+        if self.advanced_ok:
+            now = time.time()
+            planned = sum(1 for end in self.planner if end > now)
+            # The command being acknowledged is still in the queue
+            return "ok N%d P%d B%d\n" % (self.last_line,
+                                         self.planner_size - planned,
+                                         max(0, self.bufsize - len(self.queue) + 1))
+        return "ok\n"
+
+    def _check(self, line):
+        """Command of line without its number, None if it must be resent"""
+        match = line_exp.match(line)
+        if not match:
+            return line
+        number, command, sent_sum = int(match.group(1)), match.group(2), int(match.group(3))
+        self.numbered += 1
+        garbled = self.corrupt_every and self.numbered % self.corrupt_every == 0
+        if garbled or checksum(line[:line.rindex("*")]) != sent_sum:
+            error = "checksum mismatch"
+        elif number != self.last_line + 1 and not command.startswith("M110"):
+            error = "Line Number is not Last Line Number+1"
+        else:
+            self.last_line = number
+            if self.resend_since is not None:
+                self.recoveries.append(time.time() - self.resend_since)
+                self.resend_since = None
+            return command
+        self.resends += 1
+        if self.resend_since is None:
+            self.resend_since = time.time()
+        self._send("Error:%s, Last Line: %d\nResend: %d\n" %
+                   (error, self.last_line, self.last_line + 1))
+        return None
+
+    def _plan(self):
+        """Wait for room in the planner, then add a move to it"""
+        while True:
+            now = time.time()
+            while self.planner and self.planner[0] <= now:
+                self.planner.popleft()
+            if len(self.planner) < self.planner_size:
+                break
+            self.cond.wait(self.planner[0] - now)
+        start = self.planner[-1] if self.planner else now
+        self.planner.append(max(start, now) + self.move_time)
+
+    def _execute(self):
+        with self.cond:
+            while True:
+                while not self.queue and not self.stopped:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                command = self._check(self.queue[0])
+                if command is not None:
+                    if move_exp.match(command) and self.move_time:
+                        self._plan()
+                    if command.startswith(("M104", "M109")):
+                        self._set_target("T", command)
+                        if command.startswith("M109"):
+                            self._wait_heater("T")
+                    elif command.startswith(("M140", "M190")):
+                        self._set_target("B", command)
+                        if command.startswith("M190"):
+                            self._wait_heater("B")
+                    elif dwell_exp.match(command):
+                        self._dwell(command)
+                    elif command.startswith("M155"):
+                        match = s_param_exp.search(command)
+                        self.autoreport = float(match.group(1)) if match else 0
+                    self.executed.append(command)
+                    self.last_executed_time = time.time()
+                    if self.echo:
+                        self._send("echo:%s\n" % command)
+                    if command.startswith("M105"):
+                        self._send("ok %s\n" % self._temperatures())
+                        self.queue.popleft()
+                        continue
+                    if command.startswith("M115"):
+                        self._send("FIRMWARE_NAME:%s SIMULATED\n" % self.firmware +
+                                   ("Cap:ADVANCED_OK:1\n" if self.advanced_ok else ""))
+                self._send(self._ok())
+                self.queue.popleft()
+
+def main():
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], "tb:r:p:c:H:f:BC",
+                                       ["tcp", "bufsize=", "rx-buffer=", "planner=",
+                                        "corrupt-every=", "heat-rate=", "firmware=",
+                                        "basic-ok", "echo", "control"])
+    except getopt.GetoptError as err:
+        print(str(err))
+        print(__doc__.split("usage: ", 1)[1])
+        sys.exit(2)
+    kwargs = {"advanced_ok": True}
+    control = False
+    options = {"-b": ("bufsize", int), "--bufsize": ("bufsize", int),
+               "-r": ("rx_buffer", int), "--rx-buffer": ("rx_buffer", int),
+               "-p": ("planner_size", int), "--planner": ("planner_size", int),
+               "-c": ("corrupt_every", int), "--corrupt-every": ("corrupt_every", int),
+               "-H": ("heat_rate", float), "--heat-rate": ("heat_rate", float),
+               "-f": ("firmware", str), "--firmware": ("firmware", str)}
+    for o, a in opts:
+        if o in options:
+            name, kind = options[o]
+            kwargs[name] = kind(a)
+        elif o in ('-t', '--tcp'):
+            kwargs["tcp"] = True
+        elif o in ('-B', '--basic-ok'):
+            kwargs["advanced_ok"] = False
+        elif o in ('-e', '--echo'):
+            kwargs["echo"] = True
+        elif o in ('-C', '--control'):
+            control = True
+    latency = float(args[0]) if len(args) > 0 else 0.005
+    move_time = float(args[1]) if len(args) > 1 else 0.001
+    count = int(args[2]) if len(args) > 2 else 1
+    printers = [SimPrinter(latency, move_time, **kwargs)
+                for i in range(count)]
+    for printer in printers:
+        print("Simulated printer on %s, ^C to stop" % printer.port, flush = True)
+    try:
+        if control:
+            for line in sys.stdin:
+                if line.strip() == "stats":
+                    print(json.dumps([printer.stats(reset = True) for printer in printers]),
+                          flush = True)
+        else:
+            while True:
+                time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    for printer in printers:
+        printer.close()
+
+if __name__ == '__main__':
+    main()
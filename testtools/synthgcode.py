@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Generates dense synthetic G-code for the benchmarks in this directory.
+
+Each layer is a spiral of short extruding segments with a few travels,
+retractions and comments, which is close to what slicers output for
+curved surfaces."""
+
+import sys
+import math
+
+def generate(nlines, segments_per_layer = 2000, layer_height = 0.2):
+    yield "; synthetic G-code, %d lines" % nlines
+    yield "G21"
+    yield "G90"
+    yield "M82"
+    yield "G28"
+    yield "G92 E0"
+    count = 6
+    e = 0.0
+    layer = 0
+    while count < nlines:
+        layer += 1
+        z = layer * layer_height
+        yield ";LAYER:%d" % layer
+        yield "G1 Z%.3f F9000" % z
+        yield "G1 E%.5f F2400" % (e + 1.0)
+        count += 3
+        for i in range(segments_per_layer):
+            if count >= nlines:
+                break
+            angle = i * 0.05
+            radius = 20 + 10 * math.sin(i * 0.01)
+            x = 100 + radius * math.cos(angle)
+            y = 100 + radius * math.sin(angle)
+            if i % 250 == 0:
+                yield "G0 X%.3f Y%.3f F9000" % (x, y)
+            else:
+                e += 0.0125
+                yield "G1 X%.3f Y%.3f E%.5f F1800" % (x, y, e)
+            count += 1
+        yield "G1 E%.5f F2400" % (e - 1.0)
+        count += 1
+
+def write(filename, nlines, **kwargs):
+    with open(filename, "w") as f:
+        for line in generate(nlines, **kwargs):
+            f.write(line + "\n")
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print("usage: %s output.gcode nlines" % sys.argv[0])
+        sys.exit(1)
+    write(sys.argv[1], int(sys.argv[2]))